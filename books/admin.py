@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Author, Book, Category, BookCopy, Borrowing, Notification
+from .models import Author, Book, Category, BookCopy, Borrowing, FavoriteBook, Notification, UnreadNotificationCounter
 from django.utils.translation import gettext_lazy as _
 
 @admin.register(Author)
@@ -57,17 +57,31 @@ class BookAdmin(admin.ModelAdmin):
     )
     inlines = [BookCopyInline]
 
+    def get_queryset(self, request):
+        # display_authors/display_categories read the prefetched lists instead of querying per row.
+        return super().get_queryset(request).prefetch_related('authors', 'categories')
+
 
 @admin.register(BookCopy)
 class BookCopyAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'book', 'copy_id', 'status', 'date_acquired')
+    list_select_related = ('book',)
     list_filter = ('status', 'book__categories', 'date_acquired')
     search_fields = ('copy_id', 'book__title', 'book__isbn')
     autocomplete_fields = ['book']
 
+@admin.register(FavoriteBook)
+class FavoriteBookAdmin(admin.ModelAdmin):
+    list_display = ('user', 'book', 'favorited_at')
+    list_filter = ('favorited_at',)
+    search_fields = ('user__username', 'book__title', 'book__isbn')
+    autocomplete_fields = ['user', 'book']
+
 @admin.register(Borrowing)
 class BorrowingAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'borrower', 'book_copy', 'issue_date', 'due_date', 'return_date', 'status', 'fine_amount')
+    # __str__ of a borrowing and of its copy both read the book's title.
+    list_select_related = ('borrower', 'book_copy__book')
     list_filter = ('status', 'issue_date', 'due_date', 'borrower')
     search_fields = ('borrower__username', 'book_copy__copy_id', 'book_copy__book__title')
     autocomplete_fields = ['borrower', 'book_copy']
@@ -97,4 +111,16 @@ class NotificationAdmin(admin.ModelAdmin):
     def message_summary(self, obj):
         return obj.message[:50] + '...' if len(obj.message) > 50 else obj.message
     message_summary.short_description = _('Message Summary')
+    actions = ['mark_selected_read']
+
+    @admin.action(description=_('Mark selected notifications as read'))
+    def mark_selected_read(self, request, queryset):
+        self.message_user(request, _('%(count)d notification(s) marked as read.') % {'count': queryset.mark_read()})
+
+
+@admin.register(UnreadNotificationCounter)
+class UnreadNotificationCounterAdmin(admin.ModelAdmin):
+    list_display = ('user', 'unread')
+    search_fields = ('user__username',)
+    readonly_fields = ('user', 'unread')
 
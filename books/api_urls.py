@@ -3,7 +3,7 @@ from rest_framework.routers import DefaultRouter
 from .views import (
     AuthorViewSet, BookViewSet, CategoryViewSet,
     BookCopyViewSet, BorrowingViewSet, NotificationViewSet, 
-    ToggleFavoriteAPIView, ListFavoriteBooksAPIView
+    ToggleFavoriteAPIView, ListFavoriteBooksAPIView, notification_stream_view,
 )
 
 router = DefaultRouter()
@@ -15,6 +15,8 @@ router.register(r'borrowings', BorrowingViewSet, basename='borrowing')
 router.register(r'notifications', NotificationViewSet, basename='notification')
 
 urlpatterns = [
+    # Before the router, whose notification detail route would otherwise match 'stream'.
+    path('notifications/stream/', notification_stream_view, name='notification-stream'),
     path('', include(router.urls)),
 
     path('books/<str:isbn>/toggle-favorite/', ToggleFavoriteAPIView.as_view(), name='toggle-book-favorite'),
@@ -13,15 +13,11 @@ class BooksConfig(AppConfig):
         """
         This method is called once Django is ready.
         It's the recommended place to import signals to ensure they are connected.
+        A broken signals module fails startup: the receivers keep denormalized counters correct.
         """
-        print("BooksConfig ready: Importing signals...")
-        try:
-            # Import the signals module from the current app (.)
-            import books.signals
-            print("Successfully imported books.signals")
-        except ImportError:
-            # Handle case where signals.py might not exist (though we just created it)
-            print("Could not import books.signals (signals.py might be missing or contain import errors).")
-        except Exception as e:
-            # Catch any other potential errors during signal import
-            print(f"Error importing books.signals: {e}")
+        import books.signals  # noqa: F401  (connects the receivers)
+
+        # Create the catalog full-text index (FTS5 / tsvector) once the tables exist.
+        from django.db.models.signals import post_migrate
+        from books.search import ensure_search_index
+        post_migrate.connect(ensure_search_index, sender=self)
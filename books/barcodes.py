@@ -0,0 +1,95 @@
+"""
+Copy ID (barcode) allocation.
+
+Copy IDs are a prefix followed by a zero-padded number, e.g. '9780261103344-000042'.
+Numbers come from the CopyIdSequence table, one row per prefix: a whole block is reserved
+with a single UPDATE, so adding N copies costs one reservation plus one bulk INSERT no
+matter how large N is. The default prefix is the book's ISBN, optionally preceded by a
+library-specific prefix (e.g. 'MAINLIB-').
+"""
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from .models import Book, BookCopy, CopyIdSequence
+
+DEFAULT_DIGITS = 6
+
+
+def digits():
+    return getattr(settings, 'BOOK_COPY_ID_DIGITS', DEFAULT_DIGITS)
+
+
+def copy_id_prefix(book, library_prefix=''):
+    return f"{library_prefix}{book.isbn}-"
+
+
+def format_copy_id(prefix, number):
+    return f"{prefix}{number:0{digits()}d}"
+
+
+def _next_unused_number(prefix):
+    """One more than the highest number already used by a copy ID with this prefix (1 if none)."""
+    highest = 0
+    for copy_id in BookCopy.objects.filter(copy_id__startswith=prefix).values_list('copy_id', flat=True).iterator():
+        suffix = copy_id[len(prefix):]
+        if suffix.isdigit():
+            highest = max(highest, int(suffix))
+    return highest + 1
+
+
+def resync_sequence(prefix):
+    """Moves the prefix's sequence past every existing copy ID (e.g. after IDs were typed in by hand)."""
+    CopyIdSequence.objects.filter(prefix=prefix).update(
+        next_value=Greatest(F('next_value'), _next_unused_number(prefix))
+    )
+
+
+def allocate_copy_ids(prefix, count):
+    """Reserves and returns `count` consecutive copy IDs for the prefix."""
+    max_length = BookCopy._meta.get_field('copy_id').max_length
+    if len(format_copy_id(prefix, 0)) > max_length:
+        raise ValueError(f"Copy ID prefix '{prefix}' is too long for {max_length}-character copy IDs.")
+    numbers = CopyIdSequence.reserve(prefix, count, start=lambda: _next_unused_number(prefix))
+    return [format_copy_id(prefix, number) for number in numbers]
+
+
+def allocate_copy_id_blocks(counts):
+    """Reserves copy IDs for many prefixes at once: {prefix: count} -> {prefix: [copy ids]}."""
+    max_length = BookCopy._meta.get_field('copy_id').max_length
+    for prefix in counts:
+        if len(format_copy_id(prefix, 0)) > max_length:
+            raise ValueError(f"Copy ID prefix '{prefix}' is too long for {max_length}-character copy IDs.")
+    blocks = CopyIdSequence.reserve_many(counts)
+    return {prefix: [format_copy_id(prefix, number) for number in numbers] for prefix, numbers in blocks.items()}
+
+
+def next_copy_id(book, library_prefix=''):
+    return allocate_copy_ids(copy_id_prefix(book, library_prefix), 1)[0]
+
+
+def create_copies(book, count, library_prefix='', status='Available', **fields):
+    """
+    Creates `count` copies of the book with freshly allocated copy IDs (one sequence reservation
+    and one bulk INSERT) and updates the book's copy counters. Returns the new copies.
+    """
+    prefix = copy_id_prefix(book, library_prefix)
+    for attempt in range(2):
+        copies = [
+            BookCopy(book=book, copy_id=copy_id, status=status, **fields)
+            for copy_id in allocate_copy_ids(prefix, count)
+        ]
+        try:
+            with transaction.atomic():
+                BookCopy.objects.bulk_create(copies)
+                # bulk_create bypasses BookCopy.save(), so update the book's counters here.
+                Book.adjust_copy_counters(
+                    book.pk, total=len(copies), available=len(copies) if status == 'Available' else 0,
+                )
+            return copies
+        except IntegrityError:
+            # A copy ID in the block was entered by hand; skip past it and try once more.
+            if attempt:
+                raise
+            resync_sequence(prefix)
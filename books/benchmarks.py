@@ -0,0 +1,272 @@
+"""
+End-to-end load benchmarks (`manage.py run_benchmarks`).
+
+Each scenario is a real URL (portal pages, staff dashboard lists, reports, DRF endpoints)
+requested through the full middleware/URL/view/template stack with Django's test Client,
+from a pool of threads, each with its own client and database connection. Portal and
+dashboard scenarios log in with a session, API scenarios send a DRF token.
+
+Per scenario the result holds the latency percentiles (p50/p95/p99, nearest-rank), the mean
+and maximum number of SQL queries per request, throughput over the measured wall time, and
+the status codes seen. Results are plain JSON, so two runs (e.g. before and after a change,
+on the same `seed_benchmark_data` dataset) can be compared with `compare()`.
+
+Counting queries needs Django's debug cursor, which adds a little per-query overhead; it is
+the same in every run, so comparisons stay fair.
+"""
+import math
+import platform
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import django
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Count, Q
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .models import Book, BookCopy, Borrowing, FavoriteBook, Notification
+
+# A host in ALLOWED_HOSTS: the test client's default 'testserver' is not.
+HOST = 'localhost'
+RESULT_FORMAT = 1
+
+Scenario = namedtuple('Scenario', 'name user api path')
+
+
+def _with_query(path, **params):
+    return f"{path}?{urlencode(params)}"
+
+
+SCENARIOS = [
+    Scenario('portal_catalog', 'borrower', False, lambda c: reverse('books:portal_catalog')),
+    Scenario('portal_catalog_search', 'borrower', False,
+             lambda c: _with_query(reverse('books:portal_catalog'), q=c['search_term'])),
+    Scenario('portal_catalog_category', 'borrower', False,
+             lambda c: _with_query(reverse('books:portal_catalog'), category=c['category_id'])),
+    Scenario('portal_book_detail', 'borrower', False, lambda c: reverse('books:portal_book_detail', args=[c['isbn']])),
+    Scenario('portal_author', 'borrower', False, lambda c: reverse('books:portal_author_detail', args=[c['author_id']])),
+    Scenario('my_borrowings', 'borrower', False, lambda c: reverse('users:my_borrowings')),
+    Scenario('my_notifications', 'borrower', False, lambda c: reverse('users:my_notifications')),
+    Scenario('dashboard_home', 'staff', False, lambda c: reverse('books:dashboard_home')),
+    Scenario('dashboard_books', 'staff', False, lambda c: reverse('books:dashboard_book_list')),
+    Scenario('dashboard_books_search', 'staff', False,
+             lambda c: _with_query(reverse('books:dashboard_book_list'), search=c['search_term'])),
+    Scenario('dashboard_active_loans', 'staff', False, lambda c: reverse('books:dashboard_active_loans')),
+    Scenario('dashboard_history', 'staff', False, lambda c: reverse('books:dashboard_borrowing_history')),
+    Scenario('dashboard_borrowers', 'staff', False, lambda c: reverse('users:dashboard_borrower_list')),
+    Scenario('dashboard_reports', 'staff', False, lambda c: reverse('books:dashboard_library_reports')),
+    Scenario('api_books', 'borrower', True, lambda c: reverse('book-list')),
+    Scenario('api_books_search', 'borrower', True, lambda c: _with_query(reverse('book-list'), search=c['search_term'])),
+    Scenario('api_book_detail', 'borrower', True, lambda c: reverse('book-detail', args=[c['isbn']])),
+    Scenario('api_my_borrowings', 'borrower', True, lambda c: reverse('borrowing-list')),
+    Scenario('api_borrowings', 'staff', True, lambda c: reverse('borrowing-list')),
+    Scenario('api_notifications', 'borrower', True, lambda c: reverse('notification-list')),
+    Scenario('api_unread_count', 'borrower', True, lambda c: reverse('notification-unread-count')),
+]
+SCENARIOS_BY_NAME = {scenario.name: scenario for scenario in SCENARIOS}
+
+
+class BenchmarkError(Exception):
+    """The database lacks the data the scenarios need."""
+
+
+def build_context():
+    """
+    Picks the users and objects the scenarios request: the borrower with the most loans, a
+    staff member, the most borrowed book with one of its authors and categories, and a word
+    of its title as search term.
+    """
+    User = get_user_model()
+    borrower = User.objects.filter(role='BORROWER', is_active=True)\
+        .annotate(loans=Count('borrowings')).order_by('-loans', 'pk').first()
+    staff = User.objects.filter(Q(role__in=['LIBRARIAN', 'ADMIN']) | Q(is_staff=True), is_active=True).order_by('pk').first()
+    book = Book.objects.order_by('-total_borrows', 'isbn').first()
+    if borrower is None or staff is None or book is None:
+        raise BenchmarkError("The benchmarks need books, a borrower and a staff user; run `manage.py seed_benchmark_data` first.")
+    words = sorted((word.strip('.,:;!?\'"') for word in book.title.split()), key=lambda word: (-len(word), word))
+    return {
+        'users': {'borrower': borrower, 'staff': staff},
+        'tokens': {
+            'borrower': Token.objects.get_or_create(user=borrower)[0].key,
+            'staff': Token.objects.get_or_create(user=staff)[0].key,
+        },
+        'isbn': book.isbn,
+        'author_id': book.authors.order_by('pk').values_list('pk', flat=True).first() or 0,
+        'category_id': book.categories.order_by('pk').values_list('pk', flat=True).first() or '',
+        'search_term': words[0].lower() if words else book.title,
+    }
+
+
+def dataset_summary():
+    return {
+        'books': Book.objects.count(),
+        'copies': BookCopy.objects.count(),
+        'users': get_user_model().objects.count(),
+        'borrowings': Borrowing.objects.count(),
+        'notifications': Notification.objects.count(),
+        'favorites': FavoriteBook.objects.count(),
+    }
+
+
+def _client(scenario, context):
+    client = Client(SERVER_NAME=HOST, raise_request_exception=False)
+    if scenario.api:
+        client.defaults['HTTP_AUTHORIZATION'] = f"Token {context['tokens'][scenario.user]}"
+    else:
+        client.force_login(context['users'][scenario.user])
+    return client
+
+
+def _timed_get(client, path):
+    """(seconds, queries, status code) of one request, response body included."""
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        response = client.get(path)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        elapsed = time.perf_counter() - started
+    return elapsed, len(queries.captured_queries), response.status_code
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)]
+
+
+def _summarize(path, samples, wall_seconds):
+    latencies = sorted(seconds * 1000 for seconds, queries, status in samples)
+    queries = [queries for seconds, queries, status in samples]
+    statuses = Counter(str(status) for seconds, queries, status in samples)
+    return {
+        'path': path,
+        'requests': len(samples),
+        'errors': sum(n for status, n in statuses.items() if int(status) >= 400),
+        'status_codes': dict(sorted(statuses.items())),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'mean': round(sum(latencies) / len(latencies), 3),
+            'max': round(latencies[-1], 3),
+        },
+        'queries_per_request': {
+            'mean': round(sum(queries) / len(queries), 2),
+            'max': max(queries),
+        },
+        'throughput_rps': round(len(samples) / wall_seconds, 2) if wall_seconds else None,
+    }
+
+
+def run_scenario(scenario, context, requests=100, concurrency=1, warmup=5):
+    """
+    Sends `requests` GETs spread over `concurrency` threads (each warms up with its own requests
+    first) and returns the scenario's summary. With concurrency=1 everything runs in the calling
+    thread, on its database connection.
+    """
+    path = scenario.path(context)
+    shares = [requests // concurrency + (1 if index < requests % concurrency else 0) for index in range(concurrency)]
+    start_times = []
+    barrier = threading.Barrier(concurrency, action=lambda: start_times.append(time.perf_counter()))
+
+    def worker(count):
+        client = _client(scenario, context)
+        for _ in range(warmup):
+            client.get(path)
+        barrier.wait()
+        return [_timed_get(client, path) for _ in range(count)]
+
+    def pooled_worker(count):
+        try:
+            return worker(count)
+        finally:
+            connection.close()
+
+    if concurrency == 1:
+        results = [worker(shares[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(pooled_worker, shares))
+    wall_seconds = time.perf_counter() - start_times[0]
+    return _summarize(path, [sample for samples in results for sample in samples], wall_seconds)
+
+
+def run(scenarios=None, requests=100, concurrency=1, warmup=5, label='', log=None):
+    """Runs the scenarios (all by default) one after the other; returns the JSON-able result."""
+    log = log or (lambda message: None)
+    scenarios = scenarios or SCENARIOS
+    context = build_context()
+    started = time.perf_counter()
+    results = {}
+    for scenario in scenarios:
+        results[scenario.name] = run_scenario(scenario, context, requests, concurrency, warmup)
+        latency = results[scenario.name]['latency_ms']
+        log(f"{scenario.name}: p50 {latency['p50']:.1f} ms, p95 {latency['p95']:.1f} ms, "
+            f"{results[scenario.name]['queries_per_request']['mean']:g} queries")
+    return {
+        'format': RESULT_FORMAT,
+        'meta': {
+            'label': label,
+            'started_at': timezone.now().isoformat(),
+            'duration_s': round(time.perf_counter() - started, 3),
+            'requests_per_scenario': requests,
+            'concurrency': concurrency,
+            'warmup': warmup,
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'dataset': dataset_summary(),
+        },
+        'scenarios': results,
+    }
+
+
+def _change(before, after):
+    if before in (None, 0) or after is None:
+        return None
+    return round((after - before) / before * 100, 1)
+
+
+def compare(baseline, current):
+    """
+    Per scenario present in both results: p50/p95/p99 and mean queries before and after, with
+    the relative change in percent (negative is faster / fewer queries).
+    """
+    rows = {}
+    for name, after in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        row = {}
+        for key in ('p50', 'p95', 'p99'):
+            row[key] = {
+                'before': before['latency_ms'][key], 'after': after['latency_ms'][key],
+                'change_pct': _change(before['latency_ms'][key], after['latency_ms'][key]),
+            }
+        row['queries'] = {
+            'before': before['queries_per_request']['mean'], 'after': after['queries_per_request']['mean'],
+            'change_pct': _change(before['queries_per_request']['mean'], after['queries_per_request']['mean']),
+        }
+        rows[name] = row
+    return rows
+
+
+def format_comparison(rows):
+    """The comparison as a text table."""
+    def cell(values):
+        change = '' if values['change_pct'] is None else f" ({values['change_pct']:+.1f}%)"
+        return f"{values['before']:g} -> {values['after']:g}{change}"
+
+    lines = [f"{'scenario':<26} {'p50 ms':>28} {'p95 ms':>28} {'queries':>24}"]
+    for name, row in rows.items():
+        lines.append(f"{name:<26} {cell(row['p50']):>28} {cell(row['p95']):>28} {cell(row['queries']):>24}")
+    return '\n'.join(lines)
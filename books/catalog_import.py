@@ -0,0 +1,339 @@
+"""
+Streaming catalog import.
+
+The `import_catalog` management command runs a generator pipeline:
+
+    read_records(path, format)     -> raw dicts, one per input record (CSV, JSON Lines or
+                                      MARC mnemonic ".mrk" text), read lazily from the file
+    normalize_record(raw)          -> clean field values, ISBN checked with isbn_validator
+    CatalogImporter.import_chunk() -> per chunk of records: bulk_create authors/categories that
+                                      are new, books, through-table rows and copies, then index
+                                      the chunk for search
+
+Only one chunk of records is held in memory at a time. Author and category names are
+resolved through name -> id maps that are loaded once and extended as new names appear.
+Each chunk is committed on its own; books whose ISBN already exists are skipped, so an
+interrupted import can simply be run again (or resumed with an offset).
+"""
+import csv
+import json
+import re
+from datetime import date
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import barcodes, search
+from .models import Author, Book, BookCopy, Category, isbn_validator
+
+FORMATS = ('csv', 'jsonl', 'marc')
+LIST_SEPARATOR = ';'
+
+MAX_LENGTHS = {
+    'title': Book._meta.get_field('title').max_length,
+    'publisher': Book._meta.get_field('publisher').max_length,
+    'edition': Book._meta.get_field('edition').max_length,
+    'author': Author._meta.get_field('name').max_length,
+    'category': Category._meta.get_field('name').max_length,
+}
+
+
+class RecordError(ValueError):
+    """An input record that cannot be imported; the message says why."""
+
+
+def guess_format(path):
+    lowered = str(path).lower()
+    if lowered.endswith('.csv'):
+        return 'csv'
+    if lowered.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if lowered.endswith(('.mrk', '.mrk8', '.marc.txt')):
+        return 'marc'
+    return None
+
+
+# --- Readers ---
+
+def _read_csv(handle):
+    yield from csv.DictReader(handle)
+
+
+def _read_jsonl(handle):
+    for line_number, line in enumerate(handle, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as error:
+            yield {'_error': f"line {line_number}: invalid JSON ({error.msg})"}
+
+
+def _marc_subfields(data):
+    """'10$aThe hobbit /$cTolkien.' -> [('a', 'The hobbit /'), ('c', 'Tolkien.')] (indicators dropped)."""
+    return [(chunk[0], chunk[1:]) for chunk in data.split('$')[1:] if chunk]
+
+
+def _strip_marc_punctuation(value):
+    return value.strip().rstrip(' /:;,.=').strip()
+
+
+def _marc_record_to_raw(fields):
+    def values(tag, code):
+        return [
+            _strip_marc_punctuation(value)
+            for field_tag, data in fields if field_tag == tag
+            for subfield, value in _marc_subfields(data) if subfield == code
+        ]
+
+    def first(*candidates):
+        for tag, code in candidates:
+            found = values(tag, code)
+            if found:
+                return found[0]
+        return ''
+
+    title = first(('245', 'a'))
+    subtitle = first(('245', 'b'))
+    return {
+        'isbn': (first(('020', 'a')).split() or [''])[0],
+        'title': f"{title}: {subtitle}" if subtitle else title,
+        'authors': values('100', 'a') + values('110', 'a') + values('700', 'a'),
+        'categories': values('650', 'a') + values('655', 'a'),
+        'publisher': first(('264', 'b'), ('260', 'b')),
+        'publication_date': first(('264', 'c'), ('260', 'c')),
+        'edition': first(('250', 'a')),
+        'page_count': first(('300', 'a')),
+        'description': first(('520', 'a')),
+    }
+
+
+def _read_marc(handle):
+    """MARC mnemonic text (MarcEdit .mrk): '=TAG  <indicators>$a...' lines, records separated by blank lines."""
+    fields = []
+    for line in handle:
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            if fields:
+                yield _marc_record_to_raw(fields)
+                fields = []
+            continue
+        if line.startswith('=') and len(line) >= 4:
+            fields.append((line[1:4], line[6:]))
+        elif fields:
+            # Continuation of a long field wrapped onto the next line.
+            tag, data = fields[-1]
+            fields[-1] = (tag, data + line)
+    if fields:
+        yield _marc_record_to_raw(fields)
+
+
+READERS = {'csv': _read_csv, 'jsonl': _read_jsonl, 'marc': _read_marc}
+
+
+def read_records(handle, file_format):
+    """Yields one raw dict per record of an open text file, lazily."""
+    return READERS[file_format](handle)
+
+
+# --- Normalization ---
+
+def normalize_isbn(value):
+    """
+    Returns the ISBN-13 in the catalog's canonical form ('ISBN' + 13 digits), converting ISBN-10s.
+    Raises RecordError when the value is not a valid ISBN.
+    """
+    digits = re.sub(r'^ISBN(?:-1[03])?:?\s*', '', str(value or '').strip(), flags=re.IGNORECASE)
+    digits = re.sub(r'[\s-]', '', digits).upper()
+    if re.fullmatch(r'[0-9]{9}[0-9X]', digits):
+        core = '978' + digits[:9]
+        check = (10 - sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(core)) % 10) % 10
+        digits = f"{core}{check}"
+    isbn = f"ISBN{digits}"
+    try:
+        isbn_validator(isbn)
+    except ValidationError:
+        raise RecordError(f"invalid ISBN {value!r}")
+    return isbn
+
+
+def _names(value):
+    if isinstance(value, (list, tuple)):
+        names = value
+    else:
+        names = str(value or '').split(LIST_SEPARATOR)
+    seen, result = set(), []
+    for name in names:
+        name = ' '.join(str(name).split())
+        if name and name.casefold() not in seen:
+            seen.add(name.casefold())
+            result.append(name)
+    return result
+
+
+def _text(raw, key, max_length=None):
+    value = ' '.join(str(raw.get(key) or '').split())
+    if max_length and len(value) > max_length:
+        raise RecordError(f"{key} longer than {max_length} characters")
+    return value
+
+
+def _publication_date(value):
+    value = str(value or '').strip()
+    match = re.fullmatch(r'(\d{4})-(\d{2})-(\d{2})', value)
+    if match:
+        try:
+            return date(*map(int, match.groups()))
+        except ValueError:
+            raise RecordError(f"invalid publication date {value!r}")
+    match = re.search(r'\b(1[5-9]\d{2}|20\d{2})\b', value)
+    return date(int(match.group(1)), 1, 1) if match else None
+
+
+def _positive_int(value, key):
+    value = str(value if value is not None else '').strip()
+    if not value:
+        return None
+    match = re.search(r'\d+', value)
+    if not match:
+        raise RecordError(f"invalid {key} {value!r}")
+    return int(match.group())
+
+
+def normalize_record(raw, default_copies):
+    """Turns a raw record into the values to import. Raises RecordError for unusable records."""
+    if '_error' in raw:
+        raise RecordError(raw['_error'])
+    title = _text(raw, 'title', MAX_LENGTHS['title'])
+    if not title:
+        raise RecordError("missing title")
+    authors = _names(raw.get('authors'))
+    categories = _names(raw.get('categories'))
+    for kind, names in (('author', authors), ('category', categories)):
+        for name in names:
+            if len(name) > MAX_LENGTHS[kind]:
+                raise RecordError(f"{kind} name longer than {MAX_LENGTHS[kind]} characters")
+    copies = _positive_int(raw.get('copies'), 'copies')
+    return {
+        'isbn': normalize_isbn(raw.get('isbn')),
+        'title': title,
+        'authors': authors,
+        'categories': categories,
+        'publisher': _text(raw, 'publisher', MAX_LENGTHS['publisher']) or None,
+        'publication_date': _publication_date(raw.get('publication_date')),
+        'edition': _text(raw, 'edition', MAX_LENGTHS['edition']) or None,
+        'page_count': _positive_int(raw.get('page_count'), 'page_count'),
+        'description': str(raw.get('description') or '').strip() or None,
+        'copies': default_copies if copies is None else copies,
+    }
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# --- Writing ---
+
+class CatalogImporter:
+    """Writes normalized records chunk by chunk; keeps running totals in `stats`."""
+
+    def __init__(self, library_prefix='', copy_status='Available'):
+        self.library_prefix = library_prefix
+        self.copy_status = copy_status
+        self.author_ids = self._load_name_map(Author)
+        self.category_ids = self._load_name_map(Category)
+        self.stats = {'books': 0, 'copies': 0, 'authors': 0, 'categories': 0, 'duplicates': 0}
+
+    @staticmethod
+    def _load_name_map(model):
+        name_map = {}
+        for pk, name in model.objects.order_by('pk').values_list('pk', 'name').iterator(chunk_size=5000):
+            name_map.setdefault(name.casefold(), pk)
+        return name_map
+
+    def _resolve(self, model, name_map, names, stat):
+        """Bulk-creates the names missing from name_map and adds their ids to it."""
+        missing = {}
+        for name in names:
+            missing.setdefault(name.casefold(), name)
+        for key in list(missing):
+            if key in name_map:
+                del missing[key]
+        if not missing:
+            return
+        model.objects.bulk_create([model(name=name) for name in missing.values()], ignore_conflicts=True)
+        for pk, name in model.objects.filter(name__in=list(missing.values())).order_by('pk').values_list('pk', 'name'):
+            name_map.setdefault(name.casefold(), pk)
+        self.stats[stat] += len(missing)
+
+    def import_chunk(self, records):
+        """Imports one chunk of normalized records in one transaction."""
+        by_isbn = {}
+        for record in records:
+            if record['isbn'] in by_isbn:
+                self.stats['duplicates'] += 1
+            by_isbn[record['isbn']] = record
+        existing = set(Book.objects.filter(isbn__in=list(by_isbn)).values_list('isbn', flat=True))
+        self.stats['duplicates'] += len(existing)
+        records = [record for isbn, record in by_isbn.items() if isbn not in existing]
+        if not records:
+            return
+
+        with transaction.atomic():
+            self._resolve(Author, self.author_ids, (name for r in records for name in r['authors']), 'authors')
+            self._resolve(Category, self.category_ids, (name for r in records for name in r['categories']), 'categories')
+
+            Book.objects.bulk_create([
+                Book(**{key: value for key, value in record.items() if key not in ('authors', 'categories', 'copies')})
+                for record in records
+            ])
+            Book.authors.through.objects.bulk_create([
+                Book.authors.through(book_id=record['isbn'], author_id=self.author_ids[name.casefold()])
+                for record in records for name in record['authors']
+            ], ignore_conflicts=True)
+            Book.categories.through.objects.bulk_create([
+                Book.categories.through(book_id=record['isbn'], category_id=self.category_ids[name.casefold()])
+                for record in records for name in record['categories']
+            ], ignore_conflicts=True)
+            self._create_copies([record for record in records if record['copies'] > 0])
+            search.index_books([record['isbn'] for record in records], batch_size=len(records))
+        self.stats['books'] += len(records)
+
+    def _create_copies(self, records):
+        if not records:
+            return
+        prefixes = {record['isbn']: f"{self.library_prefix}{record['isbn']}-" for record in records}
+        blocks = barcodes.allocate_copy_id_blocks({prefixes[r['isbn']]: r['copies'] for r in records})
+        copies = [
+            BookCopy(book_id=record['isbn'], copy_id=copy_id, status=self.copy_status)
+            for record in records for copy_id in blocks[prefixes[record['isbn']]]
+        ]
+        try:
+            with transaction.atomic():
+                BookCopy.objects.bulk_create(copies)
+        except IntegrityError:
+            # Some copy IDs were already taken (entered by hand); fall back to per-title allocation.
+            for record in records:
+                barcodes.create_copies(Book(isbn=record['isbn']), record['copies'],
+                                       library_prefix=self.library_prefix, status=self.copy_status)
+            self.stats['copies'] += sum(record['copies'] for record in records)
+            return
+
+        # bulk_create bypasses BookCopy.save(), so set the new books' counters (one UPDATE per distinct count).
+        available = self.copy_status == 'Available'
+        by_count = {}
+        for record in records:
+            by_count.setdefault(record['copies'], []).append(record['isbn'])
+        for count, isbns in by_count.items():
+            Book.objects.filter(isbn__in=isbns).update(
+                total_copies=count, available_copies=count if available else 0, last_updated=timezone.now(),
+            )
+        self.stats['copies'] += len(copies)
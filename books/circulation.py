@@ -0,0 +1,168 @@
+"""
+Copy allocation for borrow requests and loans.
+
+Every path that hands a physical copy to a borrower goes through this module, so a copy is
+never given to two borrowers at once:
+
+* request_copy() reserves a copy for a new REQUESTED borrowing (copy status 'Reserved'),
+* issue_copy() lends a copy straight away (staff issue desk, staff API),
+* approve_request() turns a request into an ACTIVE loan, moving its reserved copy to 'On Loan',
+* release_request() rejects or cancels a request and puts its reserved copy back on the shelf.
+
+A copy changes hands with a compare-and-set UPDATE (`... WHERE id = %s AND status IN (...)`),
+which only one concurrent transaction can win. On databases that support it (PostgreSQL),
+candidates are first picked with SELECT ... FOR UPDATE SKIP LOCKED, so concurrent requests
+for the same title spread over different copies instead of queueing on the first one.
+On SQLite, where a transaction that has to wait for the write lock fails with "database is
+locked" instead of waiting, the whole allocation is retried with a short backoff.
+"""
+import functools
+import random
+import time
+
+from django.db import OperationalError, connection, transaction
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from .models import Book, BookCopy, Borrowing
+
+# Borrowings that still hold their copy.
+OPEN_STATUSES = ('REQUESTED', 'ACTIVE', 'OVERDUE')
+# Candidate copies examined per allocation attempt.
+CANDIDATE_BATCH = 10
+# Attempts at an allocation transaction that failed on SQLite lock contention.
+LOCK_RETRIES = 50
+
+
+class CopyUnavailable(Exception):
+    """No copy of the title (or not the requested copy) could be allocated."""
+
+
+class DuplicateBorrowing(Exception):
+    """The borrower already has an open request or loan for the title."""
+
+
+def _retry_on_lock_contention(func):
+    """Retries `func` (which runs its own transaction) when SQLite reports lock contention."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(LOCK_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as error:
+                # Inside an outer transaction the whole unit of work has to be retried by the caller.
+                if (connection.vendor != 'sqlite' or connection.in_atomic_block
+                        or 'locked' not in str(error) or attempt == LOCK_RETRIES - 1):
+                    raise
+                time.sleep(random.uniform(0, min(0.001 * 2 ** attempt, 0.05)))
+    return wrapper
+
+
+def _claim(copy_id, from_statuses, to_status):
+    """Compare-and-set of one copy's status. Returns True if this call made the change."""
+    return BookCopy.objects.filter(pk=copy_id, status__in=from_statuses).update(status=to_status) == 1
+
+
+def _move_copy(copy, from_statuses, to_status):
+    """
+    Moves `copy` to `to_status` if it is currently in one of `from_statuses`, keeping the Book
+    copy counters in step (the UPDATE bypasses BookCopy.save()). Returns True on success.
+    """
+    old_status = BookCopy.objects.filter(pk=copy.pk).values_list('status', flat=True).first()
+    if old_status not in from_statuses or not _claim(copy.pk, [old_status], to_status):
+        return False
+    delta = int(to_status == 'Available') - int(old_status == 'Available')
+    Book.adjust_copy_counters(copy.book_id, available=delta)
+    copy.status = to_status
+    copy._loaded_copy_state = (copy.book_id, to_status)
+    return True
+
+
+def _allocate(book, to_status):
+    """Flips one Available copy of `book` to `to_status` and returns it (must run inside a transaction)."""
+    candidates = BookCopy.objects.filter(book=book, status='Available').order_by('date_acquired', 'id')
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    if skip_locked:
+        candidates = candidates.select_for_update(skip_locked=True)
+
+    tried = set()
+    while True:
+        batch = [copy_id for copy_id in candidates.exclude(pk__in=tried).values_list('id', flat=True)[:CANDIDATE_BATCH]]
+        if not batch:
+            raise CopyUnavailable(_("No copies of '%(title)s' are currently available.") % {'title': book.title})
+        for copy_id in batch:
+            if _claim(copy_id, ['Available'], to_status):
+                Book.adjust_copy_counters(book.pk, available=-1)
+                return BookCopy.objects.select_related('book').get(pk=copy_id)
+        # Every candidate was taken by a concurrent transaction between the SELECT and the UPDATE.
+        tried.update(batch)
+
+
+def _take_copy(book, copy, to_status):
+    if copy is None:
+        return _allocate(book, to_status)
+    if not _move_copy(copy, ['Available'], to_status):
+        raise CopyUnavailable(_("The copy '%(copy_id)s' is no longer available.") % {'copy_id': copy.copy_id})
+    return copy
+
+
+def ensure_no_open_borrowing(borrower, book):
+    if Borrowing.objects.filter(borrower=borrower, book_copy__book=book, status__in=OPEN_STATUSES).exists():
+        raise DuplicateBorrowing(
+            _("You already have an active loan or pending request for '%(title)s'.") % {'title': book.title}
+        )
+
+
+@_retry_on_lock_contention
+def request_copy(borrower, book, due_date, copy=None):
+    """
+    Reserves a copy of `book` (the given `copy`, or the longest-held available one) and creates
+    the REQUESTED borrowing for it. Raises DuplicateBorrowing or CopyUnavailable.
+    """
+    with transaction.atomic():
+        ensure_no_open_borrowing(borrower, book)
+        copy = _take_copy(book, copy, 'Reserved')
+        return Borrowing.objects.create(borrower=borrower, book_copy=copy, due_date=due_date, status='REQUESTED')
+
+
+@_retry_on_lock_contention
+def issue_copy(borrower, book, due_date, copy=None, issue_date=None):
+    """Lends a copy of `book` (the given `copy`, or any available one) right away. Raises CopyUnavailable."""
+    with transaction.atomic():
+        copy = _take_copy(book, copy, 'On Loan')
+        return Borrowing.objects.create(
+            borrower=borrower, book_copy=copy, due_date=due_date, status='ACTIVE',
+            issue_date=issue_date or timezone.now(),
+        )
+
+
+@_retry_on_lock_contention
+def approve_request(borrowing):
+    """
+    Turns a REQUESTED borrowing into an ACTIVE loan. Its reserved copy goes on loan; if that copy
+    is gone (e.g. a request made before copies were reserved), another available copy of the same
+    title is allocated instead. Raises CopyUnavailable when the title has no copy left.
+    """
+    with transaction.atomic():
+        copy = borrowing.book_copy
+        if not _move_copy(copy, ['Reserved', 'Available'], 'On Loan'):
+            copy = _allocate(copy.book, 'On Loan')
+            borrowing.book_copy = copy
+        borrowing.status = 'ACTIVE'
+        borrowing.issue_date = timezone.now()
+        borrowing.save()
+    return borrowing
+
+
+@_retry_on_lock_contention
+def release_request(borrowing, status, notes=None):
+    """Closes a REQUESTED borrowing as REJECTED or CANCELLED and returns its reserved copy to the shelf."""
+    with transaction.atomic():
+        borrowing.status = status
+        update_fields = ['status']
+        if notes is not None:
+            borrowing.notes_by_librarian = notes
+            update_fields.append('notes_by_librarian')
+        borrowing.save(update_fields=update_fields)
+        _move_copy(borrowing.book_copy, ['Reserved'], 'Available')
+    return borrowing
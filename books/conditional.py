@@ -0,0 +1,146 @@
+"""
+Conditional GET for the catalog API and the portal book page.
+
+Each response gets a strong ETag computed from a few cheap, indexed queries; when the client
+sends it back in If-None-Match and nothing changed, the view answers 304 Not Modified before
+any serializer or template work.
+
+Versions:
+
+* a book:     Book.last_updated, which every write that changes what the catalog shows for
+              the book bumps (copy changes, borrow count, author/category edits; see
+              Book.adjust_copy_counters, Book.touch and books/signals.py)
+* the catalog: Max(Book.last_updated), which catches every insert and update, and the
+              'books:deleted' CollectionVersion, bumped in the transaction deleting a book
+              (books/signals.py), since a deletion leaves the maximum unchanged; versions
+              every book list
+
+Responses also depend on who asks (is_favorite, the portal's navigation bar), so the ETag
+includes the user's part as well, and responses are `Cache-Control: private, no-cache` with
+`Vary: Accept, Authorization, Cookie`.
+
+Last-Modified is sent for information, but only the ETag is used to answer 304: a date cannot
+express per-user changes such as an un-favorited book.
+"""
+import hashlib
+from functools import wraps
+
+from django.contrib import messages
+from django.db.models import Subquery
+from django.http import HttpResponseNotModified
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.utils.translation import get_language
+
+from .models import Book, Borrowing, CollectionVersion, UnreadNotificationCounter
+from .utils import get_favorite_isbns
+
+VARY_HEADERS = ('Accept', 'Authorization', 'Cookie')
+CATALOG_DELETIONS = 'books:deleted'
+
+
+def make_etag(*parts):
+    """A strong ETag (without quotes) for the given version parts."""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def catalog_version():
+    """
+    (last change, deletions) of the whole catalog, read together in one query: the newest row
+    of the last_updated index and the deletion counter.
+    """
+    deletions = CollectionVersion.objects.filter(name=CATALOG_DELETIONS).values('version')
+    latest = Book.objects.order_by('-last_updated').annotate(deletions=Subquery(deletions))\
+        .values_list('last_updated', 'deletions').first()
+    if latest is None:
+        return None, CollectionVersion.current(CATALOG_DELETIONS)
+    last_updated, deletions = latest
+    return last_updated, deletions or 0
+
+
+def book_version(isbn):
+    """The book's last_updated, or None when there is no such book."""
+    return Book.objects.filter(isbn=isbn).values_list('last_updated', flat=True).first()
+
+
+def _favorites_part(request):
+    return tuple(sorted(get_favorite_isbns(request)))
+
+
+def _media_type(request):
+    # DRF negotiated renderer: JSON and the browsable API are different representations.
+    renderer = getattr(request, 'accepted_renderer', None)
+    return getattr(renderer, 'media_type', None)
+
+
+def book_list_etag(request, **kwargs):
+    last_updated, deletions = catalog_version()
+    return make_etag('books', last_updated, deletions, request.get_full_path(), _media_type(request), _favorites_part(request))
+
+
+def book_detail_etag(request, isbn, **kwargs):
+    last_updated = book_version(isbn)
+    if last_updated is None:
+        return None, None
+    is_favorite = isbn in get_favorite_isbns(request)
+    return make_etag('book', isbn, last_updated, _media_type(request), is_favorite), last_updated
+
+
+def portal_book_etag(request, isbn, **kwargs):
+    """
+    The portal page also shows other books (related titles), the user's own requests for this
+    book and the navigation bar (name, picture, unread count), so its ETag covers those too.
+    """
+    last_updated = book_version(isbn)
+    if last_updated is None:
+        return None, None
+    user = request.user
+    user_part = None
+    if user.is_authenticated:
+        open_requests = tuple(
+            Borrowing.objects.filter(
+                borrower=user, book_copy__book_id=isbn, status__in=['REQUESTED', 'ACTIVE', 'OVERDUE'],
+            ).order_by('id').values_list('id', 'status')
+        )
+        user_part = (
+            user.pk, user.username, user.first_name, user.role, user.is_staff, user.profile_picture_digest or str(user.profile_picture),
+            isbn in get_favorite_isbns(request), open_requests, UnreadNotificationCounter.cached_count(user.pk),
+        )
+    similar = tuple(Book.objects.filter(similar_to__book_id=isbn).order_by('similar_to__rank').values_list('isbn', flat=True))
+    return make_etag('portal-book', isbn, last_updated, catalog_version(), similar, get_language(), user_part), last_updated
+
+
+def conditional_get(etag_func):
+    """
+    Decorator for GET handlers of class-based views (`get`, or a viewset's `list`/`retrieve`).
+
+    etag_func(request, **kwargs) returns the ETag or (ETag, last modified); a None ETag (e.g. an
+    unknown object) just runs the view. A matching If-None-Match returns 304 without calling it.
+    """
+    def decorator(method):
+        @wraps(method)
+        def inner(view, request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or messages.get_messages(request):
+                # Pending flash messages are shown (and consumed) by the next rendered page.
+                return method(view, request, *args, **kwargs)
+            result = etag_func(request, **kwargs)
+            etag, last_modified = result if isinstance(result, tuple) else (result, None)
+            if etag is None:
+                return method(view, request, *args, **kwargs)
+            etag = quote_etag(etag)
+
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = method(view, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            elif not isinstance(response, HttpResponseNotModified):
+                return response
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified.timestamp())
+            patch_cache_control(response, private=True, no_cache=True)
+            patch_vary_headers(response, VARY_HEADERS)
+            return response
+        return inner
+    return decorator
@@ -0,0 +1,14 @@
+import functools
+
+from .models import UnreadNotificationCounter
+
+
+def unread_notifications(request):
+    """
+    Adds `unread_notification_count` for the signed-in user (used by the portal and dashboard navbars).
+    It is a callable, so pages that don't show the count never read it; it comes from the cache.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {}
+    return {'unread_notification_count': functools.cache(lambda: UnreadNotificationCounter.cached_count(user.pk))}
@@ -0,0 +1,271 @@
+"""
+Real-time events for the notification stream (/api/notifications/stream/, see views.notification_stream_view).
+
+publish(channel, event) hands a JSON-serializable event to the configured backend, which
+delivers it to the in-process Hub of every worker; the Hub fans it out to the SSE connections
+subscribed to that channel. Channels:
+
+* user:<id> - the user's new notifications
+* staff     - "the dashboard KPIs changed" (the stream then sends the fresh, cached KPIs)
+
+Callers inside a transaction use publish_on_commit(), so no event is sent for a write that is
+rolled back.
+
+The backend is chosen with the REALTIME_EVENTS setting (shaped like CACHES):
+
+    REALTIME_EVENTS = {
+        'BACKEND': 'books.events.LocalBackend',     # single process (runserver, one ASGI worker)
+        # 'BACKEND': 'books.events.SQLiteBackend',  # several workers on one host
+        # 'OPTIONS': {'path': BASE_DIR / 'events.sqlite3', 'poll_interval': 0.25},
+    }
+
+SQLiteBackend is a small local broker: publishers append rows to a shared SQLite file and every
+worker tails it from a background thread. It needs no extra service; a network broker (Redis
+pub/sub, PostgreSQL LISTEN/NOTIFY) can be plugged in later by implementing the same
+publish()/start()/close() interface.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Events a slow client may have pending before the oldest are dropped.
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+STAFF_CHANNEL = 'staff'
+
+
+class Subscription:
+    """The events of some channels for one connection, read with `await get()`."""
+
+    def __init__(self, hub, channels, loop, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.hub = hub
+        self.channels = tuple(channels)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def deliver(self, channel, event):
+        """Thread-safe: queues the event on the subscriber's event loop."""
+        try:
+            self.loop.call_soon_threadsafe(self._put, channel, event)
+        except RuntimeError:
+            # The loop is closed; the connection is gone and will unsubscribe.
+            pass
+
+    def _put(self, channel, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait((channel, event))
+
+    async def get(self):
+        """Waits for the next (channel, event)."""
+        return await self.queue.get()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class Hub:
+    """In-process fan-out from channels to subscriptions."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, channels):
+        """Subscribes the running event loop to the channels; call from async code."""
+        subscription = Subscription(self, channels, asyncio.get_running_loop())
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscriptions.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[channel]
+
+    def dispatch(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscriptions.get(channel, ()))
+        for subscription in subscribers:
+            subscription.deliver(channel, event)
+        return len(subscribers)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({subscription for subscribers in self._subscriptions.values() for subscription in subscribers})
+
+
+class LocalBackend:
+    """Delivers events to this process only."""
+
+    def __init__(self, hub, **options):
+        self.hub = hub
+
+    def start(self):
+        pass
+
+    def publish(self, channel, event):
+        self.hub.dispatch(channel, event)
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(LocalBackend):
+    """
+    Shares events between the worker processes of one host through a SQLite file.
+    publish() appends a row; a daemon thread in each worker polls for rows newer than the last
+    one it has seen and dispatches them to its Hub. Rows older than `retention` seconds are pruned.
+    """
+
+    def __init__(self, hub, path=None, poll_interval=0.25, retention=300, **options):
+        super().__init__(hub)
+        self.path = str(path or settings.BASE_DIR / 'events.sqlite3')
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = threading.local()
+        self._thread = None
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+        self._execute('CREATE TABLE IF NOT EXISTS events ('
+                      'id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, sql, params=()):
+        return self._connection().execute(sql, params)
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._last_id = self._execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+                self._thread = threading.Thread(target=self._run, name='realtime-events', daemon=True)
+                self._thread.start()
+
+    def publish(self, channel, event):
+        self._execute('INSERT INTO events (channel, payload, created) VALUES (?, ?, ?)',
+                      (channel, json.dumps(event), time.time()))
+
+    def poll(self):
+        """Dispatches the rows published since the last poll. Returns how many there were."""
+        rows = self._execute('SELECT id, channel, payload FROM events WHERE id > ? ORDER BY id', (self._last_id,)).fetchall()
+        for row_id, channel, payload in rows:
+            self._last_id = row_id
+            self.hub.dispatch(channel, json.loads(payload))
+        return len(rows)
+
+    def _run(self):
+        last_prune = 0
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self.poll()
+                if time.time() - last_prune > self.retention:
+                    last_prune = time.time()
+                    self._execute('DELETE FROM events WHERE created < ?', (last_prune - self.retention,))
+            except sqlite3.Error:
+                logger.exception("Polling the realtime event store failed.")
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+_hub = None
+_backend = None
+_lock = threading.Lock()
+
+
+def get_hub():
+    global _hub
+    with _lock:
+        if _hub is None:
+            _hub = Hub()
+        return _hub
+
+
+def get_backend():
+    """The process-wide backend configured by REALTIME_EVENTS (started on first use)."""
+    global _backend
+    hub = get_hub()
+    with _lock:
+        if _backend is None:
+            config = getattr(settings, 'REALTIME_EVENTS', {})
+            backend_class = import_string(config.get('BACKEND', 'books.events.LocalBackend'))
+            _backend = backend_class(hub, **config.get('OPTIONS', {}))
+    _backend.start()
+    return _backend
+
+
+def publish(channel, event):
+    try:
+        get_backend().publish(channel, event)
+    except Exception:
+        # Real-time delivery is best effort: clients still see the change on their next list fetch.
+        logger.exception("Publishing a realtime event on %s failed.", channel)
+
+
+def publish_on_commit(channel, event, using=None):
+    transaction.on_commit(lambda: publish(channel, event), using=using)
+
+
+def notification_event(notification):
+    return {
+        'type': 'notification',
+        'id': notification.pk,
+        'notification_type': notification.notification_type,
+        'message': str(notification.message),
+        'timestamp': notification.timestamp.isoformat() if notification.timestamp else None,
+        'is_read': notification.is_read,
+        'related_borrowing': notification.related_borrowing_id,
+    }
+
+
+def publish_notifications(notifications, using=None):
+    """Publishes new notifications to their recipients once the transaction commits."""
+    events = [(user_channel(notification.recipient_id), notification_event(notification)) for notification in notifications]
+    if events:
+        transaction.on_commit(lambda: [publish(channel, event) for channel, event in events], using=using)
+
+
+def format_sse(data, event=None, event_id=None):
+    """One Server-Sent Events message."""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event:
+        lines.append(f'event: {event}')
+    lines.extend(f'data: {line}' for line in json.dumps(data).splitlines())
+    return '\n'.join(lines) + '\n\n'
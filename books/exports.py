@@ -0,0 +1,180 @@
+"""
+Streaming exports of circulation records and the catalog (CSV or JSON Lines).
+
+Every dataset is read with values_list(...).iterator(chunk_size=...), so rows arrive as plain
+tuples and no model instances are built; on PostgreSQL the iterator uses a server-side cursor.
+export_rows() turns them into encoded text a batch of rows at a time, and is consumed either
+by a StreamingHttpResponse (the staff export view) or written to a file (`export_data`).
+Memory use stays flat however many rows are exported, and the first bytes go out as soon as
+the first batch is read.
+
+Datasets:
+
+* loan-history   - closed borrowings; same search/status filters as the Borrowing History page
+* active-loans   - open loans; same search/status filters as the Active & Overdue Loans page
+* borrowings     - every borrowing, optionally searched and restricted to one status
+* books          - book titles with their copy counters (authors/categories from the search document);
+                   same search/category/availability filters as the staff book list
+* book-copies    - physical copies, optionally searched and restricted to one status
+
+Exports read from the read replica when one is configured (see lms/routers.py).
+"""
+import csv
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.db.models import Q
+
+from lms import routers
+
+from . import search
+from .filters import filter_active_loans, filter_borrowing_history, search_borrowings
+from .models import Book, BookCopy, Borrowing
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+# Rows fetched from the database per round trip.
+DEFAULT_CHUNK_SIZE = 2000
+# Rows encoded into one piece of the response body.
+ROWS_PER_WRITE = 500
+
+BORROWING_COLUMNS = (
+    ('id', 'id'),
+    ('status', 'status'),
+    ('borrower_id', 'borrower_id'),
+    ('borrower_username', 'borrower__username'),
+    ('borrower_first_name', 'borrower__first_name'),
+    ('borrower_last_name', 'borrower__last_name'),
+    ('borrower_email', 'borrower__email'),
+    ('isbn', 'book_copy__book__isbn'),
+    ('title', 'book_copy__book__title'),
+    ('copy_id', 'book_copy__copy_id'),
+    ('request_date', 'request_date'),
+    ('issue_date', 'issue_date'),
+    ('due_date', 'due_date'),
+    ('return_date', 'return_date'),
+    ('fine_amount', 'fine_amount'),
+    ('notes_by_librarian', 'notes_by_librarian'),
+)
+BOOK_COLUMNS = (
+    ('isbn', 'isbn'),
+    ('title', 'title'),
+    ('authors', 'search_document__authors'),
+    ('categories', 'search_document__categories'),
+    ('publisher', 'publisher'),
+    ('publication_date', 'publication_date'),
+    ('edition', 'edition'),
+    ('page_count', 'page_count'),
+    ('total_copies', 'total_copies'),
+    ('available_copies', 'available_copies'),
+    ('total_borrows', 'total_borrows'),
+    ('date_added_to_system', 'date_added_to_system'),
+)
+BOOK_COPY_COLUMNS = (
+    ('id', 'id'),
+    ('copy_id', 'copy_id'),
+    ('isbn', 'book__isbn'),
+    ('title', 'book__title'),
+    ('status', 'status'),
+    ('date_acquired', 'date_acquired'),
+    ('condition_notes', 'condition_notes'),
+)
+
+
+def _loan_history(search_term='', status='', category=''):
+    return filter_borrowing_history(Borrowing.objects.all(), search_term, status).order_by('-return_date', '-request_date')
+
+
+def _active_loans(search_term='', status='', category=''):
+    return filter_active_loans(Borrowing.objects.all(), search_term, status).order_by('due_date')
+
+
+def _borrowings(search_term='', status='', category=''):
+    queryset = search_borrowings(Borrowing.objects.all(), search_term)
+    if status:
+        queryset = queryset.filter(status=status.strip().upper())
+    return queryset.order_by('id')
+
+
+def _books(search_term='', status='', category=''):
+    queryset = Book.objects.order_by('isbn')
+    if category:
+        queryset = queryset.filter(categories__id=category)
+    if status == 'available':
+        queryset = queryset.filter(available_copies__gt=0)
+    elif status == 'unavailable':
+        queryset = queryset.filter(available_copies=0)
+    return search.filter_books(queryset, search_term)
+
+
+def _book_copies(search_term='', status='', category=''):
+    queryset = BookCopy.objects.order_by('id')
+    search_term = (search_term or '').strip()
+    if search_term:
+        queryset = queryset.filter(
+            Q(copy_id__icontains=search_term) | Q(book__isbn__icontains=search_term) | Q(book__title__icontains=search_term)
+        )
+    if status:
+        queryset = queryset.filter(status=status)
+    return queryset
+
+
+# Dataset name -> (columns, queryset builder taking (search_term, status, category)).
+DATASETS = {
+    'loan-history': (BORROWING_COLUMNS, _loan_history),
+    'active-loans': (BORROWING_COLUMNS, _active_loans),
+    'borrowings': (BORROWING_COLUMNS, _borrowings),
+    'books': (BOOK_COLUMNS, _books),
+    'book-copies': (BOOK_COPY_COLUMNS, _book_copies),
+}
+
+
+def dataset_rows(dataset, search_term='', status='', category='', chunk_size=DEFAULT_CHUNK_SIZE):
+    """Returns (header, iterator of row tuples) for a dataset, filtered like its staff page."""
+    columns, build_queryset = DATASETS[dataset]
+    # Exports tolerate a little replication lag, so they read from the replica when there is one.
+    queryset = build_queryset(search_term, status, category).using(routers.read_alias())
+    rows = queryset.values_list(*[field for _, field in columns]).iterator(chunk_size=chunk_size)
+    return [name for name, _ in columns], rows
+
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class _Echo:
+    """File-like object whose write() returns the text, so csv.writer can produce lines one at a time."""
+    def write(self, value):
+        return value
+
+
+def _csv_lines(header, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow([_plain(value) for value in row])
+
+
+def _jsonl_lines(header, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(header, map(_plain, row))), ensure_ascii=False) + '\n'
+
+
+def export_rows(header, rows, file_format):
+    """Yields the export as UTF-8 bytes: the first line on its own, then ROWS_PER_WRITE rows per piece."""
+    lines = _csv_lines(header, rows) if file_format == 'csv' else _jsonl_lines(header, rows)
+    batch = []
+    for position, line in enumerate(lines):
+        batch.append(line)
+        if len(batch) >= ROWS_PER_WRITE or position == 0:
+            yield ''.join(batch).encode('utf-8')
+            batch = []
+    if batch:
+        yield ''.join(batch).encode('utf-8')
@@ -1,26 +1,36 @@
 import django_filters
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import filters
 from .models import Book, Author, Category
+from . import search
+
+# Borrowing statuses listed on the staff "Borrowing History" page.
+HISTORICAL_BORROWING_STATUSES = ['RETURNED', 'RETURNED_LATE', 'REJECTED', 'CANCELLED', 'LOST_BY_BORROWER']
 
 class BookFilter(django_filters.FilterSet):
     """
     FilterSet for the Book model.
     Allows filtering books by various criteria including title, authors, and categories.
+    Text filters are answered by the catalog search index (see books/search.py).
     """
+    q = django_filters.CharFilter(
+        method='filter_search',
+        label='Search title, author, category, publisher, ISBN or description'
+    )
+
     title = django_filters.CharFilter(
-        field_name='title', 
-        lookup_expr='icontains', 
+        method='filter_search_column',
         label='Title contains'
     )
     
     authors_name = django_filters.CharFilter(
-        field_name='authors__name', 
-        lookup_expr='icontains', 
+        method='filter_search_column',
         label='Author name contains'
     )
     
     categories_name = django_filters.CharFilter(
-        field_name='categories__name', 
-        lookup_expr='icontains', 
+        method='filter_search_column',
         label='Category name contains'
     )
 
@@ -31,8 +41,7 @@ class BookFilter(django_filters.FilterSet):
     )
 
     publisher = django_filters.CharFilter(
-        field_name='publisher',
-        lookup_expr='icontains',
+        method='filter_search_column',
         label='Publisher contains'
     )
 
@@ -47,9 +56,18 @@ class BookFilter(django_filters.FilterSet):
         label='ISBN'
     )
 
+    # Maps filter names to columns of the search document.
+    SEARCH_COLUMN_MAP = {
+        'title': 'title',
+        'authors_name': 'authors',
+        'categories_name': 'categories',
+        'publisher': 'publisher',
+    }
+
     class Meta:
         model = Book
         fields = [
+            'q',
             'title', 
             'authors_name', 
             'categories_name', 
@@ -59,3 +77,56 @@ class BookFilter(django_filters.FilterSet):
             'isbn',
         ]
 
+    def filter_search(self, queryset, name, value):
+        return search.filter_books(queryset, value)
+
+    def filter_search_column(self, queryset, name, value):
+        return search.filter_books(queryset, value, columns=[self.SEARCH_COLUMN_MAP[name]])
+
+
+class BookSearchFilter(filters.SearchFilter):
+    """
+    Drop-in replacement for DRF's SearchFilter on book endpoints.
+    Uses the catalog search index and orders results by relevance instead of
+    chaining icontains lookups across joined tables.
+    """
+    def filter_queryset(self, request, queryset, view):
+        term = request.query_params.get(self.search_param, '')
+        return search.search_books(queryset, term)
+
+
+def search_borrowings(queryset, search_term):
+    """Borrowings whose borrower, title, copy ID or ISBN contains the term (staff circulation pages)."""
+    search_term = (search_term or '').strip()
+    if not search_term:
+        return queryset
+    return queryset.filter(
+        Q(borrower__username__icontains=search_term) |
+        Q(borrower__first_name__icontains=search_term) |
+        Q(borrower__last_name__icontains=search_term) |
+        Q(book_copy__book__title__icontains=search_term) |
+        Q(book_copy__copy_id__icontains=search_term) |
+        Q(book_copy__book__isbn__icontains=search_term)
+    )
+
+
+def filter_active_loans(queryset, search_term='', status_filter=''):
+    """The "Active & Overdue Loans" page's selection: open loans, narrowed by its search and status filters."""
+    queryset = search_borrowings(queryset.filter(status__in=['ACTIVE', 'OVERDUE']), search_term)
+    status_filter = (status_filter or '').strip().upper()
+    if status_filter == 'OVERDUE':
+        queryset = queryset.filter(status='OVERDUE')
+    elif status_filter == 'ACTIVE_NOT_OVERDUE':
+        queryset = queryset.filter(status='ACTIVE', due_date__gte=timezone.now().date())
+    elif status_filter == 'ACTIVE':
+        queryset = queryset.filter(status='ACTIVE')
+    return queryset
+
+
+def filter_borrowing_history(queryset, search_term='', status_filter=''):
+    """The "Borrowing History" page's selection: closed borrowings, narrowed by its search and status filters."""
+    queryset = search_borrowings(queryset.filter(status__in=HISTORICAL_BORROWING_STATUSES), search_term)
+    status_filter = (status_filter or '').strip()
+    if status_filter:
+        queryset = queryset.filter(status=status_filter)
+    return queryset
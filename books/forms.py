@@ -55,12 +55,17 @@ class BookCopyForm(forms.ModelForm):
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        if self.instance._state.adding:
+            # Left blank, the next ID of the book's copy ID sequence is assigned on save
+            # (StaffBookCopyCreateView); an existing copy keeps a required ID.
+            self.fields['copy_id'].required = False
+            self.fields['copy_id'].help_text = _("Leave blank to assign the next copy ID automatically.")
 
 
 class BatchAddBookCopyForm(forms.Form):
     number_of_copies = forms.IntegerField(
         min_value=1,
-        max_value=100, # Or some other reasonable max for a single batch
+        max_value=1000, # Copy IDs come from one sequence reservation, so large batches are cheap
         label=_("Number of New Copies to Add"),
         widget=forms.NumberInput(attrs={'class': 'form-control', 'value': 1})
     )
@@ -79,7 +84,7 @@ class BatchAddBookCopyForm(forms.Form):
         max_length=50,
         required=False,
         label=_("Copy ID Prefix (Optional)"),
-        help_text=_("e.g., 'MAINLIB-'. A unique suffix will be auto-generated."),
+        help_text=_("e.g., 'MAINLIB-'. The ISBN and a sequential number are appended."),
         widget=forms.TextInput(attrs={'class': 'form-control'})
     )
     condition_notes = forms.CharField(
@@ -0,0 +1,85 @@
+"""
+Versioned template fragment caching for the portal catalog.
+
+Fragments are cached under keys that contain the version of what they show, so a change never
+has to find and delete cached markup: the next render misses under the new key and the old
+entries expire (FRAGMENT_CACHE_TIMEOUT). Template tags (books/templatetags/fragment_cache.py):
+
+    {% book_card book card_size='small' %}
+    {% fragmentcache 'categories' selected_category_id with search_suffix=search_suffix %} ... {% endfragmentcache %}
+    {% fragmentcache 'catalog' 'newly_added' %} ... {% endfragmentcache %}
+
+Versions:
+
+* a book card:   the book's last_updated, read from the instance being rendered (no query).
+                 It is the stamp behind the conditional GETs (books/conditional.py), bumped by
+                 every change to the book, its copies, authors and categories, and its cover.
+* 'catalog':     conditional.catalog_version(), for sections listing books (newly added,
+                 popular); computed once per template render.
+* 'categories':  a CollectionVersion row, bumped in the transaction that saves or deletes a
+                 category (books/signals.py) or imports new ones; the category names are not
+                 part of any book's version. Being in the database, the new version reaches
+                 every worker process at once, which a per-process cache would not.
+
+A fragment is shared by everyone who renders it with the same vary-on values, so it must not
+contain anything else that depends on the user.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+
+from .conditional import catalog_version, make_etag
+from .models import CollectionVersion
+
+BOOK_CARD_TEMPLATE = 'books/portal/_book_card.html'
+
+# Collections versioned by a CollectionVersion row, bumped with bump().
+STAMPED_COLLECTIONS = ('categories',)
+# Collections whose version is computed from the database.
+COMPUTED_COLLECTIONS = {
+    'catalog': catalog_version,
+}
+
+
+def _timeout():
+    return getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def collection_version(name):
+    """The current version of a collection (see the module docstring)."""
+    if name in COMPUTED_COLLECTIONS:
+        return COMPUTED_COLLECTIONS[name]()
+    if name not in STAMPED_COLLECTIONS:
+        raise ValueError(f"Unknown fragment collection {name!r}.")
+    return CollectionVersion.current(name)
+
+
+def bump(name, using=None):
+    """
+    Moves a stamped collection to a new version, in the current transaction: other processes
+    keep rendering (and caching) the old rows under the old version until the change commits.
+    """
+    if name not in STAMPED_COLLECTIONS:
+        raise ValueError(f"Unknown fragment collection {name!r}.")
+    CollectionVersion.bump(name, using=using)
+
+
+def fragment_key(name, version, vary_on=()):
+    return f'fragments:{name}:{make_etag(version, tuple(vary_on), get_language())}'
+
+
+def cached_fragment(key, render):
+    """The fragment cached under `key`, or render() (cached for next time)."""
+    html = cache.get(key)
+    if html is None:
+        html = render()
+        cache.set(key, html, _timeout())
+    return mark_safe(html)
+
+
+def render_book_card(book, card_size=''):
+    """The catalog card of a book, rendered once per book version, card size and language."""
+    key = fragment_key('book_card', (book.isbn, book.last_updated), (card_size,))
+    return cached_fragment(key, lambda: render_to_string(BOOK_CARD_TEMPLATE, {'book': book, 'card_size': card_size}))
@@ -0,0 +1,173 @@
+"""
+Image derivatives: fixed-size thumbnails of uploaded covers, author photos and profile pictures.
+
+When an image is uploaded (see books/signals.py), every size configured for its field in
+IMAGE_DERIVATIVE_FIELDS is rendered with Pillow at 1x and 2x, as WebP and as a fallback for
+older browsers (PNG for PNG/GIF originals, JPEG otherwise). The files are stored next to the
+original under content-hash names:
+
+    book_covers/Maus.jpg
+    book_covers/Maus.3fa9c1d2e4b5a6f7.card-1x.webp
+    book_covers/Maus.3fa9c1d2e4b5a6f7.card-2x.jpg
+    ...
+
+The hash (of the original's bytes) is kept on the model in `<field>_digest`, so templates
+build the derivative URLs without touching storage ({% responsive_image %} in
+books/templatetags/responsive_images.py). A new upload gets a new hash, hence new URLs that
+can be cached forever. An image without a digest (not processed yet) is served as is;
+`manage.py generate_image_derivatives` backfills existing media.
+"""
+import hashlib
+import logging
+import posixpath
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .models import Book
+
+logger = logging.getLogger(__name__)
+
+# (app_label.model, field) -> names of the IMAGE_DERIVATIVE_SIZES rendered for it.
+IMAGE_DERIVATIVE_FIELDS = {
+    ('books.book', 'cover_image'): ('card', 'detail', 'admin'),
+    ('books.author', 'author_photo'): ('portrait', 'admin'),
+    ('users.customuser', 'profile_picture'): ('avatar', 'portrait', 'admin'),
+}
+SCALES = (1, 2)
+WEBP = 'webp'
+
+
+class DerivativeError(Exception):
+    """The original could not be read or decoded as an image."""
+
+
+def digest_field_name(field_name):
+    return f'{field_name}_digest'
+
+
+def image_fields(model):
+    """Names of the model's image fields that get derivatives."""
+    label = model._meta.label_lower
+    return [field_name for model_label, field_name in IMAGE_DERIVATIVE_FIELDS if model_label == label]
+
+
+def sizes_for(model, field_name):
+    return IMAGE_DERIVATIVE_FIELDS.get((model._meta.label_lower, field_name), ())
+
+
+def size_spec(size):
+    """(width, height, crop) of a named size; crop=True fills the box exactly (avatars)."""
+    width, height, *crop = settings.IMAGE_DERIVATIVE_SIZES[size]
+    return width, height, bool(crop and crop[0])
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def fallback_format(name):
+    return 'png' if name.lower().endswith(('.png', '.gif')) else 'jpg'
+
+
+def derivative_name(original_name, digest, size, scale, file_format):
+    directory, filename = posixpath.split(original_name)
+    stem = filename.rsplit('.', 1)[0]
+    return posixpath.join(directory, f'{stem}.{digest}.{size}-{scale}x.{file_format}')
+
+
+def _render(image, size, scale, file_format):
+    width, height, crop = size_spec(size)
+    box = (width * scale, height * scale)
+    if crop:
+        resized = ImageOps.fit(image, box, Image.LANCZOS)
+    else:
+        resized = image.copy()
+        resized.thumbnail(box, Image.LANCZOS)
+    quality = getattr(settings, 'IMAGE_DERIVATIVE_QUALITY', 80)
+    output = BytesIO()
+    if file_format == WEBP:
+        resized.save(output, 'WEBP', quality=quality, method=4)
+    elif file_format == 'png':
+        resized.save(output, 'PNG', optimize=True)
+    else:
+        resized.convert('RGB').save(output, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def generate_derivatives(original_name, sizes, storage=None, force=False):
+    """
+    Renders every derivative of the stored image `original_name` that does not exist yet
+    (all of them with force=True). Returns the content digest naming them.
+    Plain function of a file name, so the backfill command can run it in worker processes.
+    """
+    storage = storage or default_storage
+    try:
+        with storage.open(original_name, 'rb') as handle:
+            data = handle.read()
+    except OSError as error:
+        raise DerivativeError(f"cannot read {original_name}: {error}")
+    digest = content_digest(data)
+
+    image = None
+    for size in sizes:
+        for scale in SCALES:
+            for file_format in (WEBP, fallback_format(original_name)):
+                name = derivative_name(original_name, digest, size, scale, file_format)
+                if storage.exists(name):
+                    if not force:
+                        continue
+                    storage.delete(name)
+                if image is None:
+                    try:
+                        image = Image.open(BytesIO(data))
+                        image = ImageOps.exif_transpose(image)
+                        if image.mode not in ('RGB', 'RGBA'):
+                            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+                    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as error:
+                        raise DerivativeError(f"cannot decode {original_name}: {error}")
+                storage.save(name, ContentFile(_render(image, size, scale, file_format)))
+    return digest
+
+
+def process_upload(instance, field_name):
+    """
+    Generates the derivatives of a freshly uploaded image and stores their digest on the instance.
+    A broken upload is logged and left without derivatives (the original is then served as is).
+    """
+    fieldfile = getattr(instance, field_name)
+    digest = ''
+    if fieldfile:
+        try:
+            digest = generate_derivatives(fieldfile.name, sizes_for(type(instance), field_name), storage=fieldfile.storage)
+        except DerivativeError:
+            logger.warning("No thumbnails for %s.%s of %r.", type(instance).__name__, field_name, instance.pk, exc_info=True)
+    attname = digest_field_name(field_name)
+    if getattr(instance, attname) != digest:
+        setattr(instance, attname, digest)
+        store_digest(type(instance), instance.pk, field_name, digest)
+
+
+def store_digest(model, pk, field_name, digest):
+    changes = {digest_field_name(field_name): digest}
+    if model is Book:
+        # The catalog markup changes with the thumbnails (see books/conditional.py).
+        changes['last_updated'] = timezone.now()
+    model._default_manager.filter(pk=pk).update(**changes)
+
+
+def derivative_urls(fieldfile, size, file_format):
+    """[(url, scale), ...] of a size in a format, or [] when the image has no derivatives yet."""
+    if not fieldfile:
+        return []
+    digest = getattr(fieldfile.instance, digest_field_name(fieldfile.field.name), '')
+    if not digest or size not in sizes_for(type(fieldfile.instance), fieldfile.field.name):
+        return []
+    return [
+        (fieldfile.storage.url(derivative_name(fieldfile.name, digest, size, scale, file_format)), scale)
+        for scale in SCALES
+    ]
@@ -0,0 +1,69 @@
+"""
+Library KPIs.
+
+The headline counters shown on the staff dashboard and the reports page, computed with
+one conditional-aggregation query per table and kept in Django's cache for a short time
+(LIBRARY_KPI_CACHE_TIMEOUT seconds). Circulation and catalog writes drop the cached
+value (see books/signals.py), so the counters are fresh after every change and the
+TTL only bounds staleness from writes that bypass the ORM signals.
+
+Loan counters are read from the reporting rollups (TitleCirculationStat), so computing
+the KPIs never scans the Borrowing table.
+
+Every invalidation is also published on the realtime 'staff' channel, so open dashboard
+streams (see books/events.py) refresh their counters.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce
+
+from lms import routers
+
+from . import events
+from .models import Book, TitleCirculationStat
+
+KPI_CACHE_KEY = 'books:library_kpis'
+
+
+def compute_library_kpis():
+    """
+    Computes every KPI from the database: three queries, one per table. They read the primary:
+    a lagging replica right after an invalidation would get stale counters cached.
+    """
+    with routers.use_primary():
+        return _compute_library_kpis()
+
+
+def _compute_library_kpis():
+    kpis = Book.objects.aggregate(
+        book_title_count=Count('isbn'),
+        book_copy_count=Coalesce(Sum('total_copies'), 0),
+        available_copy_count=Coalesce(Sum('available_copies'), 0),
+    )
+    kpis.update(TitleCirculationStat.objects.aggregate(
+        active_loans_count=Coalesce(Sum('active_loans'), 0),
+        overdue_loans_count=Coalesce(Sum('overdue_loans'), 0),
+        pending_requests_count=Coalesce(Sum('pending_requests'), 0),
+    ))
+    kpis.update(get_user_model().objects.aggregate(
+        total_borrowers_count=Count('id', filter=Q(role='BORROWER')),
+    ))
+    return kpis
+
+
+def get_library_kpis():
+    """Returns the KPI dict, from the cache when possible."""
+    kpis = cache.get(KPI_CACHE_KEY)
+    if kpis is None:
+        kpis = compute_library_kpis()
+        cache.set(KPI_CACHE_KEY, kpis, getattr(settings, 'LIBRARY_KPI_CACHE_TIMEOUT', 60))
+    return kpis
+
+
+def invalidate_library_kpis():
+    """Drops the cached KPIs once the current transaction commits."""
+    transaction.on_commit(lambda: cache.delete(KPI_CACHE_KEY))
+    events.publish_on_commit(events.STAFF_CHANNEL, {'type': 'kpis'})
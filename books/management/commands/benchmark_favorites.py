@@ -0,0 +1,98 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from books import benchmarks
+from books.models import Book, FavoriteBook
+from books.views import BookViewSet
+from users.models import CustomUser
+
+
+SYNTHETIC_ISBN_PREFIX = '000'  # Never collides with real ISBN-13s (978/979).
+
+
+class _Rollback(Exception):
+    pass
+
+
+class _SyntheticBookViewSet(BookViewSet):
+    """BookViewSet over the synthetic books only; the list size is the requested ?page_size=."""
+    max_page_size = None
+
+    def filter_queryset(self, queryset):
+        return super().filter_queryset(queryset).filter(isbn__startswith=SYNTHETIC_ISBN_PREFIX)
+
+
+class Command(BaseCommand):
+    help = (
+        'Micro-benchmark for the book list endpoint: times GET /api/books/ for several list sizes and '
+        'favorites counts. Synthetic data is created inside a transaction that is rolled back afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='50,100,200,400',
+            help='Comma-separated numbers of books in the list response (default: 50,100,200,400).',
+        )
+        parser.add_argument(
+            '--favorites',
+            default='0,100,400',
+            help='Comma-separated numbers of favorites held by the requesting user (default: 0,100,400).',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Requests per measurement; the best run is reported (default: 5).',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = sorted(int(value) for value in options['sizes'].split(','))
+            favorite_counts = sorted(int(value) for value in options['favorites'].split(','))
+        except ValueError:
+            raise CommandError('--sizes and --favorites must be comma-separated integers.')
+
+        try:
+            with transaction.atomic():
+                self._run(sizes, favorite_counts, max(options['repeat'], 1))
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def _run(self, sizes, favorite_counts, repeat):
+        total_books = max(sizes + favorite_counts)
+        user = CustomUser.objects.create_user(username='__benchmark_favorites__', password=None)
+        isbns = [f"{SYNTHETIC_ISBN_PREFIX}{index:010d}" for index in range(total_books)]
+        Book.objects.bulk_create([
+            Book(isbn=isbn, title=f"Benchmark Book {index:06d}") for index, isbn in enumerate(isbns)
+        ])
+        factory = APIRequestFactory(SERVER_NAME=benchmarks.HOST)
+        list_view = _SyntheticBookViewSet.as_view({'get': 'list'})
+
+        self.stdout.write(f"{'books':>8} {'favorites':>10} {'ms':>10} {'us/book':>10}")
+        for favorite_count in favorite_counts:
+            FavoriteBook.objects.filter(user=user).delete()
+            FavoriteBook.objects.bulk_create([FavoriteBook(user=user, book_id=isbn) for isbn in isbns[:favorite_count]])
+            for size in sizes:
+                best = None
+                for _ in range(repeat):
+                    # Fresh request and user per run, as in production, so no cached favorites carry over.
+                    request = factory.get('/api/books/', {'page_size': size})
+                    request_user = CustomUser.objects.get(pk=user.pk)
+                    force_authenticate(request, user=request_user)
+                    started = time.perf_counter()
+                    response = list_view(request)
+                    response.render()
+                    elapsed = time.perf_counter() - started
+                    if response.status_code != 200 or len(response.data['results']) != size:
+                        raise CommandError(f"GET /api/books/ did not list {size} books: {response.status_code} {response.data}")
+                    best = elapsed if best is None else min(best, elapsed)
+                self.stdout.write(
+                    f"{size:>8} {favorite_count:>10} {best * 1000:>10.2f} {best * 1e6 / size:>10.1f}"
+                )
+        self.stdout.write(self.style.SUCCESS(
+            "Done. us/book should stay roughly flat across both list sizes and favorites counts."
+        ))
@@ -0,0 +1,63 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from books import recommendations
+
+
+class Command(BaseCommand):
+    help = (
+        'Precomputes the top-K similar books of every title from co-borrowing and category '
+        'overlap into the BookSimilarity table (run nightly).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--top-k',
+            type=int,
+            default=None,
+            help='Neighbours kept per book (default: BOOK_RECOMMENDATION_TOP_K).',
+        )
+        parser.add_argument(
+            '--category-weight',
+            type=float,
+            default=recommendations.DEFAULT_CATEGORY_WEIGHT,
+            help='Weight of category overlap vs. co-borrowing, between 0 and 1 (default: %(default)s).',
+        )
+        parser.add_argument(
+            '--max-books-per-borrower',
+            type=int,
+            default=200,
+            help='Cap on the titles counted per borrower, bounding the pairwise work (default: 200).',
+        )
+        parser.add_argument(
+            '--category-candidates',
+            type=int,
+            default=50,
+            help='Most borrowed titles per category considered as candidates (default: 50).',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Similarity rows held in memory before they are written (default: 1000).',
+        )
+
+    def handle(self, *args, **options):
+        if not 0 <= options['category_weight'] <= 1:
+            raise CommandError('--category-weight must be between 0 and 1.')
+        if options['top_k'] is not None and options['top_k'] < 1:
+            raise CommandError('--top-k must be at least 1.')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        started = time.monotonic()
+        written = recommendations.build_similarities(
+            k=options['top_k'],
+            category_weight=options['category_weight'],
+            max_books_per_borrower=options['max_books_per_borrower'],
+            category_candidates=options['category_candidates'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {written} book similarity row(s) in {time.monotonic() - started:.2f}s."
+        ))
@@ -0,0 +1,86 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from books import images
+
+
+def _setup_worker():
+    # Needed when the pool spawns fresh interpreters rather than forking this one.
+    django.setup()
+
+
+def _derive(name, sizes, force):
+    """Runs in a worker process: returns (digest, None), or (None, error message)."""
+    try:
+        return images.generate_derivatives(name, sizes, force=force), None
+    except images.DerivativeError as error:
+        return None, str(error)
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates the thumbnail and WebP derivatives of every existing book cover, author photo and '
+        'profile picture (missing files only, unless --force), using a pool of worker processes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of worker processes (1 renders in this process).',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Re-render derivatives that already exist, e.g. after IMAGE_DERIVATIVE_SIZES changed.',
+        )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError("--workers must be positive.")
+        started = time.monotonic()
+
+        jobs = []
+        for (model_label, field_name), sizes in images.IMAGE_DERIVATIVE_FIELDS.items():
+            model = apps.get_model(model_label)
+            rows = model._default_manager.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})\
+                .values_list('pk', field_name, images.digest_field_name(field_name))
+            jobs.extend((model, field_name, sizes, pk, name, digest) for pk, name, digest in rows.iterator())
+        self.stdout.write(f"Images to process: {len(jobs)}")
+        if not jobs:
+            return
+
+        if options['workers'] == 1:
+            results = ((job, _derive(job[4], job[2], options['force'])) for job in jobs)
+            processed, updated, failed = self._store(results)
+        else:
+            # Workers only read and write media files; they never use the inherited database connections.
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=_setup_worker) as pool:
+                futures = {pool.submit(_derive, job[4], job[2], options['force']): job for job in jobs}
+                results = ((futures[future], future.result()) for future in as_completed(futures))
+                processed, updated, failed = self._store(results)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {processed} image(s) in {elapsed:.2f}s ({processed / max(elapsed, 1e-6):.1f} images/s); "
+            f"{updated} digest(s) updated, {failed} image(s) could not be read."
+        ))
+
+    def _store(self, results):
+        processed = updated = failed = 0
+        for (model, field_name, sizes, pk, name, old_digest), (digest, error) in results:
+            processed += 1
+            if error:
+                failed += 1
+                self.stderr.write(f"{model.__name__} {pk}: {error}")
+                continue
+            if digest != old_digest:
+                images.store_digest(model, pk, field_name, digest)
+                updated += 1
+        return processed, updated, failed
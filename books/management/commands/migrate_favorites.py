@@ -0,0 +1,93 @@
+import time
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from books.models import Book, FavoriteBook
+from users.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Copies the legacy CustomUser.favorite_books JSON lists into the FavoriteBook table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of favorite rows inserted per query (default: 1000).',
+        )
+        parser.add_argument(
+            '--clear-legacy',
+            action='store_true',
+            help='Empty the JSON lists after copying them over, keeping the entries that could not be copied.',
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        batch_size = options['batch_size']
+        existing_isbns = set(Book.objects.values_list('isbn', flat=True))
+
+        users = CustomUser.objects.exclude(favorite_books=[]).only('id', 'favorite_books').order_by('pk')
+        rows, written, users_seen, skipped = [], 0, 0, 0
+        # Users whose every entry was copied, and the entries that could not be copied per user.
+        migrated_user_ids, rejected_by_user = [], {}
+        for user in users.iterator(chunk_size=batch_size):
+            if not isinstance(user.favorite_books, list):
+                continue
+            users_seen += 1
+            rejected = []
+            for item in user.favorite_books:
+                isbn = item.get('isbn') if isinstance(item, dict) else None
+                if not isinstance(isbn, str) or isbn not in existing_isbns:
+                    rejected.append(item)
+                    continue
+                rows.append(FavoriteBook(user_id=user.id, book_id=isbn, favorited_at=self._parse_timestamp(item.get('favorited_at'))))
+                if len(rows) >= batch_size:
+                    written += self._write(rows, batch_size)
+                    rows = []
+            skipped += len(rejected)
+            if rejected:
+                rejected_by_user[user.id] = rejected
+            else:
+                migrated_user_ids.append(user.id)
+        written += self._write(rows, batch_size)
+
+        if options['clear_legacy']:
+            # Only the copied entries are dropped; rejected ones stay in the JSON list for a manual look.
+            for start in range(0, len(migrated_user_ids), batch_size):
+                CustomUser.objects.filter(pk__in=migrated_user_ids[start:start + batch_size]).update(favorite_books=[])
+            CustomUser.objects.bulk_update(
+                [CustomUser(pk=user_id, favorite_books=items) for user_id, items in rejected_by_user.items()],
+                ['favorite_books'], batch_size=batch_size,
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {written} favorite(s) from {users_seen} user(s) (existing rows left untouched), skipped {skipped} unknown ISBN(s) "
+            f"in {time.monotonic() - started:.2f}s."
+        ))
+        if options['clear_legacy'] and rejected_by_user:
+            self.stdout.write(self.style.WARNING(
+                f"Kept {skipped} skipped entr{'y' if skipped == 1 else 'ies'} in the legacy list of "
+                f"{len(rejected_by_user)} user(s)."
+            ))
+            if options['verbosity'] > 1:
+                for user_id, items in rejected_by_user.items():
+                    self.stdout.write(f"  user {user_id}: {items!r}")
+
+    @staticmethod
+    def _write(rows, batch_size):
+        # ignore_conflicts keeps the command re-runnable (unique user/book constraint).
+        FavoriteBook.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+        return len(rows)
+
+    @staticmethod
+    def _parse_timestamp(value):
+        if value:
+            try:
+                parsed = datetime.fromisoformat(value)
+            except (TypeError, ValueError):
+                parsed = None
+            if parsed is not None:
+                return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+        return timezone.now()
@@ -0,0 +1,50 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from books.models import Book, BookCopy
+
+
+class Command(BaseCommand):
+    help = 'Recomputes Book.total_copies and Book.available_copies from the book copies table in one set-based pass.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many books have drifted counters; do not update them.',
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+
+        copy_counts = BookCopy.objects.filter(book=OuterRef('pk')).order_by().values('book')
+        actual_total = Coalesce(
+            Subquery(copy_counts.annotate(n=Count('id')).values('n'), output_field=IntegerField()),
+            Value(0),
+        )
+        actual_available = Coalesce(
+            Subquery(copy_counts.filter(status='Available').annotate(n=Count('id')).values('n'), output_field=IntegerField()),
+            Value(0),
+        )
+
+        drifted = Book.objects.annotate(
+            actual_total=actual_total,
+            actual_available=actual_available,
+        ).filter(
+            ~Q(total_copies=F('actual_total')) | ~Q(available_copies=F('actual_available'))
+        ).count()
+        self.stdout.write(f"Books with drifted copy counters: {drifted}")
+
+        if options['dry_run'] or not drifted:
+            self.stdout.write(self.style.SUCCESS(f"No changes written ({time.monotonic() - started:.2f}s)."))
+            return
+
+        updated = Book.objects.update(
+            total_copies=actual_total, available_copies=actual_available, last_updated=timezone.now(),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Recomputed copy counters for {updated} book(s) in {time.monotonic() - started:.2f}s."
+        ))
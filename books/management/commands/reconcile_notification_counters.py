@@ -0,0 +1,70 @@
+import time
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Exists, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from books.models import Notification, UnreadNotificationCounter
+
+
+class Command(BaseCommand):
+    help = 'Recomputes every UnreadNotificationCounter from the notifications table in one set-based pass.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many users have drifted counters; do not update them.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of counters updated per UPDATE statement.',
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        batch_size = options['batch_size']
+
+        # Users with unread notifications but no counter row yet (e.g. notifications created before counters existed).
+        missing = list(
+            get_user_model().objects
+            .filter(Exists(Notification.objects.filter(recipient=OuterRef('pk'), is_read=False)))
+            .filter(unread_notification_counter__isnull=True)
+            .values_list('pk', flat=True)
+        )
+        self.stdout.write(f"Users without a counter: {len(missing)}")
+
+        actual_unread = Coalesce(
+            Subquery(
+                Notification.objects.filter(recipient=OuterRef('user'), is_read=False)
+                .order_by().values('recipient').annotate(n=Count('id')).values('n'),
+                output_field=IntegerField(),
+            ),
+            Value(0),
+        )
+        drifted = list(
+            UnreadNotificationCounter.objects.annotate(actual_unread=actual_unread)
+            .filter(~Q(unread=F('actual_unread')))
+            .values_list('user_id', flat=True)
+        )
+        self.stdout.write(f"Counters that drifted: {len(drifted)}")
+
+        if options['dry_run'] or not (missing or drifted):
+            self.stdout.write(self.style.SUCCESS(f"No changes written ({time.monotonic() - started:.2f}s)."))
+            return
+
+        UnreadNotificationCounter.objects.bulk_create(
+            [UnreadNotificationCounter(user_id=user_id) for user_id in missing], batch_size=batch_size, ignore_conflicts=True,
+        )
+        user_ids = missing + drifted
+        updated = 0
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            updated += UnreadNotificationCounter.objects.filter(user_id__in=batch).update(unread=actual_unread)
+            cache.delete_many([UnreadNotificationCounter.cache_key(user_id) for user_id in batch])
+        self.stdout.write(self.style.SUCCESS(
+            f"Recomputed {updated} unread counter(s) in {time.monotonic() - started:.2f}s."
+        ))
@@ -0,0 +1,88 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from books import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-tests the real URL routes (portal, staff dashboard, reports, API) with the test client '
+        'from a pool of threads and reports p50/p95/p99 latency, queries per request and throughput '
+        'as JSON. Run it against a `seed_benchmark_data` dataset.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scenarios',
+            help=f"Comma-separated scenario names (default: all): {', '.join(benchmarks.SCENARIOS_BY_NAME)}.",
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=100,
+            help='Measured requests per scenario (default: 100).',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=4,
+            help='Number of client threads (default: 4).',
+        )
+        parser.add_argument(
+            '--warmup',
+            type=int,
+            default=5,
+            help='Unmeasured requests per thread before each scenario (default: 5).',
+        )
+        parser.add_argument(
+            '--label',
+            default='',
+            help='Free-form label stored with the results, e.g. a branch name.',
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the JSON results to this file instead of standard output.',
+        )
+        parser.add_argument(
+            '--compare',
+            metavar='BASELINE',
+            help='JSON results of an earlier run: prints the latency and query changes against it.',
+        )
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1 or options['warmup'] < 0:
+            raise CommandError("--requests and --concurrency must be positive; --warmup must not be negative.")
+        scenarios = None
+        if options['scenarios']:
+            names = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+            unknown = [name for name in names if name not in benchmarks.SCENARIOS_BY_NAME]
+            if unknown:
+                raise CommandError(f"Unknown scenario(s): {', '.join(unknown)}.")
+            scenarios = [benchmarks.SCENARIOS_BY_NAME[name] for name in names]
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare'], encoding='utf-8') as handle:
+                    baseline = json.load(handle)
+            except (OSError, ValueError) as error:
+                raise CommandError(f"Cannot read the baseline {options['compare']}: {error}")
+
+        try:
+            result = benchmarks.run(
+                scenarios, requests=options['requests'], concurrency=options['concurrency'],
+                warmup=options['warmup'], label=options['label'], log=self.stderr.write,
+            )
+        except benchmarks.BenchmarkError as error:
+            raise CommandError(str(error))
+
+        output = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as handle:
+                handle.write(output + '\n')
+            self.stderr.write(self.style.SUCCESS(f"Results written to {options['output']}."))
+        else:
+            self.stdout.write(output)
+        if baseline is not None:
+            # On stderr, so that standard output stays valid JSON.
+            self.stderr.write(benchmarks.format_comparison(benchmarks.compare(baseline, result)))
@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from books import seeding
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates a deterministic synthetic library for load benchmarks: authors, categories, books '
+        'and copies, borrowers, borrowings in every status, notifications and favorites '
+        '(see books/seeding.py). Seeded accounts use the password "benchmark".'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scale',
+            choices=sorted(seeding.SCALES),
+            default='small',
+            help='Dataset size preset (default: small, about 2,000 books and 10,000 borrowings).',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed; the same seed and scale always generate the same data.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=2000,
+            help='Rows per bulk insert.',
+        )
+        parser.add_argument(
+            '--replace',
+            action='store_true',
+            help='Delete previously seeded data first (otherwise the command refuses to run over it).',
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be positive.")
+        started = time.monotonic()
+
+        if seeding.seeded_data_exists():
+            if not options['replace']:
+                raise CommandError("Seeded benchmark data already exists; pass --replace to regenerate it.")
+            deleted = seeding.delete_seeded_data()
+            self.stdout.write(f"Deleted the previous benchmark data ({deleted} books).")
+
+        generator = seeding.BenchmarkDataGenerator(
+            seeding.SCALES[options['scale']], seed=options['seed'], chunk_size=options['chunk_size'],
+            log=self.stdout.write,
+        )
+        stats = generator.run()
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded the {options['scale']} dataset (seed {options['seed']}) in {elapsed:.2f}s: "
+            f"{stats['books']} books, {stats['copies']} copies, {stats['borrowers']} borrowers, "
+            f"{stats['borrowings']} borrowings, {stats['notifications']} notifications, {stats['favorites']} favorites."
+        ))
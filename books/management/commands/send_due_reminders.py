@@ -1,13 +1,26 @@
 import datetime
+import time
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from books import kpis, reports
 from books.models import Borrowing, Notification
-from users.utils import send_expo_push_notification
+from lms import metrics
+from users.models import PushOutbox
 from django.utils.translation import gettext_lazy as _
 
+PUSH_TITLES = {
+    'DUE_REMINDER': _("Book Due Soon"),
+    'OVERDUE_ALERT': _("Book Overdue"),
+}
+
 class Command(BaseCommand):
-    help = 'Sends due date reminders and handles overdue book alerts.'
+    help = (
+        'Sends due date reminders and handles overdue book alerts. '
+        'Works set-based: one UPDATE flips newly overdue loans, duplicates are filtered with an '
+        'anti-join against today\'s notifications, and notifications are inserted in chunks.'
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -21,150 +34,149 @@ class Command(BaseCommand):
             action='store_true',
             help='Force check for overdue items even if it is not the primary purpose of this run.'
         )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of rows read and notifications inserted per query (default: 1000).',
+        )
+        parser.add_argument(
+            '--push',
+            action='store_true',
+            help='Also queue a push notification per reminder for `run_push_dispatcher` to deliver.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would be done without changing loans or creating notifications.',
+        )
 
     def handle(self, *args, **options):
         days_due_notice = options['days_due_notice']
-        force_overdue_check = options['force_overdue_check']
+        chunk_size = options['chunk_size']
+        dry_run = options['dry_run']
+        self.push = options['push']
+        self.verbosity = options['verbosity']
 
         if days_due_notice <= 0:
             raise CommandError(_("Number of days for due notice must be positive."))
+        if chunk_size <= 0:
+            raise CommandError(_("Chunk size must be positive."))
 
+        started = time.monotonic()
         today = timezone.localdate()
+        # Start of today as an aware datetime, so the dedupe can use a range on the timestamp
+        today_start = timezone.make_aware(datetime.datetime.combine(today, datetime.time.min))
+        if dry_run:
+            self.stdout.write(self.style.WARNING("Dry run: no loans will be updated and no notifications created."))
 
         # --- 1. Send Due Date Reminders ---
         self.stdout.write(self.style.SUCCESS(f"\n--- Sending Due Date Reminders (for books due in {days_due_notice} days) ---"))
         target_due_date_for_reminder = today + datetime.timedelta(days=days_due_notice)
         self.stdout.write(f"Checking for borrowings due on {target_due_date_for_reminder}...")
 
-        # Borrowings that are ACTIVE and due on the target date
+        phase_started = time.monotonic()
         borrowings_due_soon = Borrowing.objects.filter(
-            due_date=target_due_date_for_reminder, # Filter by exact date
-            status='ACTIVE' # Only for currently active loans
-        ).select_related('borrower', 'book_copy__book')
-
-        if not borrowings_due_soon.exists():
-            self.stdout.write(self.style.SUCCESS(f"No active borrowings found due in exactly {days_due_notice} days."))
-        else:
-            self.stdout.write(f"Found {borrowings_due_soon.count()} borrowing(s) due in {days_due_notice} days. Processing reminders...")
-            success_reminders = 0
-            fail_reminders = 0
-
-            for borrowing in borrowings_due_soon:
-                user = borrowing.borrower
-                book_title = borrowing.book_copy.book.title
-                due_date_str = borrowing.due_date.strftime('%Y-%m-%d')
-
-                # Check if a DUE_REMINDER was already created for this borrowing today
-                # This helps prevent duplicate notifications if the command runs multiple times a day.
-                if Notification.objects.filter(
-                    recipient=user,
-                    notification_type='DUE_REMINDER',
-                    related_borrowing=borrowing, # Assuming you add a ForeignKey 'related_borrowing' to Notification model
-                    timestamp__date=today # Checks if created today
-                ).exists():
-                    self.stdout.write(self.style.NOTICE(f"  - Reminder for Borrowing ID {borrowing.id} ('{book_title}') already sent today. Skipping."))
-                    continue
-
-                self.stdout.write(f"  - Preparing reminder for {user.username} for '{book_title}' (Due: {due_date_str})")
-
-                message_body = _(f"Friendly reminder: Your borrowed book '{book_title}' is due on {due_date_str}.")
-                
-                try:
-                    # Create Database Notification
-                    Notification.objects.create(
-                        recipient=user,
-                        notification_type='DUE_REMINDER',
-                        message=message_body,
-                        # related_borrowing=borrowing # Uncomment if you add this field to Notification model
-                    )
-                    
-                    # Send Push Notification (optional, based on your existing setup)
-                    push_title = _("Book Due Soon!")
-                    push_data_payload = {
-                        "screen": "MyBorrowsScreen", # Example, adjust to your mobile app's navigation
-                        "borrowId": borrowing.id,
-                        "type": "due_reminder"
-                    }
-                    # sent_push = send_expo_push_notification( # Assuming users.utils.send_expo_push_notification
-                    # user=user, title=push_title, body=message_body, data=push_data_payload
-                    # )
-                    # if not sent_push:
-                    #     self.stderr.write(self.style.WARNING(f"    Failed to send PUSH notification for Borrowing ID {borrowing.id} (DB notification was created)."))
-
-                    success_reminders += 1
-                except Exception as e:
-                    fail_reminders += 1
-                    self.stderr.write(self.style.ERROR(f"    Error processing reminder for Borrowing ID {borrowing.id}: {e}"))
-            
-            self.stdout.write(self.style.SUCCESS(f"Due date reminder processing complete. Success: {success_reminders}, Failed: {fail_reminders}"))
+            due_date=target_due_date_for_reminder,
+            status='ACTIVE'
+        )
+        created, skipped = self._create_notifications(
+            borrowings_due_soon,
+            'DUE_REMINDER',
+            today_start,
+            _("Friendly reminder: Your borrowed book '{title}' is due on {due_date}."),
+            chunk_size,
+            dry_run,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Due date reminder processing complete. Created: {created}"
+            f"{f', already sent today: {skipped}' if skipped else ''} ({time.monotonic() - phase_started:.2f}s)"
+        ))
 
         # --- 2. Handle Overdue Books ---
         self.stdout.write(self.style.SUCCESS("\n--- Checking for and Processing Overdue Books ---"))
-        
-        # Find books that are 'ACTIVE' but their due_date has passed
-        overdue_borrowings_to_update = Borrowing.objects.filter(
-            status='ACTIVE',
-            due_date__lt=today # due_date is in the past
-        ).select_related('borrower', 'book_copy__book')
-
-        if not overdue_borrowings_to_update.exists():
-            self.stdout.write(self.style.SUCCESS("No active borrowings found that are newly overdue."))
-        else:
-            self.stdout.write(f"Found {overdue_borrowings_to_update.count()} active borrowing(s) that are now overdue. Updating status and sending alerts...")
-            updated_to_overdue_count = 0
-            success_overdue_alerts = 0
-            fail_overdue_alerts = 0
-
-            for borrowing in overdue_borrowings_to_update:
-                user = borrowing.borrower
-                book_title = borrowing.book_copy.book.title
-                due_date_str = borrowing.due_date.strftime('%Y-%m-%d')
-                
-                # Update status to 'OVERDUE'
-                borrowing.status = 'OVERDUE'
-                borrowing.save(update_fields=['status'])
-                updated_to_overdue_count += 1
-                self.stdout.write(f"  - Marked Borrowing ID {borrowing.id} ('{book_title}') as OVERDUE.")
-
-                # Check if an OVERDUE_ALERT was already created today for this borrowing
-                if Notification.objects.filter(
-                    recipient=user,
-                    notification_type='OVERDUE_ALERT',
-                    related_borrowing=borrowing, # Assuming 'related_borrowing' field
-                    timestamp__date=today
-                ).exists():
-                    self.stdout.write(self.style.NOTICE(f"  - Overdue alert for Borrowing ID {borrowing.id} already sent today. Skipping new alert."))
-                    continue
-                
-                alert_message = _(f"Alert: Your borrowed book '{book_title}' was due on {due_date_str} and is now overdue. Please return it as soon as possible. Fines may apply.")
-                
-                try:
-                    # Create Database Notification for Overdue Alert
-                    Notification.objects.create(
-                        recipient=user,
-                        notification_type='OVERDUE_ALERT',
-                        message=alert_message,
-                        # related_borrowing=borrowing # Uncomment if you add this field
+        phase_started = time.monotonic()
+        newly_overdue = Borrowing.objects.filter(status='ACTIVE', due_date__lt=today)
+
+        with transaction.atomic():
+            # Alert the loans being flipped first, while they still match the ACTIVE filter.
+            created, skipped = self._create_notifications(
+                newly_overdue,
+                'OVERDUE_ALERT',
+                today_start,
+                _("Alert: Your borrowed book '{title}' was due on {due_date} and is now overdue. Please return it as soon as possible. Fines may apply."),
+                chunk_size,
+                dry_run,
+            )
+            affected_books = set(newly_overdue.values_list('book_copy__book_id', flat=True).distinct())
+            if dry_run:
+                updated_to_overdue_count = newly_overdue.count()
+            else:
+                updated_to_overdue_count = newly_overdue.update(status='OVERDUE')
+                # The UPDATE bypasses Borrowing.save(), so bring the reporting rollups along explicitly.
+                reports.refresh_overdue_rollups(affected_books, batch_size=chunk_size)
+                kpis.invalidate_library_kpis()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Overdue processing complete. Marked as overdue: {updated_to_overdue_count}. "
+            f"Alerts created: {created}{f', already sent today: {skipped}' if skipped else ''} "
+            f"({time.monotonic() - phase_started:.2f}s)"
+        ))
+
+        if not dry_run:
+            # Reminders are counted by notification type with every other notification; the UPDATE
+            # above bypasses Borrowing.save(), which counts the other circulation events.
+            metrics.CIRCULATION_EVENTS.inc(updated_to_overdue_count, event='overdue')
+            metrics.JOB_DURATION.observe(time.monotonic() - started, job='send_due_reminders')
+            metrics.JOB_LAST_SUCCESS.set(time.time(), job='send_due_reminders')
+        self.stdout.write(self.style.SUCCESS(f"\nManagement command finished in {time.monotonic() - started:.2f}s."))
+
+    def _notified_today(self, notification_type, today_start):
+        """Anti-join condition: a notification of this type was already created today for the loan."""
+        return Exists(Notification.objects.filter(
+            related_borrowing=OuterRef('pk'),
+            notification_type=notification_type,
+            timestamp__gte=today_start,
+        ))
+
+    def _create_notifications(self, borrowings, notification_type, today_start, message_template, chunk_size, dry_run):
+        """
+        Streams the borrowings that were not notified today (one anti-join query) and inserts one
+        notification per loan with chunked bulk_create.
+        Returns (number created, number of loans skipped because they were notified today).
+        """
+        pending = borrowings.exclude(self._notified_today(notification_type, today_start))
+        rows = pending.order_by('pk').values_list('id', 'borrower_id', 'book_copy__book__title', 'due_date')
+        created = 0
+        batch = []
+        for borrowing_id, borrower_id, book_title, due_date in rows.iterator(chunk_size=chunk_size):
+            if self.verbosity >= 2:
+                self.stdout.write(f"  - {notification_type} for Borrowing ID {borrowing_id} ('{book_title}', due {due_date:%Y-%m-%d})")
+            batch.append(Notification(
+                recipient_id=borrower_id,
+                notification_type=notification_type,
+                message=message_template.format(title=book_title, due_date=due_date.strftime('%Y-%m-%d')),
+                related_borrowing_id=borrowing_id,
+            ))
+            if len(batch) >= chunk_size:
+                created += self._flush(batch, dry_run)
+                batch = []
+        if batch:
+            created += self._flush(batch, dry_run)
+        skipped = borrowings.count() - created if self.verbosity >= 1 else 0
+        return created, skipped
+
+    def _flush(self, batch, dry_run):
+        if not dry_run:
+            Notification.objects.bulk_create(batch, batch_size=len(batch))
+            if self.push:
+                PushOutbox.enqueue_many([
+                    (
+                        notification.recipient_id,
+                        PUSH_TITLES[notification.notification_type],
+                        notification.message,
+                        {"screen": "MyBorrowsScreen", "borrowId": notification.related_borrowing_id},
                     )
-
-                    # Send Push Notification for Overdue Alert (optional)
-                    push_title_overdue = _("Book Overdue!")
-                    push_data_overdue = {
-                        "screen": "MyBorrowsScreen",
-                        "borrowId": borrowing.id,
-                        "type": "overdue_alert"
-                    }
-                    # sent_overdue_push = send_expo_push_notification(
-                    #     user=user, title=push_title_overdue, body=alert_message, data=push_data_overdue
-                    # )
-                    # if not sent_overdue_push:
-                    #    self.stderr.write(self.style.WARNING(f"    Failed to send PUSH notification for overdue Borrowing ID {borrowing.id} (DB notification was created)."))
-                    
-                    success_overdue_alerts += 1
-                except Exception as e:
-                    fail_overdue_alerts += 1
-                    self.stderr.write(self.style.ERROR(f"    Error processing overdue alert for Borrowing ID {borrowing.id}: {e}"))
-
-            self.stdout.write(self.style.SUCCESS(f"Overdue processing complete. Marked as overdue: {updated_to_overdue_count}. Alerts sent: {success_overdue_alerts}, Failed alerts: {fail_overdue_alerts}"))
-        
-        self.stdout.write(self.style.SUCCESS("\nManagement command finished."))
\ No newline at end of file
+                    for notification in batch
+                ], batch_size=len(batch))
+        return len(batch)
@@ -1,10 +1,18 @@
-from django.db import models
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import models, router, transaction
+from django.db.models.functions import Greatest
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import RegexValidator
 
 from django.utils import timezone
 
+from lms import metrics
+
+from . import events
+
 isbn_validator = RegexValidator(
     regex=r'^(?:ISBN(?:-13)?:?)(?=[0-9]{13}$|(?=(?:[0-9]+[- ]){4})[- 0-9]{17}$)97[89][- ]?[0-9]{1,5}[- ]?[0-9]+[- ]?[0-9]+[- ]?[0-9]$',
     message=_("Enter a valid ISBN-13. It must start with 978 or 979 and be 13 digits long (hyphens optional).")
@@ -64,6 +72,8 @@ class Author(models.Model):
         null=True,
         help_text=_("A photo of the author (optional).")
     )
+    # Content hash naming the photo's thumbnails (see books/images.py); empty until they exist.
+    author_photo_digest = models.CharField(max_length=16, blank=True, default='', editable=False)
 
     def __str__(self):
         """String representation of the Author model, used in Django admin and debugging."""
@@ -73,6 +83,9 @@ class Author(models.Model):
         ordering = ['name']
         verbose_name = _('Author')
         verbose_name_plural = _('Authors')
+        indexes = [
+            models.Index(fields=['name', 'id'], name='author_name_idx'),
+        ]
 
     def get_life_span(self):
         if self.date_of_birth:
@@ -170,6 +183,8 @@ class Book(models.Model):
         null=True,
         help_text=_("Upload the book's cover image (optional).")
     )
+    # Content hash naming the cover's thumbnails (see books/images.py); empty until they exist.
+    cover_image_digest = models.CharField(max_length=16, blank=True, default='', editable=False)
     categories = models.ManyToManyField(
         Category,
         related_name='books',
@@ -180,6 +195,9 @@ class Book(models.Model):
         auto_now_add=True,
         help_text=_("Date this book record was added to the system")
     )
+    # Also bumped by every write that changes what the catalog shows for the book (copies, borrow
+    # count, author/category edits), so it versions the book's API and portal representations
+    # (see books/conditional.py).
     last_updated = models.DateTimeField(
         auto_now=True,
         help_text=_("Date this book record was last updated")
@@ -190,10 +208,38 @@ class Book(models.Model):
         help_text=_("How many times this book title has been borrowed overall")
     )
 
+    # Denormalized copy counters, maintained by BookCopy.save() and the BookCopy post_delete signal.
+    # Run `manage.py reconcile_copy_counters` to recompute them from the copies table.
+    total_copies = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text=_("Number of physical copies of this book title")
+    )
+    available_copies = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text=_("Number of physical copies currently 'Available'")
+    )
+
     def __str__(self):
         """String representation of the Book model."""
         return f"{self.title} (ISBN: {self.isbn})"
 
+    COPY_COUNTER_FIELDS = ('total_copies', 'available_copies')
+
+    def save(self, *args, **kwargs):
+        """
+        Custom save method.
+        A full save of an existing book never writes the copy counters, so a stale in-memory
+        Book (e.g. loaded by an edit form) cannot overwrite counters changed by circulation.
+        """
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COPY_COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
     def display_authors(self):
         """Helper method to display authors in the Django admin interface."""
         return ', '.join(author.name for author in self.authors.all()[:3])
@@ -207,12 +253,156 @@ class Book(models.Model):
     @property
     def available_copies_count(self):
         """Returns the number of currently 'Available' physical copies for this book title."""
-        return self.copies.filter(status='Available').count()
+        return self.available_copies
+
+    @classmethod
+    def adjust_copy_counters(cls, book_id, total=0, available=0, using=None):
+        """
+        Atomically applies deltas to a book's copy counters with a single UPDATE, which also bumps
+        last_updated (a copy changed even when the counters did not).
+        Counters never go below zero; reconcile_copy_counters fixes any drift.
+        """
+        changes = {'last_updated': timezone.now()}
+        if total:
+            changes['total_copies'] = Greatest(models.F('total_copies') + total, 0)
+        if available:
+            changes['available_copies'] = Greatest(models.F('available_copies') + available, 0)
+        cls.objects.using(using).filter(pk=book_id).update(**changes)
+
+    @classmethod
+    def touch(cls, isbns, using=None):
+        """Bumps last_updated of the given books, e.g. after one of their authors was renamed."""
+        isbns = list(isbns)
+        if isbns:
+            cls.objects.using(using).filter(pk__in=isbns).update(last_updated=timezone.now())
 
     class Meta:
         ordering = ['title', 'isbn']
         verbose_name = _('Book')
         verbose_name_plural = _('Books')
+        indexes = [
+            models.Index(fields=['-total_borrows'], name='book_popularity_idx'),
+            # Default catalog order, also the API's keyset pagination key
+            models.Index(fields=['title', 'isbn'], name='book_title_idx'),
+            # Max(last_updated) is the catalog version behind the book list's ETag
+            models.Index(fields=['last_updated'], name='book_last_updated_idx'),
+        ]
+
+
+class BookSearchDocument(models.Model):
+    """
+    Denormalized, per-book search document used by the catalog search index (see books/search.py).
+    Kept in sync with Book, Author and Category changes by signals; never edited directly.
+    """
+    book = models.OneToOneField(
+        Book,
+        on_delete=models.CASCADE,
+        related_name='search_document',
+        help_text=_("The book title this search document describes")
+    )
+    title = models.TextField(blank=True, default='')
+    authors = models.TextField(blank=True, default='')
+    categories = models.TextField(blank=True, default='')
+    publisher = models.TextField(blank=True, default='')
+    description = models.TextField(blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """String representation of the BookSearchDocument model."""
+        return f"Search document for {self.book_id}"
+
+    class Meta:
+        verbose_name = _('Book Search Document')
+        verbose_name_plural = _('Book Search Documents')
+
+
+class FavoriteBook(models.Model):
+    """
+    A book title marked as a favorite by a user.
+    Replaces the old JSON list on CustomUser.favorite_books with one indexed row per (user, book).
+    """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='favorites',
+        help_text=_("The user who favorited the book")
+    )
+    book = models.ForeignKey(
+        Book,
+        on_delete=models.CASCADE,
+        related_name='favorites',
+        help_text=_("The favorited book title")
+    )
+    favorited_at = models.DateTimeField(
+        default=timezone.now,
+        help_text=_("Date and time the book was added to the user's favorites")
+    )
+
+    def __str__(self):
+        """String representation of the FavoriteBook model."""
+        return f"Favorite of user {self.user_id}: {self.book_id}"
+
+    @classmethod
+    def toggle(cls, user, book):
+        """
+        Adds the book to the user's favorites, or removes it if already there.
+        One indexed DELETE, plus one INSERT when the book was not a favorite yet.
+        Returns True if the book is now a favorite.
+        """
+        deleted = cls.objects.filter(user=user, book=book).delete()[0]
+        if not deleted:
+            cls.objects.bulk_create([cls(user=user, book=book)], ignore_conflicts=True)
+        user.clear_favorite_cache()
+        return not deleted
+
+    class Meta:
+        ordering = ['-favorited_at']
+        verbose_name = _('Favorite Book')
+        verbose_name_plural = _('Favorite Books')
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'], name='unique_favorite_per_user_book'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-favorited_at'], name='favorite_user_recent_idx'),
+        ]
+
+
+class BookSimilarity(models.Model):
+    """
+    One precomputed "readers of this book also borrowed" neighbour of a book title.
+    Each book keeps at most BOOK_RECOMMENDATION_TOP_K rows, written by `manage.py build_recommendations`.
+    """
+    book = models.ForeignKey(
+        Book,
+        on_delete=models.CASCADE,
+        related_name='similarities',
+        help_text=_("The book these recommendations are for")
+    )
+    similar_book = models.ForeignKey(
+        Book,
+        on_delete=models.CASCADE,
+        related_name='similar_to',
+        help_text=_("The recommended book")
+    )
+    rank = models.PositiveSmallIntegerField(help_text=_("Position among the book's neighbours (0 = most similar)"))
+    score = models.FloatField(help_text=_("Combined co-borrowing and category-overlap similarity"))
+    co_borrow_count = models.PositiveIntegerField(default=0, help_text=_("Borrowers who borrowed both books"))
+    shared_category_count = models.PositiveSmallIntegerField(default=0, help_text=_("Categories the two books share"))
+
+    def __str__(self):
+        """String representation of the BookSimilarity model."""
+        return f"{self.book_id} -> {self.similar_book_id} (#{self.rank}, {self.score:.3f})"
+
+    class Meta:
+        ordering = ['book', 'rank']
+        verbose_name = _('Book Similarity')
+        verbose_name_plural = _('Book Similarities')
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'similar_book'], name='unique_book_similarity'),
+        ]
+        indexes = [
+            models.Index(fields=['book', 'rank'], name='book_similarity_rank_idx'),
+        ]
 
 
 class BookCopy(models.Model):
@@ -264,12 +454,153 @@ class BookCopy(models.Model):
         """String representation of the BookCopy model."""
         return f"{self.book.title} (Copy ID: {self.copy_id}) - Status: {self.get_status_display()}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remembers the loaded book/status so save() can update the Book counters without re-querying."""
+        instance = super().from_db(db, field_names, values)
+        if 'status' in field_names and 'book_id' in field_names:
+            instance._loaded_copy_state = (instance.book_id, instance.status)
+        return instance
+
+    def save(self, *args, **kwargs):
+        """
+        Custom save method.
+        Keeps Book.total_copies / Book.available_copies in step with this copy,
+        in the same transaction as the copy row itself.
+        """
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        update_fields = kwargs.get('update_fields')
+
+        if self._state.adding:
+            old_state = None
+        elif hasattr(self, '_loaded_copy_state'):
+            old_state = self._loaded_copy_state
+        else:
+            old_state = BookCopy.objects.using(using).filter(pk=self.pk).values_list('book_id', 'status').first()
+
+        new_book_id, new_status = self.book_id, self.status
+        if old_state is not None and update_fields is not None:
+            if 'status' not in update_fields:
+                new_status = old_state[1]
+            if 'book' not in update_fields and 'book_id' not in update_fields:
+                new_book_id = old_state[0]
+
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+            if old_state is None:
+                Book.adjust_copy_counters(new_book_id, total=1, available=int(new_status == 'Available'), using=using)
+            else:
+                old_book_id, old_status = old_state
+                if old_book_id != new_book_id:
+                    Book.adjust_copy_counters(old_book_id, total=-1, available=-int(old_status == 'Available'), using=using)
+                    Book.adjust_copy_counters(new_book_id, total=1, available=int(new_status == 'Available'), using=using)
+                else:
+                    delta = int(new_status == 'Available') - int(old_status == 'Available')
+                    Book.adjust_copy_counters(new_book_id, available=delta, using=using)
+        self._loaded_copy_state = (new_book_id, new_status)
+
     class Meta:
         ordering = ['book__title', 'copy_id']
         verbose_name = _('Book Copy')
         verbose_name_plural = _('Book Copies')
 
 
+class CopyIdSequence(models.Model):
+    """
+    Next free number of a copy ID (barcode) prefix.
+    CopyIdSequence.reserve() hands out contiguous blocks of numbers with one UPDATE, so
+    adding any number of copies needs a single reservation (see books/barcodes.py).
+    """
+    prefix = models.CharField(
+        max_length=90,
+        primary_key=True,
+        help_text=_("Copy ID prefix the numbers are appended to (e.g. '9780261103344-')")
+    )
+    next_value = models.PositiveBigIntegerField(
+        default=1,
+        help_text=_("First number not handed out yet")
+    )
+
+    def __str__(self):
+        """String representation of the CopyIdSequence model."""
+        return f"{self.prefix}* (next: {self.next_value})"
+
+    @classmethod
+    def reserve(cls, prefix, count, start=1):
+        """
+        Reserves `count` consecutive numbers of the prefix and returns them as a range.
+        The row is created on first use with next_value = start (a callable is only evaluated then).
+        The UPDATE locks the row until the surrounding transaction ends, so concurrent
+        reservations never overlap.
+        """
+        with transaction.atomic():
+            if not cls.objects.filter(prefix=prefix).update(next_value=models.F('next_value') + count):
+                start = start() if callable(start) else start
+                cls.objects.bulk_create([cls(prefix=prefix, next_value=start)], ignore_conflicts=True)
+                cls.objects.filter(prefix=prefix).update(next_value=models.F('next_value') + count)
+            end = cls.objects.filter(prefix=prefix).values_list('next_value', flat=True).get()
+        return range(end - count, end)
+
+    @classmethod
+    def reserve_many(cls, counts):
+        """
+        Reserves blocks for many prefixes at once ({prefix: count} -> {prefix: range}), with one
+        INSERT for new prefixes (numbered from 1), one UPDATE per distinct count and one SELECT.
+        """
+        by_count = {}
+        for prefix, count in counts.items():
+            by_count.setdefault(count, []).append(prefix)
+        with transaction.atomic():
+            cls.objects.bulk_create([cls(prefix=prefix) for prefix in counts], ignore_conflicts=True)
+            for count, prefixes in by_count.items():
+                cls.objects.filter(prefix__in=prefixes).update(next_value=models.F('next_value') + count)
+            ends = dict(cls.objects.filter(prefix__in=list(counts)).values_list('prefix', 'next_value'))
+        return {prefix: range(ends[prefix] - count, ends[prefix]) for prefix, count in counts.items()}
+
+    class Meta:
+        verbose_name = _('Copy ID Sequence')
+        verbose_name_plural = _('Copy ID Sequences')
+
+
+class CollectionVersion(models.Model):
+    """
+    Version counter of a collection whose changes cannot be read from its own rows, e.g. the
+    category list (no timestamp) or the deleted books (no row left). bump() increments it in the
+    writing transaction, so every process sees the new version as soon as the change commits.
+    """
+    name = models.CharField(
+        max_length=50,
+        primary_key=True,
+        help_text=_("Name of the versioned collection (e.g. 'categories')")
+    )
+    version = models.PositiveBigIntegerField(
+        default=0,
+        help_text=_("Incremented on every change to the collection")
+    )
+
+    def __str__(self):
+        """String representation of the CollectionVersion model."""
+        return f"{self.name}: {self.version}"
+
+    @classmethod
+    def bump(cls, name, using=None):
+        """Increments the collection's version; the row is created on first use."""
+        versions = cls.objects.using(using or router.db_for_write(cls))
+        with transaction.atomic(using=versions.db):
+            if not versions.filter(name=name).update(version=models.F('version') + 1):
+                versions.bulk_create([cls(name=name)], ignore_conflicts=True)
+                versions.filter(name=name).update(version=models.F('version') + 1)
+
+    @classmethod
+    def current(cls, name):
+        """The collection's version, 0 before its first change."""
+        return cls.objects.filter(name=name).values_list('version', flat=True).first() or 0
+
+    class Meta:
+        verbose_name = _('Collection Version')
+        verbose_name_plural = _('Collection Versions')
+
+
 class Borrowing(models.Model):
     """
     Represents a borrowing transaction: a specific BookCopy loaned to a specific Borrower.
@@ -337,34 +668,91 @@ class Borrowing(models.Model):
         """String representation of the Borrowing model."""
         return f"{self.borrower.username} borrowed '{self.book_copy.book.title}' (Copy: {self.book_copy.copy_id})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remembers the loaded status so save() knows the previous status without re-querying."""
+        instance = super().from_db(db, field_names, values)
+        if 'status' in field_names:
+            instance._loaded_status = instance.status
+        return instance
+
     def save(self, *args, **kwargs):
         """
         Custom save method.
         Example: Increment total_borrows on the Book when a borrowing record is first created and active.
         This could also be handled more robustly with Django Signals for better decoupling.
+        The previous status is exposed to post_save receivers as `_status_before_save`
+        (None for new records), which keeps the reporting rollups in step with circulation.
         """
-        is_new_active_loan = False
-        if self._state.adding and self.status == 'ACTIVE':
-            is_new_active_loan = True
-        elif not self._state.adding:
-            try:
-                old_instance = Borrowing.objects.get(pk=self.pk)
-                if old_instance.status != 'ACTIVE' and self.status == 'ACTIVE':
-                    is_new_active_loan = True
-            except Borrowing.DoesNotExist:
-                if self.status == 'ACTIVE':
-                    is_new_active_loan = True
-        
-        super().save(*args, **kwargs)
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        if self._state.adding:
+            old_status = None
+        elif hasattr(self, '_loaded_status'):
+            old_status = self._loaded_status
+        else:
+            old_status = Borrowing.objects.using(using).filter(pk=self.pk).values_list('status', flat=True).first()
+
+        is_new_active_loan = self.status == 'ACTIVE' and old_status != 'ACTIVE'
+        self._status_before_save = old_status
+
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
 
-        if is_new_active_loan:
-            book_title = self.book_copy.book
-            Book.objects.filter(pk=book_title.pk).update(total_borrows=models.F('total_borrows') + 1)
+            if is_new_active_loan:
+                book_title = self.book_copy.book
+                Book.objects.filter(pk=book_title.pk).update(
+                    total_borrows=models.F('total_borrows') + 1, last_updated=timezone.now(),
+                )
+        self._loaded_status = self.status
 
     class Meta:
         ordering = ['-request_date']
         verbose_name = _('Borrowing Record')
         verbose_name_plural = _('Borrowing Records')
+        indexes = [
+            # Keyset pagination of the borrowing API: staff see every record, borrowers their own
+            models.Index(fields=['-request_date', 'id'], name='borrowing_recent_idx'),
+            models.Index(fields=['borrower', '-request_date', 'id'], name='borrowing_borrower_recent_idx'),
+        ]
+
+
+def count_new_notifications(notifications, using=None):
+    """Counts new notifications per type in the metrics once the transaction commits."""
+    per_type = Counter(notification.notification_type for notification in notifications)
+    if per_type:
+        transaction.on_commit(
+            lambda: [metrics.NOTIFICATIONS_CREATED.inc(n, type=notification_type) for notification_type, n in per_type.items()],
+            using=using,
+        )
+
+
+class NotificationQuerySet(models.QuerySet):
+    """Keeps UnreadNotificationCounter in step with bulk writes, which bypass Notification.save()."""
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            UnreadNotificationCounter.adjust(
+                Counter(notification.recipient_id for notification in objs if not notification.is_read), using=self.db,
+            )
+            events.publish_notifications(objs, using=self.db)
+            count_new_notifications(objs, using=self.db)
+        return objs
+
+    def mark_read(self):
+        """
+        Marks the unread notifications of this queryset read and takes them off their recipients' counters.
+        Each recipient's counter moves by the rows its UPDATE ... WHERE is_read = false changed, so a
+        concurrent call that already marked them read is not subtracted twice.
+        """
+        updated = 0
+        with transaction.atomic(using=self.db):
+            unread = self.filter(is_read=False)
+            for recipient_id in unread.order_by().values_list('recipient', flat=True).distinct():
+                changed = unread.filter(recipient_id=recipient_id).update(is_read=True)
+                UnreadNotificationCounter.adjust({recipient_id: -changed}, using=self.db)
+                updated += changed
+        return updated
 
 
 class Notification(models.Model):
@@ -412,6 +800,8 @@ class Notification(models.Model):
         help_text=_("Link to the specific borrowing record, if applicable")
     )
     
+    objects = NotificationQuerySet.as_manager()
+
     # Optional: Link to a relevant object that the notification is about
     # This uses Django's generic relations if the related object can be of different types (e.g., a Borrowing record, a Book).
     # from django.contrib.contenttypes.fields import GenericForeignKey
@@ -424,8 +814,265 @@ class Notification(models.Model):
         """String representation of the Notification model."""
         return f"Notification for {self.recipient.username}: {self.get_notification_type_display()} ({'Read' if self.is_read else 'Unread'})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remembers the loaded read flag so save() can update the unread counter without re-querying."""
+        instance = super().from_db(db, field_names, values)
+        if 'is_read' in field_names:
+            instance._loaded_is_read = instance.is_read
+        return instance
+
+    def save(self, *args, **kwargs):
+        """Keeps the recipient's UnreadNotificationCounter in step, in the same transaction as the row."""
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        update_fields = kwargs.get('update_fields')
+
+        if self._state.adding:
+            was_unread = False
+        elif hasattr(self, '_loaded_is_read'):
+            was_unread = not self._loaded_is_read
+        else:
+            was_unread = Notification.objects.using(using).filter(pk=self.pk, is_read=False).exists()
+        is_unread = not self.is_read
+        if update_fields is not None and not self._state.adding and 'is_read' not in update_fields:
+            is_unread = was_unread
+
+        created = self._state.adding
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+            if is_unread != was_unread:
+                UnreadNotificationCounter.adjust({self.recipient_id: 1 if is_unread else -1}, using=using)
+            if created:
+                events.publish_notifications([self], using=using)
+                count_new_notifications([self], using=using)
+        self._loaded_is_read = not is_unread
+
+    def mark_read(self):
+        """
+        Marks this notification read with a compare-and-set on is_read: of two concurrent calls only
+        the one whose UPDATE still found the row unread takes it off the counter. Returns whether
+        this call changed it.
+        """
+        using = router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            changed = Notification.objects.using(using).filter(pk=self.pk, is_read=False).update(is_read=True)
+            if changed:
+                UnreadNotificationCounter.adjust({self.recipient_id: -1}, using=using)
+        self.is_read = self._loaded_is_read = True
+        return bool(changed)
+
     class Meta:
         ordering = ['-timestamp']
         verbose_name = _('Notification')
         verbose_name_plural = _('Notifications')
+        indexes = [
+            # Lets send_due_reminders check "already notified today" per loan with an index lookup
+            models.Index(fields=['related_borrowing', 'notification_type', 'timestamp'], name='notification_dedupe_idx'),
+            # A user's notification list, newest first (keyset pagination of the notification API)
+            models.Index(fields=['recipient', '-timestamp', 'id'], name='notification_recipient_idx'),
+            # The list filtered by read state (?is_read=) and the unread recount in reconcile_notification_counters
+            models.Index(fields=['recipient', 'is_read', 'timestamp'], name='notification_inbox_idx'),
+        ]
+
+
+
+class UnreadNotificationCounter(models.Model):
+    """
+    Number of unread notifications per user, so unread-count polls read one row (or the cache)
+    instead of counting the Notification table. Kept in step by Notification.save(), the
+    NotificationQuerySet bulk methods and the post_delete receiver; `reconcile_notification_counters`
+    recomputes it. A user without a row has no unread notifications.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='unread_notification_counter',
+        help_text=_("The user whose notifications are counted")
+    )
+    unread = models.PositiveIntegerField(
+        default=0,
+        help_text=_("Number of the user's notifications not read yet")
+    )
+
+    def __str__(self):
+        """String representation of the UnreadNotificationCounter model."""
+        return f"{self.user_id}: {self.unread} unread"
+
+    @staticmethod
+    def cache_key(user_id):
+        return f'notifications:unread:{user_id}'
+
+    @classmethod
+    def adjust(cls, deltas, using=None):
+        """
+        Adds {user id: delta} to the users' counters (never going below zero), with one UPDATE per
+        distinct delta. Rows are created for increments only, so decrements never resurrect the
+        counter of a user being deleted.
+        """
+        by_delta = {}
+        for user_id, delta in deltas.items():
+            if delta:
+                by_delta.setdefault(delta, []).append(user_id)
+        if not by_delta:
+            return
+        using = using or router.db_for_write(cls)
+        counters = cls.objects.using(using)
+        with transaction.atomic(using=using):
+            for delta, user_ids in by_delta.items():
+                change = {'unread': Greatest(models.F('unread') + delta, 0)}
+                if counters.filter(user_id__in=user_ids).update(**change) < len(user_ids) and delta > 0:
+                    missing = set(user_ids) - set(counters.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+                    counters.bulk_create([cls(user_id=user_id) for user_id in missing], ignore_conflicts=True)
+                    counters.filter(user_id__in=missing).update(**change)
+        keys = [cls.cache_key(user_id) for user_id in deltas]
+        transaction.on_commit(lambda: cache.delete_many(keys), using=using)
+
+    @classmethod
+    def cached_count(cls, user_id):
+        """The user's unread count, from the cache when possible."""
+        key = cls.cache_key(user_id)
+        count = cache.get(key)
+        if count is None:
+            count = cls.objects.filter(user_id=user_id).values_list('unread', flat=True).first() or 0
+            cache.set(key, count, getattr(settings, 'NOTIFICATION_COUNT_CACHE_TIMEOUT', 30))
+        return count
+
+    class Meta:
+        verbose_name = _('Unread Notification Counter')
+        verbose_name_plural = _('Unread Notification Counters')
+
+
+# --- Reporting rollups ---
+# Pre-aggregated tables read by the library reports page. They are kept current by the
+# Borrowing save hooks (see books/reports.py) and rebuilt by `manage.py rollup_reports`.
 
+class DailyCirculationStat(models.Model):
+    """Loan activity for one day and one borrower type."""
+    day = models.DateField(help_text=_("Calendar day (in the library's time zone)"))
+    borrower_type = models.CharField(
+        max_length=30,
+        blank=True,
+        default='',
+        help_text=_("Borrower type of the users involved (blank if not set)")
+    )
+    requests = models.PositiveIntegerField(default=0, help_text=_("Borrowing records created on this day (requests and direct issues)"))
+    loans_issued = models.PositiveIntegerField(default=0, help_text=_("Loans issued on this day"))
+    returns = models.PositiveIntegerField(default=0, help_text=_("Loans returned on time on this day"))
+    late_returns = models.PositiveIntegerField(default=0, help_text=_("Loans returned late on this day"))
+
+    def __str__(self):
+        """String representation of the DailyCirculationStat model."""
+        return f"{self.day} {self.borrower_type or '-'}: {self.loans_issued} issued"
+
+    class Meta:
+        ordering = ['-day', 'borrower_type']
+        verbose_name = _('Daily Circulation Stat')
+        verbose_name_plural = _('Daily Circulation Stats')
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'borrower_type'], name='unique_daily_circulation_stat'),
+        ]
+
+
+class DailyCategoryCirculationStat(models.Model):
+    """Loans issued for one day and one category (a loan counts once for each category of its book)."""
+    day = models.DateField(help_text=_("Calendar day (in the library's time zone)"))
+    category = models.ForeignKey(
+        Category,
+        on_delete=models.CASCADE,
+        related_name='daily_circulation_stats',
+        help_text=_("Category of the borrowed book")
+    )
+    loans_issued = models.PositiveIntegerField(default=0, help_text=_("Loans issued on this day"))
+
+    def __str__(self):
+        """String representation of the DailyCategoryCirculationStat model."""
+        return f"{self.day} {self.category_id}: {self.loans_issued} issued"
+
+    class Meta:
+        ordering = ['-day', 'category']
+        verbose_name = _('Daily Category Circulation Stat')
+        verbose_name_plural = _('Daily Category Circulation Stats')
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'category'], name='unique_daily_category_circulation_stat'),
+        ]
+
+
+class TitleCirculationStat(models.Model):
+    """Running circulation figures for one book title."""
+    book = models.OneToOneField(
+        Book,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='circulation_stat',
+        help_text=_("The book title these figures belong to")
+    )
+    loans_total = models.PositiveIntegerField(default=0, help_text=_("Loans ever issued (excluding lost copies)"))
+    pending_requests = models.PositiveIntegerField(default=0, help_text=_("Borrow requests awaiting approval"))
+    active_loans = models.PositiveIntegerField(default=0, help_text=_("Loans currently out and not overdue"))
+    overdue_loans = models.PositiveIntegerField(default=0, help_text=_("Loans currently overdue"))
+    last_issued_at = models.DateTimeField(null=True, blank=True, help_text=_("When the latest loan was issued"))
+
+    def __str__(self):
+        """String representation of the TitleCirculationStat model."""
+        return f"{self.book_id}: {self.loans_total} loans"
+
+    class Meta:
+        verbose_name = _('Title Circulation Stat')
+        verbose_name_plural = _('Title Circulation Stats')
+        indexes = [
+            models.Index(fields=['-loans_total'], name='title_stat_loans_idx'),
+        ]
+
+
+class BorrowerCirculationStat(models.Model):
+    """Running circulation figures for one borrower."""
+    borrower = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='circulation_stat',
+        help_text=_("The borrower these figures belong to")
+    )
+    loans_total = models.PositiveIntegerField(default=0, help_text=_("Loans ever issued (excluding lost copies)"))
+
+    def __str__(self):
+        """String representation of the BorrowerCirculationStat model."""
+        return f"{self.borrower_id}: {self.loans_total} loans"
+
+    class Meta:
+        verbose_name = _('Borrower Circulation Stat')
+        verbose_name_plural = _('Borrower Circulation Stats')
+        indexes = [
+            models.Index(fields=['-loans_total'], name='borrower_stat_loans_idx'),
+        ]
+
+
+class OverdueLoanSnapshot(models.Model):
+    """One row per currently overdue loan, denormalized for the reports page."""
+    borrowing = models.OneToOneField(
+        Borrowing,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='overdue_snapshot',
+        help_text=_("The overdue borrowing record")
+    )
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    book_title = models.CharField(max_length=255)
+    copy_id = models.CharField(max_length=100)
+    borrower = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    borrower_username = models.CharField(max_length=150)
+    due_date = models.DateField(db_index=True)
+
+    def __str__(self):
+        """String representation of the OverdueLoanSnapshot model."""
+        return f"Overdue: {self.book_title} ({self.copy_id}), due {self.due_date}"
+
+    @property
+    def days_overdue(self):
+        return max((timezone.localdate() - self.due_date).days, 0)
+
+    class Meta:
+        ordering = ['due_date']
+        verbose_name = _('Overdue Loan Snapshot')
+        verbose_name_plural = _('Overdue Loan Snapshots')
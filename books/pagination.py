@@ -0,0 +1,187 @@
+"""
+Keyset ("cursor") pagination for the API.
+
+KeysetPagination is the default DRF pagination class. A page is fetched as
+`WHERE (ordering columns) > (values of the last row seen) ORDER BY ... LIMIT page_size + 1`,
+so every page costs the same index range scan however deep the client has scrolled, and rows
+inserted meanwhile (new notifications, new loans) never shift or repeat items between pages.
+
+Unlike DRF's CursorPagination, which positions the cursor on the first ordering field only
+and skips ties with an OFFSET, the cursor here holds the values of every ordering field. The
+ordering always ends with the primary key, so it is total and no OFFSET is ever needed.
+
+Views choose their key with `cursor_ordering` (e.g. ('-timestamp', 'id')), and may set their
+own `max_page_size`. Small lookup tables opt out with `pagination_class = None`. When the
+client asks for another order (?ordering=) or for relevance-ranked search results, that order
+is kept and `cursor_ordering` is appended as the tie-breaker.
+"""
+import json
+from base64 import b64decode, b64encode
+from datetime import date, datetime, time
+from urllib import parse
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(CursorPagination):
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    # Used when a view declares no `cursor_ordering`.
+    ordering = ('-pk',)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.max_page_size = getattr(view, 'max_page_size', self.max_page_size)
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.reverse, position = self.decode_cursor(request, queryset)
+
+        ordering = [_reversed(field) for field in self.ordering] if self.reverse else self.ordering
+        queryset = queryset.order_by(*[_order_expression(field) for field in ordering])
+        if position is not None:
+            queryset = queryset.filter(_after(ordering, position))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if self.reverse:
+            self.page.reverse()
+            self.has_previous, self.has_next = has_more, True
+        else:
+            self.has_previous, self.has_next = position is not None, has_more
+        return self.page
+
+    def get_ordering(self, request, queryset, view):
+        """
+        The view's `cursor_ordering`, or the order the client asked for followed by it.
+        The primary key is appended when missing so that the ordering is total.
+        """
+        ordering = list(getattr(view, 'cursor_ordering', None) or self.ordering)
+        requested_order = any(
+            issubclass(backend, OrderingFilter) and backend.ordering_param in request.query_params
+            for backend in getattr(view, 'filter_backends', [])
+        )
+        # 'search_rank' is the relevance annotation added by search.search_books().
+        if requested_order or 'search_rank' in queryset.query.annotations:
+            leading = [field for field in queryset.query.order_by if isinstance(field, str)]
+            ordering = leading + [field for field in ordering if field.lstrip('-') not in {f.lstrip('-') for f in leading}]
+        pk_name = queryset.model._meta.pk.name
+        if not {'pk', pk_name} & {field.lstrip('-') for field in ordering}:
+            ordering.append(pk_name)
+        return tuple(ordering)
+
+    def decode_cursor(self, request, queryset=None):
+        """
+        Returns (reverse, position values) from the request's cursor, (False, None) without one.
+        With the queryset, each value is converted by its ordering field, so a tampered cursor
+        is refused here instead of failing in the query.
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return False, None
+        try:
+            tokens = parse.parse_qs(b64decode(encoded.encode('ascii')).decode('ascii'), keep_blank_values=True)
+            reverse = tokens.get('r', ['0'])[0] == '1'
+            position = json.loads(tokens['p'][0])
+            if not isinstance(position, list) or len(position) != len(self.ordering):
+                raise ValueError
+            if queryset is not None:
+                position = [
+                    None if value is None else _ordering_field(queryset, field).to_python(value)
+                    for field, value in zip(self.ordering, position)
+                ]
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return reverse, position
+
+    def encode_cursor(self, reverse, position):
+        tokens = {'p': json.dumps(position, default=_json_value, separators=(',', ':'))}
+        if reverse:
+            tokens['r'] = '1'
+        encoded = b64encode(parse.urlencode(tokens, doseq=True).encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(False, _position(self.page[-1], self.ordering))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(True, _position(self.page[0], self.ordering))
+
+
+def _json_value(value):
+    # Full precision: DjangoJSONEncoder would cut datetimes to milliseconds and break ties.
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+def _ordering_field(queryset, field):
+    """The model field (or annotation output field) an ordering entry such as '-book__title' sorts by."""
+    name = field.lstrip('-')
+    if name in queryset.query.annotations:
+        return queryset.query.annotations[name].output_field
+    model = queryset.model
+    *path, last = name.split('__')
+    for part in path:
+        model = model._meta.get_field(part).related_model
+    return model._meta.pk if last == 'pk' else model._meta.get_field(last)
+
+
+def _reversed(field):
+    return field[1:] if field.startswith('-') else f'-{field}'
+
+
+def _order_expression(field):
+    # NULLs sort as the smallest value on every database, matching the comparisons in _after().
+    if field.startswith('-'):
+        return F(field[1:]).desc(nulls_last=True)
+    return F(field).asc(nulls_first=True)
+
+
+def _position(instance, ordering):
+    values = []
+    for field in ordering:
+        value = instance
+        for name in field.lstrip('-').split('__'):
+            value = getattr(value, name) if value is not None else None
+        values.append(value)
+    return values
+
+
+def _beyond(field, value):
+    """Rows strictly past `value` in the field's sort direction (NULL counts as the smallest value)."""
+    name = field.lstrip('-')
+    if field.startswith('-'):
+        return Q(pk__in=[]) if value is None else Q(**{f'{name}__lt': value}) | Q(**{f'{name}__isnull': True})
+    return Q(**{f'{name}__isnull': False}) if value is None else Q(**{f'{name}__gt': value})
+
+
+def _equal(field, value):
+    name = field.lstrip('-')
+    return Q(**{f'{name}__isnull': True}) if value is None else Q(**{name: value})
+
+
+def _after(ordering, position):
+    """(a, b, c) > (x, y, z) in the given per-field directions, as a Q object."""
+    condition = Q(pk__in=[])
+    prefix = Q()
+    for field, value in zip(ordering, position):
+        condition |= prefix & _beyond(field, value)
+        prefix &= _equal(field, value)
+    return condition
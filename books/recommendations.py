@@ -0,0 +1,162 @@
+"""
+Item-to-item book recommendations.
+
+Similarity between two titles combines:
+
+* co-borrowing - cosine similarity of the sets of borrowers who borrowed each book
+  ("people who borrowed X also borrowed Y"), and
+* category overlap - Jaccard similarity of the books' category sets.
+
+build_similarities() computes the top-K neighbours of every book offline (see the
+`build_recommendations` management command) into the BookSimilarity table, so pages
+only ever read at most K precomputed rows per book.
+"""
+import heapq
+import math
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Book, BookSimilarity, Borrowing, FavoriteBook
+from .reports import ISSUED_STATUSES
+
+DEFAULT_TOP_K = 10
+DEFAULT_CATEGORY_WEIGHT = 0.3
+
+
+def top_k():
+    return getattr(settings, 'BOOK_RECOMMENDATION_TOP_K', DEFAULT_TOP_K)
+
+
+def _co_borrow_counts(max_books_per_borrower):
+    """Returns ({isbn: number of borrowers}, {isbn: Counter({other isbn: shared borrowers})})."""
+    borrower_counts = Counter()
+    co_borrows = defaultdict(Counter)
+
+    def add_borrower(isbns):
+        isbns = isbns[:max_books_per_borrower]
+        borrower_counts.update(isbns)
+        for index, isbn in enumerate(isbns):
+            for other in isbns[index + 1:]:
+                co_borrows[isbn][other] += 1
+                co_borrows[other][isbn] += 1
+
+    pairs = Borrowing.objects.filter(status__in=ISSUED_STATUSES)\
+        .values_list('borrower_id', 'book_copy__book_id').distinct().order_by('borrower_id')
+    current_borrower, isbns = None, []
+    for borrower_id, isbn in pairs.iterator(chunk_size=5000):
+        if borrower_id != current_borrower:
+            add_borrower(isbns)
+            current_borrower, isbns = borrower_id, []
+        isbns.append(isbn)
+    add_borrower(isbns)
+    return borrower_counts, co_borrows
+
+
+def _category_sets():
+    """Returns ({isbn: frozenset of category ids}, {category id: [isbns, most borrowed first]})."""
+    book_categories = defaultdict(set)
+    category_books = defaultdict(list)
+    memberships = Book.categories.through.objects\
+        .order_by('category_id', '-book__total_borrows', 'book_id')\
+        .values_list('book_id', 'category_id')
+    for isbn, category_id in memberships.iterator(chunk_size=5000):
+        book_categories[isbn].add(category_id)
+        category_books[category_id].append(isbn)
+    return {isbn: frozenset(ids) for isbn, ids in book_categories.items()}, category_books
+
+
+def build_similarities(k=None, category_weight=DEFAULT_CATEGORY_WEIGHT, max_books_per_borrower=200,
+                       category_candidates=50, batch_size=1000):
+    """
+    Recomputes the BookSimilarity table. Candidates for a book are its co-borrowed books plus
+    the `category_candidates` most borrowed books of each of its categories. Rows are written
+    every `batch_size` rows, so only the co-borrow counts are held for the whole catalog.
+    Returns the number of similarity rows written.
+    """
+    k = k or top_k()
+    borrower_counts, co_borrows = _co_borrow_counts(max_books_per_borrower)
+    book_categories, category_books = _category_sets()
+
+    written = 0
+    rows = []
+    with transaction.atomic():
+        # Pages keep reading the previous table until the rebuild commits.
+        BookSimilarity.objects.all().delete()
+        for isbn in Book.objects.order_by('isbn').values_list('isbn', flat=True).iterator(chunk_size=5000):
+            rows.extend(_neighbours_of(
+                isbn, k, category_weight, category_candidates, borrower_counts, co_borrows, book_categories, category_books,
+            ))
+            if len(rows) >= batch_size:
+                BookSimilarity.objects.bulk_create(rows, batch_size=batch_size)
+                written += len(rows)
+                rows = []
+        BookSimilarity.objects.bulk_create(rows, batch_size=batch_size)
+    return written + len(rows)
+
+
+def _neighbours_of(isbn, k, category_weight, category_candidates, borrower_counts, co_borrows, book_categories,
+                   category_books):
+    """The BookSimilarity rows (unsaved) of the top-k neighbours of one book."""
+    categories = book_categories.get(isbn, frozenset())
+    candidates = set(co_borrows.get(isbn, ()))
+    for category_id in categories:
+        candidates.update(category_books[category_id][:category_candidates])
+    candidates.discard(isbn)
+
+    scored = []
+    for other in candidates:
+        shared_borrowers = co_borrows[isbn][other] if isbn in co_borrows else 0
+        cosine = (
+            shared_borrowers / math.sqrt(borrower_counts[isbn] * borrower_counts[other])
+            if shared_borrowers else 0.0
+        )
+        other_categories = book_categories.get(other, frozenset())
+        shared_categories = len(categories & other_categories)
+        jaccard = shared_categories / len(categories | other_categories) if shared_categories else 0.0
+        score = (1 - category_weight) * cosine + category_weight * jaccard
+        if score > 0:
+            scored.append((score, shared_borrowers, shared_categories, other))
+
+    return [
+        BookSimilarity(
+            book_id=isbn, similar_book_id=other, rank=rank, score=score,
+            co_borrow_count=shared_borrowers, shared_category_count=shared_categories,
+        )
+        for rank, (score, shared_borrowers, shared_categories, other) in enumerate(
+            heapq.nlargest(k, scored, key=lambda item: (item[0], item[1], item[3]))
+        )
+    ]
+
+
+def _neighbours(book):
+    return Book.objects.filter(similar_to__book=book).order_by('similar_to__rank')
+
+
+def similar_books(book, limit=None):
+    """Book queryset of the precomputed neighbours of `book`, most similar first (at most K rows)."""
+    return _neighbours(book)[:limit or top_k()]
+
+
+def recommendations_for_user(user, limit=None):
+    """
+    Neighbours of the book the user most recently borrowed or favorited, most similar first,
+    leaving out the books the user already borrowed, requested or favorited (an empty queryset when there is no such book
+    or it has no neighbours yet).
+    """
+    if not user.is_authenticated:
+        return Book.objects.none()
+    seeds = [
+        Borrowing.objects.filter(borrower=user, status__in=ISSUED_STATUSES, issue_date__isnull=False)
+            .order_by('-issue_date').values_list('book_copy__book_id', 'issue_date').first(),
+        FavoriteBook.objects.filter(user=user).values_list('book_id', 'favorited_at').first(),
+    ]
+    seeds = [seed for seed in seeds if seed is not None]
+    if not seeds:
+        return Book.objects.none()
+    seed_isbn = max(seeds, key=lambda seed: seed[1])[0]
+    borrowed = Borrowing.objects.filter(borrower=user, status__in=('REQUESTED', *ISSUED_STATUSES))\
+        .values('book_copy__book_id')
+    return _neighbours(seed_isbn).exclude(isbn__in=borrowed)\
+        .exclude(isbn__in=FavoriteBook.objects.filter(user=user).values('book_id'))[:limit or top_k()]
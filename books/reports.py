@@ -0,0 +1,254 @@
+"""
+Reporting rollups.
+
+The library reports page reads only from small pre-aggregated tables:
+
+* DailyCirculationStat         - new records / loans / returns per day and borrower type
+* DailyCategoryCirculationStat - loans per day and category
+* TitleCirculationStat         - running per-title figures (total, pending, active, overdue)
+* BorrowerCirculationStat      - running per-borrower loan totals
+* OverdueLoanSnapshot          - one denormalized row per overdue loan
+
+record_borrowing_change() keeps them current as circulation happens (it runs in the
+Borrowing post_save receiver, inside the same transaction as the save), and
+rebuild_daily_rollups() / rebuild_running_rollups() recompute them from the
+Borrowing table for the `rollup_reports` management command.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest, TruncDate
+from django.utils import timezone
+
+from .models import (
+    Book, Borrowing, BorrowerCirculationStat, DailyCategoryCirculationStat,
+    DailyCirculationStat, OverdueLoanSnapshot, TitleCirculationStat,
+)
+
+# A loan has been issued once a borrowing reaches any of these statuses.
+ISSUED_STATUSES = ('ACTIVE', 'OVERDUE', 'RETURNED', 'RETURNED_LATE', 'LOST_BY_BORROWER')
+# Loans counted in the "loans_total" figures (same definition the reports page always used).
+COUNTED_LOAN_STATUSES = ('ACTIVE', 'OVERDUE', 'RETURNED', 'RETURNED_LATE')
+RETURN_STATUSES = {'RETURNED': 'returns', 'RETURNED_LATE': 'late_returns'}
+# Status -> TitleCirculationStat field holding the number of borrowings currently in that status.
+TITLE_STATUS_FIELDS = {'REQUESTED': 'pending_requests', 'ACTIVE': 'active_loans', 'OVERDUE': 'overdue_loans'}
+
+
+def _local_day(value):
+    if value is None:
+        return timezone.localdate()
+    if hasattr(value, 'tzinfo'):
+        return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+    return value
+
+
+def _increment(model, lookup, **deltas):
+    """Adds the (possibly negative) deltas to the row matching lookup, creating it when missing."""
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    updates = {field: Greatest(F(field) + delta, 0) for field, delta in deltas.items()}
+    if not model.objects.filter(**lookup).update(**updates) and any(delta > 0 for delta in deltas.values()):
+        _, created = model.objects.get_or_create(**lookup, defaults={field: max(delta, 0) for field, delta in deltas.items()})
+        if not created:
+            # Another transaction created the row in the meantime.
+            model.objects.filter(**lookup).update(**updates)
+
+
+def _borrower_type(borrowing):
+    return getattr(borrowing.borrower, 'borrower_type', None) or ''
+
+
+def record_borrowing_change(borrowing, old_status, new_status=None):
+    """
+    Applies one Borrowing status transition (old_status -> new_status) to the rollup tables.
+    old_status is None for new records; new_status is None for deleted ones.
+    """
+    if old_status == new_status:
+        return
+    book_id = borrowing.book_copy.book_id
+
+    with transaction.atomic():
+        title_deltas = defaultdict(int)
+        if old_status in TITLE_STATUS_FIELDS:
+            title_deltas[TITLE_STATUS_FIELDS[old_status]] -= 1
+        if new_status in TITLE_STATUS_FIELDS:
+            title_deltas[TITLE_STATUS_FIELDS[new_status]] += 1
+        counted_delta = int(new_status in COUNTED_LOAN_STATUSES) - int(old_status in COUNTED_LOAN_STATUSES)
+        title_deltas['loans_total'] += counted_delta
+        _increment(TitleCirculationStat, {'book_id': book_id}, **title_deltas)
+        _increment(BorrowerCirculationStat, {'borrower_id': borrowing.borrower_id}, loans_total=counted_delta)
+
+        if new_status is None:
+            # Deleted record: daily history is left as it was; the snapshot row cascades away.
+            return
+
+        borrower_type = _borrower_type(borrowing)
+        if old_status is None:
+            _increment(DailyCirculationStat, {'day': _local_day(borrowing.request_date), 'borrower_type': borrower_type}, requests=1)
+
+        if new_status in ISSUED_STATUSES and old_status not in ISSUED_STATUSES:
+            issue_day = _local_day(borrowing.issue_date)
+            _increment(DailyCirculationStat, {'day': issue_day, 'borrower_type': borrower_type}, loans_issued=1)
+            category_ids = Book.categories.through.objects.filter(book_id=book_id).values_list('category_id', flat=True)
+            for category_id in category_ids:
+                _increment(DailyCategoryCirculationStat, {'day': issue_day, 'category_id': category_id}, loans_issued=1)
+            TitleCirculationStat.objects.filter(book_id=book_id).update(
+                last_issued_at=borrowing.issue_date or timezone.now()
+            )
+
+        if new_status in RETURN_STATUSES and old_status not in RETURN_STATUSES:
+            _increment(
+                DailyCirculationStat,
+                {'day': _local_day(borrowing.return_date), 'borrower_type': borrower_type},
+                **{RETURN_STATUSES[new_status]: 1}
+            )
+
+        if new_status == 'OVERDUE':
+            OverdueLoanSnapshot.objects.update_or_create(
+                borrowing_id=borrowing.pk, defaults=_snapshot_fields(borrowing)
+            )
+        elif old_status == 'OVERDUE':
+            OverdueLoanSnapshot.objects.filter(borrowing_id=borrowing.pk).delete()
+
+
+def _snapshot_fields(borrowing):
+    book_copy = borrowing.book_copy
+    return {
+        'book_id': book_copy.book_id,
+        'book_title': book_copy.book.title,
+        'copy_id': book_copy.copy_id,
+        'borrower_id': borrowing.borrower_id,
+        'borrower_username': borrowing.borrower.username,
+        'due_date': borrowing.due_date,
+    }
+
+
+def refresh_overdue_rollups(book_ids, batch_size=1000):
+    """
+    Brings the per-title counters and the overdue snapshot up to date for the given books after
+    loans were flipped to OVERDUE with a queryset UPDATE (which skips the Borrowing save hooks).
+    """
+    book_ids = list(book_ids)
+    for start in range(0, len(book_ids), batch_size):
+        chunk = book_ids[start:start + batch_size]
+        per_book = Borrowing.objects.filter(book_copy__book_id=OuterRef('book_id')).order_by().values('book_copy__book_id')
+
+        def status_count(status):
+            return Coalesce(
+                Subquery(per_book.filter(status=status).annotate(n=Count('id')).values('n'), output_field=IntegerField()),
+                Value(0),
+            )
+
+        TitleCirculationStat.objects.filter(book_id__in=chunk).update(
+            active_loans=status_count('ACTIVE'),
+            overdue_loans=status_count('OVERDUE'),
+        )
+
+        missing = Borrowing.objects.filter(
+            status='OVERDUE', book_copy__book_id__in=chunk, overdue_snapshot__isnull=True
+        ).values_list(
+            'pk', 'book_copy__book_id', 'book_copy__book__title', 'book_copy__copy_id',
+            'borrower_id', 'borrower__username', 'due_date',
+        )
+        OverdueLoanSnapshot.objects.bulk_create([
+            OverdueLoanSnapshot(
+                borrowing_id=borrowing_id, book_id=book_id, book_title=title, copy_id=copy_id,
+                borrower_id=borrower_id, borrower_username=username, due_date=due_date,
+            )
+            for borrowing_id, book_id, title, copy_id, borrower_id, username, due_date in missing.iterator(chunk_size=batch_size)
+        ], batch_size=batch_size, ignore_conflicts=True)
+
+
+def rebuild_daily_rollups(since=None, batch_size=1000):
+    """
+    Recomputes the daily tables for every day from `since` onwards (all days if None)
+    with a handful of grouped queries. Returns the number of rows written.
+    """
+    borrowings = Borrowing.objects.all()
+
+    def grouped(date_field, extra_filter, *group_by):
+        queryset = borrowings.filter(extra_filter, **{f'{date_field}__isnull': False})
+        if since is not None:
+            queryset = queryset.filter(**{f'{date_field}__date__gte': since})
+        return queryset.annotate(day=TruncDate(date_field)).values('day', *group_by).annotate(n=Count('id')).order_by()
+
+    daily = defaultdict(lambda: defaultdict(int))
+    for row in grouped('request_date', Q(), 'borrower__borrower_type'):
+        daily[(row['day'], row['borrower__borrower_type'] or '')]['requests'] += row['n']
+    for row in grouped('issue_date', Q(status__in=ISSUED_STATUSES), 'borrower__borrower_type'):
+        daily[(row['day'], row['borrower__borrower_type'] or '')]['loans_issued'] += row['n']
+    for status, field in RETURN_STATUSES.items():
+        for row in grouped('return_date', Q(status=status), 'borrower__borrower_type'):
+            daily[(row['day'], row['borrower__borrower_type'] or '')][field] += row['n']
+
+    by_category = grouped('issue_date', Q(status__in=ISSUED_STATUSES, book_copy__book__categories__isnull=False), 'book_copy__book__categories')
+
+    daily_stats = [
+        DailyCirculationStat(day=day, borrower_type=borrower_type, **counts)
+        for (day, borrower_type), counts in daily.items()
+    ]
+    category_stats = [
+        DailyCategoryCirculationStat(day=row['day'], category_id=row['book_copy__book__categories'], loans_issued=row['n'])
+        for row in by_category
+    ]
+
+    with transaction.atomic():
+        stale_daily = DailyCirculationStat.objects.all()
+        stale_category = DailyCategoryCirculationStat.objects.all()
+        if since is not None:
+            stale_daily = stale_daily.filter(day__gte=since)
+            stale_category = stale_category.filter(day__gte=since)
+        stale_daily.delete()
+        stale_category.delete()
+        DailyCirculationStat.objects.bulk_create(daily_stats, batch_size=batch_size)
+        DailyCategoryCirculationStat.objects.bulk_create(category_stats, batch_size=batch_size)
+    return len(daily_stats) + len(category_stats)
+
+
+def rebuild_running_rollups(batch_size=1000):
+    """Recomputes the per-title, per-borrower and overdue snapshot tables. Returns the rows written."""
+    title_rows = Borrowing.objects.values('book_copy__book').annotate(
+        loans_total=Count('id', filter=Q(status__in=COUNTED_LOAN_STATUSES)),
+        pending_requests=Count('id', filter=Q(status='REQUESTED')),
+        active_loans=Count('id', filter=Q(status='ACTIVE')),
+        overdue_loans=Count('id', filter=Q(status='OVERDUE')),
+        last_issued_at=Max('issue_date', filter=Q(status__in=ISSUED_STATUSES)),
+    ).order_by()
+    title_stats = [
+        TitleCirculationStat(
+            book_id=row.pop('book_copy__book'), **row
+        ) for row in title_rows
+    ]
+
+    borrower_rows = Borrowing.objects.filter(status__in=COUNTED_LOAN_STATUSES)\
+        .values('borrower').annotate(loans_total=Count('id')).order_by()
+    borrower_stats = [
+        BorrowerCirculationStat(borrower_id=row['borrower'], loans_total=row['loans_total'])
+        for row in borrower_rows
+    ]
+
+    overdue = Borrowing.objects.filter(status='OVERDUE').select_related('book_copy__book', 'borrower')
+    snapshots = [
+        OverdueLoanSnapshot(borrowing_id=borrowing.pk, **_snapshot_fields(borrowing))
+        for borrowing in overdue.iterator(chunk_size=batch_size)
+    ]
+
+    with transaction.atomic():
+        TitleCirculationStat.objects.all().delete()
+        BorrowerCirculationStat.objects.all().delete()
+        OverdueLoanSnapshot.objects.all().delete()
+        TitleCirculationStat.objects.bulk_create(title_stats, batch_size=batch_size)
+        BorrowerCirculationStat.objects.bulk_create(borrower_stats, batch_size=batch_size)
+        OverdueLoanSnapshot.objects.bulk_create(snapshots, batch_size=batch_size)
+    return len(title_stats) + len(borrower_stats) + len(snapshots)
+
+
+def default_rollup_start(overlap_days=1):
+    """Day from which an incremental run recomputes: the latest rolled-up day minus an overlap."""
+    latest = DailyCirculationStat.objects.aggregate(latest=Max('day'))['latest']
+    if latest is None:
+        return None
+    return latest - timedelta(days=overlap_days)
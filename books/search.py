@@ -0,0 +1,303 @@
+"""
+Catalog full-text search.
+
+Every Book has a denormalized BookSearchDocument row (title, authors, categories,
+publisher, description). That table is indexed with SQLite FTS5 or a PostgreSQL
+GIN/tsvector expression index, depending on the database backend, so catalog
+searches no longer need LEFT JOINs over authors/categories plus DISTINCT.
+Other backends fall back to icontains over the document table.
+"""
+import re
+
+from django.db import NotSupportedError, connections, router
+from django.db.models import Expression, F, FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .models import Book, BookSearchDocument
+
+FTS_TABLE = 'books_search_fts'
+DOCUMENT_TABLE = BookSearchDocument._meta.db_table
+
+# Column order matters: it is the order used by the FTS5 table and the bm25() weights.
+SEARCH_COLUMNS = ['book_id', 'title', 'authors', 'categories', 'publisher', 'description']
+SQLITE_BM25_WEIGHTS = [10.0, 10.0, 6.0, 3.0, 2.0, 1.0]
+POSTGRES_WEIGHTS = {'book_id': 'A', 'title': 'A', 'authors': 'B', 'categories': 'C', 'publisher': 'D', 'description': 'D'}
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_fts_ready = set()
+
+
+def _db_alias():
+    return router.db_for_read(BookSearchDocument)
+
+
+def _vendor(alias=None):
+    return connections[alias or _db_alias()].vendor
+
+
+def _tokens(term):
+    return TOKEN_RE.findall(term or '')[:16]
+
+
+def _postgres_vector(columns=None):
+    columns = columns or SEARCH_COLUMNS
+    return ' || '.join(
+        f"setweight(to_tsvector('simple', coalesce({column}, '')), '{POSTGRES_WEIGHTS[column]}')"
+        for column in columns
+    )
+
+
+def _sqlite_match_expression(tokens, columns=None):
+    """Builds a safe FTS5 MATCH string: every token quoted and prefix-matched, all tokens required."""
+    query = ' '.join('"{}"*'.format(token.replace('"', '')) for token in tokens)
+    if columns:
+        return '{%s} : (%s)' % (' '.join(columns), query)
+    return query
+
+
+def _postgres_query(tokens):
+    return ' & '.join(f"{token}:*" for token in tokens)
+
+
+def fts_available(alias=None):
+    """Returns True if the backend-specific index exists for the given database."""
+    alias = alias or _db_alias()
+    if alias in _fts_ready:
+        return True
+    connection = connections[alias]
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            available = cursor.fetchone() is not None
+    elif connection.vendor == 'postgresql':
+        available = True
+    else:
+        available = False
+    if available:
+        _fts_ready.add(alias)
+    return available
+
+
+def ensure_search_index(using='default', **kwargs):
+    """
+    Creates the backend-specific full-text index over BookSearchDocument.
+    Connected to post_migrate in BooksConfig.ready(), and safe to run repeatedly.
+    """
+    connection = connections[using]
+    tables = connection.introspection.table_names()
+    if DOCUMENT_TABLE not in tables:
+        return
+
+    if connection.vendor == 'sqlite':
+        columns = ', '.join(SEARCH_COLUMNS)
+        new_values = ', '.join(f'new.{column}' for column in SEARCH_COLUMNS)
+        old_values = ', '.join(f'old.{column}' for column in SEARCH_COLUMNS)
+        statements = [
+            f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+                {columns},
+                content='{DOCUMENT_TABLE}', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )""",
+            f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {DOCUMENT_TABLE} BEGIN
+                INSERT INTO {FTS_TABLE}(rowid, {columns}) VALUES (new.id, {new_values});
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {DOCUMENT_TABLE} BEGIN
+                INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE ON {DOCUMENT_TABLE} BEGIN
+                INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+                INSERT INTO {FTS_TABLE}(rowid, {columns}) VALUES (new.id, {new_values});
+            END""",
+        ]
+        created = FTS_TABLE not in tables
+    elif connection.vendor == 'postgresql':
+        statements = [
+            f"CREATE INDEX IF NOT EXISTS {DOCUMENT_TABLE}_tsv ON {DOCUMENT_TABLE} USING GIN (({_postgres_vector()}))",
+        ]
+        created = False
+    else:
+        return
+
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+        if created:
+            # Existing documents predate the FTS table; index them once.
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    _fts_ready.discard(using)
+
+
+def build_document_fields(book):
+    """Returns the denormalized search fields for a Book (authors/categories should be prefetched)."""
+    return {
+        'title': book.title or '',
+        'authors': ' '.join(author.name for author in book.authors.all()),
+        'categories': ' '.join(category.name for category in book.categories.all()),
+        'publisher': book.publisher or '',
+        'description': book.description or '',
+    }
+
+
+def index_books(isbns=None, batch_size=1000):
+    """
+    Creates or refreshes the search documents of the given books (all books if isbns is None).
+    Works in batches so that rebuilding a large catalog keeps memory bounded.
+    Returns the number of documents written.
+    """
+    books = Book.objects.all()
+    if isbns is not None:
+        isbns = list(isbns)
+        if not isbns:
+            return 0
+        books = books.filter(isbn__in=isbns)
+    books = books.order_by('isbn').prefetch_related('authors', 'categories')
+
+    written = 0
+    batch = []
+    for book in books.iterator(chunk_size=batch_size):
+        batch.append(book)
+        if len(batch) >= batch_size:
+            written += _write_documents(batch, batch_size)
+            batch = []
+    if batch:
+        written += _write_documents(batch, batch_size)
+    return written
+
+
+def _write_documents(books, batch_size):
+    existing = {
+        document.book_id: document
+        for document in BookSearchDocument.objects.filter(book_id__in=[book.isbn for book in books])
+    }
+    field_names = ['title', 'authors', 'categories', 'publisher', 'description']
+    now = timezone.now()
+    to_create, to_update = [], []
+    for book in books:
+        fields = build_document_fields(book)
+        document = existing.get(book.isbn)
+        if document is None:
+            to_create.append(BookSearchDocument(book=book, **fields))
+        elif any(getattr(document, name) != value for name, value in fields.items()):
+            for name, value in fields.items():
+                setattr(document, name, value)
+            document.updated_at = now
+            to_update.append(document)
+    if to_create:
+        BookSearchDocument.objects.bulk_create(to_create, batch_size=batch_size)
+    if to_update:
+        BookSearchDocument.objects.bulk_update(to_update, field_names + ['updated_at'], batch_size=batch_size)
+    return len(to_create) + len(to_update)
+
+
+def matching_books_sql(term, columns=None):
+    """
+    Returns (sql, params) selecting the ISBNs of books matching the search term,
+    or None if the term contains nothing searchable.
+    """
+    tokens = _tokens(term)
+    if not tokens:
+        return None
+    vendor = _vendor()
+    if vendor == 'sqlite' and fts_available():
+        return (
+            f"SELECT d.book_id FROM {FTS_TABLE} JOIN {DOCUMENT_TABLE} d ON d.id = {FTS_TABLE}.rowid "
+            f"WHERE {FTS_TABLE} MATCH %s",
+            [_sqlite_match_expression(tokens, columns)],
+        )
+    if vendor == 'postgresql':
+        return (
+            f"SELECT book_id FROM {DOCUMENT_TABLE} WHERE ({_postgres_vector(columns)}) @@ to_tsquery('simple', %s)",
+            [_postgres_query(tokens)],
+        )
+    return None
+
+
+class SearchRank(Expression):
+    """
+    The relevance of the outer query's book for a search term, lower is better: a correlated
+    subquery that looks the book's document up by its unique book_id and scores that single
+    row in the full-text index (SQLite bm25(), PostgreSQL ts_rank() negated).
+    Usable in ORDER BY and in the keyset pagination WHERE clause alike.
+    """
+    output_field = FloatField()
+
+    def __init__(self, term, columns=None, isbn='isbn'):
+        super().__init__()
+        self.tokens = _tokens(term)
+        self.columns = columns
+        self.isbn = F(isbn) if isinstance(isbn, str) else isbn
+
+    def get_source_expressions(self):
+        return [self.isbn]
+
+    def set_source_expressions(self, exprs):
+        self.isbn, = exprs
+
+    def as_sql(self, compiler, connection):
+        raise NotSupportedError('Search ranking needs SQLite FTS5 or PostgreSQL full-text search.')
+
+    def as_sqlite(self, compiler, connection):
+        if not fts_available(connection.alias):
+            return self.as_sql(compiler, connection)
+        isbn_sql, isbn_params = compiler.compile(self.isbn)
+        weights = ', '.join(str(weight) for weight in SQLITE_BM25_WEIGHTS)
+        # CROSS JOIN keeps the document (found by its unique book_id) as the outer loop, so
+        # the FTS table is probed by rowid instead of enumerating every match per book.
+        sql = (
+            f"(SELECT bm25({FTS_TABLE}, {weights}) FROM {DOCUMENT_TABLE} d "
+            f"CROSS JOIN {FTS_TABLE} ON {FTS_TABLE}.rowid = d.id "
+            f"WHERE d.book_id = {isbn_sql} AND {FTS_TABLE} MATCH %s)"
+        )
+        return sql, [*isbn_params, _sqlite_match_expression(self.tokens, self.columns)]
+
+    def as_postgresql(self, compiler, connection):
+        isbn_sql, isbn_params = compiler.compile(self.isbn)
+        vector = _postgres_vector(self.columns)
+        sql = (
+            f"(SELECT -ts_rank(({vector}), to_tsquery('simple', %s)) FROM {DOCUMENT_TABLE} "
+            f"WHERE book_id = {isbn_sql})"
+        )
+        return sql, [_postgres_query(self.tokens), *isbn_params]
+
+
+def ranking_available(alias=None):
+    """Returns True if search results can be ordered by relevance on the given database."""
+    alias = alias or _db_alias()
+    return _vendor(alias) == 'postgresql' or (_vendor(alias) == 'sqlite' and fts_available(alias))
+
+
+def filter_books(queryset, term, columns=None):
+    """Restricts a Book queryset to books matching the search term (no ordering change)."""
+    if not (term or '').strip():
+        return queryset
+    tokens = _tokens(term)
+    if not tokens:
+        return queryset.none()
+    matching = matching_books_sql(term, columns)
+    if matching is not None:
+        return queryset.filter(isbn__in=RawSQL(*matching))
+    lookup = Q()
+    for token in tokens:
+        token_lookup = Q()
+        for column in (columns or SEARCH_COLUMNS):
+            field = 'book__isbn' if column == 'book_id' else column
+            token_lookup |= Q(**{f'{field}__icontains': token})
+        lookup &= token_lookup
+    return queryset.filter(isbn__in=BookSearchDocument.objects.filter(lookup).values('book_id'))
+
+
+def search_books(queryset, term, columns=None):
+    """
+    Filters a Book queryset by the search term and orders it by relevance (the `search_rank`
+    annotation), then by the queryset's existing order. Without a full-text index the
+    matches keep the existing order.
+    """
+    if not (term or '').strip():
+        return queryset
+    queryset = filter_books(queryset, term, columns)
+    if not _tokens(term) or not ranking_available(queryset.db):
+        return queryset
+    existing_ordering = list(queryset.query.order_by) or list(Book._meta.ordering)
+    return queryset.annotate(search_rank=SearchRank(term, columns)).order_by('search_rank', *existing_ordering)
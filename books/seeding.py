@@ -0,0 +1,426 @@
+"""
+Synthetic benchmark data (`manage.py seed_benchmark_data`).
+
+Generates a library of a given scale: authors, categories, books with copies, borrowers and
+librarians, borrowings in every status with consistent dates, fines and copy statuses,
+notifications and favorites. Everything is drawn from one `random.Random(seed)`, so a seed and
+a scale always give the same catalog, users and circulation history (dates are relative to
+the day of the run). Popularity is skewed, as in a real library: a few authors, categories and
+books get most of the loans.
+
+Rows are written with bulk_create in chunks; the catalog goes through CatalogImporter, so books
+get their copies, counters and search documents exactly as an import would create them. The
+denormalized data that bulk writes bypass (copy counters, total_borrows, reporting rollups,
+recommendations, cached KPIs) is recomputed at the end.
+
+Seeded rows are recognisable, so they can be removed again (`--replace`):
+
+* books:      ISBNs starting with ISBN_PREFIX (979-0 is the ISMN range, never a book's ISBN)
+* users:      usernames starting with USERNAME_PREFIX
+* authors and categories: SEED_MARKER as biography/description
+"""
+import random
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import kpis, recommendations, reports
+from .catalog_import import CatalogImporter, chunked
+from .models import Author, Book, BookCopy, Borrowing, Category, CopyIdSequence, FavoriteBook, Notification
+
+ISBN_PREFIX = 'ISBN9790'
+USERNAME_PREFIX = 'bench_'
+SEED_MARKER = 'Synthetic benchmark data (manage.py seed_benchmark_data).'
+PASSWORD = 'benchmark'
+
+SCALES = {
+    'small': {
+        'authors': 400, 'categories': 30, 'books': 2_000, 'borrowers': 500, 'librarians': 2,
+        'borrowings': 10_000, 'notifications': 5_000, 'favorites': 3_000,
+    },
+    'medium': {
+        'authors': 4_000, 'categories': 60, 'books': 20_000, 'borrowers': 5_000, 'librarians': 5,
+        'borrowings': 100_000, 'notifications': 50_000, 'favorites': 30_000,
+    },
+    'large': {
+        'authors': 20_000, 'categories': 120, 'books': 100_000, 'borrowers': 25_000, 'librarians': 10,
+        'borrowings': 500_000, 'notifications': 250_000, 'favorites': 150_000,
+    },
+}
+
+# Share of each status among the generated borrowings.
+STATUS_WEIGHTS = {
+    'RETURNED': 55, 'RETURNED_LATE': 10, 'ACTIVE': 10, 'OVERDUE': 5, 'REQUESTED': 6,
+    'REJECTED': 4, 'CANCELLED': 7, 'LOST_BY_BORROWER': 3,
+}
+OPEN_STATUSES = ('REQUESTED', 'ACTIVE', 'OVERDUE')
+LOAN_DAYS = 14
+HISTORY_DAYS = 730
+LATE_FEE_PER_DAY = Decimal('0.25')
+LOST_FEE = Decimal('25.00')
+
+NOTIFICATION_MESSAGES = {
+    'BORROW_APPROVED': "Your request for '{title}' was approved.",
+    'BORROW_REJECTED': "Your request for '{title}' was rejected.",
+    'DUE_REMINDER': "'{title}' is due on {due_date}.",
+    'OVERDUE_ALERT': "'{title}' is overdue. Please return it as soon as possible.",
+    'RETURN_CONFIRMED': "Thank you for returning '{title}'.",
+    'FINE_ISSUED': "A fine of {fine} was issued for '{title}'.",
+}
+NOTIFICATION_WEIGHTS = {
+    'BORROW_APPROVED': 25, 'RETURN_CONFIRMED': 25, 'DUE_REMINDER': 20, 'OVERDUE_ALERT': 10,
+    'BORROW_REJECTED': 5, 'FINE_ISSUED': 5, 'GENERAL_ANNOUNCEMENT': 10,
+}
+
+FIRST_NAMES = (
+    'Ada', 'Alan', 'Amara', 'Ana', 'Arjun', 'Beatriz', 'Bo', 'Carlos', 'Chen', 'Chloe', 'Dara', 'David',
+    'Elena', 'Emeka', 'Fatima', 'Felix', 'Grace', 'Hana', 'Hugo', 'Ines', 'Ivan', 'Jamal', 'Jia', 'Jonas',
+    'Kai', 'Kavya', 'Lars', 'Layla', 'Leo', 'Lucia', 'Malik', 'Maria', 'Mateo', 'Mei', 'Nadia', 'Noah',
+    'Olga', 'Omar', 'Paula', 'Priya', 'Rafael', 'Rosa', 'Sami', 'Sara', 'Tomas', 'Uma', 'Vera', 'Yuki',
+)
+LAST_NAMES = (
+    'Abbott', 'Adeyemi', 'Alvarez', 'Bauer', 'Bianchi', 'Castro', 'Chandra', 'Dubois', 'Eriksen', 'Fischer',
+    'Garcia', 'Haddad', 'Ivanova', 'Jensen', 'Kim', 'Kowalski', 'Lindqvist', 'Lopez', 'Marsh', 'Mendes',
+    'Moreau', 'Nakamura', 'Novak', 'Okafor', 'Olsen', 'Park', 'Patel', 'Quinn', 'Rossi', 'Santos', 'Schmidt',
+    'Silva', 'Tanaka', 'Torres', 'Usman', 'Varga', 'Wagner', 'Weber', 'Xu', 'Yilmaz', 'Zhang', 'Zimmermann',
+)
+GENRES = (
+    'Fiction', 'Mystery', 'Science Fiction', 'Fantasy', 'Romance', 'Thriller', 'Horror', 'Poetry',
+    'Drama', 'Biography', 'History', 'Philosophy', 'Psychology', 'Economics', 'Politics', 'Law',
+    'Mathematics', 'Physics', 'Chemistry', 'Biology', 'Medicine', 'Computer Science', 'Engineering',
+    'Art', 'Music', 'Travel', 'Cooking', 'Religion', 'Education', 'Children',
+)
+TITLE_ADJECTIVES = (
+    'Silent', 'Hidden', 'Last', 'Broken', 'Golden', 'Distant', 'Forgotten', 'Endless', 'Secret', 'Quiet',
+    'Burning', 'Invisible', 'Northern', 'Little', 'Second', 'Wild', 'Bright', 'Hollow', 'Iron', 'Paper',
+)
+TITLE_NOUNS = (
+    'River', 'Garden', 'City', 'Archive', 'Mountain', 'Letter', 'Harbor', 'Kingdom', 'Machine', 'Orchard',
+    'Island', 'Theory', 'Winter', 'Lighthouse', 'Library', 'Empire', 'Forest', 'Signal', 'Mirror', 'Voyage',
+)
+TITLE_PATTERNS = (
+    'The {adjective} {noun}', '{noun} of {other}', 'A {adjective} {noun}', 'The {noun} and the {other}',
+    'Introduction to {genre}', '{adjective} {noun}s', 'Notes on the {noun}',
+)
+PUBLISHERS = (
+    'Harbor Press', 'Northwind Books', 'Meridian House', 'Blue Lantern', 'Atlas & Finch', 'Greywater',
+    'Open Shelf', 'Kestrel Publishing', 'Lumen Academic', 'Red Oak', 'Paperlight', 'Tidewater Editions',
+)
+EDITIONS = (None, None, None, '1st Edition', '2nd Edition', 'Revised Edition', 'Anniversary Edition')
+WORDS = (
+    'a', 'story', 'about', 'memory', 'and', 'loss', 'in', 'the', 'age', 'of', 'machines', 'an', 'account',
+    'family', 'across', 'three', 'generations', 'field', 'guide', 'to', 'quiet', 'places', 'history',
+    'written', 'for', 'curious', 'readers', 'journey', 'through', 'ideas', 'that', 'shaped', 'world',
+)
+
+
+@contextmanager
+def explicit_timestamps(model, *field_names):
+    """Lets bulk_create store the given auto_now/auto_now_add fields as set (historical rows)."""
+    fields = [model._meta.get_field(name) for name in field_names]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def seeded_data_exists():
+    return (
+        Book.objects.filter(isbn__startswith=ISBN_PREFIX).exists()
+        or get_user_model().objects.filter(username__startswith=USERNAME_PREFIX).exists()
+    )
+
+
+def delete_seeded_data():
+    """Removes everything a previous run generated. Returns the number of deleted books."""
+    users = get_user_model().objects.filter(username__startswith=USERNAME_PREFIX)
+    books = Book.objects.filter(isbn__startswith=ISBN_PREFIX)
+    with transaction.atomic():
+        # Borrowing.book_copy is PROTECTed: loans of seeded copies go first.
+        Borrowing.objects.filter(Q(borrower__in=users) | Q(book_copy__book__in=books)).delete()
+        users.delete()
+        deleted = books.count()
+        books.delete()
+        # Restart the copy barcodes at 1, so a regenerated dataset gets the same copy IDs.
+        CopyIdSequence.objects.filter(prefix__startswith=ISBN_PREFIX).delete()
+        Author.objects.filter(biography=SEED_MARKER, books__isnull=True).delete()
+        Category.objects.filter(description=SEED_MARKER, books__isnull=True).delete()
+    return deleted
+
+
+class BenchmarkDataGenerator:
+    """
+    Writes one synthetic dataset. `counts` has the keys of a SCALES entry; `log` (optional)
+    receives a line per step.
+    """
+
+    def __init__(self, counts, seed=0, chunk_size=2000, log=None):
+        self.counts = counts
+        self.random = random.Random(seed)
+        self.chunk_size = chunk_size
+        self.log = log or (lambda message: None)
+        self.now = timezone.now()
+        self.stats = Counter()
+
+    def run(self):
+        author_names = self._author_names()
+        category_names = self._category_names()
+        isbns = self._create_books(author_names, category_names)
+        borrower_ids, librarian_ids = self._create_users()
+        self._create_borrowings(isbns, borrower_ids)
+        self._create_notifications(borrower_ids, librarian_ids)
+        self._create_favorites(isbns, borrower_ids)
+        self._refresh_derived_data()
+        return dict(self.stats)
+
+    def _skewed_index(self, size, exponent=3):
+        """An index in range(size), low indexes much more likely (a long-tail popularity curve)."""
+        return min(int(size * self.random.random() ** exponent), size - 1)
+
+    def _datetime_between(self, start, end):
+        return start + (end - start) * self.random.random()
+
+    # --- Catalog ---
+
+    def _author_names(self):
+        names, seen = [], set()
+        while len(names) < self.counts['authors']:
+            first, last = self.random.choice(FIRST_NAMES), self.random.choice(LAST_NAMES)
+            if self.random.random() < 0.8:
+                first = f"{first} {self.random.choice('ABCDEFGHJKLMNPRSTW')}."
+            name = f"{first} {last}"
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+        return names
+
+    def _category_names(self):
+        return [
+            GENRES[index % len(GENRES)] + ('' if index < len(GENRES) else f" {index // len(GENRES) + 1}")
+            for index in range(self.counts['categories'])
+        ]
+
+    def _book_record(self, index, author_names, category_names):
+        category = category_names[self._skewed_index(len(category_names), 2)]
+        title = self.random.choice(TITLE_PATTERNS).format(
+            adjective=self.random.choice(TITLE_ADJECTIVES), noun=self.random.choice(TITLE_NOUNS),
+            other=self.random.choice(TITLE_NOUNS), genre=category,
+        )
+        authors = {author_names[self._skewed_index(len(author_names))] for _ in range(self.random.choice((1, 1, 1, 2, 2, 3)))}
+        categories = {category} | {
+            category_names[self._skewed_index(len(category_names), 2)] for _ in range(self.random.choice((0, 1, 1, 2)))
+        }
+        return {
+            'isbn': f"{ISBN_PREFIX}{index:09d}",
+            'title': title,
+            'authors': sorted(authors),
+            'categories': sorted(categories),
+            'publisher': self.random.choice(PUBLISHERS),
+            'publication_date': date(1900, 1, 1) + timedelta(days=self.random.randrange(125 * 365)),
+            'edition': self.random.choice(EDITIONS),
+            'page_count': self.random.randrange(48, 960),
+            'description': ' '.join(self.random.choice(WORDS) for _ in range(self.random.randrange(12, 40))).capitalize() + '.',
+            'copies': self.random.choice((1, 1, 2, 2, 2, 3, 3, 4, 5, 8)),
+        }
+
+    def _create_books(self, author_names, category_names):
+        importer = CatalogImporter()
+        isbns = []
+        records = (self._book_record(index, author_names, category_names) for index in range(self.counts['books']))
+        for chunk in chunked(records, self.chunk_size):
+            importer.import_chunk(chunk)
+            isbns.extend(record['isbn'] for record in chunk)
+        Author.objects.filter(name__in=author_names, biography__isnull=True).update(biography=SEED_MARKER)
+        Category.objects.filter(name__in=category_names, description__isnull=True).update(description=SEED_MARKER)
+        self.stats.update({key: importer.stats[key] for key in ('books', 'copies', 'authors', 'categories')})
+        self.log(f"Catalog: {importer.stats['books']} books, {importer.stats['copies']} copies.")
+        return isbns
+
+    # --- Users ---
+
+    def _create_users(self):
+        User = get_user_model()
+        # One hash for every account: hashing each password would dominate the run.
+        password = make_password(PASSWORD)
+        borrower_types = [value for value, label in User.BORROWER_TYPE_CHOICES]
+        users = []
+        for index in range(self.counts['librarians']):
+            users.append(User(
+                username=f"{USERNAME_PREFIX}librarian_{index}", password=password, role='LIBRARIAN', is_staff=True,
+                first_name=self.random.choice(FIRST_NAMES), last_name=self.random.choice(LAST_NAMES),
+                email=f"{USERNAME_PREFIX}librarian_{index}@example.com",
+            ))
+        for index in range(self.counts['borrowers']):
+            users.append(User(
+                username=f"{USERNAME_PREFIX}{index:06d}", password=password, role='BORROWER',
+                borrower_type=self.random.choice(borrower_types), borrower_id_value=f"BENCH{index:06d}",
+                first_name=self.random.choice(FIRST_NAMES), last_name=self.random.choice(LAST_NAMES),
+                email=f"{USERNAME_PREFIX}{index:06d}@example.com",
+                date_joined=self.now - timedelta(days=self.random.randrange(HISTORY_DAYS + 365)),
+            ))
+        for chunk in chunked(users, self.chunk_size):
+            User.objects.bulk_create(chunk)
+        ids = dict(User.objects.filter(username__startswith=USERNAME_PREFIX).values_list('username', 'pk'))
+        borrower_ids = [ids[f"{USERNAME_PREFIX}{index:06d}"] for index in range(self.counts['borrowers'])]
+        librarian_ids = [ids[f"{USERNAME_PREFIX}librarian_{index}"] for index in range(self.counts['librarians'])]
+        self.stats.update(borrowers=len(borrower_ids), librarians=len(librarian_ids))
+        self.log(f"Users: {len(borrower_ids)} borrowers, {len(librarian_ids)} librarians.")
+        return borrower_ids, librarian_ids
+
+    # --- Circulation ---
+
+    def _loan(self, status, copy_id, borrower_id):
+        now = self.now
+        days = timedelta(days=1)
+        fine = Decimal('0.00')
+        issue_date = return_date = None
+        if status == 'REQUESTED':
+            request_date = self._datetime_between(now - 3 * days, now)
+        elif status == 'ACTIVE':
+            request_date = self._datetime_between(now - (LOAN_DAYS - 1) * days, now - days)
+        elif status == 'OVERDUE':
+            request_date = self._datetime_between(now - 60 * days, now - (LOAN_DAYS + 3) * days)
+        else:
+            request_date = self._datetime_between(now - HISTORY_DAYS * days, now - 45 * days)
+        if status in ('ACTIVE', 'OVERDUE', 'RETURNED', 'RETURNED_LATE', 'LOST_BY_BORROWER'):
+            issue_date = request_date + self._datetime_between(timedelta(minutes=10), 2 * days) if status != 'ACTIVE' \
+                else self._datetime_between(request_date, now)
+        due_date = timezone.localdate(issue_date or request_date) + LOAN_DAYS * days
+        if status == 'RETURNED':
+            return_date = issue_date + self._datetime_between(days, LOAN_DAYS * days)
+        elif status == 'RETURNED_LATE':
+            late_days = self.random.randrange(1, 30)
+            return_date = timezone.make_aware(datetime.combine(due_date + late_days * days, time(12))) \
+                + timedelta(minutes=self.random.randrange(-240, 240))
+            fine = LATE_FEE_PER_DAY * late_days
+        elif status == 'LOST_BY_BORROWER':
+            fine = LOST_FEE
+        return Borrowing(
+            book_copy_id=copy_id, borrower_id=borrower_id, status=status, request_date=request_date,
+            issue_date=issue_date, due_date=due_date, return_date=return_date, fine_amount=fine,
+        )
+
+    def _create_borrowings(self, isbns, borrower_ids):
+        copies_by_book = {}
+        copies = BookCopy.objects.filter(book__isbn__startswith=ISBN_PREFIX).order_by('id').values_list('book_id', 'id')
+        for isbn, copy_id in copies.iterator(chunk_size=10000):
+            copies_by_book.setdefault(isbn, []).append(copy_id)
+        # Popular titles are drawn from a shuffled order, so popularity is independent of the ISBN.
+        by_popularity = [isbn for isbn in isbns if isbn in copies_by_book]
+        self.random.shuffle(by_popularity)
+        statuses, weights = zip(*STATUS_WEIGHTS.items())
+
+        busy = set()  # copies with an open request or loan, or lost: at most one at a time
+        lost, on_loan = [], []
+        borrowings = []
+        for _ in range(self.counts['borrowings']):
+            status = self.random.choices(statuses, weights)[0]
+            candidates = copies_by_book[by_popularity[self._skewed_index(len(by_popularity), 2)]]
+            copy_id = self.random.choice(candidates)
+            if copy_id in busy and status in OPEN_STATUSES + ('LOST_BY_BORROWER',):
+                # The copy is taken: this one becomes past history instead.
+                status = 'RETURNED'
+            if status in OPEN_STATUSES + ('LOST_BY_BORROWER',):
+                busy.add(copy_id)
+                if status == 'LOST_BY_BORROWER':
+                    lost.append(copy_id)
+                elif status != 'REQUESTED':
+                    on_loan.append(copy_id)
+            borrowings.append(self._loan(status, copy_id, self.random.choice(borrower_ids)))
+
+        # Insert in request order, as circulation would have.
+        borrowings.sort(key=lambda borrowing: borrowing.request_date)
+        with explicit_timestamps(Borrowing, 'request_date'):
+            for chunk in chunked(borrowings, self.chunk_size):
+                Borrowing.objects.bulk_create(chunk)
+        for copy_ids, status in ((on_loan, 'On Loan'), (lost, 'Lost')):
+            for chunk in chunked(copy_ids, self.chunk_size):
+                BookCopy.objects.filter(pk__in=chunk).update(status=status)
+        self.stats.update(borrowings=len(borrowings))
+        self.stats.update(f"borrowings_{borrowing.status.lower()}" for borrowing in borrowings)
+        self.log(f"Borrowings: {len(borrowings)} ({len(on_loan)} copies on loan, {len(lost)} lost).")
+
+    # --- Notifications and favorites ---
+
+    def _create_notifications(self, borrower_ids, librarian_ids):
+        loans = list(
+            Borrowing.objects.filter(borrower_id__in=borrower_ids, issue_date__isnull=False)
+            .order_by('id').values_list('id', 'borrower_id', 'book_copy__book__title', 'due_date', 'fine_amount')[:self.counts['notifications'] * 2]
+        )
+        types, weights = zip(*NOTIFICATION_WEIGHTS.items())
+        recipients = borrower_ids + librarian_ids
+        notifications = []
+        for _ in range(self.counts['notifications']):
+            notification_type = self.random.choices(types, weights)[0]
+            timestamp = self._datetime_between(self.now - 90 * timedelta(days=1), self.now)
+            if notification_type == 'GENERAL_ANNOUNCEMENT' or not loans:
+                notification = Notification(
+                    recipient_id=self.random.choice(recipients), notification_type='GENERAL_ANNOUNCEMENT',
+                    message="The library will close early on Friday for maintenance.",
+                )
+            else:
+                borrowing_id, borrower_id, title, due_date, fine = self.random.choice(loans)
+                notification = Notification(
+                    recipient_id=borrower_id, notification_type=notification_type, related_borrowing_id=borrowing_id,
+                    message=NOTIFICATION_MESSAGES[notification_type].format(title=title, due_date=due_date, fine=fine),
+                )
+            notification.timestamp = timestamp
+            # Older notifications have mostly been read.
+            notification.is_read = self.random.random() < (0.9 if timestamp < self.now - timedelta(days=14) else 0.3)
+            notifications.append(notification)
+
+        notifications.sort(key=lambda notification: notification.timestamp)
+        with explicit_timestamps(Notification, 'timestamp'):
+            for chunk in chunked(notifications, self.chunk_size):
+                Notification.objects.bulk_create(chunk)
+        self.stats.update(notifications=len(notifications))
+        self.log(f"Notifications: {len(notifications)}.")
+
+    def _create_favorites(self, isbns, borrower_ids):
+        pairs = set()
+        limit = min(self.counts['favorites'], len(isbns) * len(borrower_ids))
+        while len(pairs) < limit:
+            pairs.add((self.random.choice(borrower_ids), isbns[self._skewed_index(len(isbns), 2)]))
+        favorites = [
+            FavoriteBook(user_id=user_id, book_id=isbn, favorited_at=self._datetime_between(self.now - HISTORY_DAYS * timedelta(days=1), self.now))
+            for user_id, isbn in sorted(pairs)
+        ]
+        for chunk in chunked(favorites, self.chunk_size):
+            FavoriteBook.objects.bulk_create(chunk)
+        self.stats.update(favorites=len(favorites))
+        self.log(f"Favorites: {len(favorites)}.")
+
+    # --- Derived data ---
+
+    def _refresh_derived_data(self):
+        """Recomputes what bulk writes bypass: copy counters, borrow counts, rollups, recommendations, KPIs."""
+        books = Book.objects.filter(isbn__startswith=ISBN_PREFIX)
+        copy_counts = BookCopy.objects.filter(book=OuterRef('pk')).order_by().values('book')
+        issued = Borrowing.objects.filter(book_copy__book=OuterRef('pk'), issue_date__isnull=False)\
+            .order_by().values('book_copy__book')
+
+        def count_of(queryset):
+            return Coalesce(Subquery(queryset.annotate(n=Count('id')).values('n'), output_field=IntegerField()), Value(0))
+
+        books.update(
+            total_copies=count_of(copy_counts),
+            available_copies=count_of(copy_counts.filter(status='Available')),
+            total_borrows=count_of(issued),
+            last_updated=timezone.now(),
+        )
+        rollups = reports.rebuild_daily_rollups() + reports.rebuild_running_rollups()
+        similarities = recommendations.build_similarities()
+        kpis.invalidate_library_kpis()
+        self.log(f"Derived data: {rollups} rollup rows, {similarities} similarities.")
@@ -1,5 +1,7 @@
 from rest_framework import serializers
 from .models import Author, Book, Category, BookCopy, Borrowing, Notification
+from .utils import get_favorite_isbns
+from . import circulation
 from django.contrib.auth import get_user_model
 from django.shortcuts import get_object_or_404
 from django.utils.translation import gettext as _
@@ -38,9 +40,24 @@ class BookCopySerializer(serializers.ModelSerializer):
     Serializer for individual BookCopy instances.
     Often used for listing copies or when a brief representation is needed.
     """
+    book_isbn = serializers.PrimaryKeyRelatedField(
+        queryset=Book.objects.all(),
+        source='book',
+        write_only=True,
+        required=False,
+        help_text="ISBN of the book this copy belongs to (required when creating a copy)."
+    )
+
     class Meta:
         model = BookCopy
-        fields = ['id', 'copy_id', 'status', 'book_id', 'date_acquired', 'condition_notes']
+        fields = ['id', 'copy_id', 'status', 'book_id', 'book_isbn', 'date_acquired', 'condition_notes']
+        # Left out, the next ID of the book's copy ID sequence is assigned (see BookCopyViewSet.perform_create).
+        extra_kwargs = {'copy_id': {'required': False}}
+
+    def validate(self, data):
+        if self.instance is None and 'book' not in data:
+            raise serializers.ValidationError({"book_isbn": "This field is required."})
+        return data
 
 class BookMinimalSerializer(serializers.ModelSerializer):
     authors = AuthorSerializer(many=True, read_only=True)
@@ -86,16 +103,16 @@ class BookSerializer(serializers.ModelSerializer):
             'description', 'cover_image', 
             'categories', 'category_ids',
             'total_borrows', 'date_added_to_system', 'last_updated',
-            'available_copies_count', 'is_favorite'
+            'total_copies', 'available_copies_count', 'is_favorite'
         ]
     
     def get_is_favorite(self, obj):
-        user = self.context['request'].user
-        if user and user.is_authenticated:
-            if not hasattr(user, 'favorite_books') or not isinstance(user.favorite_books, list):
-                return False
-            return any(fav_item.get('isbn') == obj.isbn for fav_item in user.favorite_books)
-        return False
+        # Views put a request-scoped frozenset in the context (see books.utils.favorite_isbns_context);
+        # fall back to building it from the request for callers that only pass the request.
+        favorite_isbns = self.context.get('favorite_isbns')
+        if favorite_isbns is None:
+            favorite_isbns = get_favorite_isbns(self.context.get('request'))
+        return obj.isbn in favorite_isbns
 
 class BookCopyDetailSerializer(serializers.ModelSerializer):
     """
@@ -197,42 +214,30 @@ class BorrowingSerializer(serializers.ModelSerializer):
         book_copy_instance = validated_data.get('book_copy') # This is already a BookCopy model instance
         book_isbn = validated_data.pop('book_isbn_for_request', None)
 
-        if not book_copy_instance and book_isbn: # If no specific copy chosen, find one by ISBN
+        if book_copy_instance:
+            book_obj = book_copy_instance.book
+        elif book_isbn: # If no specific copy chosen, the allocation service picks one by ISBN
             book_obj = get_object_or_404(Book, isbn=book_isbn)
-
-            # Prevent duplicate active/pending request for the same BOOK TITLE by the same user
-            if Borrowing.objects.filter(
-                borrower=borrower_for_loan,
-                book_copy__book=book_obj,
-                status__in=['REQUESTED', 'ACTIVE', 'OVERDUE']
-            ).exists():
-                raise serializers.ValidationError(f"You already have an active loan or pending request for '{book_obj.title}'.")
-
-            available_copy = BookCopy.objects.filter(book=book_obj, status='Available').order_by('date_acquired', 'id').first()
-            if not available_copy:
-                raise serializers.ValidationError(f"No copies of '{book_obj.title}' are currently available to request.")
-            validated_data['book_copy'] = available_copy
-        elif not book_copy_instance: # Should have been caught by validate, but as a safeguard
+        else: # Should have been caught by validate, but as a safeguard
             raise serializers.ValidationError("A book copy is required.")
-        
-        if not user.is_staff:
-            validated_data['status'] = 'REQUESTED'
-            validated_data.pop('issue_date', None) # Users cannot set issue_date for a request
-        else: # Staff user
-            current_status = validated_data.get('status')
-            if not current_status:
-                validated_data['status'] = 'ACTIVE' 
-
-            if validated_data['status'] == 'ACTIVE' and 'issue_date' not in validated_data:
-                validated_data['issue_date'] = timezone.now()
-
-        borrowing_instance = Borrowing.objects.create(**validated_data)
-
-        if borrowing_instance.status == 'ACTIVE':
-            active_copy = borrowing_instance.book_copy
-            if active_copy.status == 'Available':
-                active_copy.status = 'On Loan'
-                active_copy.save(update_fields=['status'])
+
+        # Users create requests; staff issue the loan directly.
+        status = 'ACTIVE' if user.is_staff else 'REQUESTED'
+
+        # The copy is reserved (request) or put on loan (ACTIVE) atomically by the circulation service,
+        # so concurrent requests are never handed the same copy.
+        try:
+            if status == 'REQUESTED':
+                borrowing_instance = circulation.request_copy(
+                    borrower_for_loan, book_obj, validated_data['due_date'], copy=book_copy_instance
+                )
+            else:
+                borrowing_instance = circulation.issue_copy(
+                    borrower_for_loan, book_obj, validated_data['due_date'], copy=book_copy_instance,
+                    issue_date=validated_data.get('issue_date'),
+                )
+        except (circulation.CopyUnavailable, circulation.DuplicateBorrowing) as e:
+            raise serializers.ValidationError(str(e))
 
         # TODO: Send notifications (e.g., using signals.py)
 
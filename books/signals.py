@@ -1,75 +1,249 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save, m2m_changed
 from django.dispatch import receiver
 from django.conf import settings
-from .models import Borrowing
-from users.utils import send_expo_push_notification
+from django.contrib.auth import get_user_model
+from .models import Author, Book, BookCopy, Borrowing, Category, CollectionVersion, Notification, UnreadNotificationCounter
+from . import conditional, fragments, images, kpis, reports, search
+from users.models import PushOutbox
+from lms import metrics
+
+# --- Push notifications ---
 
 @receiver(post_save, sender=Borrowing)
-def send_borrow_status_notification(sender, instance, created, **kwargs):
+def queue_borrow_status_push(sender, instance, created, raw=False, **kwargs):
     """
-    Listens for saves on Borrowing instances.
-    Sends a notification if the status was just changed to 'approved' OR 'rejected'.
-    Assumes the status change happens atomically (e.g., in an admin action or API call).
+    Queues a push notification when a borrow request is approved (REQUESTED -> ACTIVE) or rejected.
+    The PushOutbox row is written inside the save's transaction; `run_push_dispatcher` delivers it,
+    so approving or rejecting a request never waits on the push gateway.
     """
-    # instance here is the Borrowing object that was saved
-    print(f"Signal triggered for Borrowing ID: {instance.id}, Status: {instance.status}, Created: {created}")
+    if raw or created:
+        return
+    old_status = getattr(instance, '_status_before_save', None)
+    if old_status != 'REQUESTED' or instance.status not in ('ACTIVE', 'REJECTED'):
+        return
+
+    book_title = instance.book_copy.book.title
+    if instance.status == 'ACTIVE':
+        title = "Borrow Request Approved!"
+        due_date_str = instance.due_date.strftime('%Y-%m-%d') if instance.due_date else 'N/A'
+        body = f"Your request to borrow '{book_title}' has been approved! Please return by {due_date_str}."
+        status_label = "Approved"
+    else:
+        title = "Borrow Request Rejected"
+        body = f"Unfortunately, your request to borrow '{book_title}' was rejected."
+        status_label = "Rejected"
+    PushOutbox.enqueue(instance.borrower, title, body, data={
+        "screen": "MyBorrowsScreen",
+        "borrowId": instance.id,
+        "message": body,
+        "status": status_label,
+    })
+
+
+# --- Image derivatives ---
+
+@receiver(pre_save, sender=Book)
+@receiver(pre_save, sender=Author)
+@receiver(pre_save, sender=get_user_model())
+def note_image_uploads(sender, instance, raw=False, **kwargs):
+    """Remembers which image fields receive a new upload in this save (the file is stored during the save)."""
+    if raw:
+        return
+    instance._uploaded_image_fields = []
+    for field_name in images.image_fields(sender):
+        fieldfile = getattr(instance, field_name)
+        if fieldfile and not fieldfile._committed:
+            instance._uploaded_image_fields.append(field_name)
+        elif not fieldfile:
+            setattr(instance, images.digest_field_name(field_name), '')
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=get_user_model())
+def generate_image_derivatives(sender, instance, raw=False, using=None, **kwargs):
+    """Renders the thumbnails of new uploads once the save is committed, outside its transaction."""
+    for field_name in getattr(instance, '_uploaded_image_fields', ()):
+        transaction.on_commit(lambda field_name=field_name: images.process_upload(instance, field_name), using=using)
+    instance._uploaded_image_fields = []
+
+
+# --- Catalog search index maintenance ---
+
+@receiver(post_save, sender=Book)
+def update_book_search_document(sender, instance, raw=False, **kwargs):
+    """Refreshes the search document of a book whenever the book itself is saved."""
+    if raw:
+        return
+    search.index_books([instance.isbn])
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.categories.through)
+def update_search_documents_on_m2m_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Refreshes search documents when a book's authors or categories change (from either side)."""
+    if reverse and action == 'pre_clear':
+        # A reverse clear() does not report the affected books, so remember them up front.
+        instance._search_affected_isbns = list(instance.books.values_list('isbn', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        search.index_books([instance.pk])
+    elif action == 'post_clear':
+        search.index_books(getattr(instance, '_search_affected_isbns', []))
+    else:
+        search.index_books(pk_set or [])
 
-    # Avoid sending notifications for newly created 'pending' requests
-    if created and instance.status == 'pending':
-        print("New pending Borrowing record created, skipping notification.")
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Category)
+def update_search_documents_on_name_change(sender, instance, created, raw=False, **kwargs):
+    """Author and category names are denormalized into every related book's search document."""
+    if created or raw:
         return
+    search.index_books(instance.books.values_list('isbn', flat=True))
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Category)
+def remember_books_before_delete(sender, instance, **kwargs):
+    instance._search_affected_isbns = list(instance.books.values_list('isbn', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Category)
+def update_search_documents_after_delete(sender, instance, **kwargs):
+    search.index_books(getattr(instance, '_search_affected_isbns', []))
+
 
-    # Check if the status is 'approved'
-    # Consider checking 'update_fields' if available and relevant for more robustness
-    if instance.status == 'approved':
-        # Check if it was *just* approved (e.g., wasn't already approved before this save)
-        # This requires more complex state tracking, often handled in the view/action
-        # For simplicity, we send if status is 'approved' and not 'created'
-        if not created:
-            print(f"Borrowing {instance.id} status is 'Approved'. Attempting to send notification to user {instance.user.username}")
-            try:
-                title = "Borrow Request Approved!"
-                due_date_str = instance.due_date.strftime('%Y-%m-%d') if instance.due_date else 'N/A'
-                body = f"Your request to borrow '{instance.book.title}' has been approved! Please return by {due_date_str}."
-                data_payload = {
-                    "screen": "MyBorrowsScreen",
-                    "borrowId": instance.id,
-                    "message": body,
-                    "status": "Approved"
-                }
-                success = send_expo_push_notification(
-                    user=instance.user, title=title, body=body, data=data_payload
-                )
-                if success:
-                    print(f"Push notification request (Approved) sent successfully for Borrowing {instance.id}.")
-                else:
-                    print(f"Failed to send push notification request (Approved) for Borrowing {instance.id}.")
-            except Exception as e:
-                print(f"Error triggering push notification (Approved) for Borrowing {instance.id}: {e}")
-
-    # Check if the status is 'rejected'
-    elif instance.status == 'rejected':
-        # Similar robustness check needed as above if rejection can be saved multiple times
-        if not created:
-            print(f"Borrowing {instance.id} status is 'Rejected'. Attempting to send notification to user {instance.user.username}")
-            try:
-                title = "Borrow Request Rejected"
-                body = f"Unfortunately, your request to borrow '{instance.book.title}' was rejected."
-                data_payload = {
-                    "screen": "MyBorrowsScreen",
-                    "borrowId": instance.id,
-                    "message": body,
-                    "status": "Rejected"
-                }
-                success = send_expo_push_notification(
-                    user=instance.user, title=title, body=body, data=data_payload
-                )
-                if success:
-                    print(f"Push notification request (Rejected) sent successfully for Borrowing {instance.id}.")
-                else:
-                    print(f"Failed to send push notification request (Rejected) for Borrowing {instance.id}.")
-            except Exception as e:
-                print(f"Error triggering push notification (Rejected) for Borrowing {instance.id}: {e}")
+# --- Book versions (conditional GET, see books/conditional.py) ---
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.categories.through)
+def touch_books_on_m2m_change(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """A book's authors and categories are part of its representation."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        Book.touch([instance.pk], using=using)
+    elif action == 'post_clear':
+        Book.touch(getattr(instance, '_search_affected_isbns', []), using=using)
     else:
-        # Handle other statuses if needed
-        print(f"Borrowing {instance.id} status is '{instance.status}'. No approval/rejection notification sent by this signal.")
+        Book.touch(pk_set or [], using=using)
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Category)
+def touch_books_on_name_change(sender, instance, created, raw=False, using=None, **kwargs):
+    if created or raw:
+        return
+    Book.touch(instance.books.values_list('isbn', flat=True), using=using)
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Category)
+def touch_books_after_delete(sender, instance, using, **kwargs):
+    Book.touch(getattr(instance, '_search_affected_isbns', []), using=using)
+
+
+@receiver(post_delete, sender=Book)
+def count_catalog_deletions(sender, using=None, **kwargs):
+    """Max(last_updated) cannot see a deletion, so the catalog version counts them (same transaction)."""
+    CollectionVersion.bump(conditional.CATALOG_DELETIONS, using=using)
+
+
+# --- Template fragment versions (see books/fragments.py) ---
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def bump_category_fragments(sender, using=None, **kwargs):
+    """The category sidebar is versioned by its own stamp; book fragments follow last_updated."""
+    fragments.bump('categories', using=using)
+
+
+# --- Book copy counters ---
+
+@receiver(post_delete, sender=BookCopy)
+def update_copy_counters_on_delete(sender, instance, using, **kwargs):
+    """Keeps Book.total_copies / Book.available_copies correct when copies are deleted (including cascades)."""
+    Book.adjust_copy_counters(
+        instance.book_id,
+        total=-1,
+        available=-int(instance.status == 'Available'),
+        using=using,
+    )
+
+
+# --- Unread notification counters ---
+
+@receiver(post_delete, sender=Notification)
+def update_unread_counter_on_delete(sender, instance, using, **kwargs):
+    if not instance.is_read:
+        UnreadNotificationCounter.adjust({instance.recipient_id: -1}, using=using)
+
+
+# --- Reporting rollups ---
+
+@receiver(post_save, sender=Borrowing)
+def update_report_rollups(sender, instance, created, raw=False, **kwargs):
+    """Applies the status transition made by this save to the reporting rollup tables."""
+    if raw:
+        return
+    old_status = None if created else getattr(instance, '_status_before_save', None)
+    reports.record_borrowing_change(instance, old_status, instance.status)
+
+
+@receiver(post_delete, sender=Borrowing)
+def update_report_rollups_on_delete(sender, instance, **kwargs):
+    reports.record_borrowing_change(instance, instance.status, None)
+
+
+# --- Circulation metrics ---
+
+CIRCULATION_EVENTS = {
+    'REQUESTED': 'requested',
+    'ACTIVE': 'issued',
+    'RETURNED': 'returned',
+    'RETURNED_LATE': 'returned_late',
+    'OVERDUE': 'overdue',
+    'REJECTED': 'rejected',
+    'CANCELLED': 'cancelled',
+    'LOST_BY_BORROWER': 'lost',
+}
+
+
+@receiver(post_save, sender=Borrowing)
+def count_circulation_event(sender, instance, created, raw=False, using=None, **kwargs):
+    """
+    Counts the status change made by this save (lms_circulation_events_total) once it commits;
+    the staff views, the API and the admin all save through here.
+    """
+    if raw:
+        return
+    old_status = None if created else getattr(instance, '_status_before_save', None)
+    if old_status == instance.status or instance.status not in CIRCULATION_EVENTS:
+        return
+    event = 'approved' if (old_status, instance.status) == ('REQUESTED', 'ACTIVE') else CIRCULATION_EVENTS[instance.status]
+    transaction.on_commit(lambda: metrics.CIRCULATION_EVENTS.inc(event=event), using=using)
+
+
+# --- Library KPI cache ---
+
+@receiver(post_save, sender=Borrowing)
+@receiver(post_delete, sender=Borrowing)
+@receiver(post_save, sender=BookCopy)
+@receiver(post_delete, sender=BookCopy)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def invalidate_library_kpis(sender, **kwargs):
+    """Circulation, copy and user writes change the dashboard counters."""
+    kpis.invalidate_library_kpis()
+
+
+@receiver(post_save, sender=Book)
+def invalidate_library_kpis_on_new_book(sender, instance, created, **kwargs):
+    if created:
+        kpis.invalidate_library_kpis()
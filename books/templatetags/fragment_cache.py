@@ -0,0 +1,80 @@
+from django import template
+from django.template.base import token_kwargs
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+from books import fragments
+
+register = template.Library()
+
+
+@register.simple_tag
+def book_card(book, card_size=''):
+    """
+    Renders books/portal/_book_card.html for the book, from the fragment cache while the book is
+    unchanged (see books/fragments.py), e.g. {% book_card book card_size='small' %}.
+    """
+    return fragments.render_book_card(book, card_size)
+
+
+def _slot_marker(name):
+    return mark_safe(f'\x1efragment-slot:{name}\x1e')
+
+
+class FragmentCacheNode(template.Node):
+    def __init__(self, nodelist, name, vary_on, slots):
+        self.nodelist = nodelist
+        self.name = name
+        self.vary_on = vary_on
+        self.slots = slots
+
+    def render(self, context):
+        name = self.name.resolve(context)
+        if name is None:
+            return self.nodelist.render(context)
+        # Sections of one page share the collection versions, so each is looked up once per render.
+        versions = context.render_context.setdefault('fragment_versions', {})
+        if name not in versions:
+            versions[name] = fragments.collection_version(name)
+        key = fragments.fragment_key(name, versions[name], [value.resolve(context) for value in self.vary_on])
+
+        def render_block():
+            with context.push(**{slot: _slot_marker(slot) for slot in self.slots}):
+                return self.nodelist.render(context)
+
+        html = fragments.cached_fragment(key, render_block)
+        for slot, value in self.slots.items():
+            html = html.replace(_slot_marker(slot), conditional_escape(value.resolve(context)))
+        return mark_safe(html)
+
+
+@register.tag
+def fragmentcache(parser, token):
+    """
+    Caches the enclosed markup under the version of a collection and the vary-on values:
+
+        {% fragmentcache 'categories' selected_category_id with search_suffix=search_suffix %}
+            ... {{ search_suffix }} ...
+        {% endfragmentcache %}
+
+    Slots named after `with` are cached as placeholders and filled in on every render, so a
+    per-request value (e.g. the search term in the links) does not have to be a vary-on value.
+    A slot is output as is (escaped); filters or tests on it inside the block see the placeholder.
+
+    A name that resolves to None renders the block uncached (e.g. a section that is personal
+    for logged-in users).
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' needs at least the collection name.")
+    vary_on, slots = bits[2:], {}
+    if 'with' in vary_on:
+        index = vary_on.index('with')
+        slot_bits = vary_on[index + 1:]
+        slots = token_kwargs(slot_bits, parser, support_legacy=False)
+        if not slots or slot_bits:
+            raise template.TemplateSyntaxError(f"'{bits[0]}' expects name=value slots after 'with'.")
+        vary_on = vary_on[:index]
+    nodelist = parser.parse(('endfragmentcache',))
+    parser.delete_first_token()
+    return FragmentCacheNode(nodelist, parser.compile_filter(bits[1]), [parser.compile_filter(bit) for bit in vary_on], slots)
@@ -0,0 +1,17 @@
+from django import template
+
+from books.kpis import get_library_kpis
+
+register = template.Library()
+
+
+@register.inclusion_tag('dashboard/_includes/kpi_block.html', takes_context=True)
+def library_kpi_block(context):
+    """Renders the dashboard KPI cards, reusing the view's `kpis` when it already loaded them."""
+    return {'kpis': context.get('kpis') or get_library_kpis()}
+
+
+@register.simple_tag
+def library_kpi(name):
+    """Returns a single cached KPI value, e.g. {% library_kpi 'pending_requests_count' %}."""
+    return get_library_kpis().get(name, 0)
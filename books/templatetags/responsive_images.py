@@ -0,0 +1,34 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from books import images
+
+register = template.Library()
+
+
+def _srcset(urls):
+    return ', '.join(f'{url} {scale}x' for url, scale in urls)
+
+
+@register.simple_tag
+def responsive_image(image, size, alt='', **attrs):
+    """
+    Renders an uploaded image at one of its derivative sizes (see books/images.py): a <picture>
+    with WebP and fallback 1x/2x srcsets, e.g.
+    {% responsive_image book.cover_image 'card' alt=book.title class='book-card-img' %}.
+    Keyword arguments become attributes of the <img> (underscores turn into dashes); images
+    load lazily unless loading='eager' is given. Falls back to the original when the image has
+    no derivatives yet.
+    """
+    attrs.setdefault('loading', 'lazy')
+    attributes = format_html_join('', ' {}="{}"', [(name.replace('_', '-'), value) for name, value in attrs.items()])
+    webp = images.derivative_urls(image, size, images.WEBP)
+    if not webp:
+        return format_html('<img src="{}" alt="{}"{}>', image.url, alt, attributes)
+    fallback = images.derivative_urls(image, size, images.fallback_format(image.name))
+    # display: contents keeps the <img> sized by the surrounding layout, as if there were no <picture>.
+    return format_html(
+        '<picture style="display: contents"><source type="image/webp" srcset="{}">'
+        '<img src="{}" srcset="{}" alt="{}"{}></picture>',
+        _srcset(webp), fallback[0][0], _srcset(fallback), alt, attributes,
+    )
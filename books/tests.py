@@ -1,3 +1,1720 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from base64 import b64encode
+from collections import Counter
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import close_old_connections, connection, transaction
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.template import Context, Template
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLResolver, get_resolver, reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from books import (
+    barcodes, benchmarks, circulation, conditional, events, fragments, kpis, recommendations, reports, search, seeding,
+)
+from books.models import (
+    Author, Book, BookCopy, BookSearchDocument, BookSimilarity, BorrowerCirculationStat, Borrowing, Category,
+    CollectionVersion, CopyIdSequence, DailyCategoryCirculationStat, DailyCirculationStat, FavoriteBook, Notification,
+    OverdueLoanSnapshot, TitleCirculationStat, UnreadNotificationCounter,
+)
+from books.serializers import BookSerializer
+from books.utils import favorite_isbns_context
+from lms import metrics
+from lms.metrics import MmapFile
+from lms.query_budget import QueryBudgetExceeded, assert_no_growth, query_budget
+from lms.routers import PIN_COOKIE, PrimaryReplicaRouter, PrimaryStickinessMiddleware, use_primary
+from users.models import CustomUser, PushOutbox, UserDevice
+
+
+def run_in_threads(worker, count):
+    """Runs worker(index) in `count` threads started together; returns the results in index order."""
+    results = [None] * count
+    barrier = threading.Barrier(count)
+
+    def run(index):
+        barrier.wait()
+        try:
+            results[index] = worker(index)
+        except Exception as error:
+            results[index] = error
+        finally:
+            close_old_connections()
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class CopyAllocationTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(isbn='9780000000001', title='The Hobbit')
+        self.copies = [BookCopy.objects.create(book=self.book, copy_id=f'HOB-{index}') for index in range(2)]
+        self.reader = CustomUser.objects.create_user(username='reader')
+        self.due_date = timezone.localdate() + timedelta(days=14)
+
+    def test_request_reserves_a_copy(self):
+        borrowing = circulation.request_copy(self.reader, self.book, self.due_date)
+        self.assertEqual(borrowing.status, 'REQUESTED')
+        self.assertEqual(BookCopy.objects.get(pk=borrowing.book_copy_id).status, 'Reserved')
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 1)
+
+    def test_duplicate_request_is_refused(self):
+        circulation.request_copy(self.reader, self.book, self.due_date)
+        with self.assertRaises(circulation.DuplicateBorrowing):
+            circulation.request_copy(self.reader, self.book, self.due_date)
+
+    def test_approve_and_release(self):
+        approved = circulation.request_copy(self.reader, self.book, self.due_date)
+        other = CustomUser.objects.create_user(username='other')
+        cancelled = circulation.request_copy(other, self.book, self.due_date)
+
+        circulation.approve_request(approved)
+        circulation.release_request(cancelled, 'CANCELLED')
+
+        self.assertEqual(BookCopy.objects.get(pk=approved.book_copy_id).status, 'On Loan')
+        self.assertEqual(BookCopy.objects.get(pk=cancelled.book_copy_id).status, 'Available')
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.available_copies, self.book.total_borrows), (1, 1))
+
+    def test_approval_falls_back_to_another_copy(self):
+        borrowing = Borrowing.objects.create(
+            borrower=self.reader, book_copy=self.copies[0], due_date=self.due_date, status='REQUESTED'
+        )
+        circulation.issue_copy(CustomUser.objects.create_user(username='walk-in'), self.book, self.due_date, copy=self.copies[0])
+        circulation.approve_request(borrowing)
+        self.assertEqual((borrowing.status, borrowing.book_copy_id), ('ACTIVE', self.copies[1].pk))
+
+    def test_specific_copy_must_be_available(self):
+        circulation.issue_copy(self.reader, self.book, self.due_date, copy=self.copies[0])
+        other = CustomUser.objects.create_user(username='other')
+        with self.assertRaises(circulation.CopyUnavailable):
+            circulation.request_copy(other, self.book, self.due_date, copy=self.copies[0])
+
+
+class CopyCounterTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(isbn='9780000000501', title='Middlemarch')
+        self.other = Book.objects.create(isbn='9780000000502', title='Adam Bede')
+        self.copies = [BookCopy.objects.create(book=self.book, copy_id=f'MM-{index}') for index in range(3)]
+        self.staff = CustomUser.objects.create_user(username='librarian', is_staff=True, role='LIBRARIAN')
+        self.reader = CustomUser.objects.create_user(username='reader')
+        self.client.force_login(self.staff)
+
+    def assertCountersMatch(self, *books):
+        for book in books or (self.book, self.other):
+            book.refresh_from_db()
+            copies = BookCopy.objects.filter(book=book)
+            self.assertEqual(
+                (book.total_copies, book.available_copies),
+                (copies.count(), copies.filter(status='Available').count()),
+                book.title,
+            )
+
+    def loan(self, due_in_days=14):
+        return circulation.issue_copy(self.reader, self.book, timezone.localdate() + timedelta(days=due_in_days))
+
+    def test_return_and_mark_lost(self):
+        returned, lost = self.loan(), self.loan(due_in_days=-3)
+        self.assertCountersMatch()
+        self.client.post(reverse('books:dashboard_mark_loan_returned', args=[returned.pk]))
+        self.client.post(reverse('books:dashboard_mark_loan_lost', args=[lost.pk]))
+        self.assertEqual(BookCopy.objects.get(pk=lost.book_copy_id).status, 'Lost')
+        self.assertCountersMatch()
+        self.assertEqual((self.book.total_copies, self.book.available_copies), (3, 2))
+
+    def test_copy_edits_and_moves(self):
+        copy = self.copies[0]
+        for status in ('Damaged', 'Available', 'In Repair'):
+            copy.status = status
+            copy.save()
+            self.assertCountersMatch()
+        # Fields outside update_fields are not written, so they must not move the counters either.
+        copy.status = 'Available'
+        copy.save(update_fields=['condition_notes'])
+        self.assertCountersMatch()
+
+        moved = BookCopy.objects.get(pk=self.copies[1].pk)
+        moved.book = self.other
+        moved.save()
+        self.assertCountersMatch()
+        self.assertEqual(self.other.total_copies, 1)
+
+    def test_copy_and_book_deletes(self):
+        self.copies[0].delete()
+        self.assertCountersMatch()
+        BookCopy.objects.create(book=self.other, copy_id='AB-1')
+        # The cascade deletes the copies first; their receivers must not disturb the other book.
+        self.book.delete()
+        self.assertCountersMatch(self.other)
+        self.assertEqual(self.other.total_copies, 1)
+
+    def test_reconcile_fixes_drift(self):
+        Book.objects.filter(pk=self.book.pk).update(total_copies=7, available_copies=0)
+        out = StringIO()
+        call_command('reconcile_copy_counters', '--dry-run', stdout=out)
+        self.assertIn('drifted copy counters: 1', out.getvalue())
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.total_copies, 7)
+
+        call_command('reconcile_copy_counters', stdout=StringIO())
+        self.assertCountersMatch()
+        out = StringIO()
+        call_command('reconcile_copy_counters', stdout=out)
+        self.assertIn('drifted copy counters: 0', out.getvalue())
+
+
+class CopyAllocationStressTests(TransactionTestCase):
+    """Many borrowers request the same title at once: every copy goes to exactly one of them."""
+    COPIES = 10
+    BORROWERS = 40
+
+    def setUp(self):
+        self.book = Book.objects.create(isbn='9780000000002', title='Dune')
+        for index in range(self.COPIES):
+            BookCopy.objects.create(book=self.book, copy_id=f'DUNE-{index}')
+        self.borrowers = [CustomUser.objects.create_user(username=f'reader{index}') for index in range(self.BORROWERS)]
+        self.due_date = timezone.localdate() + timedelta(days=14)
+
+    def test_concurrent_requests_never_share_a_copy(self):
+        started = time.monotonic()
+        results = run_in_threads(
+            lambda index: circulation.request_copy(self.borrowers[index], self.book, self.due_date),
+            self.BORROWERS,
+        )
+        elapsed = time.monotonic() - started
+
+        granted = [result for result in results if isinstance(result, Borrowing)]
+        refused = [result for result in results if isinstance(result, circulation.CopyUnavailable)]
+        unexpected = [result for result in results if not isinstance(result, (Borrowing, circulation.CopyUnavailable))]
+        self.assertEqual(unexpected, [])
+        self.assertEqual((len(granted), len(refused)), (self.COPIES, self.BORROWERS - self.COPIES))
+
+        copy_owners = Counter(Borrowing.objects.filter(status='REQUESTED').values_list('book_copy_id', flat=True))
+        self.assertEqual(len(copy_owners), self.COPIES)
+        self.assertEqual(set(copy_owners.values()), {1})
+        self.assertEqual(BookCopy.objects.filter(book=self.book, status='Reserved').count(), self.COPIES)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 0)
+        # Throughput: contention must not serialize the requests into timeouts.
+        self.assertLess(elapsed, 10, f"{self.BORROWERS} concurrent requests took {elapsed:.2f}s")
+
+    def test_concurrent_approvals_and_issues_never_share_a_copy(self):
+        requests = [circulation.request_copy(borrower, self.book, self.due_date) for borrower in self.borrowers[:5]]
+        walk_ins = self.borrowers[5:]
+
+        def work(index):
+            if index < len(requests):
+                return circulation.approve_request(Borrowing.objects.get(pk=requests[index].pk))
+            return circulation.issue_copy(walk_ins[index - len(requests)], self.book, self.due_date)
+
+        results = run_in_threads(work, len(requests) + len(walk_ins))
+        approved = [result for result in results[:len(requests)] if isinstance(result, Borrowing)]
+        issued = [result for result in results[len(requests):] if isinstance(result, Borrowing)]
+        self.assertEqual(len(approved), len(requests))
+        self.assertEqual(len(issued), self.COPIES - len(requests))
+
+        loans = Counter(Borrowing.objects.filter(status='ACTIVE').values_list('book_copy_id', flat=True))
+        self.assertEqual((len(loans), set(loans.values())), (self.COPIES, {1}))
+        self.assertEqual(BookCopy.objects.filter(book=self.book, status='On Loan').count(), self.COPIES)
+
+
+class CopyIdAllocationTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(isbn='9780000000003', title='Emma')
+        self.staff = CustomUser.objects.create_user(username='librarian', is_staff=True, role='LIBRARIAN')
+
+    def test_batch_add_cost_does_not_grow_with_the_count(self):
+        barcodes.create_copies(self.book, 1)  # creates the sequence row
+        with CaptureQueriesContext(connection) as queries:
+            copies = barcodes.create_copies(self.book, 1000)
+        # One reservation (UPDATE + SELECT), the INSERT (split by SQLite's variable limit) and the counter UPDATE.
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT') and 'books_bookcopy' in query['sql']])
+        self.assertLess(len(queries), 20)
+        self.assertEqual([copy.copy_id for copy in copies[:2]], ['9780000000003-000002', '9780000000003-000003'])
+        self.assertEqual(copies[-1].copy_id, '9780000000003-001001')
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.total_copies, self.book.available_copies), (1001, 1001))
+
+    def test_sequence_starts_after_existing_ids_and_skips_hand_entered_ones(self):
+        BookCopy.objects.create(book=self.book, copy_id='9780000000003-000007')
+        self.assertEqual(barcodes.next_copy_id(self.book), '9780000000003-000008')
+        BookCopy.objects.create(book=self.book, copy_id='9780000000003-000010')
+        copies = barcodes.create_copies(self.book, 3)
+        self.assertEqual([copy.copy_id for copy in copies], [f'9780000000003-0000{n}' for n in (12, 13, 14)])
+
+    def test_batch_view_and_single_create_use_the_sequence(self):
+        self.client.force_login(self.staff)
+        self.client.post(reverse('books:dashboard_bookcopy_batch_add', args=[self.book.isbn]), {
+            'number_of_copies': 3, 'default_status': 'Available',
+            'date_acquired': timezone.localdate().isoformat(), 'copy_id_prefix': 'MAIN-',
+        })
+        self.client.post(reverse('books:dashboard_bookcopy_add', args=[self.book.isbn]), {'status': 'Available'})
+        self.assertEqual(sorted(BookCopy.objects.values_list('copy_id', flat=True)), [
+            '9780000000003-000001', 'MAIN-9780000000003-000001', 'MAIN-9780000000003-000002', 'MAIN-9780000000003-000003',
+        ])
+        self.assertEqual(CopyIdSequence.objects.count(), 2)
+
+    def test_editing_a_copy_keeps_its_id_required(self):
+        copy = BookCopy.objects.create(book=self.book, copy_id='EMMA-1')
+        self.client.force_login(self.staff)
+        response = self.client.post(reverse('books:dashboard_bookcopy_edit', args=[copy.pk]), {
+            'copy_id': '', 'status': 'Available', 'date_acquired': timezone.localdate().isoformat(),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors['copy_id'])
+        copy.refresh_from_db()
+        self.assertEqual(copy.copy_id, 'EMMA-1')
+
+
+class BenchmarkFavoritesCommandTests(TestCase):
+    def test_command_lists_every_size_and_rolls_back(self):
+        output = StringIO()
+        call_command('benchmark_favorites', '--sizes', '3,5', '--favorites', '0,2', '--repeat', '1', stdout=output)
+        rows = [line.split() for line in output.getvalue().splitlines()[1:-1]]
+        self.assertEqual([row[:2] for row in rows], [['3', '0'], ['5', '0'], ['3', '2'], ['5', '2']])
+        self.assertFalse(Book.objects.exists())
+
+
+class FavoriteFlagTests(TestCase):
+    def setUp(self):
+        self.author = Author.objects.create(name='Anne Carson')
+        self.books = [Book.objects.create(isbn=f'97800000008{index:02}', title=f'Glass {index:02}') for index in range(30)]
+        for book in self.books:
+            book.authors.add(self.author)
+        self.reader = CustomUser.objects.create_user(username='reader')
+        self.favorites = {book.isbn for book in self.books[::3]}
+        FavoriteBook.objects.bulk_create(FavoriteBook(user=self.reader, book_id=isbn) for isbn in self.favorites)
+
+    def test_book_list_queries_do_not_depend_on_the_page_size(self):
+        api = APIClient()
+        api.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.reader).key}')
+        counts = []
+        for page_size in (5, 30):
+            with CaptureQueriesContext(connection) as queries:
+                response = api.get('/api/books/', {'page_size': page_size})
+            results = response.data['results']
+            self.assertEqual(len(results), page_size)
+            self.assertEqual({item['isbn'] for item in results if item['is_favorite']}, self.favorites & {
+                item['isbn'] for item in results
+            })
+            counts.append(len(queries))
+            self.assertEqual(len([query for query in queries if 'books_favoritebook' in query['sql']]), 1)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_is_favorite_reads_the_context_set(self):
+        books = list(Book.objects.prefetch_related('authors', 'categories').order_by('isbn'))
+        with self.assertNumQueries(0):
+            data = BookSerializer(books, many=True, context={'favorite_isbns': frozenset(self.favorites)}).data
+        self.assertEqual({item['isbn'] for item in data if item['is_favorite']}, self.favorites)
+
+        request = RequestFactory().get('/api/books/')
+        request.user = CustomUser.objects.get(pk=self.reader.pk)
+        # The lazy context entry loads the set once for the whole list.
+        with self.assertNumQueries(1):
+            data = BookSerializer(books, many=True, context={'request': request, **favorite_isbns_context(request)}).data
+        self.assertEqual(sum(item['is_favorite'] for item in data), len(self.favorites))
+
+
+class MigrateFavoritesCommandTests(TestCase):
+    def setUp(self):
+        self.emma = Book.objects.create(isbn='9780000000401', title='Emma')
+        self.persuasion = Book.objects.create(isbn='9780000000402', title='Persuasion')
+        self.reader = CustomUser.objects.create_user(username='reader', favorite_books=[
+            {'isbn': self.emma.isbn, 'favorited_at': '2024-01-02T03:04:05'},
+            {'isbn': self.persuasion.isbn, 'favorited_at': 'yesterday'},
+            {'isbn': self.emma.isbn},
+            {'isbn': '9789999999999'},
+            {'isbn': ['9780000000401']},
+            {'isbn': None},
+            '9780000000402',
+        ])
+        self.other = CustomUser.objects.create_user(username='other', favorite_books={'isbn': self.emma.isbn})
+
+    def migrate(self, *args):
+        output = StringIO()
+        call_command('migrate_favorites', *args, stdout=output)
+        return output.getvalue()
+
+    def favorites(self):
+        return dict(FavoriteBook.objects.values_list('book_id', 'favorited_at').filter(user=self.reader))
+
+    def test_copies_known_isbns_and_skips_invalid_ones(self):
+        output = self.migrate()
+        self.assertIn('skipped 4 unknown ISBN(s)', output)
+        favorites = self.favorites()
+        self.assertEqual(set(favorites), {self.emma.isbn, self.persuasion.isbn})
+        self.assertEqual(favorites[self.emma.isbn], timezone.make_aware(datetime(2024, 1, 2, 3, 4, 5)))
+        # An unreadable timestamp falls back to the time of the migration.
+        self.assertLess(timezone.now() - favorites[self.persuasion.isbn], timedelta(minutes=1))
+        self.assertFalse(FavoriteBook.objects.filter(user=self.other).exists())
+
+    def test_rerunning_keeps_existing_rows(self):
+        self.migrate()
+        FavoriteBook.objects.filter(user=self.reader, book=self.persuasion).update(
+            favorited_at=timezone.make_aware(datetime(2020, 5, 6)),
+        )
+        before = self.favorites()
+        self.migrate('--clear-legacy')
+        self.assertEqual(self.favorites(), before)
+        self.assertEqual(FavoriteBook.objects.count(), 2)
+        self.migrate()
+        self.assertEqual(FavoriteBook.objects.count(), 2)
+
+    def test_clear_legacy_keeps_the_entries_it_could_not_copy(self):
+        done = CustomUser.objects.create_user(username='done', favorite_books=[{'isbn': self.persuasion.isbn}])
+        output = self.migrate('--clear-legacy', '--verbosity', '2')
+        self.assertIn('Kept 4 skipped entries in the legacy list of 1 user(s)', output)
+        self.assertIn(f"user {self.reader.pk}: [{{'isbn': '9789999999999'}}", output)
+
+        for user in (self.reader, done, self.other):
+            user.refresh_from_db()
+        self.assertEqual(self.reader.favorite_books, [
+            {'isbn': '9789999999999'}, {'isbn': ['9780000000401']}, {'isbn': None}, '9780000000402',
+        ])
+        self.assertEqual(done.favorite_books, [])
+        # Not a list at all: left as it is.
+        self.assertEqual(self.other.favorite_books, {'isbn': self.emma.isbn})
+        self.assertEqual(FavoriteBook.objects.filter(user=done).count(), 1)
+
+    def test_writes_each_batch_as_it_fills(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.migrate('--batch-size', '1')
+        inserts = [query for query in queries if query['sql'].startswith('INSERT') and '"books_favoritebook"' in query['sql']]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(set(self.favorites()), {self.emma.isbn, self.persuasion.isbn})
+
+
+class CatalogImportTests(TestCase):
+    CSV = (
+        "isbn,title,authors,categories,publisher,publication_date,copies\n"
+        "978-0-261-10334-4,The Hobbit,J.R.R. Tolkien,Fantasy; Classics,Allen & Unwin,1937,2\n"
+        "0261102389,The Lord of the Rings,j.r.r. tolkien,fantasy,,1954-07-29,\n"
+        "not-an-isbn,Broken,,,,,\n"
+        "ISBN9780261103344,The Hobbit (again),,,,,\n"
+    )
+    MARC = (
+        "=LDR  00000nam  2200000 a 4500\n"
+        "=020  \\\\$a9780141439518 (pbk.)\n"
+        "=100  1\\$aAusten, Jane.\n"
+        "=245  10$aPride and prejudice /$cJane Austen.\n"
+        "=264  \\1$aLondon :$bPenguin,$c2003.\n"
+        "=650  \\0$aCourtship$vFiction.\n"
+    )
+
+    def import_file(self, content, suffix, *args):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, 'w') as file:
+            file.write(content)
+        out, err = StringIO(), StringIO()
+        call_command('import_catalog', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_import(self):
+        Author.objects.create(name='J.R.R. Tolkien')
+        categories_version = fragments.collection_version('categories')
+        out, err = self.import_file(self.CSV, '.csv', '--chunk-size', '2')
+        # New categories are bulk-created, so the import moves the sidebar's version itself.
+        self.assertNotEqual(fragments.collection_version('categories'), categories_version)
+
+        hobbit = Book.objects.get(isbn='ISBN9780261103344')
+        lotr = Book.objects.get(isbn='ISBN9780261102385')  # converted from the ISBN-10
+        self.assertEqual(hobbit.title, 'The Hobbit')
+        self.assertEqual((hobbit.total_copies, hobbit.available_copies, lotr.total_copies), (2, 2, 1))
+        self.assertEqual(Author.objects.count(), 1)
+        self.assertEqual(sorted(Category.objects.values_list('name', flat=True)), ['Classics', 'Fantasy'])
+        self.assertEqual(list(lotr.authors.values_list('name', flat=True)), ['J.R.R. Tolkien'])
+        self.assertEqual(lotr.publication_date.isoformat(), '1954-07-29')
+        self.assertEqual(sorted(hobbit.copies.values_list('copy_id', flat=True)),
+                         ['ISBN9780261103344-000001', 'ISBN9780261103344-000002'])
+        self.assertIn("Record 2: skipped, invalid ISBN 'not-an-isbn'", err)
+        self.assertIn("Next offset: 4", out)
+
+    def test_resume_from_offset_and_marc(self):
+        self.import_file(self.CSV, '.csv', '--offset', '1')
+        self.assertEqual(sorted(Book.objects.values_list('title', flat=True)), ['The Hobbit (again)', 'The Lord of the Rings'])
+
+        self.import_file(self.MARC, '.mrk', '--copies', '0')
+        book = Book.objects.get(isbn='ISBN9780141439518')
+        self.assertEqual((book.title, book.publisher, book.publication_date.year, book.total_copies),
+                         ('Pride and prejudice', 'Penguin', 2003, 0))
+        self.assertEqual(list(book.authors.values_list('name', flat=True)), ['Austen, Jane'])
+        self.assertEqual(list(book.categories.values_list('name', flat=True)), ['Courtship'])
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.staff = CustomUser.objects.create_user(username='librarian', is_staff=True, role='LIBRARIAN')
+        self.reader = CustomUser.objects.create_user(username='reader', first_name='Ada')
+        book = Book.objects.create(isbn='9780000000004', title='Middlemarch')
+        copies = [BookCopy.objects.create(book=book, copy_id=f'MID-{index}') for index in range(3)]
+        due_date = timezone.localdate() + timedelta(days=14)
+        for copy, status in zip(copies, ['RETURNED', 'CANCELLED', 'ACTIVE']):
+            Borrowing.objects.create(borrower=self.reader, book_copy=copy, due_date=due_date, status=status)
+
+    def test_history_export_streams_filtered_rows(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('books:dashboard_export', args=['loan-history']),
+                                   {'search': 'ada', 'status_filter': 'RETURNED'})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'status', 'borrower_id'])
+        self.assertEqual([line.split(',')[1] for line in lines[1:]], ['RETURNED'])
+
+        response = self.client.get(reverse('books:dashboard_export', args=['active-loans']), {'format': 'jsonl'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([(row['status'], row['copy_id']) for row in rows], [('ACTIVE', 'MID-2')])
+
+    def test_export_requires_staff_and_a_known_dataset(self):
+        self.client.force_login(self.reader)
+        self.assertNotEqual(self.client.get(reverse('books:dashboard_export', args=['books'])).status_code, 200)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(reverse('books:dashboard_export', args=['users'])).status_code, 404)
+
+    def test_export_command(self):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        call_command('export_data', 'book-copies', '--output', path, '--search', 'MID-1', stdout=StringIO())
+        with open(path, encoding='utf-8') as file:
+            self.assertEqual([line.split(',')[1] for line in file.read().splitlines()], ['copy_id', 'MID-1'])
+
+
+class CatalogSearchTests(TestCase):
+    def setUp(self):
+        self.author = Author.objects.create(name='Frank Herbert')
+        self.category = Category.objects.create(name='Science Fiction')
+        self.dune = Book.objects.create(isbn='9780000000101', title='Dune')
+        self.dune.authors.add(self.author)
+        self.dune.categories.add(self.category)
+        self.messiah = Book.objects.create(isbn='9780000000102', title='Dune Messiah',
+                                           description='The second novel of the saga, set twelve years after the first.')
+        self.sand = Book.objects.create(isbn='9780000000103', title='Sand', description='Walking over a dune at dusk.')
+
+    def found(self, term):
+        return set(search.filter_books(Book.objects.all(), term).values_list('title', flat=True))
+
+    def test_index_follows_book_saves_and_deletes(self):
+        self.dune.title = 'Arrakis'
+        self.dune.save()
+        self.assertEqual(self.found('arrakis'), {'Arrakis'})
+        self.assertEqual(self.found('dune'), {'Dune Messiah', 'Sand'})
+        self.messiah.delete()
+        self.assertEqual(self.found('messiah'), set())
+        self.assertFalse(BookSearchDocument.objects.filter(book_id='9780000000102').exists())
+
+    def test_index_follows_author_and_category_changes(self):
+        self.assertEqual(self.found('herbert fiction'), {'Dune'})
+        self.author.name = 'Brian Herbert'
+        self.author.save()
+        self.category.name = 'Space Opera'
+        self.category.save()
+        self.assertEqual(self.found('frank'), set())
+        self.assertEqual(self.found('brian opera'), {'Dune'})
+
+        self.messiah.authors.add(self.author)
+        self.assertEqual(self.found('brian'), {'Dune', 'Dune Messiah'})
+        self.author.delete()
+        self.category.delete()
+        self.assertEqual(self.found('brian'), set())
+        self.assertEqual(self.found('opera'), set())
+
+    def test_results_are_ordered_by_rank(self):
+        ranked = search.search_books(Book.objects.all(), 'dune')
+        # Title matches outweigh the description; the longer document is the weaker title match.
+        self.assertEqual([book.title for book in ranked], ['Dune', 'Dune Messiah', 'Sand'])
+        self.assertEqual(list(search.search_books(Book.objects.all(), 'dusk').values_list('title', flat=True)), ['Sand'])
+
+        api = APIClient()
+        api.force_authenticate(CustomUser.objects.create_user(username='reader'))
+        titles, response = [], api.get('/api/books/', {'search': 'dune', 'page_size': 1})
+        while True:
+            titles += [item['title'] for item in response.data['results']]
+            if not response.data['next']:
+                break
+            response = api.get(response.data['next'])
+        self.assertEqual(titles, ['Dune', 'Dune Messiah', 'Sand'])
+
+    def test_icontains_fallback_without_an_index(self):
+        with mock.patch.object(search, 'fts_available', return_value=False):
+            # Substrings match too, and the matches keep the queryset's order (no rank).
+            self.assertEqual(self.found('une'), {'Dune', 'Dune Messiah', 'Sand'})
+            self.assertEqual(self.found('herbert science'), {'Dune'})
+            results = search.search_books(Book.objects.all(), 'dune')
+            self.assertNotIn('search_rank', results.query.annotations)
+            self.assertEqual([book.title for book in results], ['Dune', 'Dune Messiah', 'Sand'])
+            self.assertEqual(self.found('?!'), set())
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        fiction = Category.objects.create(name='Fiction')
+        self.books = {
+            key: Book.objects.create(isbn=f'978000000060{index}', title=f'Title {key}')
+            for index, key in enumerate('ABCDE')
+        }
+        for key in 'AD':
+            self.books[key].categories.add(fiction)
+        # A and B share two borrowers, A and C and B and C one; A and D only share their category.
+        for name, keys in [('reader-1', 'AB'), ('reader-2', 'ABC'), ('reader-3', 'C')]:
+            self.borrow(CustomUser.objects.create_user(username=name), keys, 'RETURNED')
+
+    def borrow(self, user, keys, status, issued=None):
+        for key in keys:
+            copy = BookCopy.objects.create(book=self.books[key], copy_id=f'{key}-{BookCopy.objects.count()}')
+            Borrowing.objects.create(
+                borrower=user, book_copy=copy, status=status, issue_date=issued or timezone.now() - timedelta(days=30),
+                due_date=timezone.localdate(),
+            )
+
+    def neighbours(self, key):
+        return [
+            (row.similar_book.title[-1], round(row.score, 3), row.co_borrow_count, row.shared_category_count)
+            for row in BookSimilarity.objects.filter(book=self.books[key]).select_related('similar_book').order_by('rank')
+        ]
+
+    def test_scores_combine_co_borrowing_and_category_overlap(self):
+        self.assertEqual(recommendations.build_similarities(category_weight=0.3), 8)
+        # 0.7 * cosine(co-borrowers) + 0.3 * jaccard(categories)
+        self.assertEqual(self.neighbours('A'), [('B', 0.7, 2, 0), ('C', 0.35, 1, 0), ('D', 0.3, 0, 1)])
+        self.assertEqual(self.neighbours('D'), [('A', 0.3, 0, 1)])
+        self.assertEqual(self.neighbours('E'), [])
+
+        recommendations.build_similarities(k=2, batch_size=1)
+        self.assertEqual(self.neighbours('A'), [('B', 0.7, 2, 0), ('C', 0.35, 1, 0)])
+        self.assertEqual(BookSimilarity.objects.filter(book=self.books['C']).count(), 2)
+        self.assertEqual(BookSimilarity.objects.count(), 7)
+
+    def test_recommendations_leave_out_borrowed_and_favorite_books(self):
+        recommendations.build_similarities()
+        member = CustomUser.objects.create_user(username='member')
+        FavoriteBook.objects.create(user=member, book=self.books['B'])
+        self.borrow(member, 'C', 'REQUESTED')
+        # The latest issued borrowing, A, is the seed.
+        self.borrow(member, 'A', 'RETURNED', issued=timezone.now() + timedelta(minutes=1))
+
+        self.assertEqual([book.title for book in recommendations.recommendations_for_user(member)], ['Title D'])
+        self.assertEqual(
+            [book.title for book in recommendations.similar_books(self.books['A'])], ['Title B', 'Title C', 'Title D'],
+        )
+
+    def test_catalog_falls_back_to_popular_titles(self):
+        Book.objects.update(date_added_to_system=timezone.now() - timedelta(days=30))
+        for index in range(6):
+            Book.objects.create(isbn=f'978000000070{index}', title=f'New {index}')
+        Book.objects.filter(isbn=self.books['C'].isbn).update(total_borrows=50)
+        Book.objects.filter(isbn=self.books['E'].isbn).update(total_borrows=40)
+
+        response = self.client.get(reverse('books:portal_catalog'))
+        self.assertEqual(
+            [book.title[-1] for book in response.context['recommended_books']], ['C', 'E', 'A', 'B', 'D'],
+        )
+
+        recommendations.build_similarities()
+        member = CustomUser.objects.create_user(username='member')
+        FavoriteBook.objects.create(user=member, book=self.books['B'])
+        self.borrow(member, 'A', 'RETURNED', issued=timezone.now() + timedelta(minutes=1))
+        self.client.force_login(member)
+        response = self.client.get(reverse('books:portal_catalog'))
+        # The neighbours of A the member has not seen, then the most borrowed remaining titles.
+        self.assertEqual([book.title[-1] for book in response.context['recommended_books']][:3], ['C', 'D', 'E'])
+
+    def test_detail_falls_back_to_the_category_without_similarities(self):
+        def related(key):
+            response = self.client.get(reverse('books:portal_book_detail', args=[self.books[key].isbn]))
+            return [book.title[-1] for book in response.context['related_books']]
+
+        self.assertEqual(related('A'), ['D'])
+        recommendations.build_similarities()
+        self.assertEqual(related('A'), ['B', 'C', 'D'])
+
+    def test_build_recommendations_command(self):
+        out = StringIO()
+        call_command('build_recommendations', '--top-k', '1', '--batch-size', '2', stdout=out)
+        self.assertIn('Wrote 4 book similarity row(s)', out.getvalue())
+        self.assertEqual(self.neighbours('C'), [('B', 0.35, 1, 0)])
+
+        for option, value in [('--top-k', '0'), ('--category-weight', '1.5'), ('--batch-size', '0')]:
+            with self.assertRaises(CommandError):
+                call_command('build_recommendations', option, value, stdout=StringIO())
+        self.assertEqual(BookSimilarity.objects.count(), 4)
+
+
+class ReportRollupTests(TestCase):
+    ROLLUP_MODELS = (
+        DailyCirculationStat, DailyCategoryCirculationStat, TitleCirculationStat, BorrowerCirculationStat,
+        OverdueLoanSnapshot,
+    )
+
+    def rollups(self):
+        tables = {}
+        for model in self.ROLLUP_MODELS:
+            fields = [field.attname for field in model._meta.concrete_fields if field.name != 'id']
+            tables[model.__name__] = sorted(model.objects.values_list(*fields), key=repr)
+        return tables
+
+    def test_incremental_rollups_match_a_rebuild(self):
+        book = Book.objects.create(isbn='9780000000201', title='Solaris')
+        book.categories.add(Category.objects.create(name='Science Fiction'))
+        for index in range(4):
+            BookCopy.objects.create(book=book, copy_id=f'SOL-{index}')
+        readers = [
+            CustomUser.objects.create_user(username=f'reader{index}', borrower_type=borrower_type)
+            for index, borrower_type in enumerate(['STUDENT', 'STUDENT', 'FACULTY', None])
+        ]
+        today = timezone.localdate()
+
+        # Request -> approve -> return on time.
+        returned = circulation.approve_request(circulation.request_copy(readers[0], book, today + timedelta(days=14)))
+        returned.status, returned.return_date = 'RETURNED', timezone.now()
+        returned.save()
+        # Request -> reject.
+        circulation.release_request(circulation.request_copy(readers[1], book, today + timedelta(days=14)), 'REJECTED')
+        # Two loans past due: the reminder job flips both to OVERDUE with a queryset UPDATE,
+        # then one comes back late.
+        late = circulation.issue_copy(readers[2], book, today - timedelta(days=1))
+        circulation.issue_copy(readers[3], book, today - timedelta(days=2))
+        call_command('send_due_reminders', stdout=StringIO())
+        self.assertEqual(Borrowing.objects.filter(status='OVERDUE').count(), 2)
+        late = Borrowing.objects.get(pk=late.pk)
+        late.status, late.return_date = 'RETURNED_LATE', timezone.now()
+        late.save()
+
+        incremental = self.rollups()
+        self.assertEqual(len(incremental['OverdueLoanSnapshot']), 1)
+        self.assertEqual(TitleCirculationStat.objects.get(book=book).overdue_loans, 1)
+        reports.rebuild_daily_rollups()
+        reports.rebuild_running_rollups()
+        self.assertEqual(self.rollups(), incremental)
+
+
+class DueReminderCommandTests(TestCase):
+    def setUp(self):
+        book = Book.objects.create(isbn='9780000000301', title='Emma')
+        copies = [BookCopy.objects.create(book=book, copy_id=f'EMM-{index}', status='On Loan') for index in range(3)]
+        self.reader = CustomUser.objects.create_user(username='reader')
+        today = timezone.localdate()
+        self.due_soon, self.overdue, self.later = [
+            Borrowing.objects.create(borrower=self.reader, book_copy=copy, status='ACTIVE', due_date=today + timedelta(days=days))
+            for copy, days in zip(copies, [3, -1, 10])
+        ]
+
+    def run_command(self, *args):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('send_due_reminders', '--push', *args, stdout=StringIO())
+
+    def notifications(self):
+        return sorted(Notification.objects.values_list('related_borrowing_id', 'notification_type'))
+
+    def test_flips_overdue_loans_and_counts_unread_notifications(self):
+        self.run_command()
+        self.assertEqual(self.notifications(), sorted([(self.due_soon.pk, 'DUE_REMINDER'), (self.overdue.pk, 'OVERDUE_ALERT')]))
+        statuses = dict(Borrowing.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {self.due_soon.pk: 'ACTIVE', self.overdue.pk: 'OVERDUE', self.later.pk: 'ACTIVE'})
+        self.assertEqual(UnreadNotificationCounter.objects.get(user=self.reader).unread, 2)
+        self.assertEqual(PushOutbox.objects.count(), 2)
+
+    def test_second_run_the_same_day_sends_nothing_new(self):
+        self.run_command()
+        # A loan that became overdue meanwhile gets its alert on the second run, once.
+        Borrowing.objects.filter(pk=self.later.pk).update(due_date=timezone.localdate() - timedelta(days=1))
+        self.run_command()
+        self.run_command()
+        self.assertEqual(self.notifications(), sorted([
+            (self.due_soon.pk, 'DUE_REMINDER'), (self.overdue.pk, 'OVERDUE_ALERT'), (self.later.pk, 'OVERDUE_ALERT'),
+        ]))
+        self.assertEqual(UnreadNotificationCounter.objects.get(user=self.reader).unread, 3)
+        self.assertEqual(PushOutbox.objects.count(), 3)
+
+    def test_dry_run_writes_nothing(self):
+        output = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('send_due_reminders', '--push', '--dry-run', stdout=output)
+        self.assertIn('Marked as overdue: 1', output.getvalue())
+        self.assertFalse(Notification.objects.exists())
+        self.assertFalse(PushOutbox.objects.exists())
+        self.assertFalse(UnreadNotificationCounter.objects.filter(user=self.reader, unread__gt=0).exists())
+        self.assertFalse(Borrowing.objects.exclude(status='ACTIVE').exists())
+        self.assertFalse(OverdueLoanSnapshot.objects.exists())
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.reader = CustomUser.objects.create_user(username='reader')
+        self.api = APIClient()
+        self.api.force_authenticate(self.reader)
+        now = timezone.now()
+        notifications = Notification.objects.bulk_create([
+            Notification(recipient=self.reader, notification_type='GENERAL', message=f'#{index}') for index in range(7)
+        ])
+        # Three notifications share a timestamp: the id tie-breaker must keep them in a stable order.
+        for index, notification in enumerate(notifications):
+            Notification.objects.filter(pk=notification.pk).update(timestamp=now - timedelta(minutes=min(index, 3)))
+
+    def collect(self, url, key='id', **params):
+        pages, response = [], self.api.get(url, params)
+        while True:
+            pages.append([item[key] for item in response.data['results']])
+            if not response.data['next']:
+                return pages, response
+            response = self.api.get(response.data['next'])
+
+    def test_walks_every_notification_once_in_order(self):
+        pages, last = self.collect('/api/notifications/', page_size=2)
+        expected = list(Notification.objects.order_by('-timestamp', 'id').values_list('id', flat=True))
+        self.assertEqual([item for page in pages for item in page], expected)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+
+        previous = self.api.get(last.data['previous'])
+        self.assertEqual([item['id'] for item in previous.data['results']], pages[-2])
+
+    def test_malformed_cursor_is_not_found(self):
+        def cursor(position):
+            return b64encode(urlencode({'p': json.dumps(position)}).encode('ascii')).decode('ascii')
+
+        for position in (['not-a-date', 1], [timezone.now().isoformat(), 'x'], [{'a': 1}, 1], [1]):
+            with self.subTest(position=position):
+                response = self.api.get('/api/notifications/', {'cursor': cursor(position)})
+                self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.api.get('/api/notifications/', {'cursor': 'not base64'}).status_code, 404)
+
+    def test_page_size_is_capped_and_lookup_tables_are_not_paginated(self):
+        response = self.api.get('/api/notifications/', {'page_size': 1000})
+        self.assertEqual(len(response.data['results']), 7)
+        with CaptureQueriesContext(connection) as queries:
+            self.api.get('/api/notifications/', {'page_size': 1000})
+        self.assertIn('LIMIT 51', queries[-1]['sql'])
+
+        Category.objects.create(name='Poetry')
+        self.reader.role = 'LIBRARIAN'
+        self.reader.save()
+        self.assertEqual([item['name'] for item in self.api.get('/api/categories/').data], ['Poetry'])
+
+    def test_client_ordering_is_kept(self):
+        for index, title in enumerate(['b', 'a', 'c']):
+            Book.objects.create(isbn=f'978000000009{index}', title=title,
+                                publication_date=None if index else timezone.localdate())
+        # NULL publication dates sort last when descending; ties fall back to (title, isbn).
+        pages, _ = self.collect('/api/books/', key='title', page_size=1, ordering='-publication_date')
+        self.assertEqual(pages, [['b'], ['a'], ['c']])
+
+
+class UnreadNotificationCounterTests(TestCase):
+    def setUp(self):
+        self.reader = CustomUser.objects.create_user(username='reader')
+        self.other = CustomUser.objects.create_user(username='other')
+        self.api = APIClient()
+        self.api.force_authenticate(self.reader)
+
+    def notify(self, user, count=1):
+        return [Notification.objects.create(recipient=user, notification_type='GENERAL_ANNOUNCEMENT', message='hi')
+                for _ in range(count)]
+
+    def unread(self, user):
+        return UnreadNotificationCounter.objects.filter(user=user).values_list('unread', flat=True).first() or 0
+
+    def test_counter_follows_creates_reads_and_deletes(self):
+        first, second, third = self.notify(self.reader, 3)
+        Notification.objects.bulk_create([
+            Notification(recipient=user, notification_type='DUE_REMINDER', message='due') for user in (self.reader, self.other)
+        ])
+        self.assertEqual((self.unread(self.reader), self.unread(self.other)), (4, 1))
+
+        self.api.post(f'/api/notifications/{first.pk}/mark-read/')
+        self.api.post(f'/api/notifications/{first.pk}/mark-read/')
+        third.delete()
+        self.assertEqual(self.unread(self.reader), 2)
+
+        self.api.post('/api/notifications/mark-all-read/')
+        self.assertEqual((self.unread(self.reader), self.unread(self.other)), (0, 1))
+
+    def test_concurrent_mark_read_counts_once(self):
+        notification, _ = self.notify(self.reader, 2)
+        # Both requests loaded the notification while it was unread; the second one's update finds it read.
+        stale = Notification.objects.get(pk=notification.pk)
+        self.api.post(f'/api/notifications/{notification.pk}/mark-read/')
+        self.assertFalse(stale.mark_read())
+        self.assertTrue(stale.is_read)
+        self.assertEqual(self.unread(self.reader), 1)
+
+        queryset = Notification.objects.filter(recipient=self.reader)
+        self.assertEqual(queryset.mark_read(), 1)
+        self.assertEqual(queryset.mark_read(), 0)
+        self.assertEqual(self.unread(self.reader), 0)
+
+    def test_unread_count_does_not_query_notifications(self):
+        self.notify(self.reader, 2)
+        with CaptureQueriesContext(connection) as queries:
+            first = self.api.get('/api/notifications/unread-count/').data
+            second = self.api.get('/api/notifications/unread-count/').data
+        self.assertEqual((first, second), ({'unread_count': 2}, {'unread_count': 2}))
+        self.assertFalse([query for query in queries if 'books_notification' in query['sql']])
+        self.assertLessEqual(len(queries), 1)
+
+        # The cached value is dropped when the counter changes.
+        with self.captureOnCommitCallbacks(execute=True):
+            self.notify(self.reader)
+        self.assertEqual(self.api.get('/api/notifications/unread-count/').data, {'unread_count': 3})
+
+    def test_reconcile_command(self):
+        self.notify(self.reader, 2)
+        self.notify(self.other, 1)
+        UnreadNotificationCounter.objects.filter(user=self.reader).update(unread=7)
+        UnreadNotificationCounter.objects.filter(user=self.other).delete()
+
+        out = StringIO()
+        call_command('reconcile_notification_counters', stdout=out)
+        self.assertIn("Users without a counter: 1", out.getvalue())
+        self.assertEqual((self.unread(self.reader), self.unread(self.other)), (2, 1))
+
+
+class RealtimeEventTests(TestCase):
+    def setUp(self):
+        self.reader = CustomUser.objects.create_user(username='reader')
+
+    async def test_hub_delivers_to_subscribed_channels_only(self):
+        hub = events.Hub()
+        backend = events.LocalBackend(hub)
+        mine = hub.subscribe([events.user_channel(1), events.STAFF_CHANNEL])
+        other = hub.subscribe([events.user_channel(2)])
+
+        backend.publish(events.user_channel(1), {'type': 'notification', 'id': 5})
+        backend.publish(events.STAFF_CHANNEL, {'type': 'kpis'})
+        self.assertEqual(await asyncio.wait_for(mine.get(), 1), ('user:1', {'type': 'notification', 'id': 5}))
+        self.assertEqual(await asyncio.wait_for(mine.get(), 1), ('staff', {'type': 'kpis'}))
+        self.assertTrue(other.queue.empty())
+
+        mine.close()
+        other.close()
+        self.assertEqual(hub.subscriber_count(), 0)
+
+    async def test_sqlite_backend_shares_events_between_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.sqlite3')
+            publisher = events.SQLiteBackend(events.Hub(), path=path)
+            hub = events.Hub()
+            receiver = events.SQLiteBackend(hub, path=path)
+            receiver._last_id = 0
+            subscription = hub.subscribe([events.user_channel(3)])
+
+            publisher.publish(events.user_channel(3), {'type': 'notification', 'id': 9})
+            publisher.publish(events.user_channel(4), {'type': 'notification', 'id': 10})
+            self.assertEqual(receiver.poll(), 2)
+            self.assertEqual(await asyncio.wait_for(subscription.get(), 1), ('user:3', {'type': 'notification', 'id': 9}))
+            self.assertTrue(subscription.queue.empty())
+            publisher.close()
+            receiver.close()
+
+    def test_notifications_are_published_on_commit(self):
+        published = []
+        backend = events.get_backend()
+        original, backend.publish = backend.publish, lambda channel, event: published.append((channel, event))
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                notification = Notification.objects.create(
+                    recipient=self.reader, notification_type='GENERAL_ANNOUNCEMENT', message='hi',
+                )
+                self.assertEqual(published, [])
+        finally:
+            backend.publish = original
+        self.assertEqual(published, [(events.user_channel(self.reader.pk), events.notification_event(notification))])
+
+    def test_stream_is_refused_under_wsgi(self):
+        self.client.force_login(self.reader)
+        response = self.client.get('/api/notifications/stream/')
+        self.assertEqual(response.status_code, 501)
+        self.assertNotEqual(response['Content-Type'], 'text/event-stream')
+
+    async def test_stream_sends_unread_count_then_notifications(self):
+        response = await self.async_client.get('/api/notifications/stream/')
+        self.assertEqual(response.status_code, 401)
+
+        token = await Token.objects.acreate(user=self.reader)
+        response = await self.async_client.get('/api/notifications/stream/', AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertIn(b'event: hello\ndata: {"unread_count": 0}', await anext(stream))
+
+        events.publish(events.user_channel(self.reader.pk), {'type': 'notification', 'id': 42, 'message': 'Due soon'})
+        message = await asyncio.wait_for(anext(stream), 1)
+        self.assertEqual(message, b'id: 42\nevent: notification\ndata: {"type": "notification", "id": 42, "message": "Due soon"}\n\n')
+        await stream.aclose()
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.reader = CustomUser.objects.create_user(username='reader', password='pw')
+        self.author = Author.objects.create(name='Ursula K. Le Guin')
+        self.book = Book.objects.create(isbn='ISBN9780441478125', title='The Left Hand of Darkness')
+        self.book.authors.add(self.author)
+        self.copy = BookCopy.objects.create(book=self.book, copy_id='LH-1')
+        self.api = APIClient()
+        self.api.force_authenticate(self.reader)
+        self.url = f'/api/books/{self.book.isbn}/'
+
+    def revalidate(self, url):
+        etag = self.api.get(url)['ETag']
+        return etag, self.api.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_book_is_not_modified_without_serializing(self):
+        etag, response = self.revalidate(self.url)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        with CaptureQueriesContext(connection) as queries:
+            self.api.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        # At most the book's version and the user's favorites; no author/category/serializer queries.
+        self.assertLessEqual(len(queries), 2)
+        self.assertFalse([query for query in queries if 'books_author' in query['sql']])
+
+    def test_changes_to_copies_authors_and_favorites_change_the_etag(self):
+        etags = [self.api.get(self.url)['ETag']]
+        self.copy.status = 'Damaged'
+        self.copy.save()
+        etags.append(self.api.get(self.url)['ETag'])
+        self.author.name = 'Ursula Le Guin'
+        self.author.save()
+        etags.append(self.api.get(self.url)['ETag'])
+        self.api.post(f'/api/books/{self.book.isbn}/toggle-favorite/')
+        self.reader.clear_favorite_cache()
+        response = self.api.get(self.url, HTTP_IF_NONE_MATCH=etags[-1])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['is_favorite'])
+        etags.append(response['ETag'])
+        self.assertEqual(len(set(etags)), 4)
+
+    def test_book_list_uses_the_catalog_version(self):
+        newer = Book.objects.create(isbn='ISBN9780441013593', title='Dune')
+        etag, response = self.revalidate('/api/books/?page_size=10')
+        self.assertEqual(response.status_code, 304)
+        self.assertNotEqual(self.api.get('/api/books/?page_size=5')['ETag'], etag)
+        with self.assertNumQueries(1):
+            conditional.catalog_version()
+        # Deleting a book other than the last updated one leaves Max(last_updated) as it was; the
+        # deletion counter is in the database, so a worker with a cache of its own sees it too.
+        self.book.delete()
+        cache.clear()
+        self.assertEqual(conditional.catalog_version(), (newer.last_updated, 1))
+        self.assertEqual(self.api.get('/api/books/?page_size=10', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_portal_book_page(self):
+        self.client.force_login(self.reader)
+        url = reverse('books:portal_book_detail', args=[self.book.isbn])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.create(recipient=self.reader, notification_type='GENERAL_ANNOUNCEMENT', message='hi')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        self.media_root = media_root.name
+        self.book = Book.objects.create(isbn='ISBN9780140449136', title='Crime and Punishment')
+
+    def upload_cover(self, color='navy'):
+        from PIL import Image
+        output = BytesIO()
+        Image.new('RGB', (1200, 1800), color).save(output, 'JPEG')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.cover_image = SimpleUploadedFile('crime.jpg', output.getvalue(), content_type='image/jpeg')
+            self.book.save()
+        self.book.refresh_from_db()
+
+    def derivative_files(self):
+        return sorted(name for name in os.listdir(os.path.join(self.media_root, 'book_covers')) if name != 'crime.jpg')
+
+    def test_upload_generates_sized_webp_and_jpeg_derivatives(self):
+        from PIL import Image
+        self.upload_cover()
+        digest = self.book.cover_image_digest
+        self.assertEqual(len(digest), 16)
+        files = self.derivative_files()
+        self.assertEqual(len(files), 3 * 2 * 2)
+        self.assertIn(f'crime.{digest}.card-2x.webp', files)
+        with Image.open(os.path.join(self.media_root, 'book_covers', f'crime.{digest}.card-1x.jpg')) as card:
+            self.assertEqual(card.size, (240, 360))
+
+        html = Template("{% load responsive_images %}{% responsive_image book.cover_image 'card' alt=book.title %}")\
+            .render(Context({'book': self.book}))
+        self.assertIn(f'<source type="image/webp" srcset="/media/book_covers/crime.{digest}.card-1x.webp 1x, '
+                      f'/media/book_covers/crime.{digest}.card-2x.webp 2x">', html)
+        self.assertIn(f'<img src="/media/book_covers/crime.{digest}.card-1x.jpg"', html)
+
+        # A new upload gets new names.
+        self.upload_cover(color='maroon')
+        self.assertNotEqual(self.book.cover_image_digest, digest)
+
+    def test_backfill_command_uses_worker_processes(self):
+        self.upload_cover()
+        digest = self.book.cover_image_digest
+        for name in self.derivative_files():
+            os.remove(os.path.join(self.media_root, 'book_covers', name))
+        Book.objects.filter(pk=self.book.pk).update(cover_image_digest='')
+
+        out = StringIO()
+        call_command('generate_image_derivatives', workers=2, stdout=out)
+        self.assertIn("Processed 1 image(s)", out.getvalue())
+        self.assertEqual(Book.objects.get(pk=self.book.pk).cover_image_digest, digest)
+        self.assertEqual(len(self.derivative_files()), 12)
+
+
+@override_settings(DATABASE_READ_REPLICA='replica')
+class PrimaryReplicaRouterTests(SimpleTestCase):
+    router = PrimaryReplicaRouter()
+
+    def request(self, view, method='get', cookies=None):
+        request = getattr(RequestFactory(), method)('/')
+        request.COOKIES.update(cookies or {})
+        return PrimaryStickinessMiddleware(view)(request)
+
+    def test_catalog_reads_use_the_replica_until_the_request_writes(self):
+        routes = []
+
+        def view(request):
+            routes.extend([self.router.db_for_read(Book), self.router.db_for_read(Borrowing)])
+            with use_primary():
+                routes.append(self.router.db_for_read(Book))
+            routes.append(self.router.db_for_write(Borrowing))
+            routes.append(self.router.db_for_read(Book))
+            return HttpResponse()
+
+        response = self.request(view)
+        self.assertEqual(routes, ['replica', 'default', 'default', 'default', 'default'])
+        self.assertEqual(response.cookies[PIN_COOKIE].value, '1')
+
+    def test_reads_stay_on_the_primary_after_a_post(self):
+        response = self.request(lambda request: HttpResponse(), method='post')
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        routes = []
+        response = self.request(lambda request: routes.append(self.router.db_for_read(Book)) or HttpResponse(),
+                                cookies={PIN_COOKIE: '1'})
+        self.assertEqual(routes, ['default'])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+        self.request(lambda request: routes.append(self.router.db_for_read(Book)) or HttpResponse())
+        self.assertEqual(routes, ['default', 'replica'])
+
+
+class BenchmarkDataTests(TestCase):
+    counts = {
+        'authors': 20, 'categories': 6, 'books': 60, 'borrowers': 15, 'librarians': 1,
+        'borrowings': 400, 'notifications': 80, 'favorites': 40,
+    }
+
+    def seed(self, seed=7):
+        return seeding.BenchmarkDataGenerator(self.counts, seed=seed, chunk_size=25).run()
+
+    def snapshot(self):
+        return (
+            list(Book.objects.order_by('isbn').values_list('isbn', 'title', 'total_copies', 'available_copies')),
+            list(Borrowing.objects.order_by('request_date').values_list(
+                'borrower__username', 'book_copy__copy_id', 'status', 'fine_amount')),
+            list(FavoriteBook.objects.order_by('user__username', 'book').values_list('user__username', 'book')),
+        )
+
+    def test_same_seed_generates_the_same_data(self):
+        stats = self.seed()
+        self.assertEqual(stats['books'], 60)
+        self.assertEqual(stats['borrowings'], 400)
+        first = self.snapshot()
+
+        seeding.delete_seeded_data()
+        self.assertFalse(seeding.seeded_data_exists())
+        self.assertFalse(Author.objects.exists())
+        self.seed()
+        self.assertEqual(self.snapshot(), first)
+
+        seeding.delete_seeded_data()
+        self.seed(seed=8)
+        self.assertNotEqual(self.snapshot()[1], first[1])
+
+    def test_generated_data_is_consistent(self):
+        self.seed()
+        statuses = set(Borrowing.objects.values_list('status', flat=True))
+        self.assertEqual(statuses, {status for status, label in Borrowing.STATUS_CHOICES})
+
+        for book in Book.objects.all():
+            copies = book.copies.all()
+            self.assertEqual(book.total_copies, copies.count())
+            self.assertEqual(book.available_copies, copies.filter(status='Available').count())
+        open_loans = Borrowing.objects.filter(status__in=seeding.OPEN_STATUSES + ('LOST_BY_BORROWER',))
+        self.assertEqual(open_loans.count(), open_loans.values('book_copy').distinct().count())
+        self.assertFalse(Borrowing.objects.filter(status='OVERDUE', due_date__gte=timezone.localdate()).exists())
+        self.assertFalse(Borrowing.objects.filter(status='ACTIVE', due_date__lt=timezone.localdate()).exists())
+        for counter in UnreadNotificationCounter.objects.all():
+            self.assertEqual(counter.unread, Notification.objects.filter(recipient=counter.user_id, is_read=False).count())
+
+    def test_benchmark_run_reports_every_scenario(self):
+        self.seed()
+        scenarios = [benchmarks.SCENARIOS_BY_NAME[name] for name in ('portal_catalog', 'dashboard_history', 'api_books')]
+        result = benchmarks.run(scenarios, requests=3, concurrency=1, warmup=1)
+
+        self.assertEqual(result['meta']['dataset']['books'], 60)
+        for name in ('portal_catalog', 'dashboard_history', 'api_books'):
+            summary = result['scenarios'][name]
+            self.assertEqual(summary['status_codes'], {'200': 3})
+            self.assertEqual(summary['errors'], 0)
+            self.assertLessEqual(summary['latency_ms']['p50'], summary['latency_ms']['p99'])
+            self.assertGreater(summary['queries_per_request']['mean'], 0)
+
+        comparison = benchmarks.compare(result, json.loads(json.dumps(result)))
+        self.assertEqual(comparison['api_books']['p95']['change_pct'], 0.0)
+        self.assertEqual(benchmarks.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(benchmarks.percentile([1, 2, 3, 4], 99), 4)
+
+
+# URL name -> (who requests it, URL kwargs taken from QueryBudgetTests.fixture(), query budget).
+# Every named URL of the portal, the dashboard and the API is either here or in
+# QUERY_BUDGET_EXEMPT; a new view needs an entry (see lms/query_budget.py).
+QUERY_BUDGETS = {
+    # Portal
+    'books:portal_catalog': ('borrower', None, 21),
+    'books:portal_book_detail': ('borrower', lambda f: {'isbn': f['isbn']}, 16),
+    'books:portal_author_detail': ('borrower', lambda f: {'pk': f['author_id']}, 8),
+    'books:portal_category_detail': ('borrower', lambda f: {'pk': f['category_id']}, 8),
+    'books:portal_borrowing_detail': ('borrower', lambda f: {'borrowing_id': f['borrowing_id']}, 11),
+    'books:my_favorites': ('borrower', None, 4),
+    'users:my_profile': ('borrower', None, 5),
+    'users:edit_my_profile': ('borrower', None, 3),
+    'users:my_borrowings': ('borrower', None, 5),
+    'users:my_reservations': ('borrower', None, 3),
+    'users:my_notifications': ('borrower', None, 5),
+    'users:password_change': ('borrower', None, 3),
+    'users:register': (None, None, 0),
+    'users:login': (None, None, 0),
+    'users:staff_login': (None, None, 0),
+    'staff_login': (None, None, 0),
+    'users:password_reset': (None, None, 0),
+    'users:password_reset_done': (None, None, 0),
+    'users:password_reset_complete': (None, None, 0),
+    # Staff dashboard
+    'books:dashboard_home': ('staff', None, 2),
+    'books:dashboard_library_reports': ('staff', None, 9),
+    'books:dashboard_book_list': ('staff', None, 7),
+    'books:dashboard_book_add': ('staff', None, 4),
+    'books:dashboard_book_detail': ('staff', lambda f: {'isbn': f['isbn']}, 10),
+    'books:dashboard_book_edit': ('staff', lambda f: {'isbn': f['isbn']}, 7),
+    'books:dashboard_book_delete_confirm': ('staff', lambda f: {'isbn': f['isbn']}, 3),
+    'books:dashboard_bookcopy_list': ('staff', lambda f: {'isbn': f['isbn']}, 10),
+    'books:dashboard_bookcopy_add': ('staff', lambda f: {'book_isbn': f['isbn']}, 3),
+    'books:dashboard_bookcopy_batch_add': ('staff', lambda f: {'book_isbn': f['isbn']}, 3),
+    'books:dashboard_bookcopy_edit': ('staff', lambda f: {'pk': f['copy_id']}, 4),
+    'books:dashboard_bookcopy_delete_confirm': ('staff', lambda f: {'pk': f['copy_id']}, 4),
+    'books:dashboard_category_list': ('staff', None, 4),
+    'books:dashboard_category_add': ('staff', None, 2),
+    'books:dashboard_category_detail': ('staff', lambda f: {'pk': f['category_id']}, 7),
+    'books:dashboard_category_edit': ('staff', lambda f: {'pk': f['category_id']}, 3),
+    'books:dashboard_category_delete_confirm': ('staff', lambda f: {'pk': f['category_id']}, 6),
+    'books:dashboard_author_list': ('staff', None, 4),
+    'books:dashboard_author_add': ('staff', None, 2),
+    'books:dashboard_author_detail': ('staff', lambda f: {'pk': f['author_id']}, 7),
+    'books:dashboard_author_edit': ('staff', lambda f: {'pk': f['author_id']}, 3),
+    'books:dashboard_author_delete_confirm': ('staff', lambda f: {'pk': f['author_id']}, 6),
+    'books:dashboard_circulation_issue': ('staff', None, 4),
+    'books:dashboard_pending_requests': ('staff', None, 4),
+    'books:dashboard_active_loans': ('staff', None, 4),
+    'books:dashboard_borrowing_history': ('staff', None, 4),
+    'books:dashboard_export': ('staff', lambda f: {'dataset': 'loan-history'}, 3),
+    'books:dashboard_borrowing_detail': ('staff', lambda f: {'borrowing_id': f['borrowing_id']}, 8),
+    'books:dashboard_mark_loan_lost': ('staff', lambda f: {'borrowing_id': f['open_loan_id']}, 6),
+    'users:dashboard_borrower_list': ('staff', None, 6),
+    'users:dashboard_borrower_add': ('staff', None, 2),
+    'users:dashboard_borrower_detail': ('staff', lambda f: {'pk': f['borrower_id']}, 6),
+    'users:dashboard_borrower_edit': ('staff', lambda f: {'pk': f['borrower_id']}, 3),
+    'users:dashboard_borrower_delete_confirm': ('staff', lambda f: {'pk': f['borrower_id']}, 3),
+    'users:dashboard_staff_list': ('admin', None, 4),
+    'users:dashboard_staff_add': ('admin', None, 2),
+    'users:dashboard_staff_edit': ('admin', lambda f: {'pk': f['staff_id']}, 3),
+    'users:dashboard_staff_delete_confirm': ('admin', lambda f: {'pk': f['staff_id']}, 3),
+    # API (token authentication)
+    'api-root': ('borrower', None, 1),
+    'author-list': ('staff', None, 2),
+    'author-detail': ('staff', lambda f: {'pk': f['author_id']}, 2),
+    'book-list': ('borrower', None, 6),
+    'book-detail': ('borrower', lambda f: {'isbn': f['isbn']}, 6),
+    'book-available-copies-list': ('borrower', lambda f: {'isbn': f['isbn']}, 5),
+    'category-list': ('staff', None, 2),
+    'category-detail': ('staff', lambda f: {'pk': f['category_id']}, 2),
+    'bookcopy-list': ('staff', None, 5),
+    'bookcopy-detail': ('staff', lambda f: {'pk': f['copy_id']}, 5),
+    'borrowing-list': ('staff', None, 5),
+    'borrowing-detail': ('borrower', lambda f: {'pk': f['borrowing_id']}, 5),
+    'notification-list': ('borrower', None, 2),
+    'notification-detail': ('borrower', lambda f: {'pk': f['notification_id']}, 2),
+    'notification-unread-count': ('borrower', None, 1),
+    'list-user-favorites': ('borrower', None, 5),
+    'api_user_profile': ('borrower', None, 1),
+    'userdevice-list': ('borrower', None, 2),
+    'userdevice-detail': ('borrower', lambda f: {'pk': f['device_id']}, 2),
+    # Prometheus scrape endpoint
+    'metrics': ('admin', None, 4),
+    # Django admin
+    'admin:books_book_changelist': ('admin', None, 9),
+    'admin:books_bookcopy_changelist': ('admin', None, 6),
+    'admin:books_borrowing_changelist': ('admin', None, 6),
+    'admin:books_notification_changelist': ('admin', None, 6),
+    'admin:books_favoritebook_changelist': ('admin', None, 5),
+    'admin:users_customuser_changelist': ('admin', None, 6),
+}
+QUERY_BUDGET_EXEMPT = {
+    # Actions: POST only, or a GET that changes state and redirects
+    'books:portal_borrow_request', 'books:portal_borrowing_cancel', 'books:portal_borrow_renew', 'books:toggle_favorite',
+    'books:dashboard_approve_request', 'books:dashboard_reject_request', 'books:dashboard_mark_loan_returned',
+    'users:logout', 'toggle-book-favorite', 'borrowing-cancel-request', 'borrowing-return-book',
+    'notification-mark-all-as-read', 'notification-mark-as-read', 'api_user_register', 'api_user_login',
+    'api_user_logout', 'api_change_password', 'api_check_username', 'api_check_email',
+    # Needs a password reset token
+    'users:password_reset_confirm',
+    # Open-ended event stream (see RealtimeEventTests)
+    'notification-stream',
+}
+QUERY_BUDGET_SIZES = {
+    # Large enough that the lists on the measured pages have rows, so an empty list skipping its
+    # prefetch does not pass for a saved query (the catalog recommends titles beyond its six newest).
+    'small': {
+        'authors': 4, 'categories': 3, 'books': 10, 'borrowers': 3, 'librarians': 2,
+        'borrowings': 30, 'notifications': 10, 'favorites': 4,
+    },
+    'large': {
+        'authors': 30, 'categories': 8, 'books': 80, 'borrowers': 10, 'librarians': 4,
+        'borrowings': 400, 'notifications': 150, 'favorites': 60,
+    },
+}
+
+
+class QueryBudgetTests(TestCase):
+    def fixture(self):
+        context = benchmarks.build_context()
+        borrower, staff = context['users']['borrower'], context['users']['staff']
+        admin = CustomUser.objects.create_superuser(username='budget_admin', password=None, role='ADMIN')
+        device = UserDevice.objects.create(user=borrower, registration_id=f'budget-device-{borrower.pk}')
+        return {
+            'users': {'borrower': borrower, 'staff': staff, 'admin': admin},
+            'tokens': {
+                'borrower': context['tokens']['borrower'], 'staff': context['tokens']['staff'],
+                'admin': Token.objects.create(user=admin).key,
+            },
+            'isbn': context['isbn'],
+            'author_id': context['author_id'],
+            'category_id': context['category_id'],
+            'copy_id': BookCopy.objects.filter(book_id=context['isbn']).order_by('pk').first().pk,
+            'borrowing_id': borrower.borrowings.order_by('pk').first().pk,
+            'open_loan_id': Borrowing.objects.filter(status__in=['ACTIVE', 'OVERDUE']).order_by('pk').first().pk,
+            'notification_id': borrower.notifications.order_by('pk').first().pk,
+            'borrower_id': borrower.pk,
+            'staff_id': CustomUser.objects.filter(role='LIBRARIAN').exclude(pk=staff.pk).order_by('pk').first().pk,
+            'device_id': device.pk,
+        }
+
+    def measure_all(self):
+        """Requests every URL in QUERY_BUDGETS once to warm caches, then once within its budget."""
+        fixture = self.fixture()
+        measured = {}
+        for name, (who, kwargs, budget) in QUERY_BUDGETS.items():
+            url = reverse(name, kwargs=kwargs(fixture) if kwargs else None)
+            client = self.client_class()
+            if who and url.startswith('/api/'):
+                client.defaults['HTTP_AUTHORIZATION'] = f"Token {fixture['tokens'][who]}"
+            elif who:
+                client.force_login(fixture['users'][who])
+            with self.subTest(url=name):
+                client.get(url)
+                with query_budget(budget, label=name) as measured[name]:
+                    response = client.get(url)
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                self.assertEqual(response.status_code, 200, url)
+        return measured
+
+    def test_views_stay_within_their_budget_whatever_the_data_size(self):
+        measured = {}
+        for size, counts in QUERY_BUDGET_SIZES.items():
+            with transaction.atomic():
+                seeding.BenchmarkDataGenerator(counts, seed=5).run()
+                cache.clear()
+                measured[size] = self.measure_all()
+                transaction.set_rollback(True)
+        for name in QUERY_BUDGETS:
+            if name in measured['small'] and name in measured['large']:
+                with self.subTest(url=name):
+                    assert_no_growth(name, measured['small'][name], measured['large'][name])
+
+    def test_every_named_url_has_a_budget(self):
+        def names(patterns, namespace=''):
+            for pattern in patterns:
+                if isinstance(pattern, URLResolver):
+                    if pattern.namespace != 'admin':
+                        yield from names(pattern.url_patterns, f"{namespace}{pattern.namespace}:" if pattern.namespace else namespace)
+                elif pattern.name:
+                    yield f"{namespace}{pattern.name}"
+
+        unlisted = {name for name in names(get_resolver().url_patterns) if not name.startswith('password_reset:')}
+        unlisted -= set(QUERY_BUDGETS) | QUERY_BUDGET_EXEMPT
+        self.assertEqual(unlisted, set())
+
+    def test_query_budget_is_a_context_manager_and_a_decorator(self):
+        with query_budget(1) as budget:
+            Book.objects.count()
+        self.assertEqual(budget.count, 1)
+        with self.assertRaisesMessage(QueryBudgetExceeded, 'books: 2 queries, budget 1'):
+            with query_budget(1, label='books'):
+                Book.objects.count()
+                Book.objects.exists()
+
+        @query_budget(0)
+        def count_books():
+            return Book.objects.count()
+
+        with self.assertRaises(QueryBudgetExceeded):
+            count_books()
+
+
+class RequestTimingTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(isbn='9780000000061', title='Timed Book')
+        self.reader = CustomUser.objects.create_user(username='timed_reader')
+        self.client.force_login(self.reader)
+        self.url = reverse('books:portal_catalog')
+
+    def test_server_timing_header_reports_queries_and_templates(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        timing = dict(entry.split(';', 1) for entry in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'total', 'view', 'db', 'tpl'})
+        self.assertIn(f'desc="{len(queries)} queries"', timing['db'])
+        self.assertGreater(float(timing['tpl'].removeprefix('dur=')), 0)
+
+        with override_settings(REQUEST_TIMING_ENABLED=False):
+            self.assertNotIn('Server-Timing', self.client.get(self.url))
+
+    def test_sampled_and_slow_requests_are_logged(self):
+        with override_settings(REQUEST_TIMING_SAMPLE_RATE=1), self.assertLogs('lms.instrumentation', 'INFO') as logs:
+            self.client.get(self.url)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['url_name'], record['status'], record['slow']), ('books:portal_catalog', 200, False))
+        self.assertNotIn('sql', record)
+
+        with override_settings(REQUEST_TIMING_SAMPLE_RATE=0, REQUEST_TIMING_SLOW_MS=0), \
+                self.assertLogs('lms.instrumentation', 'WARNING') as logs:
+            self.client.get(self.url)
+        record = logs.records[0].request_timing
+        self.assertTrue(record['slow'])
+        self.assertEqual(record['sql']['recorded'], record['queries'])
+        self.assertTrue(any('books_book' in statement['sql'] for statement in record['sql']['slowest']))
+
+    def test_the_test_runner_turns_sampling_off(self):
+        with mock.patch('lms.instrumentation.random.random', return_value=0.0), \
+                self.assertNoLogs('lms.instrumentation', 'INFO'):
+            self.client.get(self.url)
+
+
+class LibraryKpiTests(TestCase):
+    def setUp(self):
+        cache.delete(kpis.KPI_CACHE_KEY)
+        self.addCleanup(cache.delete, kpis.KPI_CACHE_KEY)
+        self.book = Book.objects.create(isbn='9780000000601', title='Villette')
+        Book.objects.create(isbn='9780000000602', title='Shirley')
+        self.copies = [BookCopy.objects.create(book=self.book, copy_id=f'VIL-{index}') for index in range(4)]
+        CustomUser.objects.create_user(username='librarian', is_staff=True, role='LIBRARIAN')
+        readers = [CustomUser.objects.create_user(username=f'reader{index}') for index in range(3)]
+        due_date = timezone.localdate() + timedelta(days=14)
+        circulation.issue_copy(readers[0], self.book, due_date)
+        circulation.request_copy(readers[1], self.book, due_date)
+        Borrowing.objects.create(
+            borrower=readers[2], book_copy=self.copies[3], status='OVERDUE', due_date=timezone.localdate() - timedelta(days=1),
+        )
+
+    def test_computed_values(self):
+        self.assertEqual(kpis.compute_library_kpis(), {
+            'book_title_count': 2, 'book_copy_count': 4, 'available_copy_count': 2,
+            'active_loans_count': 1, 'overdue_loans_count': 1, 'pending_requests_count': 1,
+            'total_borrowers_count': 3,
+        })
+
+    def test_cache_hit_runs_no_queries(self):
+        computed = kpis.get_library_kpis()
+        with self.assertNumQueries(0):
+            self.assertEqual(kpis.get_library_kpis(), computed)
+
+    def test_writes_invalidate_on_commit_only(self):
+        # Each write reloads its row: a rolled back save leaves the instance ahead of the database.
+        def write_copy():
+            copy = BookCopy.objects.get(pk=self.copies[0].pk)
+            copy.status = 'Damaged'
+            copy.save()
+
+        def write_borrowing():
+            circulation.release_request(Borrowing.objects.get(status='REQUESTED'), 'REJECTED')
+
+        for write in (write_copy, write_borrowing, lambda: CustomUser.objects.create_user(username='walk-in')):
+            with self.subTest(write=write):
+                kpis.get_library_kpis()
+                with self.captureOnCommitCallbacks(execute=True):
+                    with self.assertRaises(RuntimeError), transaction.atomic():
+                        write()
+                        raise RuntimeError
+                self.assertIsNotNone(cache.get(kpis.KPI_CACHE_KEY))
+
+                with self.captureOnCommitCallbacks(execute=True):
+                    write()
+                    # Dropped when the transaction commits, not before.
+                    self.assertIsNotNone(cache.get(kpis.KPI_CACHE_KEY))
+                self.assertIsNone(cache.get(kpis.KPI_CACHE_KEY))
+        self.assertEqual(kpis.get_library_kpis()['pending_requests_count'], 0)
+
+    def test_template_tags(self):
+        template = Template(
+            "{% load library_kpis %}{% library_kpi 'pending_requests_count' %}|{% library_kpi 'unknown' %}|"
+            "{% library_kpi_block %}"
+        )
+        pending, unknown, block = template.render(Context({})).split('|', 2)
+        self.assertEqual((pending, unknown), ('1', '0'))
+        self.assertIn('Total Book Titles', block)
+
+        # The block reuses the view's KPIs instead of reading them again.
+        cache.delete(kpis.KPI_CACHE_KEY)
+        with self.assertNumQueries(0):
+            block = Template("{% load library_kpis %}{% library_kpi_block %}").render(
+                Context({'kpis': {'book_title_count': 42}}),
+            )
+        self.assertIn('42', block)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.enterContext(override_settings(METRICS={'BACKEND': 'lms.metrics.LocalStore'}))
+        metrics.REGISTRY.reset()
+        self.addCleanup(metrics.REGISTRY.reset)
+        self.book = Book.objects.create(isbn='9780000000078', title='Measured Book')
+        self.copy = BookCopy.objects.create(book=self.book, copy_id='MEAS-1')
+        self.reader = CustomUser.objects.create_user(username='measured_reader')
+
+    def scrape(self, client=None):
+        response = (client or self.client).get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        return response.content.decode().splitlines()
+
+    def test_requests_are_counted_and_timed_per_url_name(self):
+        self.client.force_login(self.reader)
+        for _ in range(3):
+            self.client.get(reverse('books:portal_catalog'))
+        self.client.get('/no-such-page/')
+        lines = self.scrape()
+
+        self.assertIn('lms_http_requests_total{endpoint="books:portal_catalog",method="GET",status="200"} 3', lines)
+        self.assertIn('lms_http_requests_total{endpoint="<unresolved>",method="GET",status="404"} 1', lines)
+        self.assertIn('# TYPE lms_http_request_duration_seconds histogram', lines)
+        self.assertIn('lms_http_request_duration_seconds_bucket{endpoint="books:portal_catalog",method="GET",le="+Inf"} 3', lines)
+        self.assertIn('lms_http_request_duration_seconds_count{endpoint="books:portal_catalog",method="GET"} 3', lines)
+        buckets = [
+            float(line.rsplit(' ', 1)[1]) for line in lines
+            if line.startswith('lms_http_request_duration_seconds_bucket{endpoint="books:portal_catalog"')
+        ]
+        self.assertEqual(len(buckets), len(metrics.LATENCY_BUCKETS) + 1)
+        self.assertEqual(buckets, sorted(buckets))
+
+    def test_circulation_events_notifications_and_queue_depths(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            borrowing = circulation.request_copy(self.reader, self.book, timezone.localdate() + timedelta(days=7))
+        cache.clear()
+        self.assertIn('lms_borrow_requests_pending 1', self.scrape())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            circulation.approve_request(borrowing)
+            Notification.objects.create(recipient=self.reader, notification_type='BORROW_APPROVED', message='Approved')
+        with self.captureOnCommitCallbacks(execute=True):
+            # A rolled back change is not counted.
+            with transaction.atomic():
+                borrowing.status = 'RETURNED'
+                borrowing.save()
+                transaction.set_rollback(True)
+        cache.clear()
+        lines = self.scrape()
+
+        self.assertIn('lms_circulation_events_total{event="requested"} 1', lines)
+        self.assertIn('lms_circulation_events_total{event="approved"} 1', lines)
+        self.assertFalse([line for line in lines if 'event="returned"' in line])
+        self.assertIn('lms_notifications_created_total{type="BORROW_APPROVED"} 1', lines)
+        self.assertIn('lms_borrow_requests_pending 0', lines)
+        self.assertIn('lms_loans_active 1', lines)
+        # Approval queued a push for the dispatcher.
+        self.assertIn('lms_push_outbox_pending 1', lines)
+
+    def test_due_reminders_count_overdue_loans_and_the_job(self):
+        Borrowing.objects.create(
+            borrower=self.reader, book_copy=self.copy, status='ACTIVE', due_date=timezone.localdate() - timedelta(days=2),
+        )
+        metrics.REGISTRY.reset()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('send_due_reminders', stdout=StringIO())
+        lines = self.scrape()
+        self.assertIn('lms_circulation_events_total{event="overdue"} 1', lines)
+        self.assertIn('lms_notifications_created_total{type="OVERDUE_ALERT"} 1', lines)
+        self.assertIn('lms_job_duration_seconds_count{job="send_due_reminders"} 1', lines)
+        self.assertTrue(any(line.startswith('lms_job_last_success_timestamp_seconds{job="send_due_reminders"}') for line in lines))
+
+    def test_scraping_needs_an_allowed_address_or_staff(self):
+        with override_settings(METRICS_ALLOWED_IPS=[]):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            self.client.force_login(self.reader)
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            self.client.force_login(CustomUser.objects.create_user(username='measured_librarian', role='LIBRARIAN'))
+            self.scrape()
+
+    def test_mmap_store_adds_up_the_files_of_every_process(self):
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        with override_settings(METRICS={'BACKEND': 'lms.metrics.MmapStore', 'OPTIONS': {'path': directory}}):
+            metrics.REGISTRY.reset()
+            metrics.CIRCULATION_EVENTS.inc(event='issued')
+            metrics.JOB_LAST_SUCCESS.set(100, job='nightly')
+            metrics.PUSH_BATCH_DURATION.observe(0.3)
+            # Another worker's file, with enough series to grow past the initial mapping.
+            other = MmapFile(os.path.join(directory, 'metrics_1.db'))
+            other.add(json.dumps(['lms_circulation_events_total', ['issued']]), 2)
+            other.set(json.dumps(['lms_job_last_success_timestamp_seconds', ['nightly']]), 50)
+            for index in range(3000):
+                other.add(json.dumps(['lms_notifications_created_total', [f'TYPE_{index}']]), index)
+            other.close()
+            # Reopening a file continues from its values.
+            other = MmapFile(os.path.join(directory, 'metrics_1.db'))
+            other.add(json.dumps(['lms_notifications_created_total', ['TYPE_2999']]), 1)
+            other.close()
+
+            lines = metrics.REGISTRY.expose().splitlines()
+            metrics.REGISTRY.reset()
+        self.assertIn('lms_circulation_events_total{event="issued"} 3', lines)
+        self.assertIn('lms_job_last_success_timestamp_seconds{job="nightly"} 100', lines)
+        self.assertIn('lms_notifications_created_total{type="TYPE_2999"} 3000', lines)
+        self.assertIn('lms_push_batch_duration_seconds_bucket{le="0.25"} 0', lines)
+        self.assertIn('lms_push_batch_duration_seconds_bucket{le="0.5"} 1', lines)
+        self.assertIn('lms_push_batch_duration_seconds_sum 0.3', lines)
+
+    def test_labels_are_checked(self):
+        with self.assertRaises(ValueError):
+            metrics.CIRCULATION_EVENTS.inc(kind='issued')
+        with self.assertRaises(ValueError):
+            metrics.CIRCULATION_EVENTS.inc(-1, event='issued')
+
+
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = Author.objects.create(name='Ursula Le Guin')
+        self.category = Category.objects.create(name='Speculative Fiction')
+        self.book = Book.objects.create(isbn='9780000000085', title='The Dispossessed')
+        self.book.authors.add(self.author)
+        self.book.categories.add(self.category)
+        self.url = reverse('books:portal_catalog')
+
+    def get(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_fragments_are_reused_until_something_they_show_changes(self):
+        with CaptureQueriesContext(connection) as first:
+            self.get()
+        with CaptureQueriesContext(connection) as second:
+            html = self.get()
+        # The category list and the newly added and popular sections come from the cache.
+        self.assertLess(len(second), len(first))
+        self.assertFalse([query for query in second if 'books_category' in query['sql'] and 'books_book' not in query['sql']])
+        self.assertIn('Unavailable', html)
+
+        BookCopy.objects.create(book=self.book, copy_id='DISP-1')
+        self.assertIn('Available (1)', self.get())
+
+        self.author.name = 'U. K. Le Guin'
+        self.author.save()
+        self.assertIn('U. K. Le Guin', self.get())
+
+        self.category.name = 'Science Fiction'
+        self.category.save()
+        self.assertIn('Science Fiction', self.get())
+
+    def test_category_list_is_shared_between_searches(self):
+        self.client.get(self.url, {'q': 'dispossessed'})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'q': 'anarres'})
+        self.assertFalse([query for query in queries if 'books_category' in query['sql'] and 'books_book' not in query['sql']])
+        html = response.content.decode()
+        self.assertIn(f'href="{self.url}?category={self.category.pk}&amp;q=anarres"', html)
+        self.assertIn(f'href="{self.url}?q=anarres"', html)
+        self.assertNotIn('dispossessed', html)
+        self.assertIn(f'href="{self.url}?category={self.category.pk}"', self.get())
+
+    def test_recommendations_are_only_shared_between_anonymous_visitors(self):
+        reader = CustomUser.objects.create_user(username='fragment_reader')
+        FavoriteBook.objects.create(user=reader, book=self.book)
+        self.get()
+        self.client.force_login(reader)
+        html = self.get()
+        self.assertIn('Your Recent Favorites', html)
+        # The only book is the reader's favorite, so nothing is left to recommend to them.
+        self.assertNotIn('Recommendations', html)
+
+    def test_category_version_is_kept_in_the_database(self):
+        version = fragments.collection_version('categories')
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            Category.objects.create(name='Poetry')
+            raise RuntimeError
+        self.assertEqual(fragments.collection_version('categories'), version)
+        self.category.name = 'Science Fiction'
+        self.category.save()
+        # Another worker, with a cache of its own, reads the same version from the database.
+        cache.clear()
+        self.assertEqual(fragments.collection_version('categories'), version + 1)
+        self.assertEqual(CollectionVersion.objects.get(name='categories').version, version + 1)
+
+    def test_fragment_tags(self):
+        template = Template(
+            "{% load fragment_cache %}{% fragmentcache 'categories' suffix %}{{ value }}{% endfragmentcache %}|"
+            "{% fragmentcache personal 'x' %}{{ value }}{% endfragmentcache %}|{% book_card book card_size='small' %}"
+        )
+        self.book.refresh_from_db()
+        first = template.render(Context({'value': 'one', 'suffix': 'a', 'personal': None, 'book': self.book}))
+        second = template.render(Context({'value': 'two', 'suffix': 'a', 'personal': None, 'book': self.book}))
+        self.assertEqual(first.split('|')[:2], ['one', 'one'])
+        self.assertEqual(second.split('|')[:2], ['one', 'two'])
+        self.assertIn('book-card-sm', second.split('|')[2])
+        self.assertIn('The Dispossessed', second.split('|')[2])
+
+        slotted = Template(
+            "{% load fragment_cache %}{% fragmentcache 'categories' with slot=slot %}{{ value }}[{{ slot }}]{% endfragmentcache %}"
+        )
+        self.assertEqual(slotted.render(Context({'value': 'one', 'slot': 'a&b'})), 'one[a&amp;b]')
+        self.assertEqual(slotted.render(Context({'value': 'two', 'slot': ''})), 'one[]')
+
+        fragments.bump('categories')
+        third = template.render(Context({'value': 'three', 'suffix': 'a', 'personal': None, 'book': self.book}))
+        self.assertEqual(third.split('|')[0], 'three')
+        with self.assertRaises(ValueError):
+            fragments.bump('books')
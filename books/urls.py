@@ -56,6 +56,7 @@ urlpatterns = [
     path('dashboard/circulation/active-loans/', views.StaffActiveLoansView.as_view(), name='dashboard_active_loans'),
     path('dashboard/circulation/active-loans/mark-returned/<int:borrowing_id>/', views.staff_mark_loan_returned_view, name='dashboard_mark_loan_returned'),
     path('dashboard/circulation/history/', views.StaffBorrowingHistoryView.as_view(), name='dashboard_borrowing_history'),
+    path('dashboard/export/<slug:dataset>/', views.StaffDataExportView.as_view(), name='dashboard_export'),
 
     # Borrowing Management (Staff)
     path('dashboard/borrowing/<int:borrowing_id>/', views.BorrowingDetailView.as_view(), name='dashboard_borrowing_detail'),
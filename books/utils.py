@@ -0,0 +1,20 @@
+# books/utils.py
+
+from django.utils.functional import SimpleLazyObject
+
+
+def get_favorite_isbns(request):
+    """
+    Returns a frozenset of the ISBNs favorited by the request's user (empty for anonymous users).
+    The set is loaded with one query the first time it is needed and then reused for the rest of
+    the request, so membership checks stay O(1) however many books are rendered or serialized.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return frozenset()
+    return user.favorite_isbns
+
+
+def favorite_isbns_context(request):
+    """Serializer context entry for BookSerializer.get_is_favorite, evaluated lazily."""
+    return {'favorite_isbns': SimpleLazyObject(lambda: get_favorite_isbns(request))}
@@ -6,24 +6,33 @@ from django.views import View
 from django.views.decorators.http import require_POST
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView, TemplateView
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from django.utils.translation import gettext_lazy as _
 from django.shortcuts import render, redirect, get_object_or_404
-from django.db.models import Q, F, Count, Case, When, Exists, OuterRef, ExpressionWrapper, fields
+from django.db.models import Q, F, Count, Sum, Case, When, Exists, OuterRef, ExpressionWrapper, fields, prefetch_related_objects
+from django.db.models.functions import Coalesce
 from django.urls import reverse_lazy, reverse
-from datetime import datetime
-from time import time
-from uuid import uuid4
+from datetime import datetime, timedelta
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.core.exceptions import PermissionDenied
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.conf import settings
 from decimal import Decimal
+from urllib.parse import urlencode
 from datetime import date
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
 
 # DRF Imports
 from rest_framework import viewsets, permissions, status, generics, serializers, filters
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.views import APIView
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from django_filters.rest_framework import DjangoFilterBackend
 
 # User-related imports
@@ -31,8 +40,17 @@ from users.decorators import is_staff_user, StaffRequiredMixin
 from users.models import CustomUser
 
 # App-specific imports
-from .filters import BookFilter
-from .models import Author, Book, Category, BookCopy, Borrowing, Notification
+from .filters import (
+    BookFilter, BookSearchFilter, HISTORICAL_BORROWING_STATUSES, filter_active_loans, filter_borrowing_history,
+)
+from .utils import get_favorite_isbns, favorite_isbns_context
+from .kpis import get_library_kpis
+from . import barcodes, circulation, conditional, events, exports, recommendations, search
+from .models import (
+    Author, Book, Category, BookCopy, Borrowing, FavoriteBook, Notification,
+    BorrowerCirculationStat, DailyCategoryCirculationStat, DailyCirculationStat,
+    OverdueLoanSnapshot, TitleCirculationStat, UnreadNotificationCounter,
+)
 from .serializers import (
     AuthorSerializer,
     BookSerializer,
@@ -46,6 +64,7 @@ from .serializers import (
 from .forms import BookForm, BookCopyForm, CategoryForm, AuthorForm, IssueBookForm, ReturnBookForm, BatchAddBookCopyForm
 
 CustomUser = get_user_model()
+logger = logging.getLogger(__name__)
 
 # --- Custom Permissions ---
 class IsLibrarianOrAdminPermission(permissions.BasePermission):
@@ -73,6 +92,7 @@ class AuthorViewSet(viewsets.ModelViewSet):
     search_fields = ['name', 'biography']
     ordering_fields = ['name', 'date_of_birth']
     filterset_fields = ['name']
+    cursor_ordering = ('name', 'id')
 
 class CategoryViewSet(viewsets.ModelViewSet):
     """API endpoint for categories."""
@@ -83,18 +103,37 @@ class CategoryViewSet(viewsets.ModelViewSet):
     search_fields = ['name', 'description']
     ordering_fields = ['name']
     filterset_fields = ['name']
+    # Small lookup table (filter dropdowns): always returned whole.
+    pagination_class = None
+
+class FavoriteIsbnsContextMixin:
+    """Adds the request's favorite ISBN set to the serializer context of views that serialize books."""
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context.update(favorite_isbns_context(self.request))
+        return context
 
-class BookViewSet(viewsets.ModelViewSet):
+class BookViewSet(FavoriteIsbnsContextMixin, viewsets.ModelViewSet):
     """API endpoint for books."""
-    queryset = Book.objects.all().prefetch_related('authors', 'categories', 'copies').order_by('title')
+    queryset = Book.objects.all().prefetch_related('authors', 'categories').order_by('title')
     serializer_class = BookSerializer
     lookup_field = 'isbn'
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    # BookSearchFilter answers ?search= from the catalog search index, ranked by relevance.
+    # No default `ordering` here so that OrderingFilter keeps the relevance order unless ?ordering= is given.
+    filter_backends = [DjangoFilterBackend, BookSearchFilter, filters.OrderingFilter]
     filterset_class = BookFilter
-    search_fields = ['title', 'isbn', 'authors__name', 'categories__name', 'description', 'publisher']
     ordering_fields = ['title', 'publication_date', 'total_borrows', 'date_added_to_system']
-    ordering = ['title']
-    
+    # Search results keep their relevance order; the cursor then breaks ties on (title, isbn).
+    cursor_ordering = ('title', 'isbn')
+
+    @conditional.conditional_get(conditional.book_list_etag)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional.conditional_get(conditional.book_detail_etag)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
     def get_permissions(self):
         """
         Instantiates and returns the list of permissions that this view requires.
@@ -112,14 +151,18 @@ class BookViewSet(viewsets.ModelViewSet):
         serializer = BookCopySerializer(available_copies, many=True, context={'request': request})
         return Response(serializer.data)
 
-class BookCopyViewSet(viewsets.ModelViewSet):
+class BookCopyViewSet(FavoriteIsbnsContextMixin, viewsets.ModelViewSet):
     """API endpoint for book copies."""
-    queryset = BookCopy.objects.all().select_related('book').order_by('book__title', 'copy_id')
+    queryset = BookCopy.objects.all().select_related('book')\
+        .prefetch_related('book__authors', 'book__categories').order_by('book__title', 'copy_id')
     permission_classes = [IsLibrarianOrAdminPermission]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['copy_id', 'book__title', 'book__isbn', 'condition_notes']
     ordering_fields = ['date_acquired', 'status', 'book__title', 'copy_id']
     filterset_fields = ['status', 'book__isbn', 'book__categories__name']
+    # Copy IDs start with the ISBN (see barcodes.py), so this still groups copies by title.
+    cursor_ordering = ('copy_id', 'id')
+    max_page_size = 200
 
     def get_serializer_class(self):
         if self.action in ['list', 'retrieve']:
@@ -127,12 +170,13 @@ class BookCopyViewSet(viewsets.ModelViewSet):
         return BookCopySerializer
 
     def perform_create(self, serializer):
-        serializer.save()
+        copy_id = serializer.validated_data.get('copy_id') or barcodes.next_copy_id(serializer.validated_data['book'])
+        serializer.save(copy_id=copy_id)
 
     def perform_update(self, serializer):
         serializer.save()
 
-class BorrowingViewSet(viewsets.ModelViewSet):
+class BorrowingViewSet(FavoriteIsbnsContextMixin, viewsets.ModelViewSet):
     """API endpoint for borrowing records."""
     serializer_class = BorrowingSerializer
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
@@ -146,15 +190,18 @@ class BorrowingViewSet(viewsets.ModelViewSet):
         'issue_date': ['exact', 'gte', 'lte', 'gt', 'lt'],
     }
     ordering_fields = ['issue_date', 'due_date', 'status', 'borrower__username']
-    ordering = ['-issue_date']
+    ordering = ['-request_date', 'id']
+    cursor_ordering = ('-request_date', 'id')
 
     def get_queryset(self):
         user = self.request.user
         if not user.is_authenticated:
             return Borrowing.objects.none()
+        queryset = Borrowing.objects.select_related('borrower', 'book_copy__book')\
+            .prefetch_related('book_copy__book__authors', 'book_copy__book__categories')
         if user.role in ['LIBRARIAN', 'ADMIN'] or user.is_staff:
-            return Borrowing.objects.all().select_related('borrower', 'book_copy__book')
-        return Borrowing.objects.filter(borrower=user).select_related('borrower', 'book_copy__book')
+            return queryset
+        return queryset.filter(borrower=user)
 
     def get_permissions(self):
         """
@@ -194,8 +241,8 @@ class BorrowingViewSet(viewsets.ModelViewSet):
             try:
                 fine_rate = Decimal(str(settings.FINE_RATE_PER_DAY_OVERDUE))
                 borrowing_record.fine_amount = Decimal(overdue_days) * fine_rate
-            except Exception as e:
-                print(f"CRITICAL ERROR calculating fine: {e}")
+            except Exception:
+                logger.exception("Could not calculate the fine of borrowing %s.", borrowing_record.pk)
         else:
             borrowing_record.status = 'RETURNED'
         Notification.objects.create(
@@ -203,7 +250,7 @@ class BorrowingViewSet(viewsets.ModelViewSet):
             notification_type='RETURN_CONFIRMED',
             message=_(f"Your loan for '{book_copy_instance.book.title}' has been returned.")
         )
-        return Response(BorrowingSerializer(borrowing_record, context={'request': request}).data)
+        return Response(BorrowingSerializer(borrowing_record, context=self.get_serializer_context()).data)
     
     @action(detail=True, methods=['post'], url_path='cancel-request', permission_classes=[permissions.IsAuthenticated])
     def cancel_request(self, request, pk=None):
@@ -213,8 +260,7 @@ class BorrowingViewSet(viewsets.ModelViewSet):
         if borrowing.status != 'REQUESTED':
             return Response({'detail': 'Only active requests (status "REQUESTED") can be cancelled.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        borrowing.status = 'CANCELLED'
-        borrowing.save(update_fields=['status'])
+        circulation.release_request(borrowing, 'CANCELLED')
 
         return Response({'detail': 'Borrow request cancelled successfully.'}, status=status.HTTP_200_OK)
 
@@ -226,32 +272,110 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['notification_type', 'is_read']
     ordering_fields = ['timestamp', 'notification_type']
+    cursor_ordering = ('-timestamp', 'id')
+    max_page_size = 50
 
     def get_queryset(self):
-        return Notification.objects.filter(recipient=self.request.user).order_by('-timestamp')
+        return Notification.objects.filter(recipient=self.request.user).order_by('-timestamp', 'id')
 
     @action(detail=False, methods=['get'], url_path='unread-count', permission_classes=[permissions.IsAuthenticated])
     def unread_count(self, request):
         """
         Returns the count of unread notifications for the currently authenticated user.
+        Answered from the user's UnreadNotificationCounter (usually cached), not by counting notifications.
         """
-        count = Notification.objects.filter(recipient=request.user, is_read=False).count()
+        count = UnreadNotificationCounter.cached_count(request.user.pk)
         return Response({'unread_count': count}, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=['post'], url_path='mark-all-read', permission_classes=[permissions.IsAuthenticated])
     def mark_all_as_read(self, request):
-        Notification.objects.filter(recipient=request.user, is_read=False).update(is_read=True)
+        Notification.objects.filter(recipient=request.user).mark_read()
         return Response({'detail': _('All notifications marked as read.')}, status=status.HTTP_200_OK)
 
     @action(detail=True, methods=['post'], url_path='mark-read', permission_classes=[permissions.IsAuthenticated])
     def mark_as_read(self, request, pk=None):
         notification = get_object_or_404(Notification, pk=pk, recipient=request.user)
-        if not notification.is_read:
-            notification.is_read = True
-            notification.save(update_fields=['is_read'])
+        notification.mark_read()
         return Response(NotificationSerializer(notification, context={'request': request}).data)
 
 
+# --- Real-time notification stream (Server-Sent Events) ---
+
+def _stream_user(request):
+    """The user of a stream request: from an `Authorization: Token ...` header, else the session."""
+    try:
+        authenticated = TokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    if authenticated is not None:
+        return authenticated[0]
+    return request.user if request.user.is_authenticated else None
+
+
+async def notification_stream_view(request):
+    """
+    GET /api/notifications/stream/ - a text/event-stream of the user's new notifications
+    ('notification' events) and, for staff, the dashboard KPIs whenever they change ('kpis' events).
+    The first event ('hello') carries the current unread count. Needs an ASGI server: every
+    connection is a coroutine waiting on the in-process event hub (see books/events.py), not a worker.
+    Under WSGI (runserver, the wsgi.py deployment) the stream would be buffered whole while holding
+    a worker, so the view answers 501 instead; clients then fall back to polling
+    /api/notifications/unread-count/ and the notification list.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse(
+            {'detail': _('The notification stream needs an ASGI server; poll the unread count instead.')}, status=501,
+        )
+    user = await sync_to_async(_stream_user)(request)
+    if user is None:
+        return JsonResponse({'detail': _('Authentication credentials were not provided.')}, status=401)
+    is_staff = user.is_staff or user.role in ['LIBRARIAN', 'ADMIN']
+    channels = [events.user_channel(user.pk)] + ([events.STAFF_CHANNEL] if is_staff else [])
+
+    response = StreamingHttpResponse(_notification_stream(user.pk, channels, is_staff), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def _notification_stream(user_id, channels, is_staff):
+    heartbeat = getattr(settings, 'NOTIFICATION_STREAM_HEARTBEAT_SECONDS', 15)
+    kpi_interval = getattr(settings, 'NOTIFICATION_STREAM_KPI_INTERVAL_SECONDS', 2)
+    lifetime = getattr(settings, 'NOTIFICATION_STREAM_MAX_SECONDS', 3600)
+    loop = asyncio.get_running_loop()
+
+    await sync_to_async(events.get_backend, thread_sensitive=False)()
+    subscription = events.get_hub().subscribe(channels)
+    try:
+        unread = await sync_to_async(UnreadNotificationCounter.cached_count)(user_id)
+        yield 'retry: 5000\n\n' + events.format_sse({'unread_count': unread}, event='hello')
+        if is_staff:
+            yield events.format_sse(await sync_to_async(get_library_kpis)(), event='kpis')
+
+        # KPI changes arrive in bursts (one per circulation write); send at most one update per kpi_interval.
+        kpis_sent_at, kpis_pending = loop.time(), False
+        closes_at = loop.time() + lifetime
+        while loop.time() < closes_at:
+            wait = heartbeat
+            if kpis_pending:
+                wait = max(0, min(wait, kpis_sent_at + kpi_interval - loop.time()))
+            try:
+                channel, event = await asyncio.wait_for(subscription.get(), wait)
+            except asyncio.TimeoutError:
+                channel, event = None, None
+            if event is not None and event.get('type') == 'kpis':
+                kpis_pending = True
+            elif event is not None:
+                yield events.format_sse(event, event=event.get('type'), event_id=event.get('id'))
+            if kpis_pending and loop.time() >= kpis_sent_at + kpi_interval:
+                yield events.format_sse(await sync_to_async(get_library_kpis)(), event='kpis')
+                kpis_sent_at, kpis_pending = loop.time(), False
+            elif event is None:
+                yield ': keep-alive\n\n'
+    finally:
+        subscription.close()
+
+
 # --- API Views for Favorites Feature ---
 
 class ToggleFavoriteAPIView(APIView):
@@ -265,32 +389,13 @@ class ToggleFavoriteAPIView(APIView):
         user = request.user
         book = get_object_or_404(Book, isbn=isbn)
 
-        if not hasattr(user, 'favorite_books') or not isinstance(user.favorite_books, list):
-            user.favorite_books = [] # Initialize if attribute doesn't exist or is not a list
-
-        is_currently_favorited = False
-        # Check if the book is already in favorites
-        for fav_item in user.favorite_books:
-            if fav_item.get('isbn') == book.isbn:
-                is_currently_favorited = True
-                break
-        
-        if is_currently_favorited:
-            # Remove from favorites
-            user.favorite_books = [fav for fav in user.favorite_books if fav.get('isbn') != book.isbn]
-            new_favorite_status = False
-            action_message = _("'{title}' removed from your favorites.").format(title=book.title)
-        else:
-            # Add to favorites with timestamp
-            user.favorite_books.append({
-                "isbn": book.isbn,
-                "favorited_at": timezone.now().isoformat()
-            })
+        if FavoriteBook.toggle(user, book):
             new_favorite_status = True
             action_message = _("'{title}' added to your favorites.").format(title=book.title)
+        else:
+            new_favorite_status = False
+            action_message = _("'{title}' removed from your favorites.").format(title=book.title)
 
-        user.save(update_fields=['favorite_books'])
-        
         return Response({
             'status': 'success',
             'message': action_message,
@@ -308,38 +413,17 @@ class ListFavoriteBooksAPIView(APIView):
     def get(self, request, format=None):
         user = request.user
         
-        if not hasattr(user, 'favorite_books') or not isinstance(user.favorite_books, list):
-            favorite_items = []
-        else:
-            favorite_items = user.favorite_books
-
-        # Sort favorites by 'favorited_at' timestamp in descending order (newest first)
-        # Handle items that might be missing 'favorited_at' by placing them at the end or using a default past date
-        def get_sort_key(item):
-            timestamp_str = item.get('favorited_at')
-            if timestamp_str:
-                try:
-                    return timezone.datetime.fromisoformat(timestamp_str)
-                except ValueError: # Handle cases where timestamp might be malformed
-                    return timezone.datetime.min.replace(tzinfo=timezone.utc) # or timezone.datetime.min
-            return timezone.datetime.min.replace(tzinfo=timezone.utc) # Default for items without a timestamp
-
-        sorted_favorites = sorted(favorite_items, key=get_sort_key, reverse=True)
-        
-        favorite_isbns = [fav.get('isbn') for fav in sorted_favorites if fav.get('isbn')]
-        
-        # Fetch book objects in the order of sorted_favorites
-        # This preserves the sort order based on 'favorited_at'
-        # We use a CASE WHEN to order by the list of ISBNs
-        if favorite_isbns:
-            preserved_order = Case(*[When(isbn=isbn, then=pos) for pos, isbn in enumerate(favorite_isbns)])
-            favorite_books_queryset = Book.objects.filter(isbn__in=favorite_isbns).order_by(preserved_order)
-        else:
-            favorite_books_queryset = Book.objects.none()
+        # Newest favorites first, straight off the (user, -favorited_at) index
+        favorite_books_queryset = Book.objects.filter(favorites__user=user)\
+                                              .prefetch_related('authors', 'categories')\
+                                              .order_by('-favorites__favorited_at')
             
         # Serialize the book data
-        # Pass the request to the serializer context so 'is_favorite' can be determined (it will be true for all these)
-        serializer = BookSerializer(favorite_books_queryset, many=True, context={'request': request})
+        # Pass the favorite ISBN set in the serializer context so 'is_favorite' is a set lookup per book
+        serializer = BookSerializer(
+            favorite_books_queryset, many=True,
+            context={'request': request, **favorite_isbns_context(request)}
+        )
         
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -378,30 +462,27 @@ class BookPortalCatalogView(ListView):
     template_name = 'books/portal/catalog.html'
     context_object_name = 'books'
     paginate_by = 12 
+    SECTION_ITEM_LIMIT = 6
 
     def get_queryset(self):
         queryset = super().get_queryset().prefetch_related(
-            'authors', 'categories', 'copies'
+            'authors', 'categories'
         )
         
         query_term = self.request.GET.get('q', '').strip()
         category_id_str = self.request.GET.get('category', '').strip()
 
-        if query_term:
-            queryset = queryset.filter(
-                Q(title__icontains=query_term) |
-                Q(authors__name__icontains=query_term) |
-                Q(isbn__iexact=query_term)
-            ).distinct()
-
         if category_id_str:
             try:
                 category_id = int(category_id_str)
                 queryset = queryset.filter(categories__id=category_id)
             except ValueError:
                 pass 
-        
-        return queryset.order_by('title')
+
+        queryset = queryset.order_by('title')
+        if query_term:
+            queryset = search.search_books(queryset, query_term)
+        return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -409,6 +490,8 @@ class BookPortalCatalogView(ListView):
 
         context['page_title'] = _("Library Catalog")
         context['search_term'] = self.request.GET.get('q', '')
+        # Appended to the category links, which are cached for every search (see catalog.html).
+        context['search_suffix'] = f"&{urlencode({'q': context['search_term']})}" if context['search_term'] else ''
         context['all_categories'] = Category.objects.all().order_by('name')
         
         selected_category_id_str = self.request.GET.get('category', '')
@@ -422,43 +505,22 @@ class BookPortalCatalogView(ListView):
             except (Category.DoesNotExist, ValueError):
                 pass 
 
-        SECTION_ITEM_LIMIT = 6
-
         # Home Favorites Section
         if user.is_authenticated:
-            if hasattr(user, 'favorite_books') and isinstance(user.favorite_books, list):
-                def get_sort_key(item):
-                    timestamp_str = item.get('favorited_at')
-                    if timestamp_str:
-                        try: return timezone.datetime.fromisoformat(timestamp_str)
-                        except ValueError: return timezone.datetime.min.replace(tzinfo=timezone.utc)
-                    return timezone.datetime.min.replace(tzinfo=timezone.utc)
-                sorted_favorites = sorted(user.favorite_books, key=get_sort_key, reverse=True)
-                home_favorite_isbns = [fav.get('isbn') for fav in sorted_favorites[:SECTION_ITEM_LIMIT] if fav.get('isbn')]
-                
-                if home_favorite_isbns:
-                    preserved_order = Case(*[When(isbn=isbn, then=pos) for pos, isbn in enumerate(home_favorite_isbns)])
-                    context['home_favorite_books'] = Book.objects.filter(isbn__in=home_favorite_isbns).prefetch_related('authors').order_by(preserved_order)
-                else:
-                    context['home_favorite_books'] = Book.objects.none()
-            else:
-                context['home_favorite_books'] = Book.objects.none()
+            context['home_favorite_books'] = Book.objects.filter(favorites__user=user)\
+                                                     .prefetch_related('authors')\
+                                                     .order_by('-favorites__favorited_at')[:self.SECTION_ITEM_LIMIT]
         else:
             context['home_favorite_books'] = Book.objects.none()
 
-        # Newly Added Books Section
-        context['newly_added_books'] = Book.objects.all().prefetch_related('authors').order_by('-date_added_to_system')[:SECTION_ITEM_LIMIT]
-
-        # Recommendations Section
-        excluded_isbns = set()
-        if context.get('home_favorite_books'):
-            excluded_isbns.update([b.isbn for b in context['home_favorite_books']])
-        if context.get('newly_added_books'):
-            excluded_isbns.update([b.isbn for b in context['newly_added_books']])
-        
-        context['recommended_books'] = Book.objects.exclude(
-            isbn__in=list(excluded_isbns)
-        ).prefetch_related('authors').order_by('-total_borrows', '?')[:SECTION_ITEM_LIMIT]
+        # The newly added and recommended sections are cached template fragments (books/fragments.py),
+        # so they are only queried when rendered. Recommendations are personal for logged-in users
+        # and only cached for anonymous visitors.
+        context['newly_added_books'] = Book.objects.all().prefetch_related('authors').order_by('-date_added_to_system')[:self.SECTION_ITEM_LIMIT]
+        context['recommended_books'] = SimpleLazyObject(
+            lambda: self.get_recommended_books(context['home_favorite_books'], context['newly_added_books'])
+        )
+        context['recommendations_fragment'] = None if user.is_authenticated else 'catalog'
 
         # --- Recent Active Borrows (Corrected for Book Primary Key) ---
         if user.is_authenticated:
@@ -497,6 +559,28 @@ class BookPortalCatalogView(ListView):
         context['other_query_params'] = query_params.urlencode()
         
         return context
+
+    def get_recommended_books(self, home_favorite_books, newly_added_books):
+        excluded_isbns = set()
+        excluded_isbns.update([b.isbn for b in home_favorite_books])
+        excluded_isbns.update([b.isbn for b in newly_added_books])
+
+        # Precomputed neighbours of the user's latest borrow/favorite (at most K rows),
+        # topped up with the most borrowed titles (read off the popularity index).
+        # Authors are fetched once for both parts.
+        recommended_books = [
+            book for book in recommendations.recommendations_for_user(self.request.user)
+            if book.isbn not in excluded_isbns
+        ][:self.SECTION_ITEM_LIMIT]
+        if len(recommended_books) < self.SECTION_ITEM_LIMIT:
+            excluded_isbns.update(book.isbn for book in recommended_books)
+            recommended_books += list(
+                Book.objects.exclude(isbn__in=list(excluded_isbns))
+                    .order_by('-total_borrows', 'isbn')[:self.SECTION_ITEM_LIMIT - len(recommended_books)]
+            )
+        prefetch_related_objects(recommended_books, 'authors')
+        return recommended_books
+
 class BookPortalDetailView(DetailView):
     model = Book
     template_name = 'books/portal/book_detail.html'
@@ -504,20 +588,20 @@ class BookPortalDetailView(DetailView):
     slug_field = 'isbn'
     slug_url_kwarg = 'isbn'
 
+    @conditional.conditional_get(conditional.portal_book_etag)
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        book_instance = self.get_object()
+        book_instance = self.object
         user = self.request.user
 
         context['page_title'] = book_instance.title
         context['view_context'] = 'portal'
 
         # Check if the book is favorited by the current user
-        is_favorite_book = False
-        if user.is_authenticated:
-            if hasattr(user, 'favorite_books') and isinstance(user.favorite_books, list):
-                is_favorite_book = any(fav_item.get('isbn') == book_instance.isbn for fav_item in user.favorite_books)
-        context['is_favorite_book'] = is_favorite_book
+        context['is_favorite_book'] = book_instance.isbn in get_favorite_isbns(self.request)
 
         # Borrower-specific flags and data
         if user.is_authenticated and not user.is_staff:
@@ -541,13 +625,15 @@ class BookPortalDetailView(DetailView):
         context['back_url'] = reverse_lazy('books:portal_catalog')
         context['available_book_copies'] = book_instance.copies.filter(status='Available')
 
-        first_category = book_instance.categories.first()
-        if first_category:
-            context['related_books'] = Book.objects.filter(categories=first_category)\
-                                           .exclude(isbn=book_instance.isbn)\
-                                           .prefetch_related('authors', 'copies')\
-                                           .annotate(available_copies_count=Count('copies', filter=Q(copies__status='Available')))\
-                                           .distinct()[:4]
+        related_books = list(recommendations.similar_books(book_instance, limit=4).prefetch_related('authors'))
+        if not related_books:
+            # Not in the precomputed recommendations yet (e.g. a new title): fall back to its first category.
+            first_category = book_instance.categories.first()
+            if first_category:
+                related_books = Book.objects.filter(categories=first_category)\
+                                            .exclude(isbn=book_instance.isbn)\
+                                            .prefetch_related('authors')[:4]
+        context['related_books'] = related_books
         return context
 
 class FavoriteToggleView(LoginRequiredMixin, View):
@@ -559,27 +645,10 @@ class FavoriteToggleView(LoginRequiredMixin, View):
         user = request.user
         book = get_object_or_404(Book, isbn=isbn)
 
-        if not hasattr(user, 'favorite_books') or not isinstance(user.favorite_books, list):
-            user.favorite_books = []
-
-        is_currently_favorited = False
-        # Check if the book is already in favorites
-        for fav_item in user.favorite_books:
-            if fav_item.get('isbn') == book.isbn:
-                is_currently_favorited = True
-                break
-        
-        if is_currently_favorited:
-            user.favorite_books = [fav for fav in user.favorite_books if fav.get('isbn') != book.isbn]
-            messages.success(request, _("'{title}' has been removed from your favorites.").format(title=book.title))
-        else:
-            user.favorite_books.append({
-                "isbn": book.isbn,
-                "favorited_at": timezone.now().isoformat()
-            })
+        if FavoriteBook.toggle(user, book):
             messages.success(request, _("'{title}' has been added to your favorites.").format(title=book.title))
-        
-        user.save(update_fields=['favorite_books'])
+        else:
+            messages.success(request, _("'{title}' has been removed from your favorites.").format(title=book.title))
         
         # Redirect back to the referring page or the book detail page
         # referrer = request.META.get('HTTP_REFERER', reverse('books:portal_book_detail', kwargs={'isbn': isbn}))
@@ -598,27 +667,9 @@ class MyFavoritesListView(LoginRequiredMixin, ListView):
 
     def get_queryset(self):
         user = self.request.user
-        if not hasattr(user, 'favorite_books') or not isinstance(user.favorite_books, list) or not user.favorite_books:
-            return Book.objects.none()
-
-        def get_sort_key(item):
-            timestamp_str = item.get('favorited_at')
-            if timestamp_str:
-                try:
-                    return timezone.datetime.fromisoformat(timestamp_str)
-                except ValueError:
-                    return timezone.datetime.min.replace(tzinfo=timezone.utc)
-            return timezone.datetime.min.replace(tzinfo=timezone.utc)
-
-        sorted_favorites_data = sorted(user.favorite_books, key=get_sort_key, reverse=True)
-        ordered_isbns = [fav_item['isbn'] for fav_item in sorted_favorites_data if fav_item.get('isbn')]
-
-        if not ordered_isbns:
-            return Book.objects.none()
-
-        # Preserve the order based on 'favorited_at'
-        preserved_order = Case(*[When(isbn=isbn, then=pos) for pos, isbn in enumerate(ordered_isbns)])
-        return Book.objects.filter(isbn__in=ordered_isbns).order_by(preserved_order)
+        return Book.objects.filter(favorites__user=user)\
+                           .prefetch_related('authors')\
+                           .order_by('-favorites__favorited_at')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -641,59 +692,64 @@ class PortalAuthorDetailView(DetailView):
         context['back_url'] = self.request.META.get('HTTP_REFERER', reverse_lazy('books:portal_catalog'))
         return context
     
+# Number of days covered by the "recent" figures on the reports page
+REPORT_WINDOW_DAYS = 30
+
 @login_required
 # @user_passes_test(is_staff_user) # Or your specific staff check decorator
 def library_reports_view(request):
-    # Overall Statistics
-    total_book_titles = Book.objects.count()
-    total_book_copies = BookCopy.objects.count()
-    total_borrowers = CustomUser.objects.filter(role='BORROWER').count()
-    active_loans_count = Borrowing.objects.filter(status='ACTIVE').count()
-    overdue_loans_count = Borrowing.objects.filter(status='OVERDUE').count()
-    pending_requests_count = Borrowing.objects.filter(status='REQUESTED').count()
+    """
+    Library statistics page. Circulation figures come only from the reporting rollup
+    tables (see books/reports.py), so the page never scans the Borrowing table.
+    """
+    today = timezone.localdate()
+    window_start = today - timedelta(days=REPORT_WINDOW_DAYS - 1)
 
     # Most Popular Books (Top 10)
-    popular_books = Book.objects.order_by('-total_borrows')[:10]
+    popular_books = TitleCirculationStat.objects.filter(loans_total__gt=0)\
+        .select_related('book').order_by('-loans_total')[:10]
 
     # Most Active Borrowers (Top 5 by loan count)
-    active_borrowers = CustomUser.objects.filter(role='BORROWER') \
-        .annotate(loan_count=Count('borrowings', filter=Q(borrowings__status__in=['ACTIVE', 'RETURNED', 'RETURNED_LATE', 'OVERDUE']))) \
-        .filter(loan_count__gt=0) \
-        .order_by('-loan_count')[:5]
+    active_borrowers = BorrowerCirculationStat.objects.filter(loans_total__gt=0, borrower__role='BORROWER')\
+        .select_related('borrower').order_by('-loans_total')[:5]
 
-    # Books by Category
+    # Books by Category, with loans over the report window
+    category_loans = dict(
+        DailyCategoryCirculationStat.objects.filter(day__gte=window_start)
+        .values_list('category').annotate(loans=Sum('loans_issued')).order_by()
+    )
     categories_summary = Category.objects.annotate(
-        book_title_count=Count('books', distinct=True),
-        total_copies_count=Count('books__copies')
+        book_title_count=Count('books'),
+        total_copies_count=Coalesce(Sum('books__total_copies'), 0),
     ).order_by('-book_title_count')
+    categories_summary = list(categories_summary)
+    for category_stat in categories_summary:
+        category_stat.recent_loans_count = category_loans.get(category_stat.id, 0)
+
+    # Loans by Borrower Type over the report window
+    borrower_type_labels = dict(CustomUser.BORROWER_TYPE_CHOICES)
+    loans_by_borrower_type = [
+        dict(row, label=borrower_type_labels.get(row['borrower_type'], _('Not set')))
+        for row in DailyCirculationStat.objects.filter(day__gte=window_start)
+            .values('borrower_type')
+            .annotate(loans=Sum('loans_issued'), returns=Sum('returns'), late_returns=Sum('late_returns'))
+            .order_by('-loans')
+    ]
 
     # Recently Added Books (Last 5)
     recently_added_books = Book.objects.order_by('-date_added_to_system')[:5]
 
-    # Overdue Loans List
-    now = timezone.now().date()
-    overdue_loans_list = Borrowing.objects.filter(status='OVERDUE', due_date__lt=now) \
-        .select_related('book_copy__book', 'borrower') \
-        .annotate(
-            days_overdue=ExpressionWrapper(now - F('due_date'), output_field=fields.DurationField())
-        ).order_by('due_date')
-
-    # Convert days_overdue (Timedelta) to integer days for display
-    for loan in overdue_loans_list:
-        loan.days_overdue = loan.days_overdue.days
-
+    # Overdue Loans List (days overdue is computed from the snapshot's due date)
+    overdue_loans_list = OverdueLoanSnapshot.objects.filter(due_date__lt=today).order_by('due_date')
 
     context = {
         'page_title': 'Library Reports',
-        'total_book_titles': total_book_titles,
-        'total_book_copies': total_book_copies,
-        'total_borrowers': total_borrowers,
-        'active_loans_count': active_loans_count,
-        'overdue_loans_count': overdue_loans_count,
-        'pending_requests_count': pending_requests_count,
+        'kpis': get_library_kpis(),  # Overall statistics (cached)
         'popular_books': popular_books,
         'active_borrowers': active_borrowers,
         'categories_summary': categories_summary,
+        'loans_by_borrower_type': loans_by_borrower_type,
+        'report_window_days': REPORT_WINDOW_DAYS,
         'recently_added_books': recently_added_books,
         'overdue_loans_list': overdue_loans_list,
     }
@@ -728,7 +784,7 @@ class PortalCategoryDetailView(DetailView):
         context['page_title'] = f"Category: {category_instance.name}"
         context['view_context'] = 'portal'
         context['can_edit_this_object'] = False
-        context['books_in_category'] = Book.objects.filter(categories=category_instance).prefetch_related('authors').annotate(num_available_copies=Count('copies', filter=Q(copies__status='Available'))).order_by('title')
+        context['books_in_category'] = Book.objects.filter(categories=category_instance).prefetch_related('authors').order_by('title')
         context['back_url'] = self.request.META.get('HTTP_REFERER', reverse_lazy('books:portal_catalog'))
         return context
     
@@ -745,7 +801,7 @@ class StaffCategoryDetailView(StaffRequiredMixin, DetailView):
         context['page_title'] = f"Category Details: {category_instance.name}"
         context['view_context'] = 'dashboard'
         context['can_edit_this_object'] = self.request.user.is_staff
-        context['books_in_category'] = Book.objects.filter(categories=category_instance).prefetch_related('authors').annotate(num_available_copies=Count('copies', filter=Q(copies__status='Available'))).order_by('title')
+        context['books_in_category'] = Book.objects.filter(categories=category_instance).prefetch_related('authors').order_by('title')
         context['back_url'] = reverse_lazy('books:dashboard_category_list')
         return context
 
@@ -773,27 +829,12 @@ def portal_create_borrow_request_view(request):
 
     book = get_object_or_404(Book, isbn=book_isbn)
 
-    if Borrowing.objects.filter(
-        borrower=request.user,
-        book_copy__book=book,
-        status__in=['REQUESTED', 'ACTIVE', 'OVERDUE']
-    ).exists():
-        messages.warning(request, _(f"You already have an active loan or pending request for '{book.title}'."))
-        return redirect('books:portal_book_detail', isbn=book_isbn)
-
     target_copy = None
     if selected_book_copy_id:
-        try:
-            target_copy = BookCopy.objects.get(id=selected_book_copy_id, book=book, status='Available')
-        except BookCopy.DoesNotExist:
+        target_copy = BookCopy.objects.filter(id=selected_book_copy_id, book=book).first()
+        if not target_copy:
             messages.error(request, _(f"The specific copy you selected is no longer available or invalid. Please try again."))
             return redirect('books:portal_book_detail', isbn=book_isbn)
-    else:
-        target_copy = BookCopy.objects.filter(book=book, status='Available').order_by('date_acquired', 'id').first()
-
-    if not target_copy:
-        messages.error(request, _(f"Sorry, no copies of '{book.title}' are currently available to request. Please try again later."))
-        return redirect('books:portal_book_detail', isbn=book_isbn)
 
     try:
         due_date = datetime.strptime(requested_due_date_str, '%Y-%m-%d').date()
@@ -811,28 +852,23 @@ def portal_create_borrow_request_view(request):
         messages.error(request, _("Invalid due date format submitted."))
         return redirect('books:portal_book_detail', isbn=book_isbn)
 
-    # Create the Borrowing record with status 'REQUESTED'
+    # Reserve a copy and create the Borrowing record with status 'REQUESTED' in one transaction;
+    # the reservation keeps concurrent requests from being handed the same copy.
     try:
-        Borrowing.objects.create(
-            borrower=request.user,
-            book_copy=target_copy,
-            due_date=due_date,
-            status='REQUESTED'
-        )
-        # Optionally, you could mark the available_copy as 'RESERVED_FOR_REQUEST' temporarily
-        # available_copy.status = 'Reserved' # Or a new status 'PendingApproval'
-        # available_copy.save()
-        # This needs careful thought: if many request at once, which one gets it?
-        # For now, we assume staff will see multiple requests if copies are available and pick.
-        # Or, only one request per copy. A better system might lock the copy during request.
-
-        messages.success(request, _(f"Your request for '{book.title}' (Copy ID: {target_copy.copy_id}) has been submitted."))
-        return redirect('users:my_borrowings')
-
-    except Exception as e:
-        messages.error(request, _(f"An error occurred while submitting your request: {e}"))
+        borrowing = circulation.request_copy(request.user, book, due_date, copy=target_copy)
+    except circulation.DuplicateBorrowing as e:
+        messages.warning(request, str(e))
+        return redirect('books:portal_book_detail', isbn=book_isbn)
+    except circulation.CopyUnavailable:
+        if target_copy:
+            messages.error(request, _(f"The specific copy you selected is no longer available or invalid. Please try again."))
+        else:
+            messages.error(request, _(f"Sorry, no copies of '{book.title}' are currently available to request. Please try again later."))
         return redirect('books:portal_book_detail', isbn=book_isbn)
 
+    messages.success(request, _(f"Your request for '{book.title}' (Copy ID: {borrowing.book_copy.copy_id}) has been submitted."))
+    return redirect('users:my_borrowings')
+
 
 @login_required
 def renew_book_view(request, borrowing_id): # Placeholder
@@ -856,12 +892,7 @@ def staff_dashboard_home_view(request):
 
     context = {
         'page_title': _("Staff Dashboard"),
-        'book_title_count': Book.objects.count(),
-        'book_copy_count': BookCopy.objects.count(),
-        'active_loans_count': Borrowing.objects.filter(status='ACTIVE').count(),
-        'overdue_loans_count': Borrowing.objects.filter(status='OVERDUE', return_date__isnull=True).count(),
-        'total_borrowers_count': CustomUser.objects.filter(role='BORROWER').count(),
-        'pending_requests_count': Borrowing.objects.filter(status='REQUESTED').count(),
+        'kpis': get_library_kpis(),
     }
     return render(request, 'dashboard/home.html', context)
 
@@ -920,43 +951,26 @@ class StaffBookListView(StaffRequiredMixin, ListView):
     paginate_by = 10
 
     def get_queryset(self):
-        queryset = Book.objects.all()
-        queryset = queryset.annotate(
-            copy_count=Count('copies')
-        )
-        available_copies_subquery = BookCopy.objects.filter(
-            book=OuterRef('pk'),
-            status='Available'
-        )
-        queryset = queryset.annotate(
-            has_available_copies=Exists(available_copies_subquery)
-        )
-
-        queryset = queryset.prefetch_related('authors', 'categories')
+        # Copy totals come from the denormalized Book.total_copies / Book.available_copies counters.
+        queryset = Book.objects.all().prefetch_related('authors', 'categories')
 
         search_term = self.request.GET.get('search', '').strip()
         category_id_filter = self.request.GET.get('category', '').strip()
         availability_filter = self.request.GET.get('availability', '').strip()
 
-        if search_term:
-            queryset = queryset.filter(
-                Q(title__icontains=search_term) |
-                Q(isbn__icontains=search_term) |
-                Q(authors__name__icontains=search_term) |
-                Q(categories__name__icontains=search_term) |
-                Q(publisher__icontains=search_term)
-            )
-        
         if category_id_filter:
             queryset = queryset.filter(categories__id=category_id_filter)
             
         if availability_filter:
             if availability_filter == 'available':
-                queryset = queryset.filter(has_available_copies=True)
+                queryset = queryset.filter(available_copies__gt=0)
             elif availability_filter == 'unavailable':
-                queryset = queryset.filter(has_available_copies=False)
+                queryset = queryset.filter(available_copies=0)
 
-        return queryset.order_by('title').distinct()
+        queryset = queryset.order_by('title')
+        if search_term:
+            queryset = search.search_books(queryset, search_term)
+        return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1100,7 +1114,9 @@ class StaffBookCopyCreateView(StaffRequiredMixin, CreateView):
 
     def form_valid(self, form):
         form.instance.book = self.book
-        messages.success(self.request, _(f"Copy '{form.cleaned_data.get('copy_id')}' for '{self.book.title}' added."))
+        if not form.instance.copy_id:
+            form.instance.copy_id = barcodes.next_copy_id(self.book)
+        messages.success(self.request, _(f"Copy '{form.instance.copy_id}' for '{self.book.title}' added."))
         return super().form_valid(form)
 
     def get_success_url(self):
@@ -1113,8 +1129,8 @@ class StaffBookCopyCreateView(StaffRequiredMixin, CreateView):
         context['form_mode'] = 'create'
         return context
     
-    def form_invalid(self, form): # For debugging: print form errors to the console
-        print(f"BookCopyForm errors: {form.errors.as_json()}")
+    def form_invalid(self, form):
+        logger.debug("BookCopyForm errors: %s", form.errors.as_json())
         for field, errors in form.errors.items():
             for error in errors:
                 if field == '__all__':
@@ -1149,39 +1165,17 @@ class StaffBatchAddBookCopiesView(StaffRequiredMixin, View):
             condition_notes = form.cleaned_data['condition_notes']
             copy_id_prefix = form.cleaned_data.get('copy_id_prefix', '').strip()
 
-            new_copies = []
-            for i in range(number_of_copies):
-                # Generate a unique provisional copy_id
-                # This is a simple approach; you might want something more robust or sequential
-                # based on existing copy IDs for that book.
-                timestamp_suffix = int(time() * 1000) # Milliseconds for more uniqueness
-                unique_part = f"{timestamp_suffix}-{i+1}" 
-                
-                provisional_copy_id = f"{copy_id_prefix}{book.isbn}-{unique_part}"
-                if len(provisional_copy_id) > 100: # Ensure it doesn't exceed max_length of copy_id
-                    provisional_copy_id = provisional_copy_id[:97] + "..."
-
-
-                # Check for extremely unlikely collision, loop to find a unique one
-                while BookCopy.objects.filter(copy_id=provisional_copy_id).exists():
-                    unique_part = f"{int(time() * 1000)}-{i+1}-{uuid4().hex[:4]}"
-                    provisional_copy_id = f"{copy_id_prefix}{book.isbn}-{unique_part}"
-                    if len(provisional_copy_id) > 100:
-                         provisional_copy_id = provisional_copy_id[:97] + "..."
-                
-                new_copies.append(
-                    BookCopy(
-                        book=book,
-                        copy_id=provisional_copy_id,
-                        status=default_status,
-                        date_acquired=date_acquired,
-                        condition_notes=condition_notes
-                    )
-                )
-            
             try:
-                BookCopy.objects.bulk_create(new_copies)
-                messages.success(request, _(f"{number_of_copies} new copies for '{book.title}' added successfully with provisional IDs. Please review and update IDs as needed."))
+                # One sequence reservation plus one bulk INSERT, however many copies are added.
+                new_copies = barcodes.create_copies(
+                    book,
+                    number_of_copies,
+                    library_prefix=copy_id_prefix,
+                    status=default_status,
+                    date_acquired=date_acquired,
+                    condition_notes=condition_notes,
+                )
+                messages.success(request, _(f"{number_of_copies} new copies for '{book.title}' added ({new_copies[0].copy_id} to {new_copies[-1].copy_id})."))
                 return redirect('books:dashboard_bookcopy_list', isbn=book.isbn)
             except Exception as e:
                 messages.error(request, _(f"An error occurred while adding copies: {e}"))
@@ -1270,7 +1264,7 @@ class StaffCategoryListView(StaffRequiredMixin, ListView):
                 Q(name__icontains=search_term) |
                 Q(description__icontains=search_term)
             ).distinct()
-        return queryset.order_by('name')
+        return queryset.annotate(book_count=Count('books', distinct=True)).order_by('name')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1337,7 +1331,7 @@ class StaffAuthorListView(StaffRequiredMixin, ListView):
                 Q(name__icontains=search_term) |
                 Q(biography__icontains=search_term)
             ).distinct()
-        return queryset.order_by('name')
+        return queryset.annotate(book_count=Count('books', distinct=True)).order_by('name')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1404,22 +1398,12 @@ def staff_issue_book_view(request):
 
             current_time = timezone.now()
 
-            if book_copy.status == 'Available':
-                Borrowing.objects.create(
-                    borrower=borrower,
-                    book_copy=book_copy,
-                    issue_date=current_time,
-                    due_date=due_date,
-                    status='ACTIVE',
-                )
-                book_copy.status = 'On Loan'
-                book_copy.save(update_fields=['status'])
-
-                book_title = book_copy.book
-                book_title.total_borrows = F('total_borrows') + 1
-                book_title.save(update_fields=['total_borrows'])
-                book_title.refresh_from_db()
-
+            try:
+                circulation.issue_copy(borrower, book_copy.book, due_date, copy=book_copy, issue_date=current_time)
+            except circulation.CopyUnavailable:
+                book_copy.refresh_from_db(fields=['status'])
+                messages.error(request, _(f"Book copy '{book_copy.copy_id}' is no longer available. Current status: {book_copy.get_status_display()}"))
+            else:
                 Notification.objects.create(
                     recipient=borrower,
                     notification_type='BORROW_APPROVED',
@@ -1427,8 +1411,6 @@ def staff_issue_book_view(request):
                 )
                 messages.success(request, _(f"Book '{book_copy.book.title}' (Copy: {book_copy.copy_id}) issued to {borrower.username}."))
                 return redirect('books:dashboard_active_loans')
-            else:
-                messages.error(request, _(f"Book copy '{book_copy.copy_id}' is no longer available. Current status: {book_copy.get_status_display()}"))
     else:
         form = IssueBookForm()
 
@@ -1479,30 +1461,27 @@ def staff_approve_request_view(request, borrowing_id):
     """Approves a pending borrow request."""
     borrowing_request = get_object_or_404(Borrowing, id=borrowing_id, status='REQUESTED')
     book_copy = borrowing_request.book_copy
-    if book_copy.status == 'Available':
-        borrowing_request.status = 'ACTIVE'
-        borrowing_request.issue_date = timezone.now()
-        borrowing_request.save()
-        book_copy.status = 'On Loan'
-        book_copy.save()
-        book_title = book_copy.book
-        Book.objects.filter(pk=book_title.pk).update(total_borrows=F('total_borrows') + 1)
-        Notification.objects.create(
-            recipient=borrowing_request.borrower,
-            notification_type='BORROW_APPROVED',
-            message=f"Your request for '{book_copy.book.title}' has been approved. Due: {borrowing_request.due_date.strftime('%Y-%m-%d')}."
+    try:
+        circulation.approve_request(borrowing_request)
+    except circulation.CopyUnavailable:
+        book_copy.refresh_from_db(fields=['status'])
+        circulation.release_request(
+            borrowing_request, 'REJECTED',
+            notes=f"Copy '{book_copy.copy_id}' became unavailable (Status: {book_copy.get_status_display()}) before approval.",
         )
-        messages.success(request, _(f"Request for '{book_copy.book.title}' approved."))
-    else:
-        borrowing_request.status = 'REJECTED'
-        borrowing_request.notes_by_librarian = f"Copy '{book_copy.copy_id}' became unavailable (Status: {book_copy.get_status_display()}) before approval."
-        borrowing_request.save()
         Notification.objects.create(
             recipient=borrowing_request.borrower,
             notification_type='BORROW_REJECTED',
             message=f"Your request for '{book_copy.book.title}' could not be approved as the copy is no longer available."
         )
         messages.error(request, _(f"Could not approve. Copy '{book_copy.copy_id}' is not available."))
+    else:
+        Notification.objects.create(
+            recipient=borrowing_request.borrower,
+            notification_type='BORROW_APPROVED',
+            message=f"Your request for '{book_copy.book.title}' has been approved. Due: {borrowing_request.due_date.strftime('%Y-%m-%d')}."
+        )
+        messages.success(request, _(f"Request for '{book_copy.book.title}' approved."))
     return redirect('books:dashboard_pending_requests')
 
 @user_passes_test(is_staff_user)
@@ -1510,8 +1489,7 @@ def staff_approve_request_view(request, borrowing_id):
 def staff_reject_request_view(request, borrowing_id):
     """Rejects a pending borrow request."""
     borrowing_request = get_object_or_404(Borrowing, id=borrowing_id, status='REQUESTED')
-    borrowing_request.status = 'REJECTED'
-    borrowing_request.save()
+    circulation.release_request(borrowing_request, 'REJECTED')
     Notification.objects.create(
         recipient=borrowing_request.borrower,
         notification_type='BORROW_REJECTED',
@@ -1532,32 +1510,12 @@ class StaffActiveLoansView(StaffRequiredMixin, ListView):
     paginate_by = 10
 
     def get_queryset(self):
-        queryset = Borrowing.objects.filter(status__in=['ACTIVE', 'OVERDUE']) \
-                                    .select_related('borrower', 'book_copy__book') \
-                                    .order_by('due_date')
-
-        search_term = self.request.GET.get('search', '').strip()
-        status_filter = self.request.GET.get('status_filter', '').strip().upper()
-
-        if search_term:
-            queryset = queryset.filter(
-                Q(borrower__username__icontains=search_term) |
-                Q(borrower__first_name__icontains=search_term) |
-                Q(borrower__last_name__icontains=search_term) |
-                Q(book_copy__book__title__icontains=search_term) |
-                Q(book_copy__copy_id__icontains=search_term) |
-                Q(book_copy__book__isbn__icontains=search_term)
-            )
-
-        if status_filter:
-            if status_filter == 'OVERDUE':
-                queryset = queryset.filter(status='OVERDUE')
-            elif status_filter == 'ACTIVE_NOT_OVERDUE':
-                queryset = queryset.filter(status='ACTIVE', due_date__gte=timezone.now().date())
-            elif status_filter == 'ACTIVE':
-                queryset = queryset.filter(status='ACTIVE')
-            
-        return queryset
+        queryset = Borrowing.objects.select_related('borrower', 'book_copy__book').order_by('due_date')
+        return filter_active_loans(
+            queryset,
+            search_term=self.request.GET.get('search', ''),
+            status_filter=self.request.GET.get('status_filter', ''),
+        )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1587,36 +1545,13 @@ class StaffBorrowingHistoryView(StaffRequiredMixin, ListView):
     paginate_by = 15
 
     def get_queryset(self):
-        # Define statuses that represent "historical" or "closed" records
-        historical_statuses = [
-            'RETURNED', 'RETURNED_LATE', 
-            'REJECTED', 'CANCELLED', 
-            'LOST_BY_BORROWER'
-        ]
-        
-        queryset = Borrowing.objects.filter(status__in=historical_statuses) \
-                                    .select_related('borrower', 'book_copy__book') \
+        queryset = Borrowing.objects.select_related('borrower', 'book_copy__book') \
                                     .order_by('-return_date', '-request_date') # Show most recently concluded first
-
-        # --- Search Functionality ---
-        search_term = self.request.GET.get('search', '').strip()
-        status_filter = self.request.GET.get('status_filter', '').strip()
-
-        if search_term:
-            queryset = queryset.filter(
-                Q(borrower__username__icontains=search_term) |
-                Q(borrower__first_name__icontains=search_term) |
-                Q(borrower__last_name__icontains=search_term) |
-                Q(book_copy__book__title__icontains=search_term) |
-                Q(book_copy__copy_id__icontains=search_term) |
-                Q(book_copy__book__isbn__icontains=search_term)
-            )
-        
-        if status_filter:
-            queryset = queryset.filter(status=status_filter)
-        # --- End Search Functionality ---
-            
-        return queryset
+        return filter_borrowing_history(
+            queryset,
+            search_term=self.request.GET.get('search', ''),
+            status_filter=self.request.GET.get('status_filter', ''),
+        )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1625,7 +1560,7 @@ class StaffBorrowingHistoryView(StaffRequiredMixin, ListView):
         context['current_search'] = self.request.GET.get('search', '')
         context['historical_status_choices'] = [
             choice for choice in Borrowing.STATUS_CHOICES 
-            if choice[0] in ['RETURNED', 'RETURNED_LATE', 'REJECTED', 'CANCELLED', 'LOST_BY_BORROWER']
+            if choice[0] in HISTORICAL_BORROWING_STATUSES
         ]
         context['current_status_filter'] = self.request.GET.get('status_filter', '')
 
@@ -1635,6 +1570,35 @@ class StaffBorrowingHistoryView(StaffRequiredMixin, ListView):
 
         return context
 
+class StaffDataExportView(StaffRequiredMixin, View):
+    """
+    Streams a whole dataset (see books/exports.py) as CSV or JSON Lines, e.g.
+    /dashboard/export/loan-history/?format=jsonl&search=tolkien&status_filter=RETURNED.
+    Accepts the same `search` and `status_filter` (`availability` and `category` for books) parameters as the
+    circulation and book list pages, so an export matches what the page shows, unpaginated.
+    """
+    def get(self, request, dataset):
+        if dataset not in exports.DATASETS:
+            raise Http404(_("Unknown export."))
+        file_format = request.GET.get('format', 'csv')
+        if file_format not in exports.FORMATS:
+            return HttpResponseBadRequest(_("Unsupported export format."))
+
+        header, rows = exports.dataset_rows(
+            dataset,
+            search_term=request.GET.get('search', ''),
+            status=request.GET.get('status_filter') or request.GET.get('availability', ''),
+            category=request.GET.get('category', '').strip(),
+        )
+        response = StreamingHttpResponse(
+            exports.export_rows(header, rows, file_format), content_type=exports.FORMATS[file_format]
+        )
+        filename = f"{dataset}-{timezone.localdate():%Y%m%d}.{file_format}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        # Let a buffering reverse proxy (nginx) pass the rows on as they are produced.
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
 class BorrowingDetailView(LoginRequiredMixin, DetailView):
     model = Borrowing
     pk_url_kwarg = 'borrowing_id' # To match the URL
@@ -1726,9 +1690,8 @@ def borrower_cancel_request_view(request, borrowing_id):
         return redirect(request.META.get('HTTP_REFERER', reverse_lazy('users:my_borrowings'))) # Sensible fallback
 
     # Proceed to cancel
-    borrowing_request.status = 'CANCELLED'
-    # Optionally, add a note if your model supports it, e.g., borrowing_request.notes_by_borrower = "Cancelled by user."
-    borrowing_request.save(update_fields=['status']) # Only update status field
+    # Cancelling also puts the copy reserved for the request back on the shelf.
+    circulation.release_request(borrowing_request, 'CANCELLED')
 
     # Optional: Notify staff that a request was cancelled by the user, if desired
     # For example, by creating a Notification for staff or logging it.
@@ -1770,8 +1733,8 @@ def staff_mark_loan_returned_view(request, borrowing_id):
                 fine_amount_calculated = Decimal(overdue_days) * fine_rate
                 loan.fine_amount = fine_amount_calculated
                 fine_message_segment = _(f" A fine of ${fine_amount_calculated:.2f} has been applied for {overdue_days} day(s) overdue.")
-            except Exception as e:
-                print(f"Error calculating fine for borrowing ID {loan.id}: {e}")
+            except Exception:
+                logger.exception("Could not calculate the fine of borrowing %s.", loan.pk)
                 messages.warning(request, _("The book was marked as returned late, but there was an issue calculating the fine. Please check system settings."))
     else:
         loan.status = 'RETURNED'
@@ -0,0 +1,203 @@
+"""
+Per-request performance instrumentation.
+
+RequestTimingMiddleware (first in MIDDLEWARE) measures every request:
+
+* total: the whole request, all middleware included
+* view:  from the view being called until its response is back, templates included
+* db:    number of SQL queries and time spent in them, on every database alias,
+         through connection.execute_wrapper()
+* tpl:   time spent rendering templates (through the DjangoTemplates backend below)
+
+The numbers go back to the client in a `Server-Timing` header (shown by the browser's network
+panel) and, for a sample of the requests (REQUEST_TIMING_SAMPLE_RATE), to the
+'lms.instrumentation' logger as one JSON object per request, keyed by URL name:
+
+    {"url_name": "books:portal_catalog", "method": "GET", "status": 200, "total_ms": 48.1,
+     "view_ms": 45.7, "db_ms": 12.9, "queries": 19, "template_ms": 21.4, ...}
+
+Requests slower than REQUEST_TIMING_SLOW_MS are always logged (as warnings) with their SQL:
+the slowest statements and the statements repeated most often (the signature of an N+1).
+Statements are recorded without their parameters.
+
+Every request is also counted in the metrics served at /metrics (lms/metrics.py): a latency
+histogram and a queries-per-request histogram per URL name, and a request counter per status.
+"""
+import json
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.template.backends import django as django_backend
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('request_timing', default=None)
+
+HTTP_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class RequestTiming:
+    """The measurements of one request; also the execute_wrapper counting its queries."""
+
+    def __init__(self, max_statements):
+        self.started = time.perf_counter()
+        self.view_started = None
+        self.view_seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.max_statements = max_statements
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.queries += 1
+            self.db_seconds += duration
+            if len(self.statements) < self.max_statements:
+                self.statements.append((duration, sql))
+
+    def server_timing(self, total_seconds):
+        entries = [
+            ('total', total_seconds, None),
+            ('view', self.view_seconds, None),
+            ('db', self.db_seconds, f"{self.queries} queries"),
+            ('tpl', self.template_seconds, None),
+        ]
+        return ', '.join(
+            f'{name};dur={seconds * 1000:.1f}' + (f';desc="{description}"' if description else '')
+            for name, seconds, description in entries
+        )
+
+    def sql_summary(self, limit=10):
+        """The slowest statements and the most repeated ones."""
+        slowest = sorted(self.statements, key=lambda statement: statement[0], reverse=True)[:limit]
+        repeated = Counter(sql for duration, sql in self.statements).most_common(limit)
+        return {
+            'slowest': [{'ms': round(duration * 1000, 2), 'sql': sql} for duration, sql in slowest],
+            'repeated': [{'count': count, 'sql': sql} for sql, count in repeated if count > 1],
+            'recorded': len(self.statements),
+        }
+
+
+def url_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is not None and match.view_name:
+        return match.view_name
+    return None
+
+
+class RequestTimingMiddleware:
+    """Times each request's view, SQL and templates; see the module docstring."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not _setting('REQUEST_TIMING_ENABLED', True):
+            return self.get_response(request)
+
+        timing = RequestTiming(_setting('REQUEST_TIMING_MAX_SQL', 100))
+        token = _current.set(timing)
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(timing))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        total_seconds = time.perf_counter() - timing.started
+        if timing.view_started is not None:
+            timing.view_seconds = time.perf_counter() - timing.view_started
+
+        self.record_metrics(request, response, timing, total_seconds)
+        if _setting('REQUEST_TIMING_HEADER', True):
+            response['Server-Timing'] = timing.server_timing(total_seconds)
+        slow = total_seconds * 1000 >= _setting('REQUEST_TIMING_SLOW_MS', 500)
+        sampled = random.random() < _setting('REQUEST_TIMING_SAMPLE_RATE', 0.01)
+        if slow or sampled:
+            self.log(request, response, timing, total_seconds, slow)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timing = _current.get()
+        if timing is not None:
+            timing.view_started = time.perf_counter()
+        return None
+
+    def record_metrics(self, request, response, timing, total_seconds):
+        # URL names, not paths, keep the number of series bounded (404s share one).
+        endpoint = url_name(request) or '<unresolved>'
+        method = request.method if request.method in HTTP_METHODS else 'other'
+        metrics.HTTP_REQUESTS.inc(endpoint=endpoint, method=method, status=response.status_code)
+        metrics.HTTP_REQUEST_DURATION.observe(total_seconds, endpoint=endpoint, method=method)
+        metrics.HTTP_REQUEST_QUERIES.observe(timing.queries, endpoint=endpoint)
+
+    def log(self, request, response, timing, total_seconds, slow):
+        record = {
+            'url_name': url_name(request) or request.path,
+            'method': request.method,
+            'status': response.status_code,
+            'total_ms': round(total_seconds * 1000, 2),
+            'view_ms': round(timing.view_seconds * 1000, 2),
+            'db_ms': round(timing.db_seconds * 1000, 2),
+            'queries': timing.queries,
+            'template_ms': round(timing.template_seconds * 1000, 2),
+            'slow': slow,
+        }
+        if slow:
+            record['path'] = request.path
+            record['sql'] = timing.sql_summary()
+            logger.warning(json.dumps(record), extra={'request_timing': record})
+        else:
+            logger.info(json.dumps(record), extra={'request_timing': record})
+
+
+class TimedTemplate:
+    """A backend template whose top-level renders are added to the current request's timing."""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        timing = _current.get()
+        if timing is None:
+            return self.template.render(context, request)
+        timing.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            timing.template_depth -= 1
+            if not timing.template_depth:
+                # Templates rendered from within another template count once, in the outer one.
+                timing.template_seconds += time.perf_counter() - started
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The Django template backend, with rendering time reported to RequestTimingMiddleware."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
@@ -0,0 +1,489 @@
+"""
+Application metrics in the Prometheus text format, served at /metrics.
+
+Three kinds of metric, declared once at import time (the application's metrics are declared
+at the bottom of this module, so every process knows all of them):
+
+* Counter:   a total that only goes up, e.g. circulation events per kind
+* Gauge:     a value that goes up and down; a gauge with a `callback` is computed when scraped
+             (queue depths read from the database) instead of being stored
+* Histogram: observations counted in fixed buckets, with their sum and count. Prometheus
+             derives quantiles from the buckets:
+             histogram_quantile(0.99, sum by (le, endpoint) (rate(lms_http_request_duration_seconds_bucket[5m])))
+
+    CIRCULATION_EVENTS.inc(event='returned')
+    HTTP_REQUEST_DURATION.observe(0.042, endpoint='books:portal_catalog', method='GET')
+
+Values live in a store chosen with the METRICS setting (shaped like CACHES and REALTIME_EVENTS):
+
+    METRICS = {
+        'BACKEND': 'lms.metrics.LocalStore',     # one process (runserver)
+        # 'BACKEND': 'lms.metrics.MmapStore',    # gunicorn workers, cron jobs, the push dispatcher
+        # 'OPTIONS': {'path': BASE_DIR / 'metrics'},
+    }
+
+MmapStore gives every process its own memory-mapped file in a shared directory. An update
+writes to the process's own mapping, with no locking between processes and no system call;
+a scrape, whichever worker serves it, reads every file and adds them up (gauges are combined
+according to their `aggregate`: sum, max or min). Files of processes that exited are kept, so
+counters do not go backwards when gunicorn recycles a worker and the totals of management
+commands (`send_due_reminders` from cron, `run_push_dispatcher`) reach the web server's
+/metrics. Empty the directory when the whole service is (re)started.
+"""
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Request latency buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# --- Stores ---
+
+class LocalStore:
+    """Values of this process only, in a dict."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def add(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = float(value)
+
+    def process_values(self):
+        """One {key: value} dict per process that reported."""
+        with self._lock:
+            return [dict(self._values)]
+
+
+class MmapFile:
+    """
+    An append-only file of (key, float64) entries, mapped in memory.
+
+    Layout: an 8-byte header holding the number of bytes in use, then entries made of a
+    4-byte key length, the UTF-8 key padded to 8 bytes and the value as a float64. A new
+    entry is written before the header is moved past it, so readers never see half an entry.
+    """
+    INITIAL_SIZE = 64 * 1024
+    HEADER = struct.Struct('<Q')
+    KEY_LENGTH = struct.Struct('<I')
+    VALUE = struct.Struct('<d')
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size < self.INITIAL_SIZE:
+            self._file.truncate(self.INITIAL_SIZE)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._used = self.HEADER.unpack_from(self._map, 0)[0] or self.HEADER.size
+        self._positions = {key: position for key, value, position in self.read_entries(self._map, self._used)}
+
+    @classmethod
+    def read_entries(cls, data, used=None):
+        """(key, value, value position) of every entry in `data`."""
+        if used is None:
+            used = cls.HEADER.unpack_from(data, 0)[0] if len(data) >= cls.HEADER.size else 0
+        used = min(used, len(data))
+        position = cls.HEADER.size
+        while position + cls.KEY_LENGTH.size <= used:
+            length = cls.KEY_LENGTH.unpack_from(data, position)[0]
+            key_start = position + cls.KEY_LENGTH.size
+            value_position = key_start + length + (-(cls.KEY_LENGTH.size + length) % 8)
+            if value_position + cls.VALUE.size > used:
+                break
+            key = bytes(data[key_start:key_start + length]).decode('utf-8')
+            yield key, cls.VALUE.unpack_from(data, value_position)[0], value_position
+            position = value_position + cls.VALUE.size
+
+    def _position(self, key):
+        position = self._positions.get(key)
+        if position is None:
+            encoded = key.encode('utf-8')
+            padding = -(self.KEY_LENGTH.size + len(encoded)) % 8
+            size = self.KEY_LENGTH.size + len(encoded) + padding + self.VALUE.size
+            if self._used + size > len(self._map):
+                self._grow(self._used + size)
+            start = self._used
+            self.KEY_LENGTH.pack_into(self._map, start, len(encoded))
+            self._map[start + self.KEY_LENGTH.size:start + self.KEY_LENGTH.size + len(encoded)] = encoded
+            position = start + self.KEY_LENGTH.size + len(encoded) + padding
+            self.VALUE.pack_into(self._map, position, 0.0)
+            self._used += size
+            self.HEADER.pack_into(self._map, 0, self._used)
+            self._positions[key] = position
+        return position
+
+    def _grow(self, needed):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def add(self, key, amount):
+        position = self._position(key)
+        self.VALUE.pack_into(self._map, position, self.VALUE.unpack_from(self._map, position)[0] + amount)
+
+    def set(self, key, value):
+        self.VALUE.pack_into(self._map, self._position(key), float(value))
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class MmapStore:
+    """Values of every process writing to the `path` directory; see the module docstring."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def _own_file(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # First use, or a child forked from the process that opened the file: write to our own.
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._file = MmapFile(self.path / f'metrics_{pid}.db')
+            self._pid = pid
+        return self._file
+
+    def add(self, key, amount):
+        with self._lock:
+            self._own_file().add(key, amount)
+
+    def set(self, key, value):
+        with self._lock:
+            self._own_file().set(key, value)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = self._pid = None
+
+    def process_values(self):
+        values = []
+        for path in sorted(self.path.glob('metrics_*.db')):
+            try:
+                data = path.read_bytes()
+            except OSError:
+                continue
+            values.append({key: value for key, value, position in MmapFile.read_entries(data)})
+        return values
+
+
+# --- Metrics ---
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected the labels {', '.join(labelnames) or '(none)'}, got {', '.join(labels) or '(none)'}.")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _store_key(sample, label_values):
+    # JSON, so that keys survive the round trip through MmapStore's files.
+    return json.dumps([sample, list(label_values)])
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer() and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join(f'{label}="{_escape(label_value)}"' for label, label_value in labels) + '}'
+    return f'{name} {_format_value(value)}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _add(self, sample, label_values, amount):
+        if self.registry.enabled():
+            self.registry.store().add(_store_key(sample, label_values), amount)
+
+    def samples(self, series):
+        """
+        [(sample name, [(label, value), ...], value)] for the exposition, from `series`:
+        {sample name: {label values: [value of each process]}}.
+        """
+        return [
+            (self.name, list(zip(self.labelnames, label_values)), sum(values))
+            for label_values, values in sorted(series.get(self.name, {}).items())
+        ]
+
+    def expose(self, series):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(_format_sample(*sample) for sample in self.samples(series))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only be increased.")
+        self._add(self.name, _label_key(self.labelnames, labels), amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+    AGGREGATES = {'sum': sum, 'max': max, 'min': min}
+
+    def __init__(self, registry, name, documentation, labelnames=(), aggregate='sum', callback=None):
+        super().__init__(registry, name, documentation, labelnames)
+        if aggregate not in self.AGGREGATES:
+            raise ValueError(f"Unknown gauge aggregate {aggregate!r}.")
+        self.aggregate = aggregate
+        self.callback = callback
+
+    def set(self, value, **labels):
+        if self.registry.enabled():
+            self.registry.store().set(_store_key(self.name, _label_key(self.labelnames, labels)), value)
+
+    def inc(self, amount=1, **labels):
+        self._add(self.name, _label_key(self.labelnames, labels), amount)
+
+    def dec(self, amount=1, **labels):
+        self._add(self.name, _label_key(self.labelnames, labels), -amount)
+
+    def samples(self, series):
+        if self.callback is None:
+            aggregate = self.AGGREGATES[self.aggregate]
+            return [
+                (self.name, list(zip(self.labelnames, label_values)), aggregate(values))
+                for label_values, values in sorted(series.get(self.name, {}).items())
+            ]
+        # The callback returns a value, or {label values: value} for a gauge with labels.
+        value = self.callback()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [
+            (self.name, list(zip(self.labelnames, label_values)), float(label_value))
+            for label_values, label_value in sorted(value.items())
+        ]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        if 'le' in labelnames:
+            raise ValueError("'le' is reserved for histogram buckets.")
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        label_values = _label_key(self.labelnames, labels)
+        # Each observation is counted in its own bucket only; the exposition makes them cumulative.
+        bound = next(bound for bound in self.buckets if value <= bound)
+        self._add(f'{self.name}_bucket', label_values + (_format_value(bound),), 1)
+        self._add(f'{self.name}_sum', label_values, value)
+        self._add(f'{self.name}_count', label_values, 1)
+
+    def samples(self, series):
+        buckets, sums, counts = (
+            {label_values: sum(values) for label_values, values in series.get(f'{self.name}_{suffix}', {}).items()}
+            for suffix in ('bucket', 'sum', 'count')
+        )
+        samples = []
+        for label_values in sorted(counts):
+            labels = list(zip(self.labelnames, label_values))
+            cumulative = 0.0
+            for bound in self.buckets:
+                cumulative += buckets.get(label_values + (_format_value(bound),), 0.0)
+                samples.append((f'{self.name}_bucket', labels + [('le', _format_value(bound))], cumulative))
+            samples.append((f'{self.name}_sum', labels, sums.get(label_values, 0.0)))
+            samples.append((f'{self.name}_count', labels, counts[label_values]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._store = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"The metric {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def enabled(self):
+        return _setting('METRICS_ENABLED', True)
+
+    def store(self):
+        """The process-wide store configured by METRICS (created on first use)."""
+        with self._lock:
+            if self._store is None:
+                config = _setting('METRICS', {})
+                store_class = import_string(config.get('BACKEND', 'lms.metrics.LocalStore'))
+                self._store = store_class(**config.get('OPTIONS', {}))
+            return self._store
+
+    def reset(self):
+        """Closes the store, so that the next update opens the one configured now (tests)."""
+        with self._lock:
+            if self._store is not None and hasattr(self._store, 'close'):
+                self._store.close()
+            self._store = None
+
+    def expose(self):
+        """Every metric in the Prometheus text format."""
+        series = {}
+        for process in self.store().process_values():
+            for key, value in process.items():
+                sample, label_values = json.loads(key)
+                series.setdefault(sample, {}).setdefault(tuple(label_values), []).append(value)
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.expose(series))
+            except Exception:
+                # A failing callback (e.g. the database is down) must not hide the other metrics.
+                logger.exception("Collecting the metric %s failed.", metric.name)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(REGISTRY, name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), aggregate='sum', callback=None):
+    return REGISTRY.register(Gauge(REGISTRY, name, documentation, labelnames, aggregate, callback))
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(REGISTRY, name, documentation, labelnames, buckets))
+
+
+def metrics_view(request):
+    """
+    The Prometheus scrape endpoint. Open to the addresses in METRICS_ALLOWED_IPS (the scraper;
+    REMOTE_ADDR, so list the proxy when one sits in front) and to logged-in staff.
+    """
+    from users.decorators import is_staff_user
+
+    if request.META.get('REMOTE_ADDR') not in _setting('METRICS_ALLOWED_IPS', ()) and not is_staff_user(request.user):
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.expose(), content_type=CONTENT_TYPE)
+
+
+# --- Queue depths, read when scraped ---
+
+def _library_kpi(name):
+    def read():
+        from books import kpis
+        return kpis.get_library_kpis()[name]
+    return read
+
+
+def _push_outbox_pending():
+    from users.models import PushOutbox
+    return PushOutbox.objects.filter(status='PENDING').count()
+
+
+def _push_outbox_lag_seconds():
+    """How long the oldest due push has been waiting for the dispatcher (0 when none is due)."""
+    from django.utils import timezone
+    from users.models import PushOutbox
+    now = timezone.now()
+    oldest = PushOutbox.objects.filter(status='PENDING', next_attempt_at__lte=now)\
+        .order_by('next_attempt_at').values_list('next_attempt_at', flat=True).first()
+    return (now - oldest).total_seconds() if oldest else 0
+
+
+# --- The application's metrics ---
+
+HTTP_REQUESTS = counter(
+    'lms_http_requests_total', 'HTTP requests handled, by URL name, method and status code.',
+    ['endpoint', 'method', 'status'],
+)
+HTTP_REQUEST_DURATION = histogram(
+    'lms_http_request_duration_seconds', 'Time to produce the response, by URL name and method.',
+    ['endpoint', 'method'],
+)
+HTTP_REQUEST_QUERIES = histogram(
+    'lms_http_request_queries', 'SQL queries run per request, by URL name.',
+    ['endpoint'], buckets=(1, 2, 5, 10, 20, 50, 100, 200),
+)
+CIRCULATION_EVENTS = counter(
+    'lms_circulation_events_total',
+    'Borrowing status changes: requested, issued, approved, rejected, cancelled, returned, returned_late, overdue, lost.',
+    ['event'],
+)
+NOTIFICATIONS_CREATED = counter(
+    'lms_notifications_created_total', 'In-app notifications created, by notification type.', ['type'],
+)
+JOB_DURATION = histogram(
+    'lms_job_duration_seconds', 'Run time of scheduled management commands.',
+    ['job'], buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900),
+)
+JOB_LAST_SUCCESS = gauge(
+    'lms_job_last_success_timestamp_seconds', 'Unix time the job last finished successfully.',
+    ['job'], aggregate='max',
+)
+PUSH_MESSAGES = counter(
+    'lms_push_messages_total', 'Outbox messages processed by the push dispatcher, by outcome.', ['outcome'],
+)
+PUSH_BATCH_DURATION = histogram(
+    'lms_push_batch_duration_seconds', 'Time to claim and deliver one batch of push messages.',
+)
+PUSH_OUTBOX_PENDING = gauge(
+    'lms_push_outbox_pending', 'Push messages waiting for a (re)try.', callback=_push_outbox_pending,
+)
+PUSH_OUTBOX_LAG = gauge(
+    'lms_push_outbox_lag_seconds', 'Age of the oldest push message that is due but not sent.',
+    callback=_push_outbox_lag_seconds,
+)
+BORROW_REQUESTS_PENDING = gauge(
+    'lms_borrow_requests_pending', 'Borrow requests waiting for staff approval.',
+    callback=_library_kpi('pending_requests_count'),
+)
+LOANS_ACTIVE = gauge('lms_loans_active', 'Copies on loan.', callback=_library_kpi('active_loans_count'))
+LOANS_OVERDUE = gauge('lms_loans_overdue', 'Overdue loans.', callback=_library_kpi('overdue_loans_count'))
@@ -0,0 +1,80 @@
+"""
+Query budgets: a guard against views whose number of SQL queries grows with the data (N+1).
+
+`query_budget(n)` fails when the code it wraps runs more than n queries, listing them:
+
+    with query_budget(8):
+        response = client.get(url)
+
+    @query_budget(8)
+    def test_catalog(self):
+        ...
+
+`QueryBudgetExceeded` is an AssertionError, so a test runner reports a test failure rather
+than an error. books/tests.py (QueryBudgetTests) requests every named URL with seeded data at
+two sizes against the QUERY_BUDGETS table there: each must stay within its budget and run
+no more queries on the larger dataset than on the smaller one.
+"""
+from contextlib import ContextDecorator
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def format_queries(captured_queries, limit=50):
+    lines = [f"{index}. {query['sql']}" for index, query in enumerate(captured_queries[:limit], start=1)]
+    if len(captured_queries) > limit:
+        lines.append(f"... and {len(captured_queries) - limit} more")
+    return '\n'.join(lines)
+
+
+class query_budget(ContextDecorator):
+    """
+    Context manager and decorator allowing at most `max_queries` queries on the `using`
+    database. After the block, `count` and `captured_queries` hold what it ran.
+    """
+
+    def __init__(self, max_queries, using=DEFAULT_DB_ALIAS, label=''):
+        self.max_queries = max_queries
+        self.using = using
+        self.label = label
+        self.captured_queries = []
+
+    def _recreate_cm(self):
+        # A decorated function gets a fresh context per call (calls may overlap in threads).
+        return type(self)(self.max_queries, using=self.using, label=self.label)
+
+    @property
+    def count(self):
+        return len(self.captured_queries)
+
+    def __enter__(self):
+        self._context = CaptureQueriesContext(connections[self.using])
+        self._context.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._context.__exit__(exc_type, exc_value, traceback)
+        self.captured_queries = self._context.captured_queries
+        if exc_type is None and self.count > self.max_queries:
+            label = f"{self.label}: " if self.label else ''
+            raise QueryBudgetExceeded(
+                f"{label}{self.count} queries, budget {self.max_queries}:\n{format_queries(self.captured_queries)}"
+            )
+        return False
+
+
+def assert_no_growth(label, small, large):
+    """
+    Fails when a query_budget measured on the larger dataset (`large`) ran more queries than
+    the same code on the smaller one (`small`): a per-row query.
+    """
+    if large.count > small.count:
+        raise QueryBudgetExceeded(
+            f"{label}: {small.count} queries on the small dataset but {large.count} on the large one. "
+            f"Queries on the large dataset:\n{format_queries(large.captured_queries)}"
+        )
@@ -0,0 +1,119 @@
+"""
+Primary/replica database routing.
+
+With a read replica configured (settings.DATABASE_READ_REPLICA, see DATABASES in settings.py),
+PrimaryReplicaRouter sends reads of the catalog and of the reporting rollups to it, and every
+other read and every write to the primary ('default'). Circulation data (borrowings,
+notifications, favorites, users) is always read from the primary.
+
+Reads still go to the primary when a replica could return stale data:
+
+* inside a transaction on the primary (e.g. a circulation change re-reading the copy it locks);
+* for the rest of a request (or of a management command) once it has written anything;
+* for DATABASE_REPLICA_PIN_SECONDS after a client's write: PrimaryStickinessMiddleware sets a
+  short-lived cookie on responses to writes, so the redirect or list fetched right after a POST
+  shows that POST's effect (read-your-writes).
+
+Without a replica every method returns 'default'/None and Django behaves as with one database.
+Code that must read a consistent, current state outside a transaction can use `use_primary()`;
+bulk reads that tolerate a little lag (exports) can pass `read_alias()` to `.using()`.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Models whose reads may be served by the replica (Model._meta.label_lower).
+REPLICA_READ_MODELS = {
+    'books.author', 'books.category', 'books.book', 'books.book_authors', 'books.book_categories',
+    'books.bookcopy', 'books.booksearchdocument', 'books.booksimilarity',
+    'books.dailycirculationstat', 'books.dailycategorycirculationstat', 'books.titlecirculationstat',
+    'books.borrowercirculationstat', 'books.overdueloansnapshot',
+}
+PIN_COOKIE = 'db_primary_pin'
+UNSAFE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+
+class _RoutingState:
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+_state = ContextVar('db_routing_state', default=None)
+
+
+def _replica():
+    replica = getattr(settings, 'DATABASE_READ_REPLICA', None)
+    if not replica:
+        return None
+    state = _state.get()
+    if state is not None and state.pinned:
+        return None
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return None
+    return replica
+
+
+def read_alias():
+    """The alias replica-tolerant reads should use right now."""
+    return _replica() or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def use_primary():
+    """Routes every read in the block to the primary."""
+    state = _RoutingState(pinned=True)
+    outer = _state.get()
+    token = _state.set(state)
+    try:
+        yield
+    finally:
+        _state.reset(token)
+        if outer is not None and state.wrote:
+            outer.pinned = outer.wrote = True
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.label_lower in REPLICA_READ_MODELS:
+            return _replica() or DEFAULT_DB_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is None:
+            # Outside a request (management commands, shells): pinned from the first write on.
+            state = _RoutingState()
+            _state.set(state)
+        state.pinned = state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class PrimaryStickinessMiddleware:
+    """Keeps a client's reads on the primary for a few seconds after each of its writes."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = _RoutingState(pinned=request.COOKIES.get(PIN_COOKIE) == '1')
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if getattr(settings, 'DATABASE_READ_REPLICA', None) and (state.wrote or request.method in UNSAFE_METHODS):
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10),
+                httponly=True, samesite='Lax',
+            )
+        return response
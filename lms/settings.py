@@ -77,11 +77,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'lms.instrumentation.RequestTimingMiddleware',     # First, so its total covers every other middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'lms.routers.PrimaryStickinessMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -90,7 +92,8 @@ ROOT_URLCONF = 'lms.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, with rendering time reported to RequestTimingMiddleware
+        'BACKEND': 'lms.instrumentation.DjangoTemplates',
         'DIRS': [BASE_DIR / "templates"],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -98,6 +101,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'books.context_processors.unread_notifications',
             ],
         },
     },
@@ -112,7 +116,11 @@ REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
         'rest_framework.filters.SearchFilter',
-    ]
+    ],
+    # Keyset pagination on every list endpoint (see books/pagination.py); clients may ask for
+    # ?page_size= up to each view's max_page_size.
+    'DEFAULT_PAGINATION_CLASS': 'books.pagination.KeysetPagination',
+    'PAGE_SIZE': 25,
 }
 
 BOOTSTRAP5 = {
@@ -129,12 +137,55 @@ PUSH_NOTIFICATIONS_SETTINGS = {
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Configured from the environment: DB_ENGINE ('sqlite' or 'postgresql'), DB_NAME, DB_USER,
+# DB_PASSWORD, DB_HOST, DB_PORT, DB_SSLMODE, DB_CONN_MAX_AGE. Setting DB_REPLICA_NAME and/or
+# DB_REPLICA_HOST (other DB_REPLICA_* values default to the primary's) adds a read replica, which
+# lms.routers.PrimaryReplicaRouter uses for catalog and report reads. Locally, two SQLite files
+# (DB_REPLICA_NAME=db_replica.sqlite3, a copy of db.sqlite3) or two local PostgreSQL databases
+# can stand in for primary and replica.
+def database_from_env(prefix, fallback_prefix=None):
+    def env(name, default=None):
+        if fallback_prefix:
+            default = os.environ.get(f'{fallback_prefix}{name}', default)
+        return os.environ.get(f'{prefix}{name}', default)
+
+    engine = env('ENGINE', 'sqlite')
+    if engine == 'sqlite':
+        return {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / env('NAME', 'db.sqlite3'),
+        }
+    return {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': env('NAME', 'lms'),
+        'USER': env('USER', ''),
+        'PASSWORD': env('PASSWORD', ''),
+        'HOST': env('HOST', ''),
+        'PORT': env('PORT', ''),
+        'CONN_MAX_AGE': int(env('CONN_MAX_AGE', 60)),   # Seconds a connection is reused across requests
+        'CONN_HEALTH_CHECKS': True,                     # Reconnect instead of failing on a dropped connection
+        'OPTIONS': {
+            'connect_timeout': int(env('CONNECT_TIMEOUT', 5)),
+            'sslmode': env('SSLMODE', 'prefer'),
+            'application_name': 'lms',
+        },
     }
+
+
+DATABASES = {
+    'default': database_from_env('DB_'),
 }
+# A file (not the shared in-memory database) so concurrency tests see real SQLite locking.
+DATABASES['default']['TEST'] = {'NAME': BASE_DIR / 'test_db.sqlite3'} if 'sqlite3' in DATABASES['default']['ENGINE'] else {}
+
+DATABASE_READ_REPLICA = None            # Alias catalog and report reads go to (None: everything uses 'default')
+if os.environ.get('DB_REPLICA_NAME') or os.environ.get('DB_REPLICA_HOST'):
+    DATABASE_READ_REPLICA = 'replica'
+    DATABASES['replica'] = database_from_env('DB_REPLICA_', fallback_prefix='DB_')
+    # Tests run against the primary only; the replica alias reads from it.
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+DATABASE_ROUTERS = ['lms.routers.PrimaryReplicaRouter']
+DATABASE_REPLICA_PIN_SECONDS = 10       # After a write, the client's reads stay on the primary this long
 
 
 # Password validation
@@ -199,4 +250,76 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 # Library Policy
 DEFAULT_LOAN_DURATION_DAYS = 14         # Default loan period in days
 FINE_RATE_PER_DAY_OVERDUE = 1.00        # Example: 1.00 currency unit per day
-DEFAULT_LOST_BOOK_FINE_AMOUNT = 25.00   # Example: 25.00 currency units for a lost book
\ No newline at end of file
+DEFAULT_LOST_BOOK_FINE_AMOUNT = 25.00   # Example: 25.00 currency units for a lost book
+
+# Recommendations
+BOOK_RECOMMENDATION_TOP_K = 10          # Similar books precomputed per title by `build_recommendations`
+
+# Dashboard KPIs
+LIBRARY_KPI_CACHE_TIMEOUT = 60          # Seconds cached KPI counters may be served before being recomputed
+
+# Template Fragments (book cards, category sidebar and home sections; see books/fragments.py)
+FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24   # Seconds a fragment is kept; a change moves it to a new key anyway
+
+# Notifications
+NOTIFICATION_COUNT_CACHE_TIMEOUT = 30   # Seconds a user's cached unread count may be served (writes invalidate it)
+NOTIFICATION_STREAM_HEARTBEAT_SECONDS = 15      # Keep-alive comment interval on idle event streams
+NOTIFICATION_STREAM_KPI_INTERVAL_SECONDS = 2    # Minimum delay between two KPI updates on a staff stream
+NOTIFICATION_STREAM_MAX_SECONDS = 3600          # Streams are closed after this long; clients reconnect
+
+# Realtime events behind the notification stream (see books/events.py). LocalBackend serves one
+# process; use 'books.events.SQLiteBackend' (OPTIONS: path, poll_interval) when running several workers.
+REALTIME_EVENTS = {
+    'BACKEND': 'books.events.LocalBackend',
+}
+
+# Push Notifications
+EXPO_PUSH_URL = 'https://exp.host/--/api/v2/push/send'
+EXPO_RECEIPTS_URL = 'https://exp.host/--/api/v2/push/getReceipts'
+PUSH_REQUEST_TIMEOUT = 10               # Seconds the dispatcher waits for the push gateway
+PUSH_OUTBOX_MAX_ATTEMPTS = 8            # Delivery attempts before a queued push is marked FAILED
+PUSH_OUTBOX_BACKOFF_SECONDS = 30        # First retry delay; doubles on every further failure
+PUSH_OUTBOX_MAX_BACKOFF_SECONDS = 3600  # Upper bound for the retry delay
+PUSH_OUTBOX_LEASE_SECONDS = 120         # A claimed batch is retried after this long if its worker died
+
+# Copy IDs
+BOOK_COPY_ID_DIGITS = 6                 # Zero-padded width of the sequential number in generated copy IDs
+
+# Image Derivatives (thumbnails of covers, author photos and profile pictures; see books/images.py)
+IMAGE_DERIVATIVE_SIZES = {              # name: (width, height[, crop]) in CSS pixels; rendered at 1x and 2x
+    'card': (240, 360),                 # Catalog book cards
+    'detail': (400, 600),               # Book detail page
+    'admin': (80, 120),                 # Dashboard list thumbnails
+    'portrait': (150, 150, True),       # Author and profile photos
+    'avatar': (32, 32, True),           # Navigation bar
+}
+IMAGE_DERIVATIVE_QUALITY = 80           # JPEG/WebP encoder quality
+
+# Request Instrumentation (see lms/instrumentation.py)
+REQUEST_TIMING_ENABLED = True           # Count queries and time the view, SQL and templates of every request
+REQUEST_TIMING_HEADER = True            # Report the numbers to the client in a Server-Timing header
+REQUEST_TIMING_SAMPLE_RATE = 0.01       # Share of requests logged to the 'lms.instrumentation' logger
+REQUEST_TIMING_SLOW_MS = 500            # Slower requests are always logged, with their SQL
+REQUEST_TIMING_MAX_SQL = 100            # Statements recorded per request for that log
+# Runs the tests with REQUEST_TIMING_SAMPLE_RATE = 0, keeping sampled lines out of their output
+TEST_RUNNER = 'lms.test_runner.TestRunner'
+
+# Metrics (Prometheus text format at /metrics, see lms/metrics.py). LocalStore serves one process;
+# with several workers, or to see cron jobs and the push dispatcher, use 'lms.metrics.MmapStore'
+# (OPTIONS: path, a directory shared by every process and emptied when the service restarts).
+METRICS_ENABLED = True
+METRICS = {
+    'BACKEND': 'lms.metrics.LocalStore',
+}
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']  # Scrapers allowed without a staff login
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'lms.instrumentation': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
@@ -0,0 +1,21 @@
+"""
+Test runner for `manage.py test` (TEST_RUNNER).
+
+Runs the suite with REQUEST_TIMING_SAMPLE_RATE = 0, so the sampled request lines of the
+'lms.instrumentation' logger (see lms/instrumentation.py) do not end up between the test
+results. Slow requests are still logged, and tests of the sampling set the rate themselves
+with override_settings.
+"""
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._unsampled = override_settings(REQUEST_TIMING_SAMPLE_RATE=0)
+        self._unsampled.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._unsampled.disable()
+        super().teardown_test_environment(**kwargs)
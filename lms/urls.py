@@ -3,10 +3,12 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from users.views import staff_login_view
+from lms.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('dashboard/login/', staff_login_view, name='staff_login'),
+    path('metrics', metrics_view, name='metrics'),
 
     # API routes
     path('api/', include('books.api_urls')), 
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin 
-from .models import CustomUser, UserDevice
+from .models import CustomUser, UserDevice, PushOutbox
 from .forms import UserRegistrationForm, CustomUserChangeForm 
 from django.utils.translation import gettext_lazy as _
 
@@ -52,3 +52,11 @@ class UserDeviceAdmin(admin.ModelAdmin):
     def registration_id_preview(self, obj):
         return obj.registration_id[:50] + '...' if len(obj.registration_id) > 50 else obj.registration_id
     registration_id_preview.short_description = _('Registration ID Preview')
+
+
+@admin.register(PushOutbox)
+class PushOutboxAdmin(admin.ModelAdmin):
+    list_display = ('user', 'title', 'status', 'attempts', 'next_attempt_at', 'created_at', 'sent_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('user__username', 'title', 'body')
+    readonly_fields = ('created_at', 'sent_at', 'attempts', 'last_error')
@@ -0,0 +1,199 @@
+"""
+Client for the Expo push API.
+
+ExpoPushClient keeps one requests.Session per thread, so consecutive calls reuse the same
+keep-alive connection to the gateway. send() accepts any number of messages (for any number
+of users) and posts them in chunks of MAX_MESSAGES_PER_REQUEST; get_receipts() does the same
+for push receipts. Tokens the gateway reports as DeviceNotRegistered are deactivated with a
+single UPDATE per call.
+"""
+import json
+import threading
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+
+from .models import PushTicket, UserDevice
+
+EXPO_PUSH_URL = "https://exp.host/--/api/v2/push/send"
+EXPO_RECEIPTS_URL = "https://exp.host/--/api/v2/push/getReceipts"
+MAX_MESSAGES_PER_REQUEST = 100      # Expo rejects larger push requests
+MAX_RECEIPTS_PER_REQUEST = 1000     # Expo rejects larger receipt requests
+EXPO_TOKEN_PREFIXES = ('ExponentPushToken[', 'ExpoPushToken[')
+EXPO_HEADERS = {
+    "Accept": "application/json",
+    "Accept-Encoding": "gzip, deflate",
+    "Content-Type": "application/json",
+}
+
+
+def is_expo_token(token):
+    return bool(token) and token.startswith(EXPO_TOKEN_PREFIXES)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def error_ticket(message, code='RequestFailed'):
+    """A ticket standing in for messages whose request failed as a whole (HTTP error, timeout...)."""
+    return {'status': 'error', 'message': message, 'details': {'error': code}}
+
+
+def is_unregistered(ticket_or_receipt):
+    return (ticket_or_receipt.get('details') or {}).get('error') == 'DeviceNotRegistered'
+
+
+def deactivate_tokens(tokens):
+    """Marks all the given device tokens inactive in one UPDATE. Returns the number of devices changed."""
+    tokens = set(tokens)
+    if not tokens:
+        return 0
+    return UserDevice.objects.filter(registration_id__in=tokens, is_active=True).update(is_active=False)
+
+
+def active_tokens_by_user(user_ids):
+    """{user id: [Expo tokens of the user's active devices]} for the given users, in one query."""
+    tokens_by_user = {}
+    for user_id, token in UserDevice.objects.filter(user_id__in=set(user_ids), is_active=True)\
+            .order_by().values_list('user_id', 'registration_id'):
+        if is_expo_token(token):
+            tokens_by_user.setdefault(user_id, []).append(token)
+    return tokens_by_user
+
+
+def build_message(token, title, body, data=None):
+    message = {"to": token, "sound": "default", "title": str(title), "body": str(body)}
+    if data:
+        message["data"] = data
+    return message
+
+
+class ExpoPushClient:
+    def __init__(self, push_url=None, receipts_url=None, timeout=None):
+        # Unset values are read from settings on every use, so settings overrides apply.
+        self._push_url = push_url
+        self._receipts_url = receipts_url
+        self._timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def push_url(self):
+        return self._push_url or getattr(settings, 'EXPO_PUSH_URL', EXPO_PUSH_URL)
+
+    @property
+    def receipts_url(self):
+        return self._receipts_url or getattr(settings, 'EXPO_RECEIPTS_URL', EXPO_RECEIPTS_URL)
+
+    @property
+    def timeout(self):
+        return self._timeout or getattr(settings, 'PUSH_REQUEST_TIMEOUT', 10)
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(EXPO_HEADERS)
+            access_token = getattr(settings, 'EXPO_ACCESS_TOKEN', None)
+            if access_token:
+                session.headers['Authorization'] = f"Bearer {access_token}"
+            self._local.session = session
+        return session
+
+    def close(self):
+        session = getattr(self._local, 'session', None)
+        if session is not None:
+            session.close()
+            self._local.session = None
+
+    def _post(self, url, payload):
+        response = self.session.post(url, data=json.dumps(payload), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def send(self, messages, deactivate_unregistered=True):
+        """
+        Sends the messages and returns one push ticket per message, in order.
+        A chunk whose request fails yields error tickets (details.error 'RequestFailed') for its
+        messages instead of raising, so one bad chunk does not lose the tickets of the others.
+        """
+        messages = list(messages)
+        tickets = []
+        for chunk in _chunks(messages, MAX_MESSAGES_PER_REQUEST):
+            try:
+                chunk_tickets = self._post(self.push_url, chunk).get('data', [])
+                if len(chunk_tickets) != len(chunk):
+                    raise ValueError(f"Expo returned {len(chunk_tickets)} ticket(s) for {len(chunk)} message(s).")
+            except (requests.exceptions.RequestException, ValueError) as error:
+                chunk_tickets = [error_ticket(str(error))] * len(chunk)
+            tickets.extend(chunk_tickets)
+
+        if deactivate_unregistered:
+            deactivate_tokens(
+                message['to'] for message, ticket in zip(messages, tickets) if is_unregistered(ticket)
+            )
+        # Accepted messages get a receipt later; remember their tickets for check_receipts().
+        PushTicket.objects.bulk_create([
+            PushTicket(ticket_id=ticket['id'], registration_id=message['to'])
+            for message, ticket in zip(messages, tickets)
+            if ticket.get('status') == 'ok' and ticket.get('id')
+        ], batch_size=1000, ignore_conflicts=True)
+        return tickets
+
+    def get_receipts(self, ticket_ids):
+        """{ticket id: receipt} for the given ticket ids. Receipts Expo does not know yet are omitted."""
+        receipts = {}
+        for chunk in _chunks(list(ticket_ids), MAX_RECEIPTS_PER_REQUEST):
+            receipts.update(self._post(self.receipts_url, {'ids': chunk}).get('data', {}))
+        return receipts
+
+
+def check_receipts(client=None, min_age=timedelta(minutes=15), max_age=timedelta(days=1), batch_size=MAX_RECEIPTS_PER_REQUEST):
+    """
+    Fetches the receipts of stored tickets at least `min_age` old (Expo needs a while to produce
+    them), deactivates every token whose receipt says DeviceNotRegistered and forgets the tickets
+    that got a receipt. Tickets older than `max_age` are dropped, as Expo no longer keeps their receipts.
+    Returns a dict with the number of receipts 'ok', 'errors', 'deactivated' devices and 'expired' tickets.
+    """
+    client = client or get_client()
+    now = timezone.now()
+    counts = {'ok': 0, 'errors': 0, 'deactivated': 0}
+    counts['expired'] = PushTicket.objects.filter(created_at__lt=now - max_age).delete()[0]
+
+    last_id = 0
+    due = PushTicket.objects.filter(created_at__lte=now - min_age).order_by('id')
+    while True:
+        batch = list(due.filter(id__gt=last_id).values_list('id', 'ticket_id', 'registration_id')[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        receipts = client.get_receipts([ticket_id for _, ticket_id, _ in batch])
+        unregistered = []
+        for _, ticket_id, token in batch:
+            receipt = receipts.get(ticket_id)
+            if receipt is None:
+                continue
+            if receipt.get('status') == 'ok':
+                counts['ok'] += 1
+            else:
+                counts['errors'] += 1
+                if is_unregistered(receipt):
+                    unregistered.append(token)
+        counts['deactivated'] += deactivate_tokens(unregistered)
+        PushTicket.objects.filter(ticket_id__in=receipts.keys()).delete()
+    return counts
+
+
+_client = None
+
+
+def get_client():
+    """The process-wide client (its sessions, and so their connections, are reused across calls)."""
+    global _client
+    if _client is None:
+        _client = ExpoPushClient()
+    return _client
@@ -0,0 +1,41 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+
+from users import expo
+
+
+class Command(BaseCommand):
+    help = (
+        'Fetches Expo push receipts for sent messages, deactivates devices that are no longer '
+        'registered and forgets the checked tickets (run every 15-30 minutes).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=15,
+            help='Only check tickets at least this many minutes old (default: 15).',
+        )
+        parser.add_argument(
+            '--max-age',
+            type=int,
+            default=24,
+            help='Drop tickets older than this many hours without checking them (default: 24).',
+        )
+
+    def handle(self, *args, **options):
+        if options['min_age'] < 0 or options['max_age'] <= 0:
+            raise CommandError('--min-age must not be negative and --max-age must be positive.')
+
+        started = time.monotonic()
+        counts = expo.check_receipts(
+            min_age=timedelta(minutes=options['min_age']),
+            max_age=timedelta(hours=options['max_age']),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked push receipts in {time.monotonic() - started:.2f}s. OK: {counts['ok']}, "
+            f"errors: {counts['errors']}, devices deactivated: {counts['deactivated']}, "
+            f"expired tickets dropped: {counts['expired']}."
+        ))
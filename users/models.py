@@ -2,6 +2,7 @@ from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
+from django.utils.functional import cached_property
 
 class CustomUser(AbstractUser):
     """
@@ -77,11 +78,15 @@ class CustomUser(AbstractUser):
         null=True,
         help_text=_("Upload a profile picture (optional).")
     )
+    # Content hash naming the picture's thumbnails (see books/images.py); empty until they exist.
+    profile_picture_digest = models.CharField(max_length=16, blank=True, default='', editable=False)
+    # Deprecated: favorites now live in books.FavoriteBook. Kept only so existing data can be
+    # copied over with `manage.py migrate_favorites`.
     favorite_books = models.JSONField(
         _("Favorite Books"),
         default=list,
         blank=True,
-        help_text=_("List of favorite book ISBNs with timestamps.")
+        help_text=_("Legacy list of favorite book ISBNs with timestamps (see books.FavoriteBook).")
     )
 
     BORROWER_TYPE_CHOICES = (
@@ -153,24 +158,26 @@ class CustomUser(AbstractUser):
         return self.username
 
     def add_favorite(self, book_isbn):
-        if not isinstance(self.favorite_books, list):
-            self.favorite_books = []
-        self.favorite_books = [fav for fav in self.favorite_books if fav.get('isbn') != book_isbn]
-        self.favorite_books.append({
-            "isbn": book_isbn,
-            "favorited_at": timezone.now().isoformat()
-        })
+        """Adds a book to this user's favorites (no-op if it is already there)."""
+        self.favorites.model.objects.get_or_create(user=self, book_id=book_isbn)
+        self.clear_favorite_cache()
     
     def remove_favorite(self, book_isbn):
-        if not isinstance(self.favorite_books, list):
-            self.favorite_books = []
-            return
-        self.favorite_books = [fav for fav in self.favorite_books if fav.get('isbn') != book_isbn]
+        """Removes a book from this user's favorites."""
+        self.favorites.filter(book_id=book_isbn).delete()
+        self.clear_favorite_cache()
+
+    @cached_property
+    def favorite_isbns(self):
+        """ISBNs of this user's favorite books, loaded once per user instance (i.e. once per request)."""
+        return frozenset(self.favorites.values_list('book_id', flat=True))
+
+    def clear_favorite_cache(self):
+        """Forgets the cached favorite_isbns after this user's favorites changed."""
+        self.__dict__.pop('favorite_isbns', None)
 
     def is_book_favorited(self, book_isbn):
-        if not isinstance(self.favorite_books, list):
-            return False
-        return any(fav.get('isbn') == book_isbn for fav in self.favorite_books)
+        return book_isbn in self.favorite_isbns
 
     class Meta:
         verbose_name = _('User')
@@ -209,4 +216,91 @@ class UserDevice(models.Model):
     class Meta:
         verbose_name = _('User Device')
         verbose_name_plural = _('User Devices')
-        ordering = ['-date_created']
\ No newline at end of file
+        ordering = ['-date_created']
+
+class PushOutbox(models.Model):
+    """
+    A push notification waiting to be delivered.
+    Rows are written in the same transaction as the change that triggers them and are
+    delivered out of band by `manage.py run_push_dispatcher` (see users/push.py), so
+    request latency never depends on the push gateway.
+    """
+    STATUS_CHOICES = (
+        ('PENDING', _('Pending')),      # Waiting for (another) delivery attempt
+        ('SENT', _('Sent')),            # Accepted by the push gateway
+        ('SKIPPED', _('Skipped')),      # The user had no active devices
+        ('FAILED', _('Failed')),        # Gave up after the maximum number of attempts
+    )
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='push_outbox',
+        help_text=_("The user to notify")
+    )
+    title = models.CharField(max_length=255)
+    body = models.TextField()
+    data = models.JSONField(default=dict, blank=True, help_text=_("Extra payload delivered to the mobile app"))
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(
+        default=timezone.now,
+        help_text=_("Earliest time the dispatcher may (re)try this message")
+    )
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        """String representation of the PushOutbox model."""
+        return f"Push to user {self.user_id}: {self.title} ({self.status})"
+
+    @classmethod
+    def enqueue(cls, user, title, body, data=None):
+        """Queues a push notification for the user (call inside the triggering transaction)."""
+        return cls.objects.create(user=user, title=str(title), body=str(body), data=data or {})
+
+    @classmethod
+    def enqueue_many(cls, messages, batch_size=1000):
+        """
+        Queues many push notifications with chunked bulk inserts.
+        `messages` is an iterable of (user id, title, body, data) tuples. Returns the number queued.
+        """
+        queued, batch = 0, []
+        for user_id, title, body, data in messages:
+            batch.append(cls(user_id=user_id, title=str(title), body=str(body), data=data or {}))
+            if len(batch) >= batch_size:
+                cls.objects.bulk_create(batch)
+                queued, batch = queued + len(batch), []
+        if batch:
+            cls.objects.bulk_create(batch)
+            queued += len(batch)
+        return queued
+
+    class Meta:
+        verbose_name = _('Push Outbox Message')
+        verbose_name_plural = _('Push Outbox Messages')
+        ordering = ['next_attempt_at', 'id']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='push_outbox_due_idx'),
+        ]
+
+class PushTicket(models.Model):
+    """
+    A push ticket issued by Expo for a message that was accepted for delivery.
+    Kept until `manage.py check_push_receipts` has fetched its receipt, which reports
+    whether the message actually reached the device (and deactivates dead tokens).
+    """
+    ticket_id = models.CharField(max_length=64, unique=True)
+    registration_id = models.TextField(help_text=_("Device token the message was sent to"))
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """String representation of the PushTicket model."""
+        return f"Push ticket {self.ticket_id}"
+
+    class Meta:
+        verbose_name = _('Push Ticket')
+        verbose_name_plural = _('Push Tickets')
+        indexes = [
+            models.Index(fields=['created_at'], name='push_ticket_created_idx'),
+        ]
@@ -0,0 +1,117 @@
+"""
+Push notification delivery from the PushOutbox table.
+
+Producers call PushOutbox.enqueue() inside their own transaction. The dispatcher
+(`manage.py run_push_dispatcher`) claims due rows in batches, sends them to the Expo
+push API and records the outcome. Failed deliveries are retried with exponential
+backoff until PUSH_OUTBOX_MAX_ATTEMPTS is reached.
+
+Claiming moves a row's next_attempt_at forward by a lease (PUSH_OUTBOX_LEASE_SECONDS)
+instead of changing its status, so rows claimed by a worker that dies are simply
+picked up again once the lease expires.
+
+Outcomes and batch times are counted in the metrics (lms/metrics.py); with MmapStore they reach
+the web server's /metrics from the dispatcher process.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from lms import metrics
+
+from . import expo
+from .models import PushOutbox
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def backoff_delay(attempts):
+    """Delay before retry number `attempts` + 1: base * 2^(attempts - 1), capped."""
+    base = _setting('PUSH_OUTBOX_BACKOFF_SECONDS', 30)
+    cap = _setting('PUSH_OUTBOX_MAX_BACKOFF_SECONDS', 3600)
+    return timedelta(seconds=min(base * 2 ** max(attempts - 1, 0), cap))
+
+
+def claim_batch(batch_size):
+    """Claims up to batch_size due PENDING messages and returns them (with attempts already incremented)."""
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=_setting('PUSH_OUTBOX_LEASE_SECONDS', 120))
+    with transaction.atomic():
+        due = PushOutbox.objects.filter(status='PENDING', next_attempt_at__lte=now).order_by('next_attempt_at', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        ids = list(due.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+        PushOutbox.objects.filter(id__in=ids).update(next_attempt_at=lease_until, attempts=F('attempts') + 1)
+    return list(PushOutbox.objects.filter(id__in=ids).order_by('id'))
+
+
+def deliver(outbox_messages):
+    """
+    Delivers claimed outbox messages and records the outcome of each one.
+    Returns a dict counting the messages per resulting status ('SENT', 'SKIPPED', 'RETRY', 'FAILED').
+    """
+    outcome = {'SENT': 0, 'SKIPPED': 0, 'RETRY': 0, 'FAILED': 0}
+    if not outbox_messages:
+        return outcome
+
+    tokens_by_user = expo.active_tokens_by_user(message.user_id for message in outbox_messages)
+    expo_messages, owners = [], []
+    for message in outbox_messages:
+        for token in tokens_by_user.get(message.user_id, []):
+            expo_messages.append(expo.build_message(token, message.title, message.body, message.data))
+            owners.append(message)
+
+    # One pooled client sends every message of the batch, 100 per HTTP request.
+    delivered, errors = set(), {}
+    for owner, ticket in zip(owners, expo.get_client().send(expo_messages)):
+        if ticket.get('status') == 'ok':
+            delivered.add(owner.pk)
+        elif not expo.is_unregistered(ticket):
+            errors.setdefault(owner.pk, ticket.get('message') or 'Push ticket error')
+    # A message counts as sent as soon as one of the user's devices accepted it.
+    errors = {pk: error for pk, error in errors.items() if pk not in delivered}
+
+    now = timezone.now()
+    max_attempts = _setting('PUSH_OUTBOX_MAX_ATTEMPTS', 8)
+    for message in outbox_messages:
+        if message.pk in errors:
+            message.last_error = errors[message.pk]
+            if message.attempts >= max_attempts:
+                message.status = 'FAILED'
+            else:
+                message.next_attempt_at = now + backoff_delay(message.attempts)
+        elif message.pk in delivered:
+            message.status, message.sent_at, message.last_error = 'SENT', now, ''
+        else:
+            # No device, or every device turned out to be unregistered (and is now deactivated).
+            message.status, message.last_error = 'SKIPPED', 'No active devices'
+    PushOutbox.objects.bulk_update(outbox_messages, ['status', 'next_attempt_at', 'last_error', 'sent_at'])
+
+    for message in outbox_messages:
+        if message.status == 'PENDING':
+            outcome['RETRY'] += 1
+        else:
+            outcome[message.status] += 1
+    for status, count in outcome.items():
+        if count:
+            metrics.PUSH_MESSAGES.inc(count, outcome=status.lower())
+    return outcome
+
+
+def dispatch_once(batch_size=500):
+    """Claims and delivers one batch. Returns the outcome counts (all zero when nothing was due)."""
+    started = time.monotonic()
+    messages = claim_batch(batch_size)
+    outcome = deliver(messages)
+    if messages:
+        # Empty polls are left out, they would drag the distribution towards zero.
+        metrics.PUSH_BATCH_DURATION.observe(time.monotonic() - started)
+    return outcome
@@ -1,3 +1,286 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 
-# Create your tests here.
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from books.models import Book, BookCopy, Borrowing
+from lms import metrics
+from users import expo, push
+from users.models import CustomUser, PushOutbox, PushTicket, UserDevice
+from users.utils import queue_push_notifications
+
+
+class StandInExpoServer:
+    """
+    A local HTTP server that mimics Expo's push and receipts endpoints.
+    `responses` is a list of (status code, {token: ticket}) consumed one per push request; once it
+    is exhausted every message gets an "ok" ticket. `receipts` maps ticket ids to receipts.
+    `delay` simulates a slow gateway.
+    """
+
+    def __init__(self, responses=None, delay=0, receipts=None):
+        self.responses = list(responses or [])
+        self.delay = delay
+        self.receipts = receipts or {}
+        self.requests = []
+        self.receipt_requests = []
+        self.connections = set()
+        self.issued_tickets = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                server.connections.add(self.client_address)
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if self.path.endswith('/getReceipts'):
+                    server.receipt_requests.append(payload['ids'])
+                    self.respond(200, {'data': {id: server.receipts[id] for id in payload['ids'] if id in server.receipts}})
+                    return
+                messages = payload
+                server.requests.append(messages)
+                if server.delay:
+                    time.sleep(server.delay)
+                status, tickets = server.responses.pop(0) if server.responses else (200, {})
+                if status == 200:
+                    body = {'data': [tickets.get(message['to']) or server.ok_ticket() for message in messages]}
+                else:
+                    body = {'errors': [{'code': 'INTERNAL_SERVER_ERROR', 'message': 'Gateway failure'}]}
+                self.respond(status, body)
+
+            def respond(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/--/api/v2/push/send'
+        self.receipts_url = f'http://127.0.0.1:{self.httpd.server_address[1]}/--/api/v2/push/getReceipts'
+
+    def ok_ticket(self):
+        self.issued_tickets += 1
+        return {'status': 'ok', 'id': f'ticket-{self.issued_tickets}'}
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        expo.get_client().close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+DEVICE_NOT_REGISTERED = {
+    'status': 'error',
+    'message': 'The recipient device is not registered with FCM.',
+    'details': {'error': 'DeviceNotRegistered'},
+}
+
+
+@override_settings(PUSH_OUTBOX_BACKOFF_SECONDS=30, PUSH_OUTBOX_MAX_ATTEMPTS=3, PUSH_REQUEST_TIMEOUT=5)
+class PushDispatcherTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='reader', password='pw')
+        self.token = 'ExponentPushToken[reader-phone]'
+        UserDevice.objects.create(user=self.user, registration_id=self.token)
+
+    def dispatch(self, server):
+        with override_settings(EXPO_PUSH_URL=server.url):
+            return push.dispatch_once()
+
+    def make_due(self):
+        PushOutbox.objects.filter(status='PENDING').update(next_attempt_at=timezone.now())
+
+    def test_delivers_queued_message(self):
+        PushOutbox.enqueue(self.user, 'Hello', 'World', data={'screen': 'Home'})
+        with StandInExpoServer() as server:
+            outcome = self.dispatch(server)
+
+        self.assertEqual(outcome['SENT'], 1)
+        self.assertEqual(server.requests, [[{
+            'to': self.token, 'sound': 'default', 'title': 'Hello', 'body': 'World', 'data': {'screen': 'Home'},
+        }]])
+        message = PushOutbox.objects.get()
+        self.assertEqual((message.status, message.attempts), ('SENT', 1))
+        self.assertIsNotNone(message.sent_at)
+
+    def test_gateway_errors_are_retried_with_backoff_then_failed(self):
+        PushOutbox.enqueue(self.user, 'Hello', 'World')
+        with StandInExpoServer(responses=[(500, {})] * 3) as server:
+            before = timezone.now()
+            self.assertEqual(self.dispatch(server)['RETRY'], 1)
+            first = PushOutbox.objects.get()
+            self.assertEqual((first.status, first.attempts), ('PENDING', 1))
+            self.assertGreaterEqual(first.next_attempt_at, before + timedelta(seconds=30))
+            # Not due yet, so nothing is claimed.
+            self.assertEqual(sum(self.dispatch(server).values()), 0)
+
+            self.make_due()
+            before = timezone.now()
+            self.assertEqual(self.dispatch(server)['RETRY'], 1)
+            self.assertGreaterEqual(PushOutbox.objects.get().next_attempt_at, before + timedelta(seconds=60))
+
+            self.make_due()
+            self.assertEqual(self.dispatch(server)['FAILED'], 1)
+
+        message = PushOutbox.objects.get()
+        self.assertEqual((message.status, message.attempts), ('FAILED', 3))
+        self.assertIn('500', message.last_error)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_retry_succeeds_after_transient_error(self):
+        PushOutbox.enqueue(self.user, 'Hello', 'World')
+        with StandInExpoServer(responses=[(502, {})]) as server:
+            self.dispatch(server)
+            self.make_due()
+            self.assertEqual(self.dispatch(server)['SENT'], 1)
+        self.assertEqual(PushOutbox.objects.get().status, 'SENT')
+
+    def test_unregistered_devices_are_deactivated(self):
+        stale = 'ExponentPushToken[old-phone]'
+        UserDevice.objects.create(user=self.user, registration_id=stale)
+        PushOutbox.enqueue(self.user, 'Hello', 'World')
+        with StandInExpoServer(responses=[(200, {stale: DEVICE_NOT_REGISTERED})]) as server:
+            self.assertEqual(self.dispatch(server)['SENT'], 1)
+        self.assertFalse(UserDevice.objects.get(registration_id=stale).is_active)
+        self.assertTrue(UserDevice.objects.get(registration_id=self.token).is_active)
+
+    def test_message_to_only_unregistered_devices_is_skipped(self):
+        PushOutbox.enqueue(self.user, 'Hello', 'World')
+        with StandInExpoServer(responses=[(200, {self.token: DEVICE_NOT_REGISTERED})]) as server:
+            self.assertEqual(self.dispatch(server)['SKIPPED'], 1)
+        message = PushOutbox.objects.get()
+        self.assertEqual((message.status, message.sent_at), ('SKIPPED', None))
+        self.assertFalse(UserDevice.objects.get(registration_id=self.token).is_active)
+
+    def test_users_without_devices_are_skipped(self):
+        other = CustomUser.objects.create_user(username='no-phone', password='pw')
+        PushOutbox.enqueue(other, 'Hello', 'World')
+        with StandInExpoServer() as server:
+            self.assertEqual(self.dispatch(server)['SKIPPED'], 1)
+        self.assertEqual(server.requests, [])
+
+    def test_outcomes_are_counted_in_the_metrics(self):
+        self.enterContext(override_settings(METRICS={'BACKEND': 'lms.metrics.LocalStore'}))
+        metrics.REGISTRY.reset()
+        self.addCleanup(metrics.REGISTRY.reset)
+        PushOutbox.enqueue(self.user, 'Hello', 'World')
+        PushOutbox.enqueue(CustomUser.objects.create_user(username='no-phone', password='pw'), 'Hello', 'World')
+        with StandInExpoServer() as server:
+            self.dispatch(server)
+            self.dispatch(server)
+        lines = metrics.REGISTRY.expose().splitlines()
+        self.assertIn('lms_push_messages_total{outcome="sent"} 1', lines)
+        self.assertIn('lms_push_messages_total{outcome="skipped"} 1', lines)
+        # The second, empty poll is not a batch.
+        self.assertIn('lms_push_batch_duration_seconds_count 1', lines)
+        self.assertIn('lms_push_outbox_pending 0', lines)
+
+    def test_command_drains_outbox(self):
+        for index in range(5):
+            PushOutbox.enqueue(self.user, f'Message {index}', 'Body')
+        with StandInExpoServer() as server, override_settings(EXPO_PUSH_URL=server.url):
+            call_command('run_push_dispatcher', '--once', '--batch-size', '2', stdout=StringIO())
+        self.assertEqual(PushOutbox.objects.filter(status='SENT').count(), 5)
+        self.assertEqual(len(server.requests), 3)
+
+
+class ExpoPushClientTests(TestCase):
+    def setUp(self):
+        self.users = [CustomUser.objects.create_user(username=f'reader{index}') for index in range(250)]
+        UserDevice.objects.bulk_create([
+            UserDevice(user=user, registration_id=f'ExponentPushToken[{user.username}]') for user in self.users
+        ])
+
+    def test_many_users_are_sent_in_chunks_over_one_connection(self):
+        queue_push_notifications([user.pk for user in self.users], 'Library closed', 'Closed on Monday.')
+        with StandInExpoServer(responses=[(200, {'ExponentPushToken[reader7]': DEVICE_NOT_REGISTERED,
+                                                 'ExponentPushToken[reader150]': DEVICE_NOT_REGISTERED})]) as server, \
+                override_settings(EXPO_PUSH_URL=server.url):
+            outcome = push.dispatch_once(batch_size=1000)
+
+        # reader7's only device is unregistered, so nobody received that message.
+        self.assertEqual((outcome['SENT'], outcome['SKIPPED']), (249, 1))
+        self.assertEqual([len(messages) for messages in server.requests], [100, 100, 50])
+        self.assertEqual(len(server.connections), 1)
+        self.assertEqual(
+            set(UserDevice.objects.filter(is_active=False).values_list('registration_id', flat=True)),
+            {'ExponentPushToken[reader7]'},
+        )
+        self.assertEqual(PushTicket.objects.count(), 249)
+
+    def test_failed_chunk_only_retries_its_messages(self):
+        queue_push_notifications([user.pk for user in self.users], 'Library closed', 'Closed on Monday.')
+        with StandInExpoServer(responses=[(200, {}), (503, {})]) as server, override_settings(EXPO_PUSH_URL=server.url):
+            outcome = push.dispatch_once(batch_size=1000)
+        self.assertEqual((outcome['SENT'], outcome['RETRY']), (150, 100))
+
+    def test_receipts_deactivate_unregistered_devices(self):
+        PushTicket.objects.bulk_create([
+            PushTicket(ticket_id=f'ticket-{user.pk}', registration_id=f'ExponentPushToken[{user.username}]')
+            for user in self.users
+        ])
+        PushTicket.objects.update(created_at=timezone.now() - timedelta(minutes=20))
+        receipts = {f'ticket-{user.pk}': {'status': 'ok'} for user in self.users[:200]}
+        receipts[f'ticket-{self.users[0].pk}'] = DEVICE_NOT_REGISTERED
+        with StandInExpoServer(receipts=receipts) as server, override_settings(EXPO_RECEIPTS_URL=server.receipts_url):
+            call_command('check_push_receipts', stdout=StringIO())
+
+        self.assertEqual(len(server.receipt_requests), 1)
+        self.assertFalse(UserDevice.objects.get(user=self.users[0]).is_active)
+        self.assertEqual(UserDevice.objects.filter(is_active=False).count(), 1)
+        # Tickets without a receipt yet are kept for the next run.
+        self.assertEqual(PushTicket.objects.count(), 50)
+
+
+class BorrowStatusPushTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='reader', password='pw')
+        UserDevice.objects.create(user=self.user, registration_id='ExponentPushToken[reader-phone]')
+        book = Book.objects.create(isbn='9780000000001', title='The Hobbit')
+        self.copy = BookCopy.objects.create(book=book, copy_id='HOB-1')
+        self.borrowing = Borrowing.objects.create(
+            book_copy=self.copy, borrower=self.user, due_date=timezone.localdate() + timedelta(days=14),
+        )
+
+    def test_approval_is_queued_without_calling_the_gateway(self):
+        # Point the dispatcher at a gateway that takes seconds to answer: approving must not wait on it.
+        with StandInExpoServer(delay=2) as server, override_settings(EXPO_PUSH_URL=server.url):
+            started = time.monotonic()
+            self.borrowing.status = 'ACTIVE'
+            self.borrowing.issue_date = timezone.now()
+            self.borrowing.save()
+            self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(server.requests, [])
+
+        message = PushOutbox.objects.get()
+        self.assertEqual((message.user, message.status, message.title), (self.user, 'PENDING', 'Borrow Request Approved!'))
+        self.assertEqual(message.data['borrowId'], self.borrowing.pk)
+        self.assertEqual(message.data['status'], 'Approved')
+
+    def test_rejection_is_queued_once(self):
+        self.borrowing.status = 'REJECTED'
+        self.borrowing.save()
+        self.borrowing.notes_by_librarian = 'Reference copy only.'
+        self.borrowing.save()
+        message = PushOutbox.objects.get()
+        self.assertEqual(message.data['status'], 'Rejected')
+
+    def test_other_transitions_queue_nothing(self):
+        self.borrowing.status = 'CANCELLED'
+        self.borrowing.save()
+        self.assertFalse(PushOutbox.objects.exists())
@@ -546,7 +546,6 @@ class UserLoginAPIView(ObtainAuthToken):
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
         token, created = Token.objects.get_or_create(user=user)
-        print(f"Token: {token.key}")
         user_data = UserSerializer(user, context=self.get_serializer_context()).data
         return Response({
             'token': token.key,
@@ -599,6 +598,8 @@ class UserDeviceViewSet(viewsets.ModelViewSet):
     queryset = UserDevice.objects.all()
     serializer_class = UserDeviceSerializer
     permission_classes = [permissions.IsAuthenticated]
+    # A user only has a handful of devices.
+    pagination_class = None
 
     def get_queryset(self):
         return UserDevice.objects.filter(user=self.request.user)